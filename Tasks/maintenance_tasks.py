@@ -189,6 +189,10 @@ def cleanup_old_data():
                 
                 logger.info(f"✅ queues表清理完成，删除了 {queues_count:,} 条记录")
                 total_deleted += queues_count
+                
+                # 过期的黑名单记录已删除，重建黑名单（其他 worker 通过版本号重新加载）
+                from mod.services.blacklist import blacklist
+                blacklist.rebuild()
             else:
                 logger.debug("✅ queues表无需清理")
             
@@ -254,33 +258,27 @@ def cleanup_old_data():
             except Exception as e:
                 logger.debug(f"operation_logs表可能不存在: {e}")
             
-            # 5. 清理汇总表中的旧数据
-            logger.info("清理visitor_stats_cache表（90天前的汇总数据）...")
+            # 5. 清理小时汇总表中的旧数据（按天汇总的 stats_daily 长期保留）
+            logger.info("清理stats_hourly表（90天前的小时汇总）...")
             
             try:
-                ninety_days_ago_date = (datetime.now() - timedelta(days=90)).date()
+                ninety_days_ago = datetime.now() - timedelta(days=90)
                 
                 result = db.session.execute(text("""
-                    SELECT COUNT(*) as cnt 
-                    FROM visitor_stats_cache 
-                    WHERE stat_date < :date
-                """), {"date": ninety_days_ago_date})
+                    DELETE FROM stats_hourly 
+                    WHERE bucket < :date
+                """), {"date": ninety_days_ago})
                 
-                cache_count = result.fetchone()[0]
-                
-                if cache_count > 0:
-                    db.session.execute(text("""
-                        DELETE FROM visitor_stats_cache 
-                        WHERE stat_date < :date
-                    """), {"date": ninety_days_ago_date})
-                    
-                    db.session.commit()
-                    logger.info(f"✅ visitor_stats_cache表清理完成，删除了 {cache_count:,} 条记录")
-                    total_deleted += cache_count
+                db.session.commit()
+                hourly_count = result.rowcount
+                if hourly_count > 0:
+                    logger.info(f"✅ stats_hourly表清理完成，删除了 {hourly_count:,} 条记录")
+                    total_deleted += hourly_count
                 else:
-                    logger.debug("✅ visitor_stats_cache表无需清理")
+                    logger.debug("✅ stats_hourly表无需清理")
             except Exception as e:
-                logger.debug(f"visitor_stats_cache表可能不存在: {e}")
+                db.session.rollback()
+                logger.debug(f"stats_hourly表可能不存在: {e}")
             
             # 总结
             if total_deleted > 0:
@@ -289,16 +287,16 @@ def cleanup_old_data():
             else:
                 logger.info("✅ 所有表都无需清理，数据保持最新")
                 
-        except Exception as e:
-            logger.error(f"❌ 数据清理失败: {e}")
-            db.session.rollback()
-            import traceback
-            logger.error(traceback.format_exc())
-        finally:
-            try:
-                db.session.remove()
-            except:
-                pass
+    except Exception as e:
+        logger.error(f"❌ 数据清理失败: {e}")
+        db.session.rollback()
+        import traceback
+        logger.error(traceback.format_exc())
+    finally:
+        try:
+            db.session.remove()
+        except:
+            pass
 
 
 def check_table_fragmentation():
@@ -495,54 +493,19 @@ def vacuum_redis_cache():
         logger.error(f"❌ Redis缓存清理失败: {e}")
 
 
-def update_visitor_stats_cache():
+def update_stats_rollup():
     """
-    更新访客统计汇总表
-    每小时执行一次，保持汇总数据最新
+    更新数据看板统计汇总表（stats_hourly / stats_daily）
+    重算最近几个小时的时间桶，所有商户（后台任务已在运行时重复执行也无影响）
     """
     try:
         with app.app_context():
-            logger.info("📊 更新访客统计汇总表...")
-            
-            # 检查汇总表是否存在
-            from sqlalchemy import text
-            
-            try:
-                db.session.execute(text("SELECT 1 FROM visitor_stats_cache LIMIT 1"))
-            except:
-                logger.info("汇总表不存在，跳过更新")
-                return
-            
-            # 更新今天和昨天的数据
-            for days_ago in [0, 1]:
-                date = datetime.now() - timedelta(days=days_ago)
-                day_start = int(datetime.combine(date, datetime.min.time()).timestamp())
-                day_end = day_start + 86400 - 1
-                
-                # 统计访客数
-                result = db.session.execute(text("""
-                    SELECT COUNT(DISTINCT visitor_id) 
-                    FROM chats 
-                    WHERE business_id = 1 
-                    AND timestamp >= :start 
-                    AND timestamp <= :end
-                """), {"start": day_start, "end": day_end})
-                
-                count = result.fetchone()[0]
-                
-                # 更新汇总表
-                db.session.execute(text("""
-                    INSERT INTO visitor_stats_cache (business_id, stat_date, visitor_count)
-                    VALUES (1, :date, :count)
-                    ON DUPLICATE KEY UPDATE visitor_count = :count
-                """), {"date": date.date(), "count": count})
-            
-            db.session.commit()
-            logger.info("✅ 访客统计汇总表更新完成")
+            from mod.services.stats_rollup import stats_rollup
+            stats_rollup.refresh()
+            logger.info("✅ 统计汇总表更新完成")
             
     except Exception as e:
-        logger.error(f"❌ 更新汇总表失败: {e}")
-        db.session.rollback()
+        logger.error(f"❌ 更新统计汇总表失败: {e}")
     finally:
         try:
             db.session.remove()
@@ -109,12 +109,12 @@ class Config(object):
             'misfire_grace_time': 300
         },
         
-        # 更新访客统计汇总表 - 每小时执行
+        # 更新数据看板统计汇总表 - 每10分钟执行（应用内的后台任务每分钟也会更新）
         {
-            'id': 'update_visitor_stats_cache',
-            'func': 'Tasks.maintenance_tasks:update_visitor_stats_cache',
+            'id': 'update_stats_rollup',
+            'func': 'Tasks.maintenance_tasks:update_stats_rollup',
             'trigger': 'interval',
-            'hours': 1,
+            'minutes': 10,
             'misfire_grace_time': 300
         },
         
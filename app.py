@@ -194,18 +194,18 @@ def init_after_startup():
     """应用启动后初始化"""
     warmup_db_pool()
     
-    # 启动会话监控定时任务
-    try:
-        from mod.tasks import start_session_monitor
-        start_session_monitor(app, socketio)
-    except Exception as e:
-        logger.error(f"启动会话监控任务失败: {e}")
+    # 后台服务通常已在 worker 启动时启动，这里兜底（幂等）
+    from mod.services.startup import start_services
+    start_services(app, socketio)
     
     # 初始化性能监控（性能优化）
     try:
-        from mod.utils.performance_monitor import init_performance_monitoring, DatabaseQueryMonitor
+        from mod.utils.performance_monitor import (
+            init_performance_monitoring, DatabaseQueryMonitor, SocketIOEventMonitor
+        )
         init_performance_monitoring(app)
         DatabaseQueryMonitor.init_app(app)
+        SocketIOEventMonitor.init_app(socketio)
         logger.info("✅ 性能监控已启动")
     except Exception as e:
         logger.warning(f"⚠️ 性能监控启动失败: {e}")
@@ -372,6 +372,10 @@ def make_shell_context():
 
 # ========== 应用启动 ==========
 if __name__ == '__main__':
+    # 后台服务在开始处理流量前启动（Socket.IO 流量不会触发 before_first_request）
+    from mod.services.startup import start_services
+    start_services(app, socketio)
+    
     # 开发环境使用 SocketIO 运行
     socketio.run(
         app,
@@ -0,0 +1,44 @@
+"""
+回填数据看板统计汇总表（stats_hourly / stats_daily）
+首次部署后应用会在后台自动回填全部历史，本脚本用于修复某段历史数据后重算；按天重算，可重复执行
+只能重算明细（chats / queues）仍完整保留的日期，已被清理任务删除的日期会被跳过，保留现有汇总
+
+使用示例:
+  python backfill_stats.py --days 7                           # 重算最近7天
+  python backfill_stats.py --start 2025-01-01 --end 2025-01-31
+"""
+from datetime import date, datetime, timedelta
+from app import app
+import log
+
+logger = log.get_logger(__name__)
+
+
+def main():
+    """主函数"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='重算数据看板统计汇总表')
+    parser.add_argument('--days', type=int, help='重算最近N天（含今天）')
+    parser.add_argument('--start', help='开始日期 YYYY-MM-DD')
+    parser.add_argument('--end', help='结束日期 YYYY-MM-DD（含，默认今天）')
+    args = parser.parse_args()
+    
+    end = datetime.strptime(args.end, '%Y-%m-%d').date() if args.end else date.today()
+    if args.start:
+        start = datetime.strptime(args.start, '%Y-%m-%d').date()
+    elif args.days:
+        start = end - timedelta(days=args.days - 1)
+    else:
+        parser.error('需要指定 --days 或 --start')
+    
+    from mod.services.stats_rollup import stats_rollup
+    
+    with app.app_context():
+        logger.info(f"📊 开始重算统计汇总: {start} ~ {end}")
+        days = stats_rollup.backfill(start, end)
+        logger.info(f"✅ 统计汇总重算完成: {days}天")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+数据统计报表查询次数基准
+客服绩效、概览统计、评价统计的 SQL 查询次数应与客服数、评价数无关；
+本脚本在一个临时商户中按不同规模造数，分别统计各报表执行的 SQL 条数，条数随规模变化则失败。
+
+造数在同一个事务中完成，结束后回滚，不会在数据库中留下数据。
+
+使用示例:
+  python bench_statistics_queries.py
+  python bench_statistics_queries.py --sizes 5:20 50:500 200:5000    # 客服数:评价数
+"""
+import sys
+import time
+import uuid
+from datetime import datetime
+from app import app
+import log
+
+logger = log.get_logger(__name__)
+
+REPORTS = ('get_overview_statistics', 'get_service_performance', 'get_comment_statistics')
+
+
+def seed(db, services_count, comments_count):
+    """造一个临时商户：客服、会话、消息、评价及评价详情"""
+    from mod.mysql.models import Business, Service, Queue, Chat, Comment, CommentDetail
+
+    business = Business(business_name=f'bench-{uuid.uuid4().hex[:8]}')
+    db.session.add(business)
+    db.session.flush()
+
+    services = [
+        Service(user_name=f'bench-{uuid.uuid4().hex}', nick_name=f'客服{i}', password_hash='-',
+                business_id=business.id)
+        for i in range(services_count)
+    ]
+    db.session.add_all(services)
+    db.session.flush()
+
+    now = datetime.now()
+    for i in range(comments_count):
+        service = services[i % services_count]
+        visitor_id = f'bench-visitor-{i}'
+        db.session.add(Queue(visitor_id=visitor_id, business_id=business.id, service_id=service.service_id,
+                             state='complete', created_at=now))
+        db.session.add(Chat(visitor_id=visitor_id, business_id=business.id, service_id=service.service_id,
+                            content='bench', timestamp=int(now.timestamp()), created_at=now))
+        comment = Comment(business_id=business.id, service_id=service.service_id, visitor_id=visitor_id,
+                          word_comment='', add_time=now)
+        db.session.add(comment)
+        db.session.flush()
+        db.session.add_all([
+            CommentDetail(comment_id=comment.id, title='服务态度', score=i % 5 + 1),
+            CommentDetail(comment_id=comment.id, title='解决问题', score=(i + 2) % 5 + 1),
+        ])
+    db.session.flush()
+    return business.id
+
+
+def measure(db, business_id):
+    """各报表执行的SQL条数和耗时 {报表: (条数, 毫秒)}"""
+    from sqlalchemy import event
+    from mod.mysql.ModuleClass.StatisticsServiceClass import StatisticsService
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        result = {}
+        for name in REPORTS:
+            statements.clear()
+            start = time.perf_counter()
+            response = getattr(StatisticsService, name)(business_id, 7)
+            elapsed = (time.perf_counter() - start) * 1000
+            if response.get('code') != 0:
+                raise RuntimeError(f'{name}: {response.get("msg")}')
+            result[name] = (len(statements), elapsed)
+        return result
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+
+
+def main():
+    """主函数"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='数据统计报表查询次数基准')
+    parser.add_argument('--sizes', nargs='+', default=['2:10', '20:200', '100:1000'],
+                        help='规模列表，格式 客服数:评价数')
+    args = parser.parse_args()
+    sizes = [tuple(int(n) for n in size.split(':')) for size in args.sizes]
+
+    from exts import db
+
+    counts = {}
+    with app.app_context():
+        for services_count, comments_count in sizes:
+            try:
+                business_id = seed(db, services_count, comments_count)
+                result = measure(db, business_id)
+            finally:
+                db.session.rollback()
+
+            for name, (queries, elapsed) in result.items():
+                counts.setdefault(name, set()).add(queries)
+                logger.info(f"📊 客服{services_count:>4} 评价{comments_count:>5}  {name:<26} "
+                            f"{queries:>3}条SQL  {elapsed:8.1f}ms")
+
+    failed = [name for name, seen in counts.items() if len(seen) > 1]
+    if failed:
+        logger.error(f"❌ 查询次数随规模变化: {', '.join(failed)}")
+        return 1
+    logger.info("✅ 各报表查询次数与规模无关")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
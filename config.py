@@ -94,6 +94,55 @@ CELERY_RESULT_BACKEND = build_redis_url(REDIS_HOST, REDIS_PORT, REDIS_PASSWORD,
 SOCKETIO_MESSAGE_QUEUE = build_redis_url(REDIS_HOST, REDIS_PORT, REDIS_PASSWORD, '3')
 SOCKETIO_ASYNC_MODE = 'eventlet'
 
+# ========== 在线状态配置 ==========
+# 集群在线状态注册中心（默认与 SOCKETIO_MESSAGE_QUEUE 共用同一Redis）
+PRESENCE_REDIS_URL = SOCKETIO_MESSAGE_QUEUE
+PRESENCE_HEARTBEAT_INTERVAL = 30  # 每个worker刷新本地连接心跳的间隔（秒）
+PRESENCE_TTL = 90  # 连接超过该时间没有心跳即视为离线（秒）
+OFFLINE_BATCH_INTERVAL = 0.5  # 访客离线批处理间隔（秒），窗口内的断线合并为一次批量UPDATE
+OFFLINE_BATCH_MAX_SIZE = 500  # 单批最多处理的离线访客数
+STATS_PUBLISH_INTERVAL = 3  # 管理员实时统计推送周期（秒），每个商户每周期最多推送一次变化
+UNREAD_RECONCILE_INTERVAL = 300  # Redis未读计数与数据库校准间隔（秒）
+WAITING_LINE_RECONCILE_INTERVAL = 60  # 访客等待线与数据库校准间隔（秒）
+ASSIGNMENT_STRATEGY = 'least_loaded'  # 客服分配策略: least_loaded / round_robin / weighted
+ASSIGNMENT_LOAD_TTL = 10  # 分配引擎负载表从数据库刷新的间隔（秒）
+WORKLOAD_RECONCILE_INTERVAL = 120  # 客服接待数与Queue表校准间隔（秒）
+WAIT_ESTIMATOR_ALPHA = 0.1  # 会话处理时长指数衰减系数，越大越偏重最近的会话
+WAIT_ESTIMATOR_CACHE_TTL = 5  # 处理时长统计的进程内缓存时间（秒）
+QUERY_CAPTURE_SIZE = 500  # 性能监控采集的不同SQL语句数上限（供索引分析用EXPLAIN回放）
+SESSION_CACHE_TTL = 60  # 访客活跃会话缓存有效期（秒），会话变更时由ORM事件同步刷新
+BLACKLIST_SYNC_INTERVAL = 2  # 各worker检查黑名单变更的间隔（秒），本worker的变更立即生效
+BLACKLIST_REBUILD_INTERVAL = 3600  # 从数据库全量重建黑名单的间隔（秒），清理任务、手工改库后据此收敛
+EXPORT_CHUNK_SIZE = 2000  # 聊天记录导出每次从数据库读取的行数（流式导出，内存占用与总条数无关）
+STATS_ROLLUP_INTERVAL = 60  # 数据看板统计汇总表（stats_hourly/stats_daily）的重算间隔（秒）
+STATS_ROLLUP_LOOKBACK_HOURS = 2  # 每次重算最近多少小时（覆盖会话结束、首次回复等晚到的数据）
+VISITOR_HLL_RETENTION_DAYS = 90  # 每日去重访客 HyperLogLog 保留天数
+RATING_STATS_CACHE_TTL = 300  # 评价统计/排行榜缓存秒数（提交评价时立即失效）
+CHAT_ANALYTICS_CACHE_TTL = 300  # 聊天记录统计（响应时间/处理时长分布）缓存秒数
+
+# ========== 消息写后持久化配置 ==========
+# 开启后消息先写入Redis日志并立即推送，由后台任务批量入库（需要Redis）
+MESSAGE_WRITE_BEHIND = False
+MESSAGE_WRITE_BEHIND_INTERVAL = 0.05  # 批量入库间隔（秒）
+MESSAGE_WRITE_BEHIND_BATCH = 500  # 单批最多入库的消息数
+
+# ========== 后台任务池配置 ==========
+# Socket事件中的后台任务（访客信息保存、延迟推送、在线IP查询）统一由任务池执行
+TASK_POOL_WORKERS = 8  # worker数量（最大并发，需小于数据库连接池容量）
+TASK_POOL_MAX_QUEUE = 1000  # 队列容量
+TASK_POOL_SUBMIT_TIMEOUT = 5  # 队列满时提交方最多等待的时间（秒）
+TASK_POOL_TYPE_LIMITS = {  # 按任务类型限制并发
+    'visitor_save': 4,
+    'comment_request': 2,
+    'ip_geo': 2,
+}
+
+# ========== IP地理位置配置 ==========
+IP_GEO_DB_PATH = os.path.join(BASE_DIR, 'data', 'qqwry.dat')  # 本地IP库（纯真 qqwry.dat 或 MaxMind .mmdb）
+IP_GEO_CACHE_SIZE = 10000  # IP位置LRU缓存容量
+IP_GEO_CACHE_TTL = 3600  # IP位置缓存有效期（秒）
+IP_GEO_ONLINE_FALLBACK = False  # 本地库查不到时是否在后台调用在线API
+
 # ========== 文件上传配置 ==========
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads')
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
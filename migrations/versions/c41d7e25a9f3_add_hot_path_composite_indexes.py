@@ -0,0 +1,77 @@
+"""add_hot_path_composite_indexes
+
+按实际的高频查询为 queues / chats 添加复合索引（覆盖索引）：
+- queues (visitor_id, business_id, state, created_at)  访客当前会话，按创建时间取最新一条无需排序
+- queues (business_id, state, service_id, last_message_time)  客服会话列表、等待线校准、超时检查
+- queues (service_id, state, updated_at)  客服接待数统计 / 校准
+- chats (visitor_id, direction, state)  未读消息数
+- chats (visitor_id, timestamp)  访客历史消息
+- chats (business_id, created_at)  数据看板按时间范围统计
+
+部分索引可能已由 migrations/add_composite_indexes.sql 手工创建，同名索引已存在时跳过；
+本迁移创建的索引带注释 alembic:c41d7e25a9f3，降级时只删除带该注释的索引，不删除手工创建的同名索引
+
+Revision ID: c41d7e25a9f3
+Revises: b842ecc180e8
+Create Date: 2026-10-16 10:12:40.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d7e25a9f3'
+down_revision = 'b842ecc180e8'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('queues', 'idx_queue_visitor_business_state', ['visitor_id', 'business_id', 'state', 'created_at']),
+    ('queues', 'idx_queue_business_state_service', ['business_id', 'state', 'service_id', 'last_message_time']),
+    ('queues', 'idx_queue_service_state', ['service_id', 'state', 'updated_at']),
+    ('chats', 'idx_chat_visitor_direction_state', ['visitor_id', 'direction', 'state']),
+    ('chats', 'idx_chat_visitor_timestamp', ['visitor_id', 'timestamp']),
+    ('chats', 'idx_chat_business_created', ['business_id', 'created_at']),
+]
+
+
+# 本迁移创建的索引的注释（MySQL INDEX_COMMENT），用于降级时区分手工创建的同名索引
+MARKER = f'alembic:{revision}'
+
+
+def _existing_indexes(table):
+    inspector = sa.inspect(op.get_bind())
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+
+def _created_here(table):
+    """本迁移创建的索引（按注释识别）"""
+    rows = op.get_bind().execute(sa.text(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND INDEX_COMMENT = :marker"
+    ), {'table': table, 'marker': MARKER})
+    return {name for (name,) in rows}
+
+
+def upgrade():
+    existing = {}
+    for table, name, columns in INDEXES:
+        if table not in existing:
+            existing[table] = _existing_indexes(table)
+        if name in existing[table]:
+            continue
+        op.execute(
+            f"CREATE INDEX `{name}` ON `{table}` ({', '.join(f'`{c}`' for c in columns)}) COMMENT '{MARKER}'"
+        )
+
+
+def downgrade():
+    created = {}
+    for table, name, columns in reversed(INDEXES):
+        if table not in created:
+            created[table] = _created_here(table)
+        if name not in created[table]:
+            continue   # 升级时已存在（手工创建）而跳过的索引保留
+        op.drop_index(name, table_name=table)
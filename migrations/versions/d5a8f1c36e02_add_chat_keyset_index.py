@@ -0,0 +1,52 @@
+"""add_chat_keyset_index
+
+聊天历史改为按 (created_at, cid) 游标分页后，访客历史消息的查询为
+WHERE visitor_id = ? AND (created_at < ? OR (created_at = ? AND cid < ?)) ORDER BY created_at DESC, cid DESC
+- chats (visitor_id, created_at)  InnoDB 二级索引自带主键 cid，排序和游标条件都可以直接走索引
+
+同名索引已存在时跳过；本迁移创建的索引带注释 alembic:d5a8f1c36e02，降级时只删除带该注释的索引
+
+Revision ID: d5a8f1c36e02
+Revises: c41d7e25a9f3
+Create Date: 2026-10-16 15:27:09.803114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5a8f1c36e02'
+down_revision = 'c41d7e25a9f3'
+branch_labels = None
+depends_on = None
+
+
+# 本迁移创建的索引的注释（MySQL INDEX_COMMENT），用于降级时区分手工创建的同名索引
+MARKER = f'alembic:{revision}'
+
+
+def _existing_indexes(table):
+    inspector = sa.inspect(op.get_bind())
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+
+def _created_here(table):
+    """本迁移创建的索引（按注释识别）"""
+    rows = op.get_bind().execute(sa.text(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND INDEX_COMMENT = :marker"
+    ), {'table': table, 'marker': MARKER})
+    return {name for (name,) in rows}
+
+
+def upgrade():
+    if 'idx_chat_visitor_created' not in _existing_indexes('chats'):
+        op.execute(
+            f"CREATE INDEX `idx_chat_visitor_created` ON `chats` (`visitor_id`, `created_at`) COMMENT '{MARKER}'"
+        )
+
+
+def downgrade():
+    if 'idx_chat_visitor_created' in _created_here('chats'):
+        op.drop_index('idx_chat_visitor_created', table_name='chats')
@@ -0,0 +1,59 @@
+"""add_stats_rollup_tables
+
+数据看板的统计汇总表：stats_hourly / stats_daily（按 商户 + 客服 + 时间桶）
+由 mod/services/stats_rollup 增量维护，历史数据用 backfill_stats.py 回填
+
+Revision ID: e7b3c9a41d58
+Revises: d5a8f1c36e02
+Create Date: 2026-10-16 16:05:31.274019
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3c9a41d58'
+down_revision = 'd5a8f1c36e02'
+branch_labels = None
+depends_on = None
+
+
+def _metric_columns():
+    return [
+        sa.Column('messages', sa.Integer(), nullable=False, server_default='0', comment='消息数'),
+        sa.Column('sessions', sa.Integer(), nullable=False, server_default='0', comment='新会话数'),
+        sa.Column('completed_sessions', sa.Integer(), nullable=False, server_default='0', comment='结束会话数'),
+        sa.Column('visitors', sa.Integer(), nullable=False, server_default='0', comment='去重访客数（有消息的访客）'),
+        sa.Column('new_visitors', sa.Integer(), nullable=False, server_default='0', comment='新访客数（仅全商户行）'),
+        sa.Column('comments', sa.Integer(), nullable=False, server_default='0', comment='评价数'),
+        sa.Column('response_time_sum', sa.BigInteger(), nullable=False, server_default='0', comment='首次响应时间总和（秒）'),
+        sa.Column('response_count', sa.Integer(), nullable=False, server_default='0', comment='有首次响应的会话数'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True, comment='更新时间'),
+    ]
+
+
+def upgrade():
+    op.create_table('stats_hourly',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('business_id', sa.Integer(), nullable=False, comment='商户ID'),
+    sa.Column('service_id', sa.Integer(), nullable=False, server_default='0', comment='客服ID（0表示全商户）'),
+    sa.Column('bucket', sa.DateTime(), nullable=False, comment='小时（整点）'),
+    *_metric_columns(),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('business_id', 'service_id', 'bucket', name='uix_stats_hourly_bucket')
+    )
+    op.create_table('stats_daily',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('business_id', sa.Integer(), nullable=False, comment='商户ID'),
+    sa.Column('service_id', sa.Integer(), nullable=False, server_default='0', comment='客服ID（0表示全商户）'),
+    sa.Column('bucket', sa.Date(), nullable=False, comment='日期'),
+    *_metric_columns(),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('business_id', 'service_id', 'bucket', name='uix_stats_daily_bucket')
+    )
+
+
+def downgrade():
+    op.drop_table('stats_daily')
+    op.drop_table('stats_hourly')
@@ -0,0 +1,67 @@
+"""add_rating_stats_indexes
+
+评价统计改为 SQL 聚合（COUNT / GROUP BY rating）后的查询为
+- 单个客服：WHERE service_id = ? [AND created_at >= ?] GROUP BY rating
+- 全部客服 / 排行榜：WHERE created_at >= ? GROUP BY service_id, rating
+两个覆盖索引让聚合只扫描索引，不回表：
+- service_ratings (service_id, created_at, rating)
+- service_ratings (created_at, service_id, rating)
+
+模型已声明这两个索引，db.create_all 建表时可能已存在，同名索引已存在时跳过；
+本迁移创建的索引带注释 alembic:f3a9d2c7b14e，降级时只删除带该注释的索引
+
+Revision ID: f3a9d2c7b14e
+Revises: e7b3c9a41d58
+Create Date: 2026-10-17 10:12:45.219837
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9d2c7b14e'
+down_revision = 'e7b3c9a41d58'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = {
+    'idx_rating_service_created': ['service_id', 'created_at', 'rating'],
+    'idx_rating_created_service': ['created_at', 'service_id', 'rating'],
+}
+
+
+# 本迁移创建的索引的注释（MySQL INDEX_COMMENT），用于降级时区分建表时已有的同名索引
+MARKER = f'alembic:{revision}'
+
+
+def _existing_indexes(table):
+    inspector = sa.inspect(op.get_bind())
+    return {index['name'] for index in inspector.get_indexes(table)}
+
+
+def _created_here(table):
+    """本迁移创建的索引（按注释识别）"""
+    rows = op.get_bind().execute(sa.text(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND INDEX_COMMENT = :marker"
+    ), {'table': table, 'marker': MARKER})
+    return {name for (name,) in rows}
+
+
+def upgrade():
+    existing = _existing_indexes('service_ratings')
+    for name, columns in INDEXES.items():
+        if name not in existing:
+            op.execute(
+                f"CREATE INDEX `{name}` ON `service_ratings` ({', '.join(f'`{c}`' for c in columns)}) "
+                f"COMMENT '{MARKER}'"
+            )
+
+
+def downgrade():
+    created = _created_here('service_ratings')
+    for name in INDEXES:
+        if name in created:
+            op.drop_index(name, table_name='service_ratings')
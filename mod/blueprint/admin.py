@@ -1,7 +1,7 @@
 """
 管理API蓝图
 """
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response
 from flask_login import login_required, current_user
 from mod.mysql.ModuleClass import (
     service_management,
@@ -195,9 +195,10 @@ def get_chat_history():
         if current_user.level not in ['super_manager', 'manager']:
             return jsonify({'code': -1, 'msg': '权限不足'}), 403
         
+        from mod.utils.pagination import cursor_args
+        
         business_id = current_user.business_id
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 50, type=int)
+        cursor, limit, with_total = cursor_args(request)
         
         # 筛选条件
         visitor_id = request.args.get('visitor_id')
@@ -213,8 +214,9 @@ def get_chat_history():
             start_date=start_date,
             end_date=end_date,
             keyword=keyword,
-            page=page,
-            per_page=per_page
+            cursor=cursor,
+            limit=limit,
+            with_total=with_total
         )
         
         return jsonify(result)
@@ -256,7 +258,7 @@ def get_chat_sessions():
 @admin_bp.route('/statistics/overview', methods=['GET'])
 @login_required
 def get_statistics_overview():
-    """获取概览统计"""
+    """获取概览统计（total 为统计汇总表累计值，见 StatisticsService.get_overview_statistics）"""
     try:
         if current_user.level not in ['super_manager', 'manager']:
             return jsonify({'code': -1, 'msg': '权限不足'}), 403
@@ -323,76 +325,13 @@ def get_chat_history_statistics():
         business_id = current_user.business_id
         days = request.args.get('days', 7, type=int)
         
-        from mod.mysql.models import Chat, Queue
-        from datetime import datetime, timedelta
-        from sqlalchemy import func
-
-        start_date = datetime.now() - timedelta(days=days)
-
-        # 总消息数
-        total_messages = Chat.query.filter(
-            Chat.business_id == business_id,
-            Chat.created_at >= start_date
-        ).count()
-
-        # 总会话数
-        total_sessions = Queue.query.filter(
-            Queue.business_id == business_id,
-            Queue.created_at >= start_date
-        ).count()
-
-        # 平均时长（分钟）- 计算已完成会话的平均时长
-        completed_sessions = Queue.query.filter(
-            Queue.business_id == business_id,
-            Queue.created_at >= start_date,
-            Queue.state == 'complete',
-            Queue.updated_at.isnot(None)
-        ).all()
-
-        avg_duration = 0
-        if completed_sessions:
-            total_duration = 0
-            for session in completed_sessions:
-                duration = (session.updated_at - session.created_at).total_seconds()
-                total_duration += duration
-            avg_duration = int(total_duration / len(completed_sessions) / 60)  # 转换为分钟
-
-        # 平均响应时间（秒）- 计算客服首次响应时间
-        avg_response_time = 0
-        sessions_with_response = 0
-
-        for session in Queue.query.filter(
-            Queue.business_id == business_id,
-            Queue.created_at >= start_date,
-            Queue.service_id.isnot(None)
-        ).limit(100).all():
-            # 查找客服的第一条消息
-            first_service_msg = Chat.query.filter_by(
-                visitor_id=session.visitor_id,
-                business_id=business_id,
-                direction='to_visitor'
-            ).filter(
-                Chat.created_at >= session.created_at,
-                Chat.service_id > 0  # 排除机器人
-            ).order_by(Chat.created_at.asc()).first()
-
-            if first_service_msg:
-                response_time = (first_service_msg.created_at - session.created_at).total_seconds()
-                avg_response_time += response_time
-                sessions_with_response += 1
-
-        if sessions_with_response > 0:
-            avg_response_time = int(avg_response_time / sessions_with_response)
+        # 一次窗口查询 + NumPy 统计（均值/中位数/P90），按窗口缓存
+        from mod.services.chat_analytics import chat_analytics
         
         return jsonify({
             'code': 0,
             'msg': '获取成功',
-            'data': {
-                'total_messages': total_messages,
-                'total_sessions': total_sessions,
-                'avg_duration': avg_duration,
-                'avg_response_time': avg_response_time
-            }
+            'data': chat_analytics.summary(business_id, days)
         })
         
     except Exception as e:
@@ -487,17 +426,20 @@ def get_session_detail(queue_id):
 @admin_bp.route('/chat-history/session/<visitor_id>/messages', methods=['GET'])
 @login_required
 def get_session_messages_paginated(visitor_id):
-    """分页获取会话消息（性能优化版）"""
+    """
+    分页获取会话消息（游标分页，从最新往前翻，每页内按时间正序）
+
+    参数: cursor（上一页返回的 next_cursor）, limit, with_total
+    """
     try:
         if current_user.level not in ['super_manager', 'manager']:
             return jsonify({'code': -1, 'msg': '权限不足'}), 403
         
         from mod.mysql.models import Chat, Visitor, Service
-        from datetime import datetime
+        from mod.utils.pagination import InvalidCursor, cursor_args, keyset_paginate
         
         business_id = current_user.business_id
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 50, type=int)
+        cursor, limit, with_total = cursor_args(request)
         
         # 获取访客信息
         visitor = Visitor.query.filter_by(
@@ -508,21 +450,21 @@ def get_session_messages_paginated(visitor_id):
         if not visitor:
             return jsonify({'code': -1, 'msg': '访客不存在'}), 404
         
-        # 获取消息总数
-        total_count = Chat.query.filter_by(
+        query = Chat.query.filter_by(
             visitor_id=visitor_id,
             business_id=business_id
-        ).count()
+        )
+        try:
+            page = keyset_paginate(query, Chat.created_at, Chat.cid, cursor=cursor,
+                                   limit=limit, with_total=with_total)
+        except InvalidCursor as e:
+            return jsonify({'code': -1, 'msg': str(e)}), 400
         
-        if total_count == 0:
+        if not cursor and not page.items:
             return jsonify({'code': -1, 'msg': '没有聊天记录'}), 404
         
-        # 分页查询消息
-        offset = (page - 1) * per_page
-        messages = Chat.query.filter_by(
-            visitor_id=visitor_id,
-            business_id=business_id
-        ).order_by(Chat.created_at.asc()).offset(offset).limit(per_page).all()
+        # 反转成正序（最早的在前）
+        messages = list(reversed(page.items))
         
         # 优化：一次性获取所有需要的客服信息
         service_ids = list(set([msg.service_id for msg in messages if msg.service_id is not None and msg.service_id > 0]))
@@ -553,20 +495,13 @@ def get_session_messages_paginated(visitor_id):
                 'timestamp': msg.created_at.isoformat() if msg.created_at else None
             })
         
-        # 计算总页数
-        import math
-        total_pages = math.ceil(total_count / per_page)
-        
         return jsonify({
             'code': 0,
             'msg': '获取成功',
             'data': {
                 'messages': message_list,
-                'page': page,
-                'per_page': per_page,
-                'total': total_count,
-                'total_pages': total_pages,
-                'has_more': page < total_pages
+                'limit': limit,
+                **page.meta()
             }
         })
         
@@ -580,11 +515,19 @@ def get_session_messages_paginated(visitor_id):
 @admin_bp.route('/chat-history/export', methods=['GET'])
 @login_required
 def export_chat_history():
-    """导出聊天记录"""
+    """
+    导出聊天记录（流式输出，不限条数）
+
+    参数: 与 /chat-history 相同的筛选条件，format（csv / xlsx / ndjson / json，默认json），gzip（1=压缩）
+    """
     try:
         if current_user.level not in ['super_manager', 'manager']:
             return jsonify({'code': -1, 'msg': '权限不足'}), 403
         
+        from flask import stream_with_context
+        from datetime import datetime
+        from mod.services.chat_export import chat_exporter, FORMATS
+        
         # 获取筛选参数
         business_id = current_user.business_id
         visitor_id = request.args.get('visitor_id')
@@ -592,79 +535,46 @@ def export_chat_history():
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         keyword = request.args.get('keyword')
-        export_format = request.args.get('format', 'json')  # json or csv
+        export_format = request.args.get('format', 'json')
+        gzip = request.args.get('gzip', '0').lower() in ('1', 'true', 'yes')
         
-        # 获取聊天记录
-        result = chat_service.get_chat_history(
+        if export_format not in FORMATS:
+            return jsonify({'code': -1, 'msg': f'不支持的导出格式: {export_format}'}), 400
+        
+        query = chat_service.history_query(
             business_id=business_id,
             visitor_id=visitor_id,
             service_id=service_id,
             start_date=start_date,
             end_date=end_date,
-            keyword=keyword,
-            page=1,
-            per_page=10000  # 导出所有记录
+            keyword=keyword
         )
+        meta = {
+            'export_time': datetime.now().isoformat(),
+            'business_id': business_id,
+            'filters': {
+                'visitor_id': visitor_id,
+                'service_id': service_id,
+                'start_date': start_date,
+                'end_date': end_date,
+                'keyword': keyword
+            }
+        }
+        records = chat_exporter.rows(query, business_id, visitor_id=visitor_id)
+        chunks = chat_exporter.stream(records, export_format, gzip=gzip, meta=meta)
         
-        if result['code'] == 0:
-            from flask import make_response
-            import json
-            from datetime import datetime
-            
-            if export_format == 'csv':
-                # 生成CSV格式
-                import csv
-                import io
-                
-                output = io.StringIO()
-                writer = csv.writer(output)
-                
-                # 写入表头
-                writer.writerow(['消息ID', '访客', '客服', '消息内容', '消息方向', '消息类型', '时间'])
-                
-                # 写入数据
-                for msg in result['data']['list']:
-                    writer.writerow([
-                        msg['id'],
-                        msg['visitor_name'],
-                        msg['service_name'],
-                        msg['content'],
-                        '访客→客服' if msg['direction'] == 'to_service' else '客服→访客',
-                        msg.get('msg_type', 'text'),
-                        msg['timestamp']
-                    ])
-                
-                output.seek(0)
-                response = make_response(output.getvalue())
-                response.headers['Content-Type'] = 'text/csv; charset=utf-8-sig'
-                filename = f'chat_history_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-                response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-                
-            else:
-                # 生成JSON格式
-                export_data = {
-                    'export_time': datetime.now().isoformat(),
-                    'business_id': business_id,
-                    'filters': {
-                        'visitor_id': visitor_id,
-                        'service_id': service_id,
-                        'start_date': start_date,
-                        'end_date': end_date,
-                        'keyword': keyword
-                    },
-                    'total_records': result['data']['total'],
-                    'records': result['data']['list']
-                }
-                
-                response = make_response(json.dumps(export_data, ensure_ascii=False, indent=2))
-                response.headers['Content-Type'] = 'application/json; charset=utf-8'
-                filename = f'chat_history_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-                response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-            
-            logger.info(f"管理员 {current_user.user_name} 导出了{result['data']['total']}条聊天记录（格式：{export_format}）")
-            return response
-        else:
-            return jsonify(result), 500
+        extension, content_type = FORMATS[export_format]
+        filename = f'chat_history_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+        if gzip:
+            filename += '.gz'
+            content_type = 'application/gzip'
+        
+        response = Response(stream_with_context(chunks), content_type=content_type)
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        response.headers['X-Accel-Buffering'] = 'no'  # 禁止 nginx 缓冲整个响应
+        
+        logger.info(f"管理员 {current_user.user_name} 开始导出聊天记录（格式：{export_format}，gzip：{gzip}）")
+        return response
         
     except Exception as e:
         import traceback
@@ -893,6 +803,7 @@ def get_system_monitor():
     try:
         import psutil
         from exts import db
+        from mod.services.task_pool import task_pool
         
         # 获取内存信息
         memory = psutil.virtual_memory()
@@ -940,7 +851,8 @@ def get_system_monitor():
                     'percent': cpu_percent,  # CPU使用率
                     'count': cpu_count  # CPU核心数
                 },
-                'db_connections': db_connections
+                'db_connections': db_connections,
+                'task_pool': task_pool.get_stats()
             }
         })
         
@@ -949,6 +861,59 @@ def get_system_monitor():
         return jsonify({'code': -1, 'msg': str(e)}), 500
 
 
+@admin_bp.route('/system-monitor/socketio-events', methods=['GET'])
+@login_required
+def get_socketio_event_stats():
+    """获取SocketIO事件处理性能统计（当前worker，p50/p95/p99）"""
+    try:
+        if current_user.level not in ['super_manager', 'manager']:
+            return jsonify({'code': -1, 'msg': '权限不足'}), 403
+        
+        from mod.utils.performance_monitor import SocketIOEventMonitor
+        return jsonify({
+            'code': 0,
+            'msg': 'success',
+            'data': SocketIOEventMonitor.get_stats()
+        })
+        
+    except Exception as e:
+        logger.error(f'获取SocketIO事件统计失败: {e}')
+        return jsonify({'code': -1, 'msg': str(e)}), 500
+
+
+@admin_bp.route('/system-monitor/index-advisor', methods=['GET'])
+@login_required
+def get_index_advice():
+    """用 EXPLAIN 回放当前worker采集到的SQL，列出全表扫描/文件排序的语句及候选索引"""
+    try:
+        if current_user.level != 'super_manager':
+            return jsonify({'code': -1, 'msg': '权限不足'}), 403
+        
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        from mod.utils.index_advisor import index_advisor
+        return jsonify({
+            'code': 0,
+            'msg': 'success',
+            'data': index_advisor.analyze(limit)
+        })
+        
+    except Exception as e:
+        logger.error(f'索引分析失败: {e}')
+        return jsonify({'code': -1, 'msg': str(e)}), 500
+
+
+@admin_bp.route('/system-monitor/metrics', methods=['GET'])
+@login_required
+def get_prometheus_metrics():
+    """Prometheus 文本格式的SocketIO事件指标"""
+    if current_user.level not in ['super_manager', 'manager']:
+        return jsonify({'code': -1, 'msg': '权限不足'}), 403
+    
+    from mod.utils.performance_monitor import SocketIOEventMonitor
+    return Response(SocketIOEventMonitor.render_prometheus(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 @admin_bp.route('/statistics/region-stats', methods=['GET'])
 @login_required
 def get_region_statistics():
@@ -74,13 +74,10 @@ def queue_status():
             return jsonify({'code': 1000, 'msg': '访客ID不能为空'}), 400
         
         from mod.mysql.models import Queue
-        queue = Queue.query.filter_by(
-            visitor_id=visitor_id,
-            business_id=business_id,
-            state='normal'
-        ).first()
+        from mod.services.session_cache import active_sessions
+        session = active_sessions.get(business_id, visitor_id)
         
-        if not queue:
+        if not session:
             return jsonify({
                 'code': 0,
                 'data': {
@@ -90,8 +87,8 @@ def queue_status():
             })
         
         # 已分配客服
-        if queue.service_id > 0:
-            service = Service.query.get(queue.service_id)
+        if session.service_id and session.service_id > 0:
+            service = Service.query.get(session.service_id)
             return jsonify({
                 'code': 0,
                 'data': {
@@ -102,7 +99,8 @@ def queue_status():
                 }
             })
         
-        # 排队中
+        # 排队中（需要排队位置等字段，按主键加载）
+        queue = Queue.query.get(session.qid)
         return jsonify({
             'code': 0,
             'data': {
@@ -4,6 +4,7 @@
 from flask import Blueprint, request, jsonify
 from exts import db
 from mod.mysql.models import ServiceRating, Service, Queue, Visitor
+from mod.services.rating_stats import rating_stats
 from datetime import datetime, timedelta
 import log
 
@@ -135,6 +136,7 @@ def submit_rating():
         
         db.session.add(new_rating)
         db.session.commit()
+        rating_stats.invalidate(service_id)
         
         logger.info(f"✅ 访客{visitor_id}评价客服{service_id}: {rating}星")
         
@@ -208,37 +210,14 @@ def get_rating_stats(service_id):
     获取客服评价统计
     """
     try:
-        # 获取所有评价
-        ratings = ServiceRating.query.filter_by(service_id=service_id).all()
-        
-        if not ratings:
-            return jsonify({
-                'code': 0,
-                'data': {
-                    'total_count': 0,
-                    'average_rating': 0,
-                    'rating_distribution': {
-                        '5': 0, '4': 0, '3': 0, '2': 0, '1': 0
-                    }
-                }
-            })
-        
-        # 计算统计数据
-        total_count = len(ratings)
-        total_score = sum(r.rating for r in ratings)
-        average_rating = round(total_score / total_count, 2)
-        
-        # 评分分布
-        rating_distribution = {'5': 0, '4': 0, '3': 0, '2': 0, '1': 0}
-        for r in ratings:
-            rating_distribution[str(r.rating)] += 1
+        stats = rating_stats.summary(service_id=service_id)
         
         return jsonify({
             'code': 0,
             'data': {
-                'total_count': total_count,
-                'average_rating': average_rating,
-                'rating_distribution': rating_distribution
+                'total_count': stats['total_count'],
+                'average_rating': stats['avg_score'],
+                'rating_distribution': stats['level_distribution']
             }
         })
         
@@ -257,57 +236,10 @@ def get_overall_statistics():
         days = request.args.get('days', type=int)
         service_id = request.args.get('service_id', type=int)
         
-        # 构建查询
-        query = ServiceRating.query
-        
-        # 筛选客服
-        if service_id:
-            query = query.filter_by(service_id=service_id)
-        
-        # 筛选时间范围
-        if days:
-            from datetime import datetime, timedelta
-            start_date = datetime.now() - timedelta(days=days)
-            query = query.filter(ServiceRating.created_at >= start_date)
-        
-        ratings = query.all()
-        
-        if not ratings:
-            return jsonify({
-                'code': 0,
-                'data': {
-                    'total_count': 0,
-                    'avg_score': 0,
-                    'satisfaction_rate': 0,
-                    'level_distribution': {
-                        '5': 0, '4': 0, '3': 0, '2': 0, '1': 0
-                    }
-                }
-            })
-        
-        # 计算统计数据
-        total_count = len(ratings)
-        total_score = sum(r.rating for r in ratings)
-        avg_score = total_score / total_count
-        
-        # 评分分布
-        level_distribution = {'5': 0, '4': 0, '3': 0, '2': 0, '1': 0}
-        for r in ratings:
-            level_distribution[str(r.rating)] += 1
-        
-        # 满意度（4星及以上视为满意）
-        satisfied_count = level_distribution['5'] + level_distribution['4']
-        satisfaction_rate = (satisfied_count / total_count * 100) if total_count > 0 else 0
-        
         return jsonify({
             'code': 0,
             'msg': '获取成功',
-            'data': {
-                'total_count': total_count,
-                'avg_score': round(avg_score, 2),
-                'satisfaction_rate': round(satisfaction_rate, 2),
-                'level_distribution': level_distribution
-            }
+            'data': rating_stats.summary(service_id=service_id, days=days)
         })
         
     except Exception as e:
@@ -326,59 +258,10 @@ def get_rating_ranking():
         days = request.args.get('days', 7, type=int)
         limit = request.args.get('limit', 10, type=int)
         
-        # 筛选时间范围
-        from datetime import datetime, timedelta
-        start_date = datetime.now() - timedelta(days=days)
-        
-        # 查询评价数据
-        ratings = ServiceRating.query.filter(
-            ServiceRating.created_at >= start_date
-        ).all()
-        
-        # 按客服ID分组统计
-        service_stats = {}
-        for rating in ratings:
-            service_id = rating.service_id
-            if service_id not in service_stats:
-                service_stats[service_id] = {
-                    'service_id': service_id,
-                    'total_count': 0,
-                    'total_score': 0,
-                    'rating_distribution': {'5': 0, '4': 0, '3': 0, '2': 0, '1': 0}
-                }
-            
-            service_stats[service_id]['total_count'] += 1
-            service_stats[service_id]['total_score'] += rating.rating
-            service_stats[service_id]['rating_distribution'][str(rating.rating)] += 1
-        
-        # 计算平均分并获取客服信息
-        ranking = []
-        for service_id, stats in service_stats.items():
-            service = Service.query.get(service_id)
-            if service:
-                avg_score = stats['total_score'] / stats['total_count']
-                satisfied_count = stats['rating_distribution']['5'] + stats['rating_distribution']['4']
-                satisfaction_rate = (satisfied_count / stats['total_count'] * 100) if stats['total_count'] > 0 else 0
-                
-                ranking.append({
-                    'service_id': service_id,
-                    'service_name': service.nick_name,
-                    'total_count': stats['total_count'],
-                    'avg_score': round(avg_score, 2),
-                    'satisfaction_rate': round(satisfaction_rate, 2),
-                    'level_distribution': stats['rating_distribution']
-                })
-        
-        # 按平均分降序排序
-        ranking.sort(key=lambda x: x['avg_score'], reverse=True)
-        
-        # 限制返回数量
-        ranking = ranking[:limit]
-        
         return jsonify({
             'code': 0,
             'msg': '获取成功',
-            'data': ranking
+            'data': rating_stats.ranking(days=days, limit=limit)
         })
         
     except Exception as e:
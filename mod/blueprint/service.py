@@ -7,6 +7,8 @@ from exts import db
 from mod.mysql.models import Queue, Visitor, Service, Chat
 from mod.mysql.ModuleClass.QueueServiceClass import QueueService
 from mod.mysql.ModuleClass import chat_service
+from mod.services.unread_counter import unread_counter
+from mod.utils.pagination import InvalidCursor, cursor_args, keyset_paginate
 from sqlalchemy import case, and_, or_, func
 from datetime import datetime
 import log
@@ -232,8 +234,12 @@ def get_visitors_list():
         
         active_visitor_id_list = [v[0] for v in active_visitor_ids.all()]
         
-        # 统计这些活跃会话访客的未读消息
-        if active_visitor_id_list:
+        # 统计这些活跃会话访客的未读消息（优先使用Redis未读计数，不可用时回退SQL统计）
+        unread_counts_dict = unread_counter.get_counts(
+            business_id, active_visitor_id_list,
+            service_id=None if level in ['super_manager', 'manager'] else service_id
+        )
+        if unread_counts_dict is None and active_visitor_id_list:
             unread_filter_conditions = [
                 Chat.visitor_id.in_(active_visitor_id_list),
                 Chat.direction == 'to_service',
@@ -251,7 +257,7 @@ def get_visitors_list():
                 *unread_filter_conditions
             ).group_by(Chat.visitor_id).all()
             unread_counts_dict = {row.visitor_id: row.unread_count for row in unread_counts_query}
-        else:
+        elif unread_counts_dict is None:
             unread_counts_dict = {}
         
         # ⚡ 现在构建访客列表，使用预查询的数据
@@ -459,11 +465,12 @@ def transfer_to_me():
         
         # 🔔 广播转接事件（通过Socket.IO）
         from socketio_events import socketio
+        from mod.services.socket_rooms import all_agents_rooms
         
         # 获取访客信息
         visitor = Visitor.query.filter_by(visitor_id=visitor_id).first()
         
-        # 广播给所有在线客服（使用 visitor_assignment_updated 事件）
+        # 广播给本商户的在线客服（使用 visitor_assignment_updated 事件）
         socketio.emit('visitor_assignment_updated', {
             'visitor_id': visitor_id,
             'visitor_name': visitor.visitor_name if visitor else visitor_id,
@@ -475,7 +482,7 @@ def transfer_to_me():
             'can_view': True,
             'reason': 'transferred',
             'message': f'访客已转接到 {current_user.nick_name}'
-        }, room='service_room', namespace='/')
+        }, room=all_agents_rooms(current_user.business_id), namespace='/')
         
         return jsonify({
             'code': 0,
@@ -788,46 +795,49 @@ def delete_service_group(group_id):
 @service_bp.route('/chat/history', methods=['GET'])
 @login_required
 def get_chat_history():
-    """获取与访客的聊天历史"""
+    """
+    获取与访客的聊天历史（游标分页，从最新往前翻）
+
+    参数: visitor_id, cursor（上一页返回的 next_cursor）, limit, with_total
+    """
     try:
         visitor_id = request.args.get('visitor_id')
-        limit = request.args.get('limit', 50, type=int)
-        offset = request.args.get('offset', 0, type=int)
+        cursor, limit, with_total = cursor_args(request)
         
         if not visitor_id:
             return jsonify({'code': -1, 'msg': '缺少访客ID参数'}), 400
         
         # ✅ 先倒序获取最新的limit条记录，然后反转成正序
-        # 倒序查询最新的记录
-        messages = Chat.query.filter_by(
+        query = Chat.query.filter_by(
             visitor_id=visitor_id,
             business_id=current_user.business_id
-        ).order_by(Chat.created_at.desc()).offset(offset).limit(limit).all()
+        )
+        try:
+            page = keyset_paginate(query, Chat.created_at, Chat.cid, cursor=cursor,
+                                   limit=limit, with_total=with_total)
+        except InvalidCursor as e:
+            return jsonify({'code': -1, 'msg': str(e)}), 400
         
         # ✅ 反转成正序（最早的在前，最新的在后）
-        messages.reverse()
-        
-        # ⚡ 批量更新未读消息为已读（性能优化：使用update()而不是逐条更新）
-        try:
-            updated_count = Chat.query.filter_by(
-                visitor_id=visitor_id,
-                business_id=current_user.business_id,
-                direction='to_service',  # 访客发给客服的消息
-                state='unread'
-            ).update({'state': 'read'}, synchronize_session=False)
-            
-            if updated_count > 0:
-                db.session.commit()
-                logger.info(f"✅ 批量标记已读: 访客 {visitor_id} 的 {updated_count} 条消息")
-        except Exception as e:
-            logger.error(f"标记已读失败: {e}")
-            db.session.rollback()
-        
-        # 获取总数
-        total = Chat.query.filter_by(
-            visitor_id=visitor_id,
-            business_id=current_user.business_id
-        ).count()
+        messages = list(reversed(page.items))
+        
+        # ⚡ 批量更新未读消息为已读（只在打开会话时做一次，往前翻页时不再重复）
+        if not cursor:
+            try:
+                updated_count = Chat.query.filter_by(
+                    visitor_id=visitor_id,
+                    business_id=current_user.business_id,
+                    direction='to_service',  # 访客发给客服的消息
+                    state='unread'
+                ).update({'state': 'read'}, synchronize_session=False)
+                
+                if updated_count > 0:
+                    db.session.commit()
+                    unread_counter.clear_visitor(current_user.business_id, visitor_id)
+                    logger.info(f"✅ 批量标记已读: 访客 {visitor_id} 的 {updated_count} 条消息")
+            except Exception as e:
+                logger.error(f"标记已读失败: {e}")
+                db.session.rollback()
         
         # 转换为字典格式
         result = []
@@ -857,8 +867,7 @@ def get_chat_history():
             'code': 0,
             'msg': 'success',
             'data': result,
-            'total': total,
-            'has_more': (offset + limit) < total
+            **page.meta()
         })
         
     except Exception as e:
@@ -928,6 +937,7 @@ def mark_visitor_read():
         if updated_count > 0:
             db.session.commit()
             logger.info(f"✅ 客服{current_user.service_id}打开会话，标记已读: 访客 {visitor_id} 的 {updated_count} 条消息")
+        unread_counter.clear_visitor(current_user.business_id, visitor_id)
         
         return jsonify({
             'code': 0,
@@ -960,14 +970,24 @@ def get_unread_messages():
         # 管理员可以看到所有未读消息，普通客服只看自己的
         business_id = current_user.business_id
         
-        if level in ['super_manager', 'manager']:
+        # 📬 优先使用Redis未读计数（只需查询进行中的会话访客ID）
+        active_visitor_ids = db.session.query(Queue.visitor_id).filter(
+            Queue.business_id == business_id,
+            Queue.state == 'normal'
+        )
+        if level not in ['super_manager', 'manager']:
+            active_visitor_ids = active_visitor_ids.filter(Queue.service_id == service_id)
+        active_visitor_id_list = [v[0] for v in active_visitor_ids.all()]
+        
+        unread_count = unread_counter.total(
+            business_id, active_visitor_id_list,
+            service_id=None if level in ['super_manager', 'manager'] else service_id
+        )
+        
+        if unread_count is not None:
+            logger.debug(f"📬 Redis未读计数: {unread_count}")
+        elif level in ['super_manager', 'manager']:
             # ✅ 管理员：查询所有未读消息（只统计当前在会话中的访客）
-            active_visitor_ids = db.session.query(Queue.visitor_id).filter(
-                Queue.business_id == business_id,
-                Queue.state == 'normal'
-            ).all()
-            active_visitor_id_list = [v[0] for v in active_visitor_ids]
-            
             if active_visitor_id_list:
                 unread_count = db.session.query(func.count(Chat.cid)).filter(
                     and_(
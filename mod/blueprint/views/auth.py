@@ -231,6 +231,8 @@ def logout():
     if current_user.is_authenticated:
         current_user.state = 'offline'
         db.session.commit()
+        from mod.services.assignment_engine import assignment_engine
+        assignment_engine.update(current_user)
         logger.info(f"用户登出: {current_user.user_name}")
     
     logout_user()
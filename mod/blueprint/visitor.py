@@ -10,6 +10,7 @@ from mod.mysql.ModuleClass.QueueServiceClass import QueueService
 # 性能优化：导入缓存服务
 from mod.services.cache_service import FAQCache, SystemSettingsCache, VisitorCache
 from mod.utils.performance_monitor import PerformanceMonitor
+from mod.utils.pagination import InvalidCursor, cursor_args, keyset_paginate
 import log
 import requests
 import re
@@ -70,13 +71,8 @@ def send_message():
         
         # 🚫 检查访客是否在黑名单中
         if visitor_id:
-            from mod.mysql.models import Queue
-            blacklist_check = Queue.query.filter_by(
-                visitor_id=visitor_id,
-                state='blacklist'
-            ).first()
-            
-            if blacklist_check:
+            from mod.services.blacklist import blacklist
+            if blacklist.contains(visitor_id):
                 logger.warning(f"🚫 拦截黑名单访客的API消息请求: {visitor_id}")
                 return jsonify({
                     'code': -1,
@@ -92,15 +88,18 @@ def send_message():
 
 @visitor_bp.route('/history', methods=['GET'])
 def get_history():
-    """获取历史消息"""
+    """
+    获取历史消息（游标分页，从最新往前翻）
+
+    参数: visitor_id, service_id, cursor（上一页返回的 next_cursor）, limit, with_total
+    """
     try:
         visitor_id = request.args.get('visitor_id')
         service_id = request.args.get('service_id', type=int)
         business_id = request.args.get('business_id', type=int)
-        offset = request.args.get('offset', 0, type=int)
-        limit = request.args.get('limit', 50, type=int)
+        cursor, limit, with_total = cursor_args(request)
         
-        logger.info(f'获取历史消息: visitor_id={visitor_id}, service_id={service_id}, business_id={business_id}, offset={offset}, limit={limit}')
+        logger.info(f'获取历史消息: visitor_id={visitor_id}, service_id={service_id}, business_id={business_id}, cursor={cursor}, limit={limit}')
         
         if not visitor_id:
             return jsonify({'code': 1000, 'msg': '缺少visitor_id参数'}), 400
@@ -115,15 +114,15 @@ def get_history():
         # 如果提供了business_id，也可以作为额外过滤（虽然Chat表可能没有这个字段）
         # business_id 主要用于权限验证
         
-        query = query.order_by(Chat.created_at.desc())
-        
-        # 分页
-        total = query.count()
-        messages = query.offset(offset).limit(limit).all()
+        try:
+            page = keyset_paginate(query, Chat.created_at, Chat.cid, cursor=cursor,
+                                   limit=limit, with_total=with_total)
+        except InvalidCursor as e:
+            return jsonify({'code': 1000, 'msg': str(e)}), 400
         
-        # 转换为字典列表（注意：需要反转顺序，因为是DESC查询）
+        # 转换为字典列表（注意：需要反转顺序，因为是从最新往前取的）
         message_list = []
-        for msg in reversed(messages):
+        for msg in reversed(page.items):
             msg_dict = {
                 'cid': msg.cid,
                 'content': msg.content,
@@ -136,17 +135,15 @@ def get_history():
             }
             message_list.append(msg_dict)
         
-        logger.info(f'查询到 {len(message_list)} 条历史消息，总数: {total}')
+        logger.info(f'查询到 {len(message_list)} 条历史消息，has_more: {page.has_more}')
         
         return jsonify({
             'code': 0,
             'msg': 'success',
             'data': {
                 'messages': message_list,
-                'offset': offset,
                 'limit': limit,
-                'total': total,
-                'has_more': (offset + limit) < total
+                **page.meta()
             }
         })
         
@@ -203,6 +200,7 @@ def get_visitor_list():
         )
         
         # 转换分页结果
+        from mod.services.blacklist import blacklist
         visitors_data = []
         for visitor in pagination.items:
             visitor_dict = visitor.to_dict()
@@ -224,11 +222,7 @@ def get_visitor_list():
                 visitor_dict['queue'] = None
             
             # 🚫 添加黑名单状态
-            blacklist_queue = Queue.query.filter_by(
-                visitor_id=visitor.visitor_id,
-                state='blacklist'
-            ).first()
-            visitor_dict['is_blacklisted'] = blacklist_queue is not None
+            visitor_dict['is_blacklisted'] = blacklist.contains(visitor.visitor_id)
             
             visitors_data.append(visitor_dict)
         
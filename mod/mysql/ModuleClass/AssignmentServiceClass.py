@@ -2,7 +2,7 @@
 智能客服分配服务
 实现访客到客服的智能分配逻辑
 """
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Dict, Optional, List, Tuple
 from exts import db
 from mod.mysql.models import Service, Queue, Visitor, Business
@@ -120,8 +120,10 @@ class AssignmentService:
     def _handle_auto_assignment(self, visitor_id: str, business_id: int,
                                priority: int) -> Dict:
         """处理自动分配"""
-        # 1. 查找可用客服
-        available_service = self._find_available_service(business_id)
+        # 1. 查找可用客服并预占接待名额
+        available_service = self.reserve_available_service(
+            business_id, f"访客接入: {visitor_id}"
+        )
         
         # 2. 如果有可用客服，直接分配
         if available_service:
@@ -137,13 +139,6 @@ class AssignmentService:
             db.session.add(queue)
             db.session.commit()
             
-            # ✅ 使用统一的接待数管理器
-            from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
-            workload_manager.increment_workload(
-                available_service.service_id,
-                f"访客接入: {visitor_id}"
-            )
-            
             return {
                 'action': 'assigned',
                 'service_id': available_service.service_id,
@@ -157,7 +152,7 @@ class AssignmentService:
     
     def _find_available_service(self, business_id: int) -> Optional[Service]:
         """
-        查找可用客服（负载最低）
+        查找可用客服（由分配引擎按负载表选择）
         
         优先级规则：
         1. 优先分配给在线且空闲的普通客服（level='service'）
@@ -167,44 +162,37 @@ class AssignmentService:
         Returns:
             Service or None
         """
-        # 1. 查找在线且未满载的普通客服（排除机器人）
-        normal_services = Service.query.filter_by(
-            business_id=business_id,
-            state='online',
-            level='service'  # 仅查询普通客服
-        ).filter(
-            Service.current_chat_count < Service.max_concurrent_chats,
-            Service.user_name != 'robot'  # ⚡ 排除机器人账号
-        ).order_by(
-            Service.current_chat_count.asc(),  # 按接待数升序（优先分配给空闲的）
-            Service.last_assign_time.asc()  # 最后分配时间升序（MySQL不支持NULLS FIRST）
-        ).all()
-        
-        if normal_services:
-            # 有可用的普通客服，返回负载最低的
-            logger.info(f"✅ 分配给普通客服: {normal_services[0].nick_name} (ID: {normal_services[0].service_id})")
-            return normal_services[0]
-        
-        # 2. 没有可用的普通客服，查找在线且未满载的管理员
-        admin_services = Service.query.filter_by(
-            business_id=business_id,
-            state='online'
-        ).filter(
-            Service.level.in_(['manager', 'super_manager'])  # 仅查询管理员
-        ).filter(
-            Service.current_chat_count < Service.max_concurrent_chats
-        ).order_by(
-            Service.current_chat_count.asc(),  # 按接待数升序
-            Service.last_assign_time.asc()  # 最后分配时间升序（MySQL不支持NULLS FIRST）
-        ).all()
-        
-        if admin_services:
-            # 有可用的管理员，返回负载最低的
-            logger.info(f"⚠️ 普通客服都忙/离线，分配给管理员: {admin_services[0].nick_name} (ID: {admin_services[0].service_id})")
-            return admin_services[0]
-        
-        # 3. 所有客服和管理员都不可用
-        logger.warning(f"⚠️ 所有客服和管理员都不可用，将分配给机器人: business_id={business_id}")
+        from mod.services.assignment_engine import assignment_engine
+        
+        service = assignment_engine.select_service(business_id)
+        if service is None:
+            logger.warning(f"⚠️ 所有客服和管理员都不可用，将分配给机器人: business_id={business_id}")
+        elif service.level in ['super_manager', 'manager']:
+            logger.info(f"⚠️ 普通客服都忙/离线，分配给管理员: {service.nick_name} (ID: {service.service_id})")
+        else:
+            logger.info(f"✅ 分配给普通客服: {service.nick_name} (ID: {service.service_id})")
+        return service
+    
+    def reserve_available_service(self, business_id: int, reason: str = '',
+                                  max_attempts: int = 3) -> Optional[Service]:
+        """
+        查找可用客服并原子地预占一个接待名额（接待数 +1）
+        
+        负载表可能落后于其他 worker 的分配，预占失败（已满载）时刷新负载表后重选
+        
+        Returns:
+            已预占名额的客服，没有可用客服返回 None
+        """
+        from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
+        from mod.services.assignment_engine import assignment_engine
+        
+        for _ in range(max_attempts):
+            service = self._find_available_service(business_id)
+            if service is None:
+                return None
+            if workload_manager.reserve_workload(service.service_id, reason)['success']:
+                return service
+            assignment_engine.invalidate(business_id)
         return None
     
     def _add_to_queue(self, visitor_id: str, business_id: int,
@@ -223,9 +211,12 @@ class AssignmentService:
         db.session.add(queue)
         db.session.commit()
         
-        # 计算排队位置和预估时间
-        position = self._calculate_queue_position(visitor_id, business_id)
-        estimated_time = self._estimate_wait_time(business_id, position, priority)
+        # 进入等待线，得到排队位置
+        from mod.services.waiting_line import waiting_line
+        from mod.services.wait_estimator import wait_estimator
+        position = waiting_line.add_queue(queue)
+        eta = wait_estimator.estimate(business_id, position, priority, queue.group_id)
+        estimated_time = eta['p50']
         
         # 更新队列信息
         queue.wait_position = position
@@ -237,92 +228,27 @@ class AssignmentService:
             'service_id': None,
             'position': position,
             'estimated_wait_time': estimated_time,
+            'estimated_wait_time_p90': eta['p90'],
             'message': self._generate_queue_message(position, estimated_time),
             'is_exclusive': False
         }
     
     def _calculate_queue_position(self, visitor_id: str, business_id: int) -> int:
-        """计算排队位置（考虑优先级）"""
-        current = Queue.query.filter(
-            Queue.visitor_id == visitor_id,
-            Queue.business_id == business_id,
-            (Queue.service_id == None) | (Queue.service_id == 0),  # ✅ 兼容旧数据
-            state='normal'
-        ).first()
-        
-        if not current:
-            return 0
-        
-        # 统计排在前面的人数
-        count = Queue.query.filter(
-            Queue.business_id == business_id,
-            (Queue.service_id == None) | (Queue.service_id == 0),  # ✅ 兼容旧数据
-            Queue.state == 'normal'
-        ).filter(
-            db.or_(
-                Queue.priority > current.priority,
-                db.and_(
-                    Queue.priority == current.priority,
-                    Queue.created_at < current.created_at
-                )
-            )
-        ).count()
-        
-        return count + 1
+        """计算排队位置（考虑优先级），由等待线直接给出"""
+        from mod.services.waiting_line import waiting_line
+        return waiting_line.position(business_id, visitor_id)
     
     def _estimate_wait_time(self, business_id: int, position: int,
-                           priority: int) -> int:
-        """预估等待时间（秒）"""
-        # 获取在线客服数
-        online_count = Service.query.filter_by(
-            business_id=business_id,
-            state='online'
-        ).count()
-        
-        if online_count == 0:
-            return -1  # 无客服在线
-        
-        # 获取平均处理时间
-        avg_handle_time = self._get_avg_handle_time(business_id)
-        
-        # 优先级权重
-        priority_factor = 1.0
-        if priority == 2:  # 紧急
-            priority_factor = 0.3
-        elif priority == 1:  # VIP
-            priority_factor = 0.6
+                           priority: int, online_count: Optional[int] = None,
+                           group_id: int = 0) -> int:
+        """
+        预估等待时间（秒，p50），由流式处理时长统计给出，不查询数据库
         
-        # 计算预估时间
-        estimated = (position / online_count) * avg_handle_time * priority_factor
-        return int(estimated)
-    
-    def _get_avg_handle_time(self, business_id: int) -> float:
-        """获取平均处理时间（秒）"""
-        # 查询最近完成的会话
-        recent = Queue.query.filter_by(
-            business_id=business_id,
-            state='complete'
-        ).filter(
-            Queue.updated_at >= datetime.now() - timedelta(hours=2)
-        ).order_by(Queue.updated_at.desc()).limit(20).all()
-        
-        if not recent:
-            return 300.0  # 默认5分钟
-        
-        total_time = 0
-        valid_count = 0
-        
-        for q in recent:
-            if q.created_at and q.updated_at:
-                duration = (q.updated_at - q.created_at).total_seconds()
-                # 过滤异常值
-                if 30 <= duration <= 3600:
-                    total_time += duration
-                    valid_count += 1
-        
-        if valid_count > 0:
-            return total_time / valid_count
-        return 300.0
+        Args:
+            online_count: 在线客服数，批量计算时由调用方取一次后传入
+        """
+        from mod.services.wait_estimator import wait_estimator
+        return wait_estimator.estimate(business_id, position, priority, group_id, online_count)['p50']
     
     def _generate_queue_message(self, position: int, estimated_time: int) -> str:
         """生成排队提示消息"""
@@ -347,71 +273,161 @@ class AssignmentService:
     
     def process_queue(self, business_id: int) -> int:
         """
-        处理排队队列，为等待的访客分配空闲客服
+        处理排队队列：按等待线顺序和各客服的空闲名额一次性计算分配方案，
+        在同一事务中批量写入（每个客服一条 UPDATE queues ... WHERE qid IN (...)），
+        提交后每个客服只推送一次通知
         
         Returns:
             成功分配的数量
         """
-        assigned_count = 0
+        from collections import defaultdict
+        from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
+        from mod.services.assignment_engine import assignment_engine
+        from mod.services.waiting_line import waiting_line
         
+        waiting = [e for e in waiting_line.snapshot(business_id) if e.get('qid')]
+        if not waiting:
+            return 0
+        
+        assigned = {}
         try:
-            # 获取等待队列（按优先级排序）
-            waiting = Queue.query.filter(
-                Queue.business_id == business_id,
-                (Queue.service_id == None) | (Queue.service_id == 0),  # ✅ 兼容旧数据
-                Queue.state == 'normal',
-                Queue.assign_status == 'waiting'
-            ).order_by(
-                Queue.priority.desc(),
-                Queue.created_at.asc()
-            ).all()
+            # 1. 过滤等待线中已失效的条目（已被其他途径分配/结束）
+            valid_qids = {
+                qid for (qid,) in db.session.query(Queue.qid).filter(
+                    Queue.qid.in_([e['qid'] for e in waiting]),
+                    Queue.state == 'normal',
+                    (Queue.service_id == None) | (Queue.service_id == 0),  # ✅ 兼容旧数据
+                    db.or_(Queue.assign_status == None, Queue.assign_status != 'timeout')
+                ).all()
+            }
+            for entry in waiting:
+                if entry['qid'] not in valid_qids:
+                    waiting_line.remove(business_id, entry['visitor_id'])
+            waiting = [e for e in waiting if e['qid'] in valid_qids]
             
-            for queue in waiting:
-                # 查找可用客服
-                service = self._find_available_service(business_id)
-                if not service:
-                    break  # 没有可用客服，停止处理
-                
-                # 分配客服
-                queue.service_id = service.service_id
-                queue.assign_status = 'assigned'
-                queue.wait_position = None
-                queue.estimated_wait_time = 0
-                service.last_assign_time = datetime.now()
-                
-                assigned_count += 1
+            # 2. 在内存中计算分配方案
+            plan = defaultdict(list)  # service_id -> [entry]
+            for entry, service_id in zip(waiting, assignment_engine.plan(business_id, [e['group_id'] for e in waiting])):
+                if service_id is None:
+                    break
+                plan[service_id].append(entry)
+            if not plan:
+                return 0
+            
+            # 3. 预占名额（其他 worker 同时分配导致名额不足的客服，本轮跳过）
+            reserved = workload_manager.reserve_workloads({sid: len(es) for sid, es in plan.items()})
+            plan = {sid: es for sid, es in plan.items() if reserved.get(sid)}
             
-            if assigned_count > 0:
-                db.session.commit()
-                logger.info(f"队列处理完成: business={business_id}, assigned={assigned_count}")
+            # 4. 每个客服一条批量 UPDATE（条件保证不会覆盖并发分配）
+            now = datetime.now()
+            for service_id, entries in plan.items():
+                Queue.query.filter(
+                    Queue.qid.in_([e['qid'] for e in entries]),
+                    Queue.state == 'normal',
+                    (Queue.service_id == None) | (Queue.service_id == 0)
+                ).update({
+                    'service_id': service_id,
+                    'assign_status': 'assigned',
+                    'wait_position': None,
+                    'estimated_wait_time': 0,
+                    'updated_at': now
+                }, synchronize_session=False)
+            
+            # 5. 以事务内实际写入的结果为准，撤销多占的名额
+            planned_qids = [e['qid'] for es in plan.values() for e in es]
+            actual = dict(
+                db.session.query(Queue.qid, Queue.service_id).filter(Queue.qid.in_(planned_qids)).all()
+            ) if planned_qids else {}
+            surplus = {}
+            for service_id, entries in plan.items():
+                done = [e for e in entries if actual.get(e['qid']) == service_id]
+                if done:
+                    assigned[service_id] = done
+                surplus[service_id] = len(entries) - len(done)
+            workload_manager.release_workloads(surplus)
+            
+            db.session.commit()
             
         except Exception as e:
             logger.error(f"处理队列失败: business={business_id}, error={str(e)}")
             db.session.rollback()
+            assignment_engine.invalidate(business_id)
+            return 0
+        
+        assigned_count = sum(len(es) for es in assigned.values())
+        if assigned_count:
+            from mod.services.session_cache import active_sessions
+            for entries in assigned.values():
+                for entry in entries:
+                    waiting_line.remove(business_id, entry['visitor_id'])
+            # 批量 UPDATE 不经过 ORM 事件，手动失效会话缓存
+            active_sessions.invalidate(business_id, [e['visitor_id'] for es in assigned.values() for e in es])
+            workload_manager.announce_workloads(list(assigned))
+            self._notify_batch_assigned(business_id, assigned)
+            logger.info(f"队列处理完成: business={business_id}, assigned={assigned_count}, services={len(assigned)}")
+        assignment_engine.invalidate(business_id)
         
         return assigned_count
     
+    def _notify_batch_assigned(self, business_id: int, assigned: Dict[int, List[Dict]]):
+        """批量分配后，每个客服一条合并通知，每个访客一条接入通知"""
+        try:
+            from exts import socketio
+            from mod.services.socket_rooms import agent_room
+            from mod.services.stats_publisher import stats_publisher
+            
+            timestamp = datetime.now().isoformat()
+            names = dict(db.session.query(Service.service_id, Service.nick_name).filter(
+                Service.service_id.in_(list(assigned))
+            ).all())
+            for service_id, entries in assigned.items():
+                socketio.emit('visitors_assigned', {
+                    'service_id': service_id,
+                    'visitors': [{'visitor_id': e['visitor_id'], 'queue_id': e['qid']} for e in entries],
+                    'count': len(entries),
+                    'timestamp': timestamp
+                }, room=agent_room(business_id, service_id))
+                for entry in entries:
+                    socketio.emit('service_connected', {
+                        'service_id': service_id,
+                        'service_name': names.get(service_id, ''),
+                        'queue_id': entry['qid']
+                    }, room=f"visitor_{entry['visitor_id']}")
+            
+            stats_publisher.mark_dirty(business_id)
+        except Exception as e:
+            logger.error(f"推送批量分配通知失败: business={business_id}, error={str(e)}")
+    
     def update_queue_positions(self, business_id: int):
-        """更新所有排队访客的位置和预估时间"""
+        """更新所有排队访客的位置和预估时间（顺序取自等待线）"""
+        from mod.services.waiting_line import waiting_line
+        
         try:
-            waiting = Queue.query.filter(
-                Queue.business_id == business_id,
-                (Queue.service_id == None) | (Queue.service_id == 0),  # ✅ 兼容旧数据
-                Queue.state == 'normal',
-                Queue.assign_status == 'waiting'
-            ).order_by(
-                Queue.priority.desc(),
-                Queue.created_at.asc()
-            ).all()
+            waiting = waiting_line.snapshot(business_id)
+            if not waiting:
+                return
             
-            for idx, queue in enumerate(waiting):
-                position = idx + 1
-                estimated_time = self._estimate_wait_time(
-                    business_id, position, queue.priority or 0
-                )
+            queues = {
+                q.qid: q for q in Queue.query.filter(
+                    Queue.qid.in_([e['qid'] for e in waiting if e.get('qid')])
+                ).all()
+            }
+            from mod.services.wait_estimator import wait_estimator
+            online_count = wait_estimator.online_count(business_id)
+            
+            # 位置按分组分别计数
+            group_positions = {}
+            for entry in waiting:
+                queue = queues.get(entry.get('qid'))
+                if not queue:
+                    continue
+                position = group_positions.get(entry['group_id'], 0) + 1
+                group_positions[entry['group_id']] = position
                 
                 queue.wait_position = position
-                queue.estimated_wait_time = estimated_time
+                queue.estimated_wait_time = self._estimate_wait_time(
+                    business_id, position, entry['priority'], online_count, entry['group_id']
+                )
             
             db.session.commit()
             
@@ -432,11 +448,8 @@ class AssignmentService:
         if not service:
             return False, '客服不存在', None
         
-        session = Queue.query.filter_by(
-            visitor_id=visitor_id,
-            business_id=business_id,
-            state='normal'
-        ).first()
+        from mod.services.session_cache import active_sessions
+        session = active_sessions.get(business_id, visitor_id)
         
         if not session:
             # 没有会话，允许回复（会创建新会话）
@@ -455,7 +468,7 @@ class AssignmentService:
         # 普通客服只能回复自己的访客
         if session.service_id == service_id:
             return True, None, None
-        elif session.service_id > 0:
+        elif session.service_id and session.service_id > 0:
             assigned_service = Service.query.get(session.service_id)
             return False, f'该访客已分配给其他客服', \
                    assigned_service.to_dict() if assigned_service else None
@@ -13,12 +13,43 @@ from mod.mysql.models import Chat, Queue, Visitor, Service
 class ChatService:
     """聊天记录服务"""
     
+    @staticmethod
+    def history_query(business_id, visitor_id=None, service_id=None,
+                      start_date=None, end_date=None, keyword=None):
+        """
+        按筛选条件构建聊天记录查询（未排序，供分页查询和导出共用）
+        
+        Returns:
+            Chat 查询对象
+        """
+        # 构建查询，通过business_id过滤
+        query = Chat.query.filter_by(business_id=business_id)
+        
+        if visitor_id:
+            query = query.filter_by(visitor_id=visitor_id)
+        
+        if service_id:
+            query = query.filter(Chat.service_id == service_id)
+        
+        if start_date:
+            start = datetime.strptime(start_date, '%Y-%m-%d')
+            query = query.filter(Chat.created_at >= start)
+        
+        if end_date:
+            end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+            query = query.filter(Chat.created_at < end)
+        
+        if keyword:
+            query = query.filter(Chat.content.like(f'%{keyword}%'))
+        
+        return query
+    
     @staticmethod
     def get_chat_history(business_id, visitor_id=None, service_id=None, 
                         start_date=None, end_date=None, keyword=None,
-                        page=1, per_page=50):
+                        cursor=None, limit=50, with_total=False):
         """
-        获取聊天记录
+        获取聊天记录（游标分页，从最新往前翻）
         
         Args:
             business_id: 商户ID
@@ -27,46 +58,37 @@ class ChatService:
             start_date: 开始日期（可选）
             end_date: 结束日期（可选）
             keyword: 关键词（可选）
-            page: 页码
-            per_page: 每页数量
+            cursor: 上一页返回的 next_cursor，None 表示第一页
+            limit: 每页数量
+            with_total: 是否附带（近似）总数
         
         Returns:
             dict: 聊天记录列表
         """
+        from mod.utils.pagination import InvalidCursor, keyset_paginate
+        
         try:
-            # 构建查询，通过business_id过滤
-            query = Chat.query.filter_by(business_id=business_id)
-            
-            if visitor_id:
-                query = query.filter_by(visitor_id=visitor_id)
-            
-            if service_id:
-                query = query.filter(Chat.service_id == service_id)
-            
-            if start_date:
-                start = datetime.strptime(start_date, '%Y-%m-%d')
-                query = query.filter(Chat.created_at >= start)
-            
-            if end_date:
-                end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
-                query = query.filter(Chat.created_at < end)
-            
-            if keyword:
-                query = query.filter(Chat.content.like(f'%{keyword}%'))
+            query = ChatService.history_query(business_id, visitor_id, service_id,
+                                              start_date, end_date, keyword)
             
             # 排序和分页
-            query = query.order_by(Chat.created_at.desc())
-            pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+            page = keyset_paginate(query, Chat.created_at, Chat.cid, cursor=cursor,
+                                   limit=limit, with_total=with_total)
+            
+            # 一次性获取本页涉及的访客和客服名称
+            visitor_ids = {chat.visitor_id for chat in page.items}
+            service_ids = {chat.service_id for chat in page.items if chat.service_id}
+            visitor_names = dict(db.session.query(Visitor.visitor_id, Visitor.visitor_name).filter(
+                Visitor.business_id == business_id,
+                Visitor.visitor_id.in_(visitor_ids)
+            ).all()) if visitor_ids else {}
+            service_names = dict(db.session.query(Service.service_id, Service.nick_name).filter(
+                Service.service_id.in_(service_ids)
+            ).all()) if service_ids else {}
             
             # 组装数据
             chat_list = []
-            for chat in pagination.items:
-                visitor = Visitor.query.filter_by(
-                    visitor_id=chat.visitor_id,
-                    business_id=business_id
-                ).first()
-                service = Service.query.filter_by(service_id=chat.service_id).first() if chat.service_id else None
-                
+            for chat in page.items:
                 # 判断消息类型
                 msg_type = 'text'
                 if chat.msg_type == 2:
@@ -75,9 +97,9 @@ class ChatService:
                 chat_list.append({
                     'id': chat.cid,
                     'visitor_id': chat.visitor_id,
-                    'visitor_name': visitor.visitor_name if visitor else '未知',
+                    'visitor_name': visitor_names.get(chat.visitor_id, '未知'),
                     'service_id': chat.service_id,
-                    'service_name': service.nick_name if service else '机器人',
+                    'service_name': service_names.get(chat.service_id, '机器人') if chat.service_id else '机器人',
                     'content': chat.content,
                     'direction': chat.direction,
                     'msg_type': msg_type,
@@ -88,12 +110,13 @@ class ChatService:
                 'code': 0,
                 'data': {
                     'list': chat_list,
-                    'total': pagination.total,
-                    'pages': pagination.pages,
-                    'page': page
+                    'limit': limit,
+                    **page.meta()
                 }
             }
             
+        except InvalidCursor as e:
+            return {'code': -1, 'msg': str(e)}
         except Exception as e:
             import traceback
             traceback.print_exc()
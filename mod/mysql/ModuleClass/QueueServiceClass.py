@@ -86,35 +86,8 @@ class QueueService:
         Returns:
             int: 队列位置（从1开始）
         """
-        try:
-            # 查找当前访客的队列记录
-            current_queue = Queue.query.filter_by(
-                visiter_id=visitor_id,
-                business_id=business_id,
-                state='waiting'
-            ).first()
-            
-            if not current_queue:
-                return 0
-            
-            # 计算在他之前有多少人（按优先级和时间排序）
-            position = Queue.query.filter(
-                Queue.business_id == business_id,
-                Queue.state == 'waiting',
-                or_(
-                    Queue.priority > current_queue.priority,
-                    and_(
-                        Queue.priority == current_queue.priority,
-                        Queue.created_at < current_queue.created_at
-                    )
-                )
-            ).count()
-            
-            return position + 1
-            
-        except Exception as e:
-            print(f'获取队列位置失败: {e}')
-            return 0
+        from mod.services.waiting_line import waiting_line
+        return waiting_line.position(business_id, visitor_id)
     
     @staticmethod
     def auto_assign_service(queue_id):
@@ -140,97 +113,24 @@ class QueueService:
             if not queue or queue.state != 'waiting':
                 return {'code': -1, 'msg': '队列记录不存在或状态不正确'}
             
-            # 1. 先查找可用的普通客服（在线且未达到最大接待数）
-            normal_services = Service.query.filter_by(
-                business_id=queue.business_id,
-                state='online',
-                level='service'  # 仅查询普通客服
-            ).all()
-            
-            # 计算每个普通客服的当前接待数
-            best_service = None
-            min_sessions = float('inf')
-            
-            for service in normal_services:
-                # 计算当前接待数
-                current_sessions = Queue.query.filter_by(
-                    service_id=service.service_id,
-                    state='chatting'
-                ).count()
-                
-                # 检查是否达到最大接待数（默认5个）
-                max_sessions = getattr(service, 'max_sessions', 5)
-                if current_sessions >= max_sessions:
-                    continue
-                
-                # 选择接待数最少的客服
-                if current_sessions < min_sessions:
-                    min_sessions = current_sessions
-                    best_service = service
-            
-            # 如果找到可用的普通客服，直接分配
-            if best_service:
-                queue.service_id = best_service.service_id
-                queue.state = 'chatting'
-                queue.start_time = datetime.now()
-                db.session.commit()
-                
-                return {
-                    'code': 0,
-                    'msg': '分配客服成功',
-                    'data': {
-                        'service_id': best_service.service_id,
-                        'service_name': best_service.nick_name
-                    }
-                }
-            
-            # 2. 没有可用的普通客服，查找可用的管理员
-            admin_services = Service.query.filter_by(
-                business_id=queue.business_id,
-                state='online'
-            ).filter(
-                Service.level.in_(['manager', 'super_manager'])
-            ).all()
-            
-            if not admin_services:
-                return {'code': -1, 'msg': '暂无在线客服'}
-            
-            # 计算每个管理员的当前接待数
-            best_admin = None
-            min_admin_sessions = float('inf')
-            
-            for service in admin_services:
-                # 计算当前接待数
-                current_sessions = Queue.query.filter_by(
-                    service_id=service.service_id,
-                    state='chatting'
-                ).count()
-                
-                # 检查是否达到最大接待数（默认5个）
-                max_sessions = getattr(service, 'max_sessions', 5)
-                if current_sessions >= max_sessions:
-                    continue
-                
-                # 选择接待数最少的管理员
-                if current_sessions < min_admin_sessions:
-                    min_admin_sessions = current_sessions
-                    best_admin = service
-            
-            if not best_admin:
-                return {'code': -1, 'msg': '所有客服已满载'}
+            # 由分配引擎按负载表选择（普通客服优先，其次管理员）
+            from mod.services.assignment_engine import assignment_engine
+            best_service = assignment_engine.select_service(queue.business_id)
+            if not best_service:
+                return {'code': -1, 'msg': '暂无可用客服'}
             
-            # 分配管理员
-            queue.service_id = best_admin.service_id
+            queue.service_id = best_service.service_id
             queue.state = 'chatting'
             queue.start_time = datetime.now()
             db.session.commit()
             
+            is_manager = best_service.level in ['manager', 'super_manager']
             return {
                 'code': 0,
-                'msg': '分配客服成功（管理员接入）',
+                'msg': '分配客服成功（管理员接入）' if is_manager else '分配客服成功',
                 'data': {
-                    'service_id': best_admin.service_id,
-                    'service_name': best_admin.nick_name
+                    'service_id': best_service.service_id,
+                    'service_name': best_service.nick_name
                 }
             }
             
@@ -408,6 +308,9 @@ class QueueService:
             queue.end_time = datetime.now()
             db.session.commit()
             
+            from mod.services.wait_estimator import wait_estimator
+            wait_estimator.observe_queue(queue)
+            
             return {'code': 0, 'msg': '会话已结束'}
             
         except Exception as e:
@@ -649,20 +552,29 @@ class QueueService:
             list: 等待队列列表
         """
         try:
-            # 按优先级降序，同优先级按创建时间升序
-            queues = Queue.query.filter_by(
-                business_id=business_id,
-                service_id=0,
-                state='normal'
-            ).order_by(
-                Queue.priority.desc() if hasattr(Queue, 'priority') else Queue.created_at.asc(),
-                Queue.created_at.asc()
-            ).limit(limit).all()
+            from mod.services.waiting_line import waiting_line
+            
+            # 按等待线顺序（优先级降序，同优先级按创建时间升序）
+            waiting = waiting_line.snapshot(business_id, limit=limit)
+            if not waiting:
+                return []
+            
+            queues = {
+                q.qid: q for q in Queue.query.filter(
+                    Queue.qid.in_([e['qid'] for e in waiting if e.get('qid')])
+                ).all()
+            }
+            visitors = {
+                v.visitor_id: v for v in Visitor.query.filter(
+                    Visitor.visitor_id.in_([e['visitor_id'] for e in waiting])
+                ).all()
+            }
             
             waiting_list = []
-            for queue in queues:
-                visitor = Visitor.query.filter_by(visitor_id=queue.visitor_id).first()
-                if visitor:
+            for entry in waiting:
+                queue = queues.get(entry.get('qid'))
+                visitor = visitors.get(entry['visitor_id'])
+                if queue and visitor:
                     wait_time = 0
                     if queue.created_at:
                         wait_time = int((datetime.now() - queue.created_at).total_seconds())
@@ -822,6 +734,9 @@ class QueueService:
             queue.updated_at = datetime.now()
             db.session.commit()
             
+            from mod.services.waiting_line import waiting_line
+            waiting_line.remove(queue.business_id, visitor_id)
+            
             return True
             
         except Exception as e:
@@ -887,6 +802,9 @@ class QueueService:
             queue.updated_at = datetime.now()
             db.session.commit()
             
+            from mod.services.wait_estimator import wait_estimator
+            wait_estimator.observe_queue(queue, queue.updated_at)
+            
             return True
             
         except Exception as e:
@@ -915,12 +833,8 @@ class QueueService:
             
             if not queue:
                 # 如果已在黑名单
-                blacklist_queue = Queue.query.filter_by(
-                    visitor_id=visitor_id,
-                    state='blacklist'
-                ).first()
-                
-                if blacklist_queue:
+                from mod.services.blacklist import blacklist
+                if blacklist.contains(visitor_id):
                     return True  # 已在黑名单
                 
                 # 获取访客信息创建新记录
@@ -944,6 +858,9 @@ class QueueService:
                 queue.updated_at = datetime.now()
             
             db.session.commit()
+            
+            from mod.services.blacklist import blacklist
+            blacklist.add(visitor_id)
             return True
             
         except Exception as e:
@@ -973,6 +890,15 @@ class QueueService:
             db.session.delete(blacklist_queue)
             db.session.commit()
             
+            # 同一访客可能有多条黑名单记录，全部移除后才移出黑名单集合
+            still_blacklisted = Queue.query.filter_by(
+                visitor_id=visitor_id,
+                state='blacklist'
+            ).first() is not None
+            if not still_blacklisted:
+                from mod.services.blacklist import blacklist
+                blacklist.remove(visitor_id)
+            
             return True
             
         except Exception as e:
@@ -992,34 +918,19 @@ class QueueService:
             dict: 位置信息
         """
         try:
-            # 查找当前访客的队列记录
-            current = Queue.query.filter_by(
-                visitor_id=visitor_id,
-                business_id=business_id,
-                state='normal'
-            ).first()
-            
-            if not current or current.service_id > 0:
-                position = 0
+            from mod.services.waiting_line import waiting_line
+            from mod.services.wait_estimator import wait_estimator
+            position = waiting_line.position(business_id, visitor_id)
+            entry = waiting_line.get(business_id, visitor_id) if position > 0 else None
+            if entry:
+                eta = wait_estimator.estimate(business_id, position, entry['priority'], entry['group_id'])
             else:
-                # 统计排在前面的人数（考虑优先级）
-                count = Queue.query.filter_by(
-                    business_id=business_id,
-                    service_id=0,
-                    state='normal'
-                ).filter(
-                    or_(
-                        Queue.priority > current.priority if hasattr(Queue, 'priority') else False,
-                        and_(
-                            Queue.priority == current.priority if hasattr(Queue, 'priority') else True,
-                            Queue.created_at < current.created_at
-                        )
-                    )
-                ).count()
-                position = count + 1
+                eta = {'p50': 0, 'p90': 0}
             
             return {
                 'position': position,
+                'estimated_wait_time': eta['p50'],
+                'estimated_wait_time_p90': eta['p90'],
                 'is_waiting': position > 0
             }
             
@@ -1038,6 +949,13 @@ class QueueService:
             dict: 黑名单状态信息
         """
         try:
+            # 绝大多数访客不在黑名单中，由黑名单集合直接判定，不查询数据库
+            from mod.services.blacklist import blacklist
+            if not blacklist.contains(visitor_id):
+                return {
+                    'is_blacklisted': False
+                }
+            
             blacklist_queue = Queue.query.filter_by(
                 visitor_id=visitor_id,
                 state='blacklist'
@@ -1,6 +1,10 @@
 """
 客服接待负载统一管理器
 所有客服接待计数的变更都必须通过这个管理器进行，确保数据一致性
+
+计数使用原子 SQL 更新（SET x = x + 1 / WHERE x < max），多个 worker 同时分配给同一客服不会丢失更新；
+分配前可用 reserve_workload 在不加行锁、不重新统计的情况下预占名额。
+计数与 Queue 表的偏差由后台任务定期一次性校准（GROUP BY 统计），客服上线时不再逐个重新统计。
 """
 from exts import db
 from mod.mysql.models import Service, Queue
@@ -27,7 +31,7 @@ class ServiceWorkloadManager:
     
     def increment_workload(self, service_id: int, reason: str = '') -> dict:
         """
-        增加客服接待数 +1
+        增加客服接待数 +1（原子更新，不检查上限；用于已经确定的分配，如专属客服）
         
         Args:
             service_id: 客服ID
@@ -36,80 +40,88 @@ class ServiceWorkloadManager:
         Returns:
             {'success': bool, 'current_count': int, 'message': str}
         """
-        try:
-            service = Service.query.get(service_id)
-            if not service:
-                logger.error(f"❌ 增加接待数失败：客服{service_id}不存在")
-                return {'success': False, 'message': '客服不存在'}
-            
-            # 管理员不计入接待数
-            if self._is_manager(service):
-                logger.info(f"⚪ 管理员 {service.nick_name} 不计入接待数")
-                return {'success': True, 'current_count': 0, 'message': '管理员不计入'}
-            
-            # 增加计数
-            old_count = service.current_chat_count or 0
-            service.current_chat_count = old_count + 1
-            service.last_assign_time = datetime.now()
-            db.session.commit()
-            
-            logger.info(f"✅ 客服 {service.nick_name} (ID:{service_id}) 接待数增加: {old_count} -> {service.current_chat_count} | 原因: {reason or '未指定'}")
-            
-            # 广播工作负载更新
-            self._broadcast_workload_update(service)
-            
-            return {
-                'success': True,
-                'current_count': service.current_chat_count,
-                'message': '接待数已增加'
-            }
+        return self._apply_delta(service_id, 1, reason, cap=False)
+    
+    def reserve_workload(self, service_id: int, reason: str = '') -> dict:
+        """
+        预占一个接待名额：仅当当前接待数未达到上限时 +1（原子条件更新）
+        
+        Args:
+            service_id: 客服ID
+            reason: 变更原因（用于日志）
             
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"❌ 增加接待数失败: {e}")
-            return {'success': False, 'message': str(e)}
+        Returns:
+            {'success': bool, 'current_count': int, 'message': str}，已满载时 success=False
+        """
+        return self._apply_delta(service_id, 1, reason, cap=True)
     
-    def decrement_workload(self, service_id: int, reason: str = '') -> dict:
+    def decrement_workload(self, service_id: int, reason: str = '', count: int = 1) -> dict:
         """
-        减少客服接待数 -1
+        减少客服接待数 -count（默认 -1，原子更新，不小于0）
         
         Args:
             service_id: 客服ID
             reason: 变更原因（用于日志）
+            count: 减少的数量（批量离线时合并为一次更新）
             
         Returns:
             {'success': bool, 'current_count': int, 'message': str}
         """
+        return self._apply_delta(service_id, -count, reason)
+    
+    def _apply_delta(self, service_id: int, delta: int, reason: str = '', cap: bool = False) -> dict:
+        """
+        原子地调整接待数
+        
+        Args:
+            delta: 变化量（正数增加，负数减少）
+            cap: 增加时是否要求未达到 max_concurrent_chats
+        """
+        action = '增加' if delta > 0 else '减少'
         try:
             service = Service.query.get(service_id)
             if not service:
-                logger.error(f"❌ 减少接待数失败：客服{service_id}不存在")
+                logger.error(f"❌ {action}接待数失败：客服{service_id}不存在")
                 return {'success': False, 'message': '客服不存在'}
             
             # 管理员不计入接待数
             if self._is_manager(service):
+                if delta > 0:
+                    service.last_assign_time = datetime.now()
+                    db.session.commit()
                 logger.info(f"⚪ 管理员 {service.nick_name} 不计入接待数")
                 return {'success': True, 'current_count': 0, 'message': '管理员不计入'}
             
-            # 减少计数（不能小于0）
-            old_count = service.current_chat_count or 0
-            service.current_chat_count = max(0, old_count - 1)
+            current = db.func.coalesce(Service.current_chat_count, 0)
+            query = Service.query.filter(Service.service_id == service_id)
+            if delta > 0:
+                if cap:
+                    query = query.filter(current < Service.max_concurrent_chats)
+                values = {'current_chat_count': current + delta, 'last_assign_time': datetime.now()}
+            else:
+                values = {'current_chat_count': db.case((current > -delta, current + delta), else_=0)}
+            updated = query.update(values, synchronize_session=False)
             db.session.commit()
             
-            logger.info(f"✅ 客服 {service.nick_name} (ID:{service_id}) 接待数减少: {old_count} -> {service.current_chat_count} | 原因: {reason or '未指定'}")
+            if not updated:
+                logger.info(f"⛔ 客服 {service.nick_name} (ID:{service_id}) 接待数已满，预占失败 | 原因: {reason or '未指定'}")
+                return {'success': False, 'current_count': service.current_chat_count or 0, 'message': '接待数已满'}
+            
+            # 提交后 service 已过期，读取时自动加载最新计数
+            logger.info(f"✅ 客服 {service.nick_name} (ID:{service_id}) 接待数{action}{abs(delta)}: 当前{service.current_chat_count} | 原因: {reason or '未指定'}")
             
-            # 广播工作负载更新
-            self._broadcast_workload_update(service)
+            # 同步负载表并广播工作负载更新
+            self._on_workload_changed(service)
             
             return {
                 'success': True,
                 'current_count': service.current_chat_count,
-                'message': '接待数已减少'
+                'message': f'接待数已{action}'
             }
             
         except Exception as e:
             db.session.rollback()
-            logger.error(f"❌ 减少接待数失败: {e}")
+            logger.error(f"❌ {action}接待数失败: {e}")
             return {'success': False, 'message': str(e)}
     
     def sync_workload(self, service_id: int, reason: str = '') -> dict:
@@ -151,8 +163,8 @@ class ServiceWorkloadManager:
             else:
                 logger.info(f"✅ 客服 {service.nick_name} (ID:{service_id}) 接待数准确: {actual_count}")
             
-            # 广播工作负载更新
-            self._broadcast_workload_update(service)
+            # 同步负载表并广播工作负载更新
+            self._on_workload_changed(service)
             
             return {
                 'success': True,
@@ -241,6 +253,149 @@ class ServiceWorkloadManager:
             logger.error(f"❌ 批量同步失败: {e}")
             return {'success': False, 'message': str(e)}
     
+    def reserve_workloads(self, counts: dict) -> dict:
+        """
+        批量预占接待名额：每个客服一次条件更新（x = x + n WHERE x + n <= max）
+        不提交，由调用方与其他更改在同一事务中提交，提交后调用 announce_workloads
+        
+        Args:
+            counts: {service_id: 预占数量}
+            
+        Returns:
+            {service_id: 是否预占成功}
+        """
+        if not counts:
+            return {}
+        levels = dict(
+            db.session.query(Service.service_id, Service.level).filter(
+                Service.service_id.in_(list(counts))
+            ).all()
+        )
+        
+        now = datetime.now()
+        current = db.func.coalesce(Service.current_chat_count, 0)
+        result = {}
+        for service_id, count in counts.items():
+            query = Service.query.filter(Service.service_id == service_id)
+            if levels.get(service_id) in ['super_manager', 'manager']:
+                # 管理员不计入接待数
+                values = {'last_assign_time': now}
+            else:
+                query = query.filter(current + count <= Service.max_concurrent_chats)
+                values = {'current_chat_count': current + count, 'last_assign_time': now}
+            result[service_id] = bool(query.update(values, synchronize_session=False))
+        return result
+    
+    def release_workloads(self, counts: dict):
+        """撤销 reserve_workloads 中多占的名额（不提交）"""
+        current = db.func.coalesce(Service.current_chat_count, 0)
+        for service_id, count in counts.items():
+            if count > 0:
+                Service.query.filter(
+                    Service.service_id == service_id,
+                    Service.level == 'service'
+                ).update({
+                    'current_chat_count': db.case((current > count, current - count), else_=0)
+                }, synchronize_session=False)
+    
+    def announce_workloads(self, service_ids):
+        """批量变更提交后：每个客服同步一次负载表并推送一次接待数"""
+        if not service_ids:
+            return
+        for service in Service.query.filter(Service.service_id.in_(list(service_ids))).all():
+            self._on_workload_changed(service)
+    
+    def announce_workload(self, service):
+        """
+        客服上线：同步分配引擎负载表并推送当前接待数
+        （计数的准确性由定期校准保证，上线时不再重新统计）
+        """
+        self._on_workload_changed(service)
+    
+    def reconcile_workloads(self) -> int:
+        """
+        按 Queue 表一次性校准所有客服的接待数（一次 GROUP BY + 仅更新有偏差的客服）
+        
+        更新带比较条件（current_chat_count 仍等于查询时的值）：查询之后提交的分配 / 释放
+        会让条件不成立，该客服本轮跳过，下个周期再校准，不会用旧快照覆盖新的接待数
+        
+        Returns:
+            修正的客服数
+        """
+        actual = dict(
+            db.session.query(Queue.service_id, db.func.count(Queue.qid)).filter(
+                Queue.state == 'normal',
+                Queue.service_id > 0
+            ).group_by(Queue.service_id).all()
+        )
+        
+        services = db.session.query(
+            Service.service_id, Service.level, Service.current_chat_count
+        ).all()
+        
+        fixed = []
+        for service_id, level, current in services:
+            expected = 0 if level in ['super_manager', 'manager'] else actual.get(service_id, 0)
+            if (current or 0) != expected:
+                fixed.append({'b_service_id': service_id, 'b_seen': current or 0, 'b_count': expected})
+        
+        if not fixed:
+            return 0
+        
+        table = Service.__table__
+        result = db.session.execute(
+            table.update().where(db.and_(
+                table.c.service_id == db.bindparam('b_service_id'),
+                db.func.coalesce(table.c.current_chat_count, 0) == db.bindparam('b_seen')
+            )).values(current_chat_count=db.bindparam('b_count')),
+            fixed
+        )
+        db.session.commit()
+        
+        updated = result.rowcount if result.rowcount is not None and result.rowcount >= 0 else len(fixed)
+        if updated:
+            from mod.services.assignment_engine import assignment_engine
+            assignment_engine.invalidate()
+        skipped = len(fixed) - updated
+        logger.info(f"🔄 接待数校准: 修正{updated}个客服" + (f"，{skipped}个期间有变更已跳过" if skipped > 0 else ""))
+        return updated
+    
+    def start(self, socketio, interval: int = 120):
+        """启动定期校准任务（集群内同一周期只有一个worker执行）"""
+        if getattr(self, '_started', False):
+            return
+        self._started = True
+        
+        def reconcile_loop():
+            import exts
+            from exts import app
+            while True:
+                socketio.sleep(interval)
+                try:
+                    redis = exts.redis_client
+                    if redis is not None and not redis.set('kefu:workload:reconcile_lock', 1,
+                                                           nx=True, ex=max(1, interval - 1)):
+                        continue
+                    with app.app_context():
+                        try:
+                            self.reconcile_workloads()
+                        finally:
+                            db.session.remove()
+                except Exception as e:
+                    logger.error(f"❌ 接待数校准失败: {e}")
+        
+        socketio.start_background_task(reconcile_loop)
+        logger.info(f"✅ 接待数校准任务已启动 (间隔{interval}s)")
+    
+    def _on_workload_changed(self, service):
+        """接待数变更后：同步分配引擎的负载表，并广播到客服端"""
+        try:
+            from mod.services.assignment_engine import assignment_engine
+            assignment_engine.update(service)
+        except Exception as e:
+            logger.error(f"⚠️ 更新分配引擎负载表失败: {e}")
+        self._broadcast_workload_update(service)
+    
     def _broadcast_workload_update(self, service):
         """
         广播工作负载更新到客服端（Socket.IO）
@@ -251,19 +406,16 @@ class ServiceWorkloadManager:
             if self._is_manager(service):
                 return
             
-            # 导入socketio和online_users（延迟导入避免循环依赖）
-            from socketio_events import socketio, online_users
-            
-            # 查找该客服的所有在线连接
-            for user_key, user_info in list(online_users.items()):
-                if user_info.get('type') == 'service' and user_info.get('service_id') == service.service_id:
-                    sids = user_info.get('sids', [])
-                    for sid in sids:
-                        socketio.emit('workload_update', {
-                            'current': service.current_chat_count,
-                            'max': service.max_concurrent_chats,
-                            'utilization': round(service.current_chat_count / service.max_concurrent_chats * 100, 0) if service.max_concurrent_chats > 0 else 0
-                        }, room=sid)
+            # 延迟导入避免循环依赖
+            from exts import socketio
+            from mod.services.socket_rooms import agent_room
+            
+            # 发送到该客服的个人房间（覆盖所有worker上的所有连接）
+            socketio.emit('workload_update', {
+                'current': service.current_chat_count,
+                'max': service.max_concurrent_chats,
+                'utilization': round(service.current_chat_count / service.max_concurrent_chats * 100, 0) if service.max_concurrent_chats > 0 else 0
+            }, room=agent_room(service.business_id, service.service_id))
                         
             logger.debug(f"📡 已广播工作负载更新: {service.nick_name} -> {service.current_chat_count}")
             
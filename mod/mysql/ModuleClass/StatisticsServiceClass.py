@@ -5,9 +5,11 @@
 负责各种统计数据的计算和查询
 """
 from datetime import datetime, timedelta
-from sqlalchemy import func, distinct, and_
+from sqlalchemy import case, func
 from exts import db, redis_client
-from mod.mysql.models import Visitor, Queue, Chat, Service, Comment
+from mod.mysql.models import Visitor, Queue, Chat, Service, Comment, StatsDaily
+from mod.services.stats_rollup import ALL_SERVICES
+from mod.services.unique_visitors import unique_visitors
 import json
 import log
 
@@ -39,6 +41,44 @@ class StatisticsService:
             # 普通客服：只看自己的
             return {'service_id': self.service_id}
     
+    def _rollup_service_id(self):
+        """汇总表中对应的 service_id（超级管理员看全商户汇总行）"""
+        return ALL_SERVICES if self.level == 'super_manager' else self.service_id
+    
+    @staticmethod
+    def _daily_sums(business_id, service_id=ALL_SERVICES, start=None, end=None,
+                    metrics=('messages', 'sessions', 'comments')):
+        """
+        汇总表中一段日期的指标之和
+        
+        Args:
+            start: 开始日期（含），None 表示不限
+            end: 结束日期（含），None 表示不限
+        
+        Returns:
+            dict: {指标: 和}
+        """
+        query = db.session.query(*[func.coalesce(func.sum(getattr(StatsDaily, m)), 0) for m in metrics]).filter(
+            StatsDaily.business_id == business_id,
+            StatsDaily.service_id == service_id
+        )
+        if start:
+            query = query.filter(StatsDaily.bucket >= start)
+        if end:
+            query = query.filter(StatsDaily.bucket <= end)
+        return {m: int(v) for m, v in zip(metrics, query.one())}
+    
+    @staticmethod
+    def _daily_rows(business_id, service_id, start, end):
+        """汇总表中一段日期的逐日数据 {日期: StatsDaily}"""
+        rows = StatsDaily.query.filter(
+            StatsDaily.business_id == business_id,
+            StatsDaily.service_id == service_id,
+            StatsDaily.bucket >= start,
+            StatsDaily.bucket <= end
+        ).all()
+        return {row.bucket: row for row in rows}
+    
     def get_realtime_stats(self):
         """获取实时统计数据（带缓存）"""
         
@@ -78,29 +118,9 @@ class StatisticsService:
             Service.user_name != 'robot'  # ⚡ 排除机器人
         ).count()
         
-        # 4. 接入总量（去重访客）- 多级优化策略
-        # 优先级1: 尝试使用汇总表（最快）
-        # 优先级2: 使用限制时间范围的查询（较快）
-        try:
-            # 尝试使用汇总表（如果存在）
-            from sqlalchemy import text
-            total_visitors = db.session.execute(text("""
-                SELECT SUM(visitor_count) 
-                FROM visitor_stats_cache 
-                WHERE business_id = :business_id 
-                AND stat_date >= DATE_SUB(CURDATE(), INTERVAL 30 DAY)
-            """), {"business_id": self.business_id}).scalar() or 0
-            logger.debug(f"✅ 使用汇总表查询访客数: {total_visitors}")
-        except:
-            # 汇总表不存在，使用优化后的查询
-            thirty_days_ago = int((datetime.now() - timedelta(days=30)).timestamp())
-            total_visitors = db.session.query(
-                func.count(distinct(Chat.visitor_id))
-            ).filter(
-                Chat.business_id == self.business_id,
-                Chat.timestamp >= thirty_days_ago  # ✅ 限制时间范围
-            ).scalar() or 0
-            logger.debug(f"✅ 使用时间范围查询访客数: {total_visitors}")
+        # 4. 接入总量（近30天去重访客数，由每日 HyperLogLog 合并得到）
+        thirty_days_ago = datetime.now().date() - timedelta(days=30)
+        total_visitors = unique_visitors.count(self.business_id, thirty_days_ago)
         
         result = {
             'waiting_count': waiting_count,
@@ -116,107 +136,87 @@ class StatisticsService:
         return result
     
     def get_today_stats(self):
-        """获取今日统计数据"""
-        
-        where = self._get_where_condition()
-        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_timestamp = int(today_start.timestamp())
-        now_timestamp = int(datetime.now().timestamp())
-        
-        # 1. 今日会话量
-        today_chats = Chat.query.filter(
-            and_(
-                Chat.timestamp > today_timestamp,
-                Chat.timestamp <= now_timestamp
-            )
-        ).filter_by(**where).count()
+        """
+        获取今日统计数据（来自统计汇总表）
         
-        # 2. 总会话量
-        total_chats = Chat.query.filter_by(**where).count()
+        total_chats / total_comments 是统计汇总表的累计值：首次部署后由后台任务自动回填全部历史，
+        回填完成前偏小；明细被60天清理任务删除后累计值不受影响
+        """
         
-        # 3. 今日评价数
-        today_comments = Comment.query.filter(
-            Comment.add_time >= today_start
-        ).filter_by(**where).count()
+        service_id = self._rollup_service_id()
+        today = datetime.now().date()
         
-        # 4. 总评价数
-        total_comments = Comment.query.filter_by(**where).count()
+        today_sums = self._daily_sums(self.business_id, service_id, start=today, end=today,
+                                      metrics=('messages', 'comments'))
+        total_sums = self._daily_sums(self.business_id, service_id, metrics=('messages', 'comments'))
         
         return {
-            'today_chats': today_chats,
-            'total_chats': total_chats,
-            'today_comments': today_comments,
-            'total_comments': total_comments
+            'today_chats': today_sums['messages'],
+            'total_chats': total_sums['messages'],
+            'today_comments': today_sums['comments'],
+            'total_comments': total_sums['comments']
         }
     
     def get_trend_stats(self, days=15):
-        """获取趋势统计数据（带缓存）"""
-        
-        # 尝试从缓存获取
-        cache_key = f"dashboard:{self.business_id}:trend:{days}d"
-        if redis_client:
-            cached = redis_client.get(cache_key)
-            if cached:
-                return json.loads(cached)
-        
-        where = self._get_where_condition()
-        result = []
+        """获取趋势统计数据（来自统计汇总表，一次查询）"""
         
-        # 生成日期列表
         today = datetime.now().date()
         dates = [(today - timedelta(days=i)) for i in range(days)]
         dates.reverse()  # 从旧到新
         
+        rows = self._daily_rows(self.business_id, self._rollup_service_id(), dates[0], today)
+        # 整个商户的每日接入量来自 HyperLogLog（含当天最新数据）；客服个人仍取汇总表
+        line = unique_visitors.count_days(self.business_id, dates) if self.level == 'super_manager' else {}
+        
+        result = []
         for date in dates:
-            day_start = int(datetime.combine(date, datetime.min.time()).timestamp())
-            day_end = day_start + 86400 - 1
-            
-            # 每日会话量
-            chat_count = Chat.query.filter(
-                and_(
-                    Chat.timestamp >= day_start,
-                    Chat.timestamp <= day_end
-                )
-            ).filter_by(**where).count()
-            
-            # 每日接入量（去重）
-            line_count = db.session.query(
-                func.count(distinct(Chat.visitor_id))
-            ).filter(
-                and_(
-                    Chat.timestamp >= day_start,
-                    Chat.timestamp <= day_end
-                )
-            ).filter_by(**where).scalar() or 0
-            
-            # 每日评价数
-            day_start_dt = datetime.fromtimestamp(day_start)
-            day_end_dt = datetime.fromtimestamp(day_end)
-            comment_count = Comment.query.filter(
-                and_(
-                    Comment.add_time >= day_start_dt,
-                    Comment.add_time <= day_end_dt
-                )
-            ).filter_by(**where).count()
-            
+            row = rows.get(date)
             result.append({
                 'date': date.strftime('%m-%d'),
-                'chat': chat_count,
-                'line': line_count,
-                'comment': comment_count
+                'chat': row.messages if row else 0,
+                'line': line.get(date, row.visitors if row else 0),
+                'comment': row.comments if row else 0
             })
         
-        # 缓存1小时
-        if redis_client:
-            redis_client.setex(cache_key, 3600, json.dumps(result))
-        
         return result
     
+    @staticmethod
+    def _satisfaction(business_id, start_date):
+        """
+        一段时间内评价的平均分和满意率（单条评价平均分>=4视为满意）
+        
+        Returns:
+            (平均分, 满意率%)
+        """
+        from mod.mysql.models import CommentDetail
+        
+        per_comment = db.session.query(
+            func.avg(CommentDetail.score).label('score')
+        ).join(
+            Comment, Comment.id == CommentDetail.comment_id
+        ).filter(
+            Comment.business_id == business_id,
+            Comment.add_time >= start_date
+        ).group_by(CommentDetail.comment_id).subquery()
+        
+        avg_score, satisfied, rated = db.session.query(
+            func.avg(per_comment.c.score),
+            func.sum(case((per_comment.c.score >= 4, 1), else_=0)),
+            func.count()
+        ).select_from(per_comment).one()
+        
+        if not rated:
+            return 0, 0
+        return float(avg_score), int(satisfied) / rated * 100
+    
     @staticmethod
     def get_overview_statistics(business_id, days=7):
         """
         获取概览统计数据
         
+        访客、会话、消息的 total 是统计汇总表的累计值（首次部署后由后台任务自动回填全部历史，
+        回填完成前偏小），new / period 是最近 days 天
+        
         Args:
             business_id: 商户ID
             days: 统计天数
@@ -227,36 +227,20 @@ class StatisticsService:
         try:
             start_date = datetime.now() - timedelta(days=days)
             
-            # 访客数统计
-            total_visitors = Visitor.query.filter_by(business_id=business_id).count()
-            new_visitors = Visitor.query.filter(
-                Visitor.business_id == business_id,
-                Visitor.created_at >= start_date
-            ).count()
-            
-            # 会话数统计
-            total_sessions = Queue.query.filter_by(business_id=business_id).count()
-            period_sessions = Queue.query.filter(
-                Queue.business_id == business_id,
-                Queue.created_at >= start_date
-            ).count()
-            completed_sessions = Queue.query.filter(
-                Queue.business_id == business_id,
-                Queue.state == 'complete',
-                Queue.updated_at >= start_date
-            ).count()
-            
-            # 消息数统计
-            total_messages = db.session.query(func.count(Chat.cid)).join(
-                Visitor, Chat.visitor_id == Visitor.visitor_id
-            ).filter(Visitor.business_id == business_id).scalar()
-            
-            period_messages = db.session.query(func.count(Chat.cid)).join(
-                Visitor, Chat.visitor_id == Visitor.visitor_id
-            ).filter(
-                Visitor.business_id == business_id,
-                Chat.created_at >= start_date
-            ).scalar()
+            # 访客、会话、消息、响应时间来自统计汇总表（全商户汇总行）
+            metrics = ('new_visitors', 'sessions', 'completed_sessions', 'messages',
+                       'response_time_sum', 'response_count')
+            totals = StatisticsService._daily_sums(business_id, ALL_SERVICES, metrics=metrics)
+            period = StatisticsService._daily_sums(business_id, ALL_SERVICES, start=start_date.date(),
+                                                   metrics=metrics)
+            
+            total_visitors = totals['new_visitors']
+            new_visitors = period['new_visitors']
+            total_sessions = totals['sessions']
+            period_sessions = period['sessions']
+            completed_sessions = period['completed_sessions']
+            total_messages = totals['messages']
+            period_messages = period['messages']
             
             # 客服统计
             total_services = Service.query.filter_by(business_id=business_id).count()
@@ -265,34 +249,12 @@ class StatisticsService:
                 state='online'
             ).count()
             
-            # 平均响应时间（简化计算）
-            avg_response_time = 0  # TODO: 需要更复杂的逻辑计算
-            
-            # 满意度统计
-            from mod.mysql.models import CommentDetail
-            comments = Comment.query.filter(
-                Comment.business_id == business_id,
-                Comment.add_time >= start_date
-            ).all()
+            # 平均首次响应时间（秒）
+            avg_response_time = round(period['response_time_sum'] / period['response_count'], 1) \
+                if period['response_count'] else 0
             
-            if comments:
-                # 计算平均评分（从评价详情中获取）
-                scores = []
-                for comment in comments:
-                    details = CommentDetail.query.filter_by(comment_id=comment.id).all()
-                    if details:
-                        avg = sum([d.score for d in details]) / len(details)
-                        scores.append(avg)
-                
-                if scores:
-                    avg_score = sum(scores) / len(scores)
-                    satisfaction_rate = len([s for s in scores if s >= 4]) / len(scores) * 100
-                else:
-                    avg_score = 0
-                    satisfaction_rate = 0
-            else:
-                avg_score = 0
-                satisfaction_rate = 0
+            # 满意度统计（每条评价先取各评价项的平均分，再汇总，一次查询）
+            avg_score, satisfaction_rate = StatisticsService._satisfaction(business_id, start_date)
             
             return {
                 'code': 0,
@@ -338,40 +300,19 @@ class StatisticsService:
             dict: 趋势数据
         """
         try:
+            today = datetime.now().date()
+            start = today - timedelta(days=days - 1)
+            rows = StatisticsService._daily_rows(business_id, ALL_SERVICES, start, today)
+            
             trend_data = []
             for i in range(days):
-                date = datetime.now() - timedelta(days=days-i-1)
-                start = date.replace(hour=0, minute=0, second=0, microsecond=0)
-                end = start + timedelta(days=1)
-                
-                # 当天会话数
-                sessions = Queue.query.filter(
-                    Queue.business_id == business_id,
-                    Queue.created_at >= start,
-                    Queue.created_at < end
-                ).count()
-                
-                # 当天访客数
-                visitors = Visitor.query.filter(
-                    Visitor.business_id == business_id,
-                    Visitor.created_at >= start,
-                    Visitor.created_at < end
-                ).count()
-                
-                # 当天消息数
-                messages = db.session.query(func.count(Chat.cid)).join(
-                    Visitor, Chat.visitor_id == Visitor.visitor_id
-                ).filter(
-                    Visitor.business_id == business_id,
-                    Chat.created_at >= start,
-                    Chat.created_at < end
-                ).scalar()
-                
+                date = start + timedelta(days=i)
+                row = rows.get(date)
                 trend_data.append({
-                    'date': start.strftime('%Y-%m-%d'),
-                    'sessions': sessions,
-                    'visitors': visitors,
-                    'messages': messages
+                    'date': date.strftime('%Y-%m-%d'),
+                    'sessions': row.sessions if row else 0,
+                    'visitors': row.new_visitors if row else 0,
+                    'messages': row.messages if row else 0
                 })
             
             return {
@@ -396,46 +337,46 @@ class StatisticsService:
         """
         try:
             start_date = datetime.now() - timedelta(days=days)
-            services = Service.query.filter_by(business_id=business_id).all()
+            services = db.session.query(Service.service_id, Service.nick_name).filter(
+                Service.business_id == business_id
+            ).all()
             
-            performance_list = []
-            for service in services:
-                # 会话数
-                session_count = Queue.query.filter(
-                    Queue.service_id == service.service_id,
-                    Queue.created_at >= start_date
-                ).count()
-                
-                # 消息数
-                message_count = Chat.query.filter(
-                    Chat.service_id == service.service_id,
-                    Chat.created_at >= start_date
-                ).count()
-                
-                # 评价数和平均分
-                from mod.mysql.models import CommentDetail
-                comments = Comment.query.filter(
-                    Comment.service_id == service.service_id,
+            # 会话数、消息数、评价数/平均分各一次 GROUP BY service_id，查询次数与客服数无关
+            session_counts = dict(db.session.query(Queue.service_id, func.count(Queue.qid)).filter(
+                Queue.business_id == business_id,
+                Queue.created_at >= start_date
+            ).group_by(Queue.service_id).all())
+            
+            message_counts = dict(db.session.query(Chat.service_id, func.count(Chat.cid)).filter(
+                Chat.business_id == business_id,
+                Chat.created_at >= start_date
+            ).group_by(Chat.service_id).all())
+            
+            from mod.mysql.models import CommentDetail
+            comment_stats = {
+                service_id: (comment_count, avg_score)
+                for service_id, comment_count, avg_score in db.session.query(
+                    Comment.service_id,
+                    func.count(func.distinct(Comment.id)),
+                    func.avg(CommentDetail.score)   # 所有评价项的平均分，没有评价项的评价不参与
+                ).outerjoin(
+                    CommentDetail, CommentDetail.comment_id == Comment.id
+                ).filter(
+                    Comment.business_id == business_id,
                     Comment.add_time >= start_date
-                ).all()
-                
-                # 计算平均分（从评价详情获取）
-                comment_ids = [c.id for c in comments]
-                if comment_ids:
-                    details = CommentDetail.query.filter(
-                        CommentDetail.comment_id.in_(comment_ids)
-                    ).all()
-                    avg_score = sum([d.score for d in details]) / len(details) if details else 0
-                else:
-                    avg_score = 0
-                
+                ).group_by(Comment.service_id).all()
+            }
+            
+            performance_list = []
+            for service_id, nick_name in services:
+                comment_count, avg_score = comment_stats.get(service_id, (0, None))
                 performance_list.append({
-                    'service_id': service.service_id,
-                    'service_name': service.nick_name,
-                    'session_count': session_count,
-                    'message_count': message_count,
-                    'comment_count': len(comments),
-                    'avg_score': round(avg_score, 2)
+                    'service_id': service_id,
+                    'service_name': nick_name,
+                    'session_count': session_counts.get(service_id, 0),
+                    'message_count': message_counts.get(service_id, 0),
+                    'comment_count': comment_count,
+                    'avg_score': round(float(avg_score or 0), 2)
                 })
             
             # 按会话数排序
@@ -457,32 +398,15 @@ class StatisticsService:
             
             start_date = datetime.now() - timedelta(days=days)
             
-            # 获取评价ID列表
-            comment_ids = db.session.query(Comment.id).filter(
-                Comment.business_id == business_id,
-                Comment.add_time >= start_date
-            ).all()
-            
-            comment_ids = [c[0] for c in comment_ids]
-            
-            if not comment_ids:
-                return {
-                    'code': 0,
-                    'data': {
-                        'total_count': 0,
-                        'avg_score': 0,
-                        'score_distribution': {
-                            '5': 0, '4': 0, '3': 0, '2': 0, '1': 0
-                        }
-                    }
-                }
-            
-            # 统计评分分布
+            # 统计评分分布（关联评价表筛选，一次查询）
             distribution = db.session.query(
                 CommentDetail.score,
                 func.count(CommentDetail.id)
+            ).join(
+                Comment, Comment.id == CommentDetail.comment_id
             ).filter(
-                CommentDetail.comment_id.in_(comment_ids)
+                Comment.business_id == business_id,
+                Comment.add_time >= start_date
             ).group_by(CommentDetail.score).all()
             
             # 转换为字典
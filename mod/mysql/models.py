@@ -352,6 +352,10 @@ class Chat(db.Model):
         db.Index('idx_service_id', 'service_id'),
         db.Index('idx_business_id', 'business_id'),
         db.Index('idx_timestamp', 'timestamp'),
+        db.Index('idx_chat_visitor_direction_state', 'visitor_id', 'direction', 'state'),
+        db.Index('idx_chat_visitor_timestamp', 'visitor_id', 'timestamp'),
+        db.Index('idx_chat_business_created', 'business_id', 'created_at'),
+        db.Index('idx_chat_visitor_created', 'visitor_id', 'created_at'),
     )
     
     def __repr__(self):
@@ -411,6 +415,9 @@ class Queue(db.Model):
         db.Index('idx_business_id', 'business_id'),
         db.Index('idx_state', 'state'),
         db.Index('idx_priority', 'priority'),
+        db.Index('idx_queue_visitor_business_state', 'visitor_id', 'business_id', 'state', 'created_at'),
+        db.Index('idx_queue_business_state_service', 'business_id', 'state', 'service_id', 'last_message_time'),
+        db.Index('idx_queue_service_state', 'service_id', 'state', 'updated_at'),
     )
     
     def __repr__(self):
@@ -798,6 +805,12 @@ class ServiceRating(db.Model):
     # 时间
     created_at = db.Column(db.DateTime, default=datetime.now, comment='评价时间')
     
+    # 索引（评价统计的聚合查询只扫描索引）
+    __table_args__ = (
+        db.Index('idx_rating_service_created', 'service_id', 'created_at', 'rating'),
+        db.Index('idx_rating_created_service', 'created_at', 'service_id', 'rating'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -811,4 +824,60 @@ class ServiceRating(db.Model):
             'visitor_name': self.visitor_name,
             'visitor_ip': self.visitor_ip,
             'created_at': self.created_at.isoformat() if self.created_at else None
-        }
\ No newline at end of file
+        }
+
+# ========== 统计汇总模型 ==========
+class StatsHourly(db.Model):
+    """
+    按小时汇总的统计数据（由 mod/services/stats_rollup 增量维护）
+    service_id = 0 的行是整个商户的汇总（去重访客数不能由各客服相加得到）
+    """
+    __tablename__ = 'stats_hourly'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    business_id = db.Column(db.Integer, nullable=False, comment='商户ID')
+    service_id = db.Column(db.Integer, nullable=False, default=0, comment='客服ID（0表示全商户）')
+    bucket = db.Column(db.DateTime, nullable=False, comment='小时（整点）')
+    
+    messages = db.Column(db.Integer, nullable=False, default=0, comment='消息数')
+    sessions = db.Column(db.Integer, nullable=False, default=0, comment='新会话数')
+    completed_sessions = db.Column(db.Integer, nullable=False, default=0, comment='结束会话数')
+    visitors = db.Column(db.Integer, nullable=False, default=0, comment='去重访客数（有消息的访客）')
+    new_visitors = db.Column(db.Integer, nullable=False, default=0, comment='新访客数（仅全商户行）')
+    comments = db.Column(db.Integer, nullable=False, default=0, comment='评价数')
+    response_time_sum = db.Column(db.BigInteger, nullable=False, default=0, comment='首次响应时间总和（秒）')
+    response_count = db.Column(db.Integer, nullable=False, default=0, comment='有首次响应的会话数')
+    
+    updated_at = db.Column(db.DateTime, default=get_local_time, onupdate=get_local_time, comment='更新时间')
+    
+    __table_args__ = (
+        db.UniqueConstraint('business_id', 'service_id', 'bucket', name='uix_stats_hourly_bucket'),
+    )
+
+
+class StatsDaily(db.Model):
+    """
+    按天汇总的统计数据（可累加的指标由 stats_hourly 相加，去重访客数按天单独统计）
+    service_id = 0 的行是整个商户的汇总
+    """
+    __tablename__ = 'stats_daily'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    business_id = db.Column(db.Integer, nullable=False, comment='商户ID')
+    service_id = db.Column(db.Integer, nullable=False, default=0, comment='客服ID（0表示全商户）')
+    bucket = db.Column(db.Date, nullable=False, comment='日期')
+    
+    messages = db.Column(db.Integer, nullable=False, default=0, comment='消息数')
+    sessions = db.Column(db.Integer, nullable=False, default=0, comment='新会话数')
+    completed_sessions = db.Column(db.Integer, nullable=False, default=0, comment='结束会话数')
+    visitors = db.Column(db.Integer, nullable=False, default=0, comment='去重访客数（有消息的访客）')
+    new_visitors = db.Column(db.Integer, nullable=False, default=0, comment='新访客数（仅全商户行）')
+    comments = db.Column(db.Integer, nullable=False, default=0, comment='评价数')
+    response_time_sum = db.Column(db.BigInteger, nullable=False, default=0, comment='首次响应时间总和（秒）')
+    response_count = db.Column(db.Integer, nullable=False, default=0, comment='有首次响应的会话数')
+    
+    updated_at = db.Column(db.DateTime, default=get_local_time, onupdate=get_local_time, comment='更新时间')
+    
+    __table_args__ = (
+        db.UniqueConstraint('business_id', 'service_id', 'bucket', name='uix_stats_daily_bucket'),
+    )
@@ -0,0 +1,306 @@
+"""
+客服分配引擎
+原来每次分配都要查询所有在线客服，再对每个客服执行一次 Queue...count() 统计负载（普通客服、管理员各一轮），
+AssignmentService._find_available_service / app QueueService._find_best_service / QueueService.auto_assign_service
+三处各自实现了一遍相似的规则。
+
+这里统一为一个分配引擎：
+- 进程内维护每个商户的负载表：service_id -> 当前接待数、最大接待数、最后分配时间、级别、分组
+- 负载表由 ServiceWorkloadManager 的计数变更和客服上下线事件增量更新，并按 TTL 从数据库整表刷新
+  （一次查询，用于同步其他 worker 上发生的变更）
+- 每个 (级别, 分组) 一个最小堆，选择客服 O(log n)；堆中过期条目按版本号惰性丢弃
+- 选择本身不写数据库，只在负载表中预占一个名额；由调用方持久化最终的分配结果
+
+分配顺序与原规则一致：指定分组的普通客服 -> 所有普通客服 -> 指定分组的管理员 -> 所有管理员
+
+分配策略（ASSIGNMENT_STRATEGY）：
+- least_loaded  当前接待数最少优先，相同时最久未分配优先
+- round_robin   最久未分配优先（轮询）
+- weighted      接待率（当前接待数 / 最大接待数）最低优先，按接待能力加权
+"""
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import log
+
+logger = log.get_logger(__name__)
+
+
+MANAGER_LEVELS = ('super_manager', 'manager')
+STRATEGIES = ('least_loaded', 'round_robin', 'weighted')
+
+
+class AgentLoad:
+    """负载表中的一个客服"""
+
+    __slots__ = ('service_id', 'level', 'group_id', 'current', 'max_chats', 'last_assign', 'version')
+
+    def __init__(self, service_id: int, level: str, group_id, current: int, max_chats: int,
+                 last_assign: float, version: int = 0):
+        self.service_id = service_id
+        self.level = level
+        self.group_id = str(group_id or '0')
+        self.current = current
+        self.max_chats = max_chats
+        self.last_assign = last_assign
+        self.version = version
+
+    @property
+    def tier(self) -> int:
+        """0=普通客服 1=管理员"""
+        return 1 if self.level in MANAGER_LEVELS else 0
+
+    @property
+    def available(self) -> bool:
+        return self.current < self.max_chats
+
+    def to_dict(self) -> Dict:
+        return {
+            'service_id': self.service_id,
+            'level': self.level,
+            'group_id': self.group_id,
+            'current': self.current,
+            'max': self.max_chats,
+            'last_assign': self.last_assign
+        }
+
+
+class _BusinessTable:
+    """单个商户的负载表和选择堆"""
+
+    def __init__(self):
+        self.agents: Dict[int, AgentLoad] = {}
+        self.heaps: Dict[Tuple, List] = {}   # (tier, group_id或None) -> [(排序键, service_id, version)]
+        self.loaded_at = 0.0
+
+
+class AssignmentEngine:
+    """
+    客服分配引擎
+
+    使用方式：
+        service_id = assignment_engine.select(business_id, group_id)
+        service = assignment_engine.select_service(business_id)   # 返回 Service 对象
+    """
+
+    def __init__(self, strategy: str = 'least_loaded', ttl: float = 10.0):
+        """
+        Args:
+            strategy: 分配策略 least_loaded / round_robin / weighted
+            ttl: 负载表从数据库整表刷新的间隔（秒）
+        """
+        self.strategy = strategy
+        self.ttl = ttl
+        self._tables: Dict[int, _BusinessTable] = {}
+        self._versions = itertools.count(1)  # 全局递增，客服下线再上线后旧条目也不会被误认
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        """从Flask配置读取分配策略和刷新间隔"""
+        strategy = app.config.get('ASSIGNMENT_STRATEGY', self.strategy)
+        if strategy not in STRATEGIES:
+            logger.warning(f"⚠️ 未知的分配策略: {strategy}，使用 least_loaded")
+            strategy = 'least_loaded'
+        self.strategy = strategy
+        self.ttl = app.config.get('ASSIGNMENT_LOAD_TTL', self.ttl)
+        with self._lock:
+            self._tables.clear()
+
+    # ========== 负载表 ==========
+
+    def _sort_key(self, agent: AgentLoad) -> Tuple:
+        if self.strategy == 'round_robin':
+            return agent.last_assign, agent.service_id
+        if self.strategy == 'weighted':
+            return agent.current / max(agent.max_chats, 1), agent.last_assign, agent.service_id
+        return agent.current, agent.last_assign, agent.service_id
+
+    def _push(self, table: _BusinessTable, agent: AgentLoad):
+        """把客服（新版本）放入所属级别的"全部"堆和分组堆"""
+        agent.version = next(self._versions)
+        item = (self._sort_key(agent), agent.service_id, agent.version)
+        for group in (None, agent.group_id):
+            heap = table.heaps.setdefault((agent.tier, group), [])
+            heapq.heappush(heap, item)
+            # 过期条目过多时重建，避免堆无限增长
+            if len(heap) > 4 * len(table.agents) + 16:
+                self._compact(table, (agent.tier, group))
+
+    def _compact(self, table: _BusinessTable, heap_key: Tuple):
+        tier, group = heap_key
+        heap = [
+            (self._sort_key(a), a.service_id, a.version) for a in table.agents.values()
+            if a.tier == tier and (group is None or a.group_id == group)
+        ]
+        heapq.heapify(heap)
+        table.heaps[heap_key] = heap
+
+    def _load(self, business_id) -> _BusinessTable:
+        """从数据库加载商户的在线客服（一次查询）"""
+        from exts import db
+        from mod.mysql.models import Service
+
+        rows = db.session.query(
+            Service.service_id, Service.level, Service.group_id,
+            Service.current_chat_count, Service.max_concurrent_chats, Service.last_assign_time
+        ).filter(
+            Service.business_id == business_id,
+            Service.state == 'online',
+            Service.user_name != 'robot'  # ⚡ 排除机器人账号
+        ).all()
+
+        table = _BusinessTable()
+        for service_id, level, group_id, current, max_chats, last_assign in rows:
+            agent = AgentLoad(
+                service_id, level, group_id,
+                current or 0, max_chats if max_chats is not None else 5,
+                last_assign.timestamp() if last_assign else 0.0
+            )
+            table.agents[service_id] = agent
+            self._push(table, agent)
+        table.loaded_at = time.time()
+        return table
+
+    def _table(self, business_id) -> _BusinessTable:
+        business_id = int(business_id)
+        table = self._tables.get(business_id)
+        if table is None or time.time() - table.loaded_at > self.ttl:
+            table = self._load(business_id)
+            self._tables[business_id] = table
+        return table
+
+    def update(self, service):
+        """
+        客服的接待数 / 在线状态 / 级别变化后更新负载表（由 ServiceWorkloadManager 和上下线事件调用）
+
+        Args:
+            service: Service 对象
+        """
+        if service is None:
+            return
+        with self._lock:
+            table = self._tables.get(int(service.business_id))
+            if table is None:
+                return  # 该商户尚未加载，首次选择时会从数据库加载
+
+            if service.state != 'online' or service.user_name == 'robot':
+                table.agents.pop(service.service_id, None)
+                return
+
+            agent = table.agents.get(service.service_id)
+            last_assign = service.last_assign_time.timestamp() if service.last_assign_time else 0.0
+            if agent is None:
+                agent = AgentLoad(service.service_id, service.level, service.group_id, 0, 0, last_assign)
+                table.agents[service.service_id] = agent
+            agent.level = service.level
+            agent.group_id = str(service.group_id or '0')
+            agent.current = service.current_chat_count or 0
+            agent.max_chats = service.max_concurrent_chats if service.max_concurrent_chats is not None else 5
+            agent.last_assign = max(agent.last_assign, last_assign)
+            self._push(table, agent)
+
+    def invalidate(self, business_id=None):
+        """丢弃负载表，下次选择时从数据库重新加载"""
+        with self._lock:
+            if business_id is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(int(business_id), None)
+
+    # ========== 选择 ==========
+
+    def _peek(self, table: _BusinessTable, tier: int, group) -> Optional[AgentLoad]:
+        """取堆顶的有效客服；过期条目和已满载的客服直接出堆（计数变化时会重新入堆）"""
+        heap = table.heaps.get((tier, group))
+        while heap:
+            _, service_id, version = heap[0]
+            agent = table.agents.get(service_id)
+            if agent is not None and agent.version == version and agent.available:
+                return agent
+            heapq.heappop(heap)
+        return None
+
+    def select(self, business_id, group_id=0) -> Optional[int]:
+        """
+        选择一个客服并在负载表中预占名额
+
+        Args:
+            business_id: 商户ID
+            group_id: 客服分组ID（0 表示不限分组）
+
+        Returns:
+            客服ID，所有客服和管理员都不可用时返回None
+        """
+        group = str(group_id) if group_id and str(group_id) != '0' else None
+        candidates = [group, None] if group else [None]
+
+        with self._lock:
+            table = self._table(business_id)
+            for tier in (0, 1):
+                for heap_group in candidates:
+                    agent = self._peek(table, tier, heap_group)
+                    if agent is None:
+                        continue
+                    # 预占：普通客服接待数+1（管理员不计入接待数），更新最后分配时间
+                    if tier == 0:
+                        agent.current += 1
+                    agent.last_assign = time.time()
+                    self._push(table, agent)
+                    return agent.service_id
+        return None
+
+    def plan(self, business_id, group_ids: List) -> List[Optional[int]]:
+        """
+        为一批等待中的访客计算分配方案（先从数据库刷新负载表，之后全部在内存中完成）
+
+        Args:
+            business_id: 商户ID
+            group_ids: 按排队顺序排列的访客分组ID
+
+        Returns:
+            与 group_ids 一一对应的客服ID；客服名额用完后其余为None
+        """
+        self.invalidate(business_id)
+        result = []
+        for group_id in group_ids:
+            service_id = self.select(business_id, group_id)
+            if service_id is None:
+                break
+            result.append(service_id)
+        return result + [None] * (len(group_ids) - len(result))
+
+    def select_service(self, business_id, group_id=0):
+        """
+        选择一个客服，返回 Service 对象（仅按主键加载选中的客服）
+
+        Returns:
+            Service or None
+        """
+        from mod.mysql.models import Service
+
+        service_id = self.select(business_id, group_id)
+        if service_id is None:
+            return None
+        service = Service.query.get(service_id)
+        if service is None or service.state != 'online':
+            # 负载表已过期，重新加载后再选一次
+            self.invalidate(business_id)
+            service_id = self.select(business_id, group_id)
+            service = Service.query.get(service_id) if service_id else None
+        return service
+
+    def get_stats(self, business_id) -> Dict:
+        """商户负载表快照"""
+        with self._lock:
+            table = self._table(business_id)
+            return {
+                'strategy': self.strategy,
+                'loaded_at': table.loaded_at,
+                'agents': [a.to_dict() for a in table.agents.values()]
+            }
+
+
+# 全局单例
+assignment_engine = AssignmentEngine()
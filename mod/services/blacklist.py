@@ -0,0 +1,330 @@
+"""
+访客黑名单
+黑名单以 Queue.state='blacklist' 的记录保存，原来访客每次加入、每条消息都要执行一次
+Queue.query.filter_by(visitor_id=..., state='blacklist').first()，而绝大多数访客并不在黑名单中。
+
+这里在内存中维护黑名单：
+- 进程内布隆过滤器：判定"不在黑名单"无需任何IO（绝大多数请求到此为止）
+- 布隆过滤器判定"可能在"时，再查 Redis 集合确认（无 Redis 时查进程内集合）
+- 加入 / 移除黑名单时同步更新集合并递增版本号；其他 worker 的后台任务发现版本变化后重新加载
+  （不到 BLACKLIST_SYNC_INTERVAL 秒内生效，本 worker 立即生效）
+- 布隆过滤器不支持删除，移除黑名单后由集合确认兜底，重新加载时清除
+- 启动时、以及之后每 BLACKLIST_REBUILD_INTERVAL 秒从数据库全量重建一次（整个集群只由一个 worker 执行），
+  过期数据清理、手工改库、数据恢复等绕过 add/remove 的变更也能收敛
+- 重建在查询数据库前记下版本号，替换集合时（WATCH 版本号）发现期间有 add/remove 就重新查询，
+  不会用旧快照覆盖刚提交的变更；多次重试仍有变更时放弃本次重建，保留现有集合
+
+存储结构（Redis）：
+- kefu:blacklist                  Set     黑名单访客ID
+- kefu:blacklist:version          String  版本号，每次变更+1
+- kefu:blacklist:rebuild_lock     String  重建互斥锁
+- kefu:blacklist:rebuilt          String  本周期已有 worker 重建过（过期时间 = 重建间隔）
+"""
+import hashlib
+import math
+import threading
+import time
+from typing import Optional, Set
+import log
+
+logger = log.get_logger(__name__)
+
+
+class BloomFilter:
+    """布隆过滤器（双重哈希）"""
+
+    def __init__(self, capacity: int = 1024, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class Blacklist:
+    """
+    访客黑名单
+
+    使用方式：
+        if blacklist.contains(visitor_id): ...
+        blacklist.add(visitor_id) / blacklist.remove(visitor_id)   # 数据库提交后调用
+    """
+
+    KEY = 'kefu:blacklist'
+    VERSION_KEY = 'kefu:blacklist:version'
+    LOCK_KEY = 'kefu:blacklist:rebuild_lock'
+    REBUILT_KEY = 'kefu:blacklist:rebuilt'
+    ERROR_RATE = 0.01
+    REBUILD_ATTEMPTS = 3
+
+    def __init__(self, sync_interval: float = 2.0, rebuild_interval: float = 3600):
+        """
+        Args:
+            sync_interval: 检查其他 worker 变更的间隔（秒）
+            rebuild_interval: 从数据库全量重建的间隔（秒）
+        """
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self._bloom = BloomFilter()
+        self._members: Set[str] = set()   # 无 Redis 时的权威集合
+        self._version = None
+        self._changes = 0                 # 本进程 add/remove 次数（无 Redis 时判断重建期间是否有变更）
+        self._last_rebuild = None         # 无 Redis 时本进程上次重建的时间
+        self._loaded = False
+        self._started = False
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """从Flask配置读取同步间隔和重建间隔"""
+        self.sync_interval = app.config.get('BLACKLIST_SYNC_INTERVAL', self.sync_interval)
+        self.rebuild_interval = app.config.get('BLACKLIST_REBUILD_INTERVAL', self.rebuild_interval)
+
+    @staticmethod
+    def _redis():
+        import exts
+        return exts.redis_client
+
+    # ========== 加载 ==========
+
+    @staticmethod
+    def _query_members() -> Set[str]:
+        from exts import db
+        from mod.mysql.models import Queue
+        rows = db.session.query(Queue.visitor_id).filter(Queue.state == 'blacklist').distinct().all()
+        return {visitor_id for (visitor_id,) in rows}
+
+    def _install(self, members: Set[str], version, expected_changes: Optional[int] = None) -> bool:
+        """
+        替换进程内的布隆过滤器和集合
+
+        Args:
+            expected_changes: 查询前的本进程变更次数，之后又有 add/remove 时不替换（返回 False）
+        """
+        bloom = BloomFilter(capacity=max(1024, len(members) * 2), error_rate=self.ERROR_RATE)
+        for visitor_id in members:
+            bloom.add(visitor_id)
+        with self._lock:
+            if expected_changes is not None and self._changes != expected_changes:
+                return False
+            self._bloom = bloom
+            self._members = members
+            self._version = version
+            self._loaded = True
+        return True
+
+    def rebuild(self) -> int:
+        """
+        从数据库重建黑名单（启动时、定期、清理任务删除数据后），需要应用上下文
+        其他 worker 正在重建时只从 Redis 重新加载
+
+        Returns:
+            黑名单访客数
+        """
+        redis = self._redis()
+        if redis is None:
+            return self._rebuild_local()
+
+        try:
+            if not redis.set(self.LOCK_KEY, 1, nx=True, ex=60):
+                self._sync()
+                return len(self._members)
+        except Exception as e:
+            logger.warning(f"获取黑名单重建锁失败: {e}")
+            return self._rebuild_local()
+
+        try:
+            return self._rebuild_redis(redis)
+        finally:
+            redis.delete(self.LOCK_KEY)
+
+    def _rebuild_redis(self, redis) -> int:
+        from exts import db
+        from redis.exceptions import WatchError
+
+        for attempt in range(self.REBUILD_ATTEMPTS):
+            if attempt:
+                db.session.commit()   # 结束上次查询的事务，下次查询读取最新数据
+            before = redis.get(self.VERSION_KEY)
+            members = self._query_members()
+            try:
+                with redis.pipeline() as pipe:
+                    pipe.watch(self.VERSION_KEY)
+                    if pipe.get(self.VERSION_KEY) != before:
+                        continue   # 查询期间有 add/remove，重新查询
+                    tmp_key = f'{self.KEY}:rebuild'
+                    pipe.multi()
+                    pipe.delete(tmp_key)
+                    if members:
+                        pipe.sadd(tmp_key, *members)
+                        pipe.rename(tmp_key, self.KEY)
+                    else:
+                        pipe.delete(self.KEY)
+                    pipe.incr(self.VERSION_KEY)
+                    version = pipe.execute()[-1]
+            except WatchError:
+                continue
+            self._install(members, version)
+            logger.info(f"🚫 黑名单已重建: {len(members)}个访客")
+            return len(members)
+
+        logger.warning("⚠️ 重建期间黑名单持续变更，放弃本次重建（保留现有集合）")
+        self._sync()
+        return len(self._members)
+
+    def _rebuild_local(self) -> int:
+        """无 Redis 时重建进程内集合（查询期间本进程有 add/remove 则重新查询）"""
+        from exts import db
+
+        for attempt in range(self.REBUILD_ATTEMPTS):
+            if attempt:
+                db.session.commit()
+            with self._lock:
+                before = self._changes
+            members = self._query_members()
+            if self._install(members, None, expected_changes=before):
+                logger.info(f"🚫 黑名单已加载: {len(members)}个访客")
+                return len(members)
+
+        logger.warning("⚠️ 重建期间黑名单持续变更，放弃本次重建（保留现有集合）")
+        return len(self._members)
+
+    def _sync(self):
+        """版本号变化时从 Redis 重新加载（Redis 集合不存在时从数据库重建）"""
+        redis = self._redis()
+        if redis is None:
+            if not self._loaded:
+                self._rebuild_local()
+            return
+        version = redis.get(self.VERSION_KEY)
+        version = int(version) if version is not None else None
+        if self._loaded and version == self._version:
+            return
+        if version is None:
+            # Redis 中还没有黑名单（首次启动或 Redis 数据丢失）：持有锁的 worker 会写入，这里先从数据库加载
+            if redis.set(self.LOCK_KEY, 1, nx=True, ex=60):
+                try:
+                    self._rebuild_redis(redis)
+                finally:
+                    redis.delete(self.LOCK_KEY)
+            elif not self._loaded:
+                self._install(self._query_members(), None)
+            return
+        members = {m.decode() if isinstance(m, bytes) else m for m in redis.smembers(self.KEY)}
+        self._install(members, version)
+
+    def _rebuild_due(self) -> bool:
+        """本周期是否轮到本 worker 全量重建（整个集群每个周期只重建一次；无 Redis 时每个进程各自重建）"""
+        redis = self._redis()
+        if redis is None:
+            now = time.monotonic()
+            if self._last_rebuild is not None and now - self._last_rebuild < self.rebuild_interval:
+                return False
+            self._last_rebuild = now
+            return True
+        try:
+            return bool(redis.set(self.REBUILT_KEY, 1, nx=True, ex=max(1, int(self.rebuild_interval))))
+        except Exception as e:
+            logger.warning(f"检查黑名单重建周期失败: {e}")
+            return False
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            try:
+                self._sync()
+            except Exception as e:
+                logger.error(f"加载黑名单失败: {e}")
+
+    # ========== 查询 ==========
+
+    def contains(self, visitor_id: Optional[str]) -> bool:
+        """访客是否在黑名单中（绝大多数访客由布隆过滤器直接判定，不产生IO）"""
+        if not visitor_id:
+            return False
+        self._ensure_loaded()
+        if visitor_id not in self._bloom:
+            return False
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                return bool(redis.sismember(self.KEY, visitor_id))
+            except Exception as e:
+                logger.warning(f"查询Redis黑名单失败: {e}")
+        if self._loaded:
+            with self._lock:
+                return visitor_id in self._members
+        # 黑名单尚未加载成功时回退到数据库
+        from mod.mysql.models import Queue
+        return Queue.query.filter_by(visitor_id=visitor_id, state='blacklist').first() is not None
+
+    # ========== 变更（数据库提交后调用）==========
+
+    def add(self, visitor_id: str):
+        """访客已加入黑名单"""
+        self._ensure_loaded()
+        with self._lock:
+            self._bloom.add(visitor_id)
+            self._members.add(visitor_id)
+            self._changes += 1
+        self._publish('sadd', visitor_id)
+
+    def remove(self, visitor_id: str):
+        """访客已从黑名单移除"""
+        with self._lock:
+            self._members.discard(visitor_id)
+            self._changes += 1
+        self._publish('srem', visitor_id)
+
+    def _publish(self, op: str, visitor_id: str):
+        redis = self._redis()
+        if redis is None:
+            return
+        try:
+            pipe = redis.pipeline()
+            getattr(pipe, op)(self.KEY, visitor_id)
+            pipe.incr(self.VERSION_KEY)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"同步Redis黑名单失败: {e}")
+
+    # ========== 后台同步 ==========
+
+    def start(self, socketio):
+        """启动后定期检查其他 worker 的变更，并按周期全量重建（每个周期整个集群只有一个 worker 重建）"""
+        if self._started:
+            return
+        self._started = True
+
+        def sync_loop():
+            from exts import app, db
+            while True:
+                with app.app_context():
+                    try:
+                        if self._rebuild_due():
+                            self.rebuild()
+                        else:
+                            self._sync()
+                    except Exception as e:
+                        logger.error(f"黑名单同步失败: {e}")
+                    finally:
+                        db.session.remove()
+                socketio.sleep(self.sync_interval)
+
+        socketio.start_background_task(sync_loop)
+        logger.info(f"✅ 黑名单同步任务已启动 (间隔{self.sync_interval}s)")
+
+
+# 全局单例
+blacklist = Blacklist()
@@ -0,0 +1,214 @@
+"""
+聊天记录流式导出
+原来的导出先用 get_chat_history(per_page=10000) 取出全部记录（每行两次访客/客服查询），
+再在内存中拼出完整的 CSV / JSON 才返回：记录数超过 1 万被截断，大商户导出时内存暴涨。
+
+这里改为边查边写：
+- 服务端游标（stream_results）逐块读取 chats，只取导出需要的列
+- 访客名称、客服名称在导出前一次性加载为字典，不再逐行查询
+- 生成器逐块产出 CSV / NDJSON / JSON；XLSX 用 openpyxl 只写模式写入临时文件后分块读出
+- 可选 gzip 压缩（边压缩边输出）
+内存占用与导出的记录数无关。
+"""
+import csv
+import io
+import json
+import tempfile
+import zlib
+from typing import Dict, Iterable, Iterator
+import log
+
+logger = log.get_logger(__name__)
+
+
+HEADERS = ['消息ID', '访客', '客服', '消息内容', '消息方向', '消息类型', '时间']
+
+# 格式 -> (扩展名, Content-Type)
+FORMATS = {
+    'csv': ('csv', 'text/csv; charset=utf-8'),
+    'ndjson': ('ndjson', 'application/x-ndjson; charset=utf-8'),
+    'json': ('json', 'application/json; charset=utf-8'),
+    'xlsx': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+
+class ChatExporter:
+    """
+    聊天记录导出器
+
+    使用方式：
+        records = chat_exporter.rows(ChatService.history_query(business_id, ...), business_id)
+        return Response(stream_with_context(chat_exporter.stream(records, 'csv', gzip=True)), ...)
+    """
+
+    def __init__(self, chunk_size: int = 2000):
+        """
+        Args:
+            chunk_size: 每次从数据库读取的行数
+        """
+        self.chunk_size = chunk_size
+
+    def init_app(self, app):
+        """从Flask配置读取分块大小"""
+        self.chunk_size = app.config.get('EXPORT_CHUNK_SIZE', self.chunk_size)
+
+    # ========== 读取 ==========
+
+    @staticmethod
+    def _name_maps(business_id, visitor_id=None):
+        """一次性加载访客名称和客服名称"""
+        from exts import db
+        from mod.mysql.models import Visitor, Service
+
+        visitor_query = db.session.query(Visitor.visitor_id, Visitor.visitor_name).filter(
+            Visitor.business_id == business_id)
+        if visitor_id:
+            visitor_query = visitor_query.filter(Visitor.visitor_id == visitor_id)
+        visitors = dict(visitor_query.all())
+        services = dict(db.session.query(Service.service_id, Service.nick_name).filter(
+            Service.business_id == business_id).all())
+        return visitors, services
+
+    def rows(self, query, business_id, visitor_id=None) -> Iterator[Dict]:
+        """
+        逐行产出导出记录（服务端游标，按 chunk_size 分块读取）
+
+        Args:
+            query: ChatService.history_query 构建的查询（已包含筛选条件）
+            business_id: 商户ID
+            visitor_id: 按访客筛选时传入，只加载该访客的名称
+        """
+        from exts import db
+        from mod.mysql.models import Chat
+
+        visitors, services = self._name_maps(business_id, visitor_id)
+        statement = query.with_entities(
+            Chat.cid, Chat.visitor_id, Chat.service_id, Chat.content,
+            Chat.direction, Chat.msg_type, Chat.created_at
+        ).order_by(Chat.created_at.desc(), Chat.cid.desc()).statement
+
+        count = 0
+        with db.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(statement)
+            for chunk in result.partitions(self.chunk_size):
+                count += len(chunk)
+                for cid, vid, service_id, content, direction, msg_type, created_at in chunk:
+                    if msg_type == 2:
+                        msg_type = 'image' if 'image' in content or 'jpg' in content or 'png' in content else 'file'
+                    else:
+                        msg_type = 'text'
+                    yield {
+                        'id': cid,
+                        'visitor_id': vid,
+                        'visitor_name': visitors.get(vid, '未知'),
+                        'service_id': service_id,
+                        'service_name': services.get(service_id, '机器人') if service_id else '机器人',
+                        'content': content,
+                        'direction': direction,
+                        'msg_type': msg_type,
+                        'timestamp': created_at.isoformat() if created_at else None
+                    }
+        logger.info(f"📤 商户 {business_id} 导出聊天记录 {count} 条")
+
+    # ========== 格式化 ==========
+
+    @staticmethod
+    def _row_values(record: Dict) -> list:
+        return [
+            record['id'],
+            record['visitor_name'],
+            record['service_name'],
+            record['content'],
+            '访客→客服' if record['direction'] == 'to_service' else '客服→访客',
+            record['msg_type'],
+            record['timestamp']
+        ]
+
+    def _csv(self, records: Iterable[Dict]) -> Iterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')  # BOM，Excel 直接打开不乱码
+        writer.writerow(HEADERS)
+        for i, record in enumerate(records, 1):
+            writer.writerow(self._row_values(record))
+            if i % self.chunk_size == 0:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+
+    def _ndjson(self, records: Iterable[Dict]) -> Iterator[bytes]:
+        lines = []
+        for record in records:
+            lines.append(json.dumps(record, ensure_ascii=False))
+            if len(lines) >= self.chunk_size:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+                lines = []
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def _json(self, records: Iterable[Dict], meta: Dict) -> Iterator[bytes]:
+        head = json.dumps(meta, ensure_ascii=False)[:-1]  # 去掉结尾的 }，后面接 records 数组
+        yield (head + (', ' if meta else '') + '"records": [\n').encode('utf-8')
+        parts = []
+        for i, record in enumerate(records):
+            parts.append((',\n' if i else '') + json.dumps(record, ensure_ascii=False))
+            if len(parts) >= self.chunk_size:
+                yield ''.join(parts).encode('utf-8')
+                parts = []
+        yield (''.join(parts) + '\n]}').encode('utf-8')
+
+    def _xlsx(self, records: Iterable[Dict]) -> Iterator[bytes]:
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('聊天记录')
+        sheet.append(HEADERS)
+        for record in records:
+            sheet.append(self._row_values(record))
+
+        # 只写模式下行数据已写入临时文件，save 时打包为 xlsx，再分块读出
+        with tempfile.TemporaryFile() as tmp:
+            workbook.save(tmp)
+            tmp.seek(0)
+            while True:
+                data = tmp.read(64 * 1024)
+                if not data:
+                    break
+                yield data
+
+    @staticmethod
+    def _gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip 格式
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    # ========== 入口 ==========
+
+    def stream(self, records: Iterable[Dict], export_format: str, gzip: bool = False,
+               meta: Dict = None) -> Iterator[bytes]:
+        """
+        把记录流格式化为字节流
+
+        Args:
+            records: rows() 产出的记录
+            export_format: csv / ndjson / json / xlsx
+            gzip: 是否gzip压缩
+            meta: json 格式的导出信息（导出时间、筛选条件等）
+        """
+        if export_format == 'csv':
+            chunks = self._csv(records)
+        elif export_format == 'ndjson':
+            chunks = self._ndjson(records)
+        elif export_format == 'xlsx':
+            chunks = self._xlsx(records)
+        else:
+            chunks = self._json(records, meta or {})
+        return self._gzip(chunks) if gzip else chunks
+
+
+# 全局单例
+chat_exporter = ChatExporter()
@@ -0,0 +1,81 @@
+"""
+延迟任务调度器
+用于"模拟人工回复延迟"、"会话结束后延迟推送评价请求"等场景。
+
+原来的做法是在事件处理函数里 time.sleep()（或另起线程再 sleep），
+等待期间会一直占用 worker 和数据库会话（连接池中的连接）。
+这里把延迟交给 socketio.start_background_task + socketio.sleep：
+eventlet 下每个定时任务只是一个挂起的绿色线程，不占用任何数据库连接；
+到期后才把回调提交到后台任务池（mod.services.task_pool）执行，受任务池并发上限约束。
+"""
+import threading
+from typing import Callable, Optional
+import log
+
+logger = log.get_logger(__name__)
+
+
+class DelayedScheduler:
+    """
+    延迟任务调度器
+
+    使用方式：
+        delayed_scheduler.emit_later(0.5, 'receive_message', message, room=visitor_room)
+        delayed_scheduler.call_later(1, push_comment_request, queue_id, service_id)
+    """
+
+    def __init__(self):
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        """尚未执行的延迟任务数"""
+        return self._pending
+
+    def call_later(self, delay: float, func: Callable, *args,
+                   task_type: str = 'delayed', key=None, **kwargs):
+        """
+        延迟执行函数（到期后提交到后台任务池，在应用上下文中执行）
+
+        Args:
+            delay: 延迟时间（秒）
+            func: 回调函数
+            task_type: 任务池中的任务类型
+            key: 任务池合并键
+            *args, **kwargs: 回调参数
+        """
+        from exts import socketio
+        from mod.services.task_pool import task_pool
+
+        with self._lock:
+            self._pending += 1
+
+        def run():
+            try:
+                socketio.sleep(delay)
+                task_pool.submit(task_type, func, *args, key=key, **kwargs)
+            except Exception as e:
+                logger.error(f"延迟任务提交失败 {getattr(func, '__name__', func)}: {e}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+        socketio.start_background_task(run)
+
+    def emit_later(self, delay: float, event: str, data, room: Optional[str] = None, **kwargs):
+        """
+        延迟推送 Socket.IO 事件（不需要数据库的纯推送）
+
+        Args:
+            delay: 延迟时间（秒）
+            event: 事件名
+            data: 事件数据
+            room: 目标房间（可以是房间列表）
+        """
+        from exts import socketio
+        self.call_later(delay, socketio.emit, event, data, room=room, task_type='delayed_emit', **kwargs)
+
+
+# 全局单例
+delayed_scheduler = DelayedScheduler()
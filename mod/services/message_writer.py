@@ -0,0 +1,405 @@
+"""
+聊天消息写后（write-behind）持久化
+热路径上只做"分配ID + 写Redis日志"，立即推送给接收方；
+后台任务每隔几十毫秒把日志中的消息批量 INSERT 到 chats 表，
+并把同一会话的 last_message_time 更新合并为一条 UPDATE。
+
+可靠性（至少一次）：
+- 消息先 RPUSH 到 Redis 日志列表，再推送给客户端
+- 刷新时用 Lua 原子地把一批消息从日志移到 inflight 有序集合（score=取出时间）
+- 事务提交成功后才从 inflight 删除；worker 崩溃遗留的 inflight 消息超时后被放回日志
+- 消息ID预先分配（Redis INCR），每条消息带一个 UUID（chats.unstr），主键已存在且 unstr 相同即为重放
+- 普通 INSERT：数据库不可用等错误使整批留在 inflight 重试；个别行本身有问题（超长、外键、枚举）时
+  逐行插入，问题行放入 kefu:chat:dead 并记录错误日志，不会被静默丢弃，也不会卡住后面的消息
+- 开启后所有 Chat 插入（包括同步写入的系统消息、机器人消息）都从同一个 Redis 分配器取ID，
+  不再与 AUTO_INCREMENT 交替分配；ID一经推送给客户端就不再改变，冲突的消息放入
+  kefu:chat:conflict 并记录错误日志，不会换ID入库
+
+需要 Redis；Redis 不可用或未开启 MESSAGE_WRITE_BEHIND 时自动走原来的同步提交
+"""
+import atexit
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+import log
+
+logger = log.get_logger(__name__)
+
+
+class MessageWriter:
+    """
+    聊天消息写后持久化管道
+
+    设计原则：
+    - 可选开启（MESSAGE_WRITE_BEHIND），关闭时调用方走同步提交
+    - 消息体进 Redis 日志保证不丢；会话时间戳/已读标记属于可合并的软状态，只在进程内合并
+    """
+
+    PREFIX = 'kefu:chat'
+
+    # KEYS: wal_list, inflight_zset  ARGV: count, now
+    _TAKE_SCRIPT = """
+    local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #items == 0 then
+        return items
+    end
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    for _, item in ipairs(items) do
+        redis.call('ZADD', KEYS[2], ARGV[2], item)
+    end
+    return items
+    """
+
+    # KEYS: wal_list, inflight_zset  ARGV: before
+    _REQUEUE_SCRIPT = """
+    local items = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+    for _, item in ipairs(items) do
+        redis.call('ZREM', KEYS[2], item)
+        redis.call('LPUSH', KEYS[1], item)
+    end
+    return #items
+    """
+
+    # KEYS: id_key  ARGV: floor
+    _ID_FLOOR_SCRIPT = """
+    local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+    if current < tonumber(ARGV[1]) then
+        redis.call('SET', KEYS[1], ARGV[1])
+    end
+    return 1
+    """
+
+    def __init__(self):
+        self.interval = 0.05
+        self.batch_size = 500
+        self.inflight_timeout = 30
+        self._redis = None
+        self._available = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._queue_touches: Dict[int, datetime] = {}    # qid -> 最后消息时间
+        self._read_marks: Dict[str, int] = {}            # visitor_id -> 已读截止cid
+
+    # ========== 初始化 ==========
+
+    def init_app(self, app):
+        """开启写后模式时在启动阶段完成初始化（否则在首条消息时初始化）"""
+        if app.config.get('MESSAGE_WRITE_BEHIND', False) and self._available is None:
+            self._setup(app)
+
+    def _key(self, name: str) -> str:
+        return f'{self.PREFIX}:{name}'
+
+    @property
+    def enabled(self) -> bool:
+        """是否启用写后模式（配置开启且Redis可用）"""
+        from exts import app
+        if not app.config.get('MESSAGE_WRITE_BEHIND', False):
+            return False
+        if self._available is None:
+            self._setup(app)
+        return self._available
+
+    def _setup(self, app):
+        """连接Redis、校准ID分配器、恢复遗留消息并启动后台刷新任务"""
+        with self._lock:
+            if self._available is not None:
+                return
+
+            self.interval = app.config.get('MESSAGE_WRITE_BEHIND_INTERVAL', self.interval)
+            self.batch_size = app.config.get('MESSAGE_WRITE_BEHIND_BATCH', self.batch_size)
+
+            try:
+                import exts
+                if exts.redis_client is None:
+                    raise RuntimeError('Redis未连接')
+                self._redis = exts.redis_client
+                self._take = self._redis.register_script(self._TAKE_SCRIPT)
+                self._requeue = self._redis.register_script(self._REQUEUE_SCRIPT)
+                self._id_floor = self._redis.register_script(self._ID_FLOOR_SCRIPT)
+
+                self._floor_ids(app)
+
+                # 恢复上次退出时未入库的消息
+                recovered = self._requeue(keys=[self._key('wal'), self._key('inflight')], args=['+inf'])
+                if recovered:
+                    logger.warning(f"♻️ 恢复{recovered}条未入库的消息")
+
+                self._install_allocator()
+                self._available = True
+            except Exception as e:
+                logger.warning(f"⚠️ 消息写后模式不可用: {e}，使用同步提交")
+                self._available = False
+                return
+
+        self._start()
+
+    def _floor_ids(self, app):
+        """ID分配器不能低于表中已有的最大ID（启动时、以及 Redis 数据丢失后）"""
+        with app.app_context():
+            from exts import db
+            from mod.mysql.models import Chat
+            try:
+                max_cid = db.session.query(db.func.max(Chat.cid)).scalar() or 0
+            finally:
+                db.session.remove()
+        self._id_floor(keys=[self._key('id')], args=[max_cid])
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+
+        from exts import app, socketio
+
+        def flush_loop():
+            while True:
+                socketio.sleep(self.interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"消息批量入库失败: {e}")
+
+        def recover_loop():
+            while True:
+                socketio.sleep(self.inflight_timeout)
+                try:
+                    count = self._requeue(
+                        keys=[self._key('wal'), self._key('inflight')],
+                        args=[time.time() - self.inflight_timeout]
+                    )
+                    if count:
+                        logger.warning(f"♻️ {count}条超时未确认的消息已放回日志")
+                    self._floor_ids(app)
+                except Exception as e:
+                    logger.error(f"恢复超时消息失败: {e}")
+
+        socketio.start_background_task(flush_loop)
+        socketio.start_background_task(recover_loop)
+        atexit.register(self.shutdown)
+        logger.info(f"✅ 消息写后持久化已启动 (间隔{self.interval * 1000:.0f}ms, 批量{self.batch_size})")
+
+    def _install_allocator(self):
+        """同步插入的 Chat（ORM）也从 Redis 分配ID，保证全表只有一个ID来源"""
+        from sqlalchemy import event
+        from mod.mysql.models import Chat
+
+        def assign_cid(mapper, connection, target):
+            if target.cid is None and self._available:
+                target.cid = self.allocate_id()
+
+        event.listen(Chat, 'before_insert', assign_cid)
+
+    def allocate_id(self) -> int:
+        """分配一个消息ID（开启写后模式时所有 Chat 插入共用）"""
+        return int(self._redis.incr(self._key('id')))
+
+    # ========== 热路径接口 ==========
+
+    def enqueue(self, fields: Dict) -> int:
+        """
+        登记一条待入库消息
+
+        Args:
+            fields: Chat 字段（visitor_id, service_id, business_id, content, msg_type,
+                    timestamp, direction, state）
+
+        Returns:
+            预分配的消息ID（cid）
+        """
+        cid = self.allocate_id()
+        record = dict(fields, cid=cid, created_at=datetime.now().isoformat())
+        record['unstr'] = record.get('unstr') or uuid.uuid4().hex   # 幂等键
+        self._redis.rpush(self._key('wal'), json.dumps(record, ensure_ascii=False))
+        return cid
+
+    def touch_queue(self, qid: int, when: Optional[datetime] = None):
+        """合并会话的最后消息时间更新（同一会话在一个刷新周期内只UPDATE一次）"""
+        when = when or datetime.now()
+        with self._lock:
+            if qid not in self._queue_touches or self._queue_touches[qid] < when:
+                self._queue_touches[qid] = when
+
+    def mark_read(self, visitor_id: str, upto_cid: int):
+        """合并"客服回复后标记访客消息已读"（在消息入库之后执行）"""
+        with self._lock:
+            self._read_marks[visitor_id] = max(upto_cid, self._read_marks.get(visitor_id, 0))
+
+    def pending(self, redis=None) -> List[Dict]:
+        """
+        尚未入库的消息（日志 + inflight，在一个事务中读取，不会漏掉正在移动的消息）
+
+        Args:
+            redis: Redis 连接，默认使用本管道的连接（本进程未开启写后模式时由调用方传入）
+        """
+        redis = redis or self._redis
+        if redis is None:
+            return []
+        pipe = redis.pipeline(transaction=True)
+        pipe.lrange(self._key('wal'), 0, -1)
+        pipe.zrange(self._key('inflight'), 0, -1)
+        wal, inflight = pipe.execute()
+        return [json.loads(item) for item in list(wal) + list(inflight)]
+
+    # ========== 后台刷新 ==========
+
+    def flush(self) -> int:
+        """
+        刷新一批消息及合并的会话更新
+
+        Returns:
+            本次入库的消息数
+        """
+        items = self._take(
+            keys=[self._key('wal'), self._key('inflight')],
+            args=[self.batch_size, time.time()]
+        )
+
+        with self._lock:
+            touches, self._queue_touches = self._queue_touches, {}
+            read_marks, self._read_marks = self._read_marks, {}
+
+        if not items and not touches and not read_marks:
+            return 0
+
+        from exts import app, db
+        from mod.mysql.models import Chat, Queue
+
+        records = [json.loads(item) for item in items]
+        inserted, rejected = [], []
+        with app.app_context():
+            try:
+                if records:
+                    inserted, rejected = self._insert_chats(db, Chat, records)
+
+                if touches:
+                    db.session.execute(
+                        Queue.__table__.update()
+                        .where(Queue.qid == db.bindparam('b_qid'))
+                        .values(last_message_time=db.bindparam('b_ts'), updated_at=db.bindparam('b_ts')),
+                        [{'b_qid': qid, 'b_ts': ts} for qid, ts in touches.items()]
+                    )
+
+                for visitor_id, upto_cid in read_marks.items():
+                    Chat.query.filter(
+                        Chat.visitor_id == visitor_id,
+                        Chat.direction == 'to_service',
+                        Chat.state == 'unread',
+                        Chat.cid <= upto_cid
+                    ).update({'state': 'read'}, synchronize_session=False)
+
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # 软状态放回，下个周期重试；消息留在 inflight，超时后自动放回日志
+                with self._lock:
+                    for qid, ts in touches.items():
+                        self._queue_touches[qid] = max(ts, self._queue_touches.get(qid, ts))
+                    for visitor_id, upto_cid in read_marks.items():
+                        self._read_marks[visitor_id] = max(upto_cid, self._read_marks.get(visitor_id, 0))
+                raise
+            finally:
+                db.session.remove()
+
+        for key, batch in rejected:
+            self._redis.rpush(self._key(key), *[
+                json.dumps(dict(record, created_at=record['created_at'].isoformat()), ensure_ascii=False)
+                for record in batch
+            ])
+
+        if inserted:
+            from mod.services.unique_visitors import unique_visitors
+            unique_visitors.add_messages(inserted)
+
+        if items:
+            self._redis.zrem(self._key('inflight'), *items)
+            logger.debug(f"💾 批量入库{len(items)}条消息, 合并更新{len(touches)}个会话")
+        return len(items)
+
+    @staticmethod
+    def _same_message(row, record: Dict) -> bool:
+        """已有记录是否就是这条消息（重放）"""
+        if 'unstr' in record:
+            return row.unstr == record['unstr']
+        # 升级前写入日志的消息没有 unstr
+        return (row.visitor_id, row.timestamp, row.direction) == \
+            (record['visitor_id'], record['timestamp'], record['direction'])
+
+    @classmethod
+    def _insert_chats(cls, db, Chat, records: List[Dict]):
+        """
+        批量插入消息（幂等）
+        主键已存在时：同一条消息（重放）直接跳过；不同消息说明有绕过分配器的写入占用了该ID，
+        不换ID入库（ID已推送给客户端），交给调用方另行保存
+
+        Returns:
+            (本次入库的消息, [(Redis列表名, 未入库的消息)])
+        """
+        from sqlalchemy.exc import DataError, IntegrityError
+
+        for record in records:
+            record['created_at'] = datetime.fromisoformat(record['created_at'])
+
+        def existing_rows(cids):
+            return {
+                row.cid: row for row in db.session.query(
+                    Chat.cid, Chat.unstr, Chat.visitor_id, Chat.timestamp, Chat.direction
+                ).filter(Chat.cid.in_(cids)).all()
+            }
+
+        existing = existing_rows([r['cid'] for r in records])
+        fresh, conflicts, dead = [], [], []
+        for record in records:
+            row = existing.get(record['cid'])
+            if row is None:
+                fresh.append(record)
+            elif not cls._same_message(row, record):
+                conflicts.append(record)
+
+        inserted = []
+        if fresh:
+            insert = Chat.__table__.insert()
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert, fresh)
+                inserted = fresh
+            except (DataError, IntegrityError):
+                # 逐行插入找出问题行，其余照常入库
+                for record in fresh:
+                    try:
+                        with db.session.begin_nested():
+                            db.session.execute(insert, [record])
+                        inserted.append(record)
+                    except IntegrityError as e:
+                        row = existing_rows([record['cid']]).get(record['cid'])
+                        if row is not None and cls._same_message(row, record):
+                            continue   # 其他 worker 已重放入库
+                        logger.error(f"❌ 消息 {record['cid']} 入库失败: {e.orig}")
+                        (conflicts if row is not None else dead).append(record)
+                    except DataError as e:
+                        logger.error(f"❌ 消息 {record['cid']} 入库失败: {e.orig}")
+                        dead.append(record)
+
+        for record in conflicts:
+            logger.error(f"❌ 消息ID {record['cid']} 已被其他写入占用，消息未入库（已保存到 kefu:chat:conflict）")
+        if dead:
+            logger.error(f"❌ {len(dead)}条消息数据有误未入库（已保存到 kefu:chat:dead）")
+        return inserted, [(name, batch) for name, batch in (('conflict', conflicts), ('dead', dead)) if batch]
+
+    def shutdown(self):
+        """进程退出前把日志中的消息全部入库"""
+        if not self._available:
+            return
+        try:
+            while self.flush() > 0:
+                pass
+            logger.info("✅ 消息写后队列已全部入库")
+        except Exception as e:
+            logger.error(f"退出时消息入库失败（将在下次启动时恢复）: {e}")
+
+
+# 全局单例
+message_writer = MessageWriter()
@@ -0,0 +1,212 @@
+"""
+访客离线批处理
+CDN/代理抖动时会有成千上万个访客同时断线，逐个处理意味着每个断线都要
+SELECT ... FOR UPDATE + COMMIT + 接待数更新 + 统计广播。
+这里把一段时间窗口内的断线合并为一次批量 UPDATE。
+"""
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict
+import log
+
+logger = log.get_logger(__name__)
+
+
+class VisitorOfflineBatcher:
+    """
+    访客离线批处理器
+
+    设计原则：
+    - 断线事件只入队，不访问数据库（断线处理 O(1)）
+    - 后台任务按固定间隔（或达到批量上限时）合并刷新：
+      1 次查询进行中的会话 + 1 次批量关闭会话 + 1 次批量更新访客状态
+    - 刷新前再次确认访客是否已重连（页面刷新场景），重连的访客不关闭会话
+    """
+
+    def __init__(self, interval: float = 0.5, max_batch: int = 500):
+        """
+        Args:
+            interval: 刷新间隔（秒）
+            max_batch: 单次刷新的最大访客数
+        """
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: Dict[str, int] = {}  # visitor_id -> business_id
+        self._lock = threading.Lock()
+        self._started = False
+
+    def init_app(self, app):
+        """从Flask配置读取批处理参数"""
+        self.interval = app.config.get('OFFLINE_BATCH_INTERVAL', self.interval)
+        self.max_batch = app.config.get('OFFLINE_BATCH_MAX_SIZE', self.max_batch)
+
+    def add(self, visitor_id: str, business_id: int = 1):
+        """
+        登记一个离线访客（首次调用时自动启动后台刷新任务）
+
+        Args:
+            visitor_id: 访客ID
+            business_id: 商户ID
+        """
+        with self._lock:
+            self._pending[visitor_id] = business_id
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        self._started = True
+
+        from exts import socketio
+
+        def flush_loop():
+            while True:
+                socketio.sleep(self.interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"访客离线批处理失败: {e}")
+
+        socketio.start_background_task(flush_loop)
+        logger.info(f"✅ 访客离线批处理任务已启动 (间隔{self.interval}s)")
+
+    def _take_batch(self) -> Dict[str, int]:
+        with self._lock:
+            if len(self._pending) <= self.max_batch:
+                batch, self._pending = self._pending, {}
+            else:
+                keys = list(self._pending)[:self.max_batch]
+                batch = {k: self._pending.pop(k) for k in keys}
+        return batch
+
+    def flush(self) -> int:
+        """
+        刷新一批离线访客
+
+        Returns:
+            本次关闭的会话数
+        """
+        batch = self._take_batch()
+        if not batch:
+            return 0
+
+        from exts import app, db
+        from mod.mysql.models import Queue, Visitor
+        from mod.services.presence_service import presence_registry
+
+        # 页面刷新等场景下访客可能已经重连，跳过这些访客
+        visitor_ids = [
+            vid for vid in batch
+            if not presence_registry.is_online(f'visitor_{vid}')
+        ]
+        if not visitor_ids:
+            return 0
+
+        with app.app_context():
+            now = datetime.now()
+            try:
+                sessions = db.session.query(
+                    Queue.qid, Queue.visitor_id, Queue.service_id, Queue.business_id,
+                    Queue.group_id, Queue.created_at
+                ).filter(
+                    Queue.visitor_id.in_(visitor_ids),
+                    Queue.state == 'normal'
+                ).all()
+
+                if sessions:
+                    Queue.query.filter(
+                        Queue.qid.in_([s.qid for s in sessions]),
+                        Queue.state == 'normal'
+                    ).update({'state': 'complete', 'updated_at': now}, synchronize_session=False)
+
+                Visitor.query.filter(
+                    Visitor.visitor_id.in_(visitor_ids)
+                ).update({'state': 'offline'}, synchronize_session=False)
+
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                db.session.remove()
+                logger.error(f"批量关闭离线访客会话失败: {e}")
+                import traceback
+                logger.error(traceback.format_exc())
+                # 数据库未提交，失败的批次放回队列，下次重试
+                with self._lock:
+                    for vid in visitor_ids:
+                        self._pending.setdefault(vid, batch[vid])
+                return 0
+
+            logger.info(f"🔒 批量离线处理: {len(visitor_ids)}个访客, 关闭{len(sessions)}个会话")
+            # 会话已关闭，之后的步骤失败也不能重试整批（重试时会话已是 complete，接待数不会再扣减）
+            try:
+                self._after_commit(sessions, now)
+            finally:
+                db.session.remove()
+            return len(sessions)
+
+    @staticmethod
+    def _after_commit(sessions, now: datetime):
+        """会话关闭后的缓存、等待线、接待数、通知与统计更新（每一步单独容错）"""
+        from exts import socketio
+
+        def guarded(step, func):
+            try:
+                func()
+            except Exception as e:
+                logger.error(f"批量离线后续处理失败({step}): {e}")
+
+        def invalidate_cache():
+            # 批量 UPDATE 不经过 ORM 事件，手动失效会话缓存
+            from mod.services.session_cache import active_sessions
+            closed_by_business = defaultdict(list)
+            for s in sessions:
+                closed_by_business[s.business_id].append(s.visitor_id)
+            for closed_business_id, closed_visitor_ids in closed_by_business.items():
+                active_sessions.invalidate(closed_business_id, closed_visitor_ids)
+
+        def update_waiting():
+            # 仍在排队的访客移出等待线，已接待的会话计入处理时长统计
+            from mod.services.waiting_line import waiting_line
+            from mod.services.wait_estimator import wait_estimator
+            for s in sessions:
+                if not s.service_id:
+                    waiting_line.remove(s.business_id, s.visitor_id)
+                else:
+                    wait_estimator.observe_queue(s, now)
+
+        def release_workloads():
+            # 按客服合并接待数变更（每个客服只更新一次）
+            workload_changes = Counter(
+                s.service_id for s in sessions if s.service_id and s.service_id > 0
+            )
+            if workload_changes:
+                from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
+                for service_id, count in workload_changes.items():
+                    workload_manager.decrement_workload(service_id, f"访客离线(批量{count}个)", count=count)
+
+        def notify():
+            # 通知接待该访客的客服及本商户管理员（不再广播给所有商户）
+            from mod.services.socket_rooms import agent_and_admins_rooms
+            for s in sessions:
+                socketio.emit('visitor_offline', {
+                    'visitor_id': s.visitor_id,
+                    'message': '访客已离线，会话自动关闭',
+                    'timestamp': now.isoformat()
+                }, room=agent_and_admins_rooms(s.business_id, s.service_id))
+
+            # 每个商户只标记一次统计更新
+            from mod.services.stats_publisher import stats_publisher
+            for business_id in {s.business_id for s in sessions}:
+                stats_publisher.mark_dirty(business_id)
+
+        if not sessions:
+            return
+        guarded('会话缓存', invalidate_cache)
+        guarded('等待线', update_waiting)
+        guarded('接待数', release_workloads)
+        guarded('通知', notify)
+
+
+# 全局单例
+visitor_offline_batcher = VisitorOfflineBatcher()
@@ -0,0 +1,439 @@
+"""
+在线状态注册中心（集群级）
+替代每个worker进程各自持有的 online_users 字典，所有worker/节点共享同一份在线状态
+
+存储结构（Redis，使用 SOCKETIO_MESSAGE_QUEUE 同一实例）：
+- kefu:presence:sids                    Hash  sid -> {user_key, type, business_id}
+- kefu:presence:users                   Hash  user_key -> 用户信息JSON
+- kefu:presence:user_sids:{user_key}    Set   该用户的所有连接sid
+- kefu:presence:biz:{business_id}:{type} Set  商户下某类用户的user_key
+- kefu:presence:heartbeat               ZSet  sid -> 最后心跳时间戳
+
+心跳由服务端维护，客户端不发送心跳事件：
+- 每个worker的后台任务每 PRESENCE_HEARTBEAT_INTERVAL 秒为本worker持有的所有连接刷新心跳
+- 连接断开由 Socket.IO 自身的 ping/pong 检测，走正常的 disconnect 流程
+- 心跳超过 TTL 未刷新的连接说明所在worker已崩溃，由存活worker清理并按离线处理
+
+Redis 不可用时自动降级为进程内实现（LocalPresenceBackend），接口完全一致
+"""
+import json
+import time
+from typing import Dict, List, Optional, Set, Tuple
+import log
+
+logger = log.get_logger(__name__)
+
+
+# 客服类用户类型（管理员也是客服）
+SERVICE_TYPES = ('service', 'admin')
+
+
+class LocalPresenceBackend:
+    """
+    进程内在线状态存储（Redis不可用时的替代实现）
+
+    所有操作均为字典/集合操作，O(1)
+    """
+
+    def __init__(self):
+        self._sids: Dict[str, Dict] = {}            # sid -> {user_key, type, business_id}
+        self._users: Dict[str, Dict] = {}           # user_key -> info
+        self._user_sids: Dict[str, Set[str]] = {}   # user_key -> {sid}
+        self._biz: Dict[Tuple, Set[str]] = {}       # (business_id, type) -> {user_key}
+        self._heartbeat: Dict[str, float] = {}      # sid -> 最后心跳时间
+
+    def join(self, sid: str, user_key: str, user_type: str, business_id, info: Dict) -> int:
+        self._sids[sid] = {'user_key': user_key, 'type': user_type, 'business_id': business_id}
+        self._users.setdefault(user_key, {}).update(info)
+        self._user_sids.setdefault(user_key, set()).add(sid)
+        self._biz.setdefault((str(business_id), user_type), set()).add(user_key)
+        self._heartbeat[sid] = time.time()
+        return len(self._user_sids[user_key])
+
+    def leave(self, sid: str) -> Optional[Tuple[str, Dict, int]]:
+        entry = self._sids.pop(sid, None)
+        self._heartbeat.pop(sid, None)
+        if not entry:
+            return None
+
+        user_key = entry['user_key']
+        sids = self._user_sids.get(user_key, set())
+        sids.discard(sid)
+        remaining = len(sids)
+        info = dict(self._users.get(user_key, {}))
+
+        if remaining == 0:
+            self._user_sids.pop(user_key, None)
+            self._users.pop(user_key, None)
+            biz_set = self._biz.get((str(entry['business_id']), entry['type']))
+            if biz_set is not None:
+                biz_set.discard(user_key)
+
+        info.setdefault('type', entry['type'])
+        info.setdefault('business_id', entry['business_id'])
+        return user_key, info, remaining
+
+    def lookup_sid(self, sid: str) -> Optional[str]:
+        entry = self._sids.get(sid)
+        return entry['user_key'] if entry else None
+
+    def get_user(self, user_key: str) -> Optional[Dict]:
+        info = self._users.get(user_key)
+        return dict(info) if info is not None else None
+
+    def get_users(self, user_keys: List[str]) -> Dict[str, Dict]:
+        return {key: dict(self._users[key]) for key in user_keys if key in self._users}
+
+    def update_user(self, user_key: str, fields: Dict) -> bool:
+        if user_key not in self._users:
+            return False
+        self._users[user_key].update(fields)
+        return True
+
+    def get_sids(self, user_key: str) -> Set[str]:
+        return set(self._user_sids.get(user_key, set()))
+
+    def users_by_business(self, business_id, user_type: str) -> Set[str]:
+        return set(self._biz.get((str(business_id), user_type), set()))
+
+    def heartbeat(self, sids) -> None:
+        now = time.time()
+        for sid in sids:
+            if sid in self._sids:
+                self._heartbeat[sid] = now
+
+    def expired_sids(self, before: float) -> List[str]:
+        return [sid for sid, ts in self._heartbeat.items() if ts < before]
+
+
+class RedisPresenceBackend:
+    """
+    Redis 在线状态存储
+
+    join 使用事务管道，leave 使用 Lua 脚本保证"最后一个连接断开时清理用户"的原子性
+    """
+
+    PREFIX = 'kefu:presence'
+
+    # KEYS: sids_hash, users_hash, heartbeat_zset
+    # ARGV: sid, prefix
+    # 返回: [user_key, info_json, entry_json, remaining] 或 nil
+    _LEAVE_SCRIPT = """
+    local entry = redis.call('HGET', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    if not entry then
+        return nil
+    end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    local data = cjson.decode(entry)
+    local user_key = data['user_key']
+    local sids_key = ARGV[2] .. ':user_sids:' .. user_key
+    redis.call('SREM', sids_key, ARGV[1])
+    local remaining = redis.call('SCARD', sids_key)
+    local info = redis.call('HGET', KEYS[2], user_key) or '{}'
+    if remaining == 0 then
+        redis.call('DEL', sids_key)
+        redis.call('HDEL', KEYS[2], user_key)
+        redis.call('SREM', ARGV[2] .. ':biz:' .. tostring(data['business_id']) .. ':' .. data['type'], user_key)
+    end
+    return {user_key, info, entry, remaining}
+    """
+
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+        self._leave = redis_conn.register_script(self._LEAVE_SCRIPT)
+
+    def _key(self, *parts) -> str:
+        return ':'.join([self.PREFIX] + [str(p) for p in parts])
+
+    def join(self, sid: str, user_key: str, user_type: str, business_id, info: Dict) -> int:
+        # 合并已有信息（多标签页时保留旧字段，新字段覆盖）
+        merged = self.get_user(user_key) or {}
+        merged.update(info)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self._key('sids'), sid, json.dumps({
+            'user_key': user_key, 'type': user_type, 'business_id': business_id
+        }))
+        pipe.hset(self._key('users'), user_key, json.dumps(merged, ensure_ascii=False, default=str))
+        pipe.sadd(self._key('user_sids', user_key), sid)
+        pipe.sadd(self._key('biz', business_id, user_type), user_key)
+        pipe.zadd(self._key('heartbeat'), {sid: time.time()})
+        pipe.scard(self._key('user_sids', user_key))
+        return int(pipe.execute()[-1])
+
+    def leave(self, sid: str) -> Optional[Tuple[str, Dict, int]]:
+        result = self._leave(
+            keys=[self._key('sids'), self._key('users'), self._key('heartbeat')],
+            args=[sid, self.PREFIX]
+        )
+        if not result:
+            return None
+
+        user_key, info_json, entry_json, remaining = result
+        try:
+            info = json.loads(info_json)
+        except (TypeError, ValueError):
+            info = {}
+        entry = json.loads(entry_json)
+        info.setdefault('type', entry['type'])
+        info.setdefault('business_id', entry['business_id'])
+        return user_key, info, int(remaining)
+
+    def lookup_sid(self, sid: str) -> Optional[str]:
+        entry = self.redis.hget(self._key('sids'), sid)
+        return json.loads(entry)['user_key'] if entry else None
+
+    def get_user(self, user_key: str) -> Optional[Dict]:
+        info = self.redis.hget(self._key('users'), user_key)
+        return json.loads(info) if info else None
+
+    def get_users(self, user_keys: List[str]) -> Dict[str, Dict]:
+        if not user_keys:
+            return {}
+        infos = self.redis.hmget(self._key('users'), user_keys)
+        return {key: json.loads(info) for key, info in zip(user_keys, infos) if info}
+
+    def update_user(self, user_key: str, fields: Dict) -> bool:
+        info = self.get_user(user_key)
+        if info is None:
+            return False
+        info.update(fields)
+        self.redis.hset(self._key('users'), user_key, json.dumps(info, ensure_ascii=False, default=str))
+        return True
+
+    def get_sids(self, user_key: str) -> Set[str]:
+        return set(self.redis.smembers(self._key('user_sids', user_key)))
+
+    def users_by_business(self, business_id, user_type: str) -> Set[str]:
+        return set(self.redis.smembers(self._key('biz', business_id, user_type)))
+
+    def heartbeat(self, sids) -> None:
+        sids = list(sids)
+        if sids:
+            now = time.time()
+            # XX：只刷新仍然存在的连接，避免复活已被清理的sid
+            self.redis.zadd(self._key('heartbeat'), {sid: now for sid in sids}, xx=True)
+
+    def expired_sids(self, before: float) -> List[str]:
+        return list(self.redis.zrangebyscore(self._key('heartbeat'), '-inf', before))
+
+
+class PresenceRegistry:
+    """
+    在线状态注册中心
+
+    设计原则：
+    - 按 sid / user_key / business 三个维度建立索引，加入、离开、查询均为 O(1)
+    - 每个worker定期为自己持有的连接刷新心跳，worker崩溃后其连接在 TTL 后被任意worker清理
+    - 后端可替换：优先 Redis（跨worker共享），失败时降级为进程内存储
+    """
+
+    def __init__(self):
+        self._backend = None
+        self._local_sids: Set[str] = set()  # 本worker持有的连接（用于刷新心跳）
+        self._started = False
+        self.heartbeat_interval = 30
+        self.ttl = 90
+
+    @property
+    def backend(self):
+        """延迟初始化后端（首次使用时连接Redis）"""
+        if self._backend is None:
+            self._backend = self._create_backend()
+        return self._backend
+
+    @staticmethod
+    def _create_backend():
+        try:
+            import config
+            from redis import Redis
+            redis_url = getattr(config, 'PRESENCE_REDIS_URL', None) or config.SOCKETIO_MESSAGE_QUEUE
+            conn = Redis.from_url(redis_url, decode_responses=True)
+            conn.ping()
+            logger.info(f"✅ 在线状态注册中心使用Redis: {redis_url}")
+            return RedisPresenceBackend(conn)
+        except Exception as e:
+            logger.warning(f"⚠️ 在线状态注册中心Redis不可用: {e}，降级为进程内存储（仅单worker有效）")
+            return LocalPresenceBackend()
+
+    def init_app(self, app):
+        """从Flask配置读取心跳参数"""
+        self.heartbeat_interval = app.config.get('PRESENCE_HEARTBEAT_INTERVAL', self.heartbeat_interval)
+        self.ttl = app.config.get('PRESENCE_TTL', self.ttl)
+
+    # ========== 加入 / 离开 ==========
+
+    def join(self, sid: str, user_key: str, user_type: str, business_id, info: Dict = None) -> int:
+        """
+        登记一个连接
+
+        Args:
+            sid: Socket连接ID
+            user_key: 用户键（visitor_xxx / service_1 / admin_1）
+            user_type: 'visitor' / 'service' / 'admin'
+            business_id: 商户ID
+            info: 用户展示信息（名称、设备、service_id等）
+
+        Returns:
+            该用户当前的连接数
+        """
+        info = dict(info or {})
+        info.update({'type': user_type, 'business_id': business_id})
+        self._local_sids.add(sid)
+        try:
+            return self.backend.join(sid, user_key, user_type, business_id, info)
+        except Exception as e:
+            logger.error(f"在线状态登记失败 [{user_key}]: {e}")
+            return 0
+
+    def leave(self, sid: str) -> Optional[Tuple[str, Dict, int]]:
+        """
+        注销一个连接
+
+        Returns:
+            (user_key, 用户信息, 剩余连接数)；sid未登记时返回 None
+        """
+        self._local_sids.discard(sid)
+        try:
+            return self.backend.leave(sid)
+        except Exception as e:
+            logger.error(f"在线状态注销失败 [{sid}]: {e}")
+            return None
+
+    # ========== 查询 ==========
+
+    def lookup_sid(self, sid: str) -> Optional[str]:
+        """根据sid查找用户键"""
+        try:
+            return self.backend.lookup_sid(sid)
+        except Exception as e:
+            logger.error(f"在线状态查询失败 [{sid}]: {e}")
+            return None
+
+    def get_user(self, user_key: str) -> Optional[Dict]:
+        """获取在线用户信息（不在线返回 None）"""
+        try:
+            return self.backend.get_user(user_key)
+        except Exception as e:
+            logger.error(f"在线用户查询失败 [{user_key}]: {e}")
+            return None
+
+    def get_users(self, user_keys) -> Dict[str, Dict]:
+        """批量获取在线用户信息（一次 HMGET，不在线的用户不在结果中）"""
+        try:
+            return self.backend.get_users(list(user_keys))
+        except Exception as e:
+            logger.error(f"批量查询在线用户失败: {e}")
+            return {}
+
+    def update_user(self, user_key: str, **fields) -> bool:
+        """更新在线用户信息（如异步解析出的地理位置）"""
+        try:
+            return self.backend.update_user(user_key, fields)
+        except Exception as e:
+            logger.error(f"在线用户信息更新失败 [{user_key}]: {e}")
+            return False
+
+    def get_sids(self, user_key: str) -> Set[str]:
+        """获取用户的所有连接sid（跨worker）"""
+        try:
+            return self.backend.get_sids(user_key)
+        except Exception as e:
+            logger.error(f"获取用户连接失败 [{user_key}]: {e}")
+            return set()
+
+    def is_online(self, user_key: str) -> bool:
+        """用户是否至少有一个连接"""
+        return len(self.get_sids(user_key)) > 0
+
+    def is_service_online(self, service_id) -> bool:
+        """客服是否在线（service_join 与 admin_join 两种连接都算）"""
+        if not service_id:
+            return False
+        return any(self.is_online(f'{t}_{service_id}') for t in SERVICE_TYPES)
+
+    def users_by_business(self, business_id, user_types=SERVICE_TYPES) -> Set[str]:
+        """获取商户下指定类型的在线用户键"""
+        if isinstance(user_types, str):
+            user_types = (user_types,)
+        result = set()
+        try:
+            for user_type in user_types:
+                result |= self.backend.users_by_business(business_id, user_type)
+        except Exception as e:
+            logger.error(f"按商户查询在线用户失败 [{business_id}]: {e}")
+        return result
+
+    def online_service_ids(self, business_id) -> Set[int]:
+        """获取商户下在线客服ID（按账号去重）"""
+        service_ids = set()
+        for user_key in self.users_by_business(business_id, SERVICE_TYPES):
+            try:
+                service_ids.add(int(user_key.rsplit('_', 1)[1]))
+            except (IndexError, ValueError):
+                continue
+        return service_ids
+
+    def count_online_services(self, business_id) -> int:
+        """商户下在线客服数量"""
+        return len(self.online_service_ids(business_id))
+
+    # ========== 心跳与过期 ==========
+
+    def refresh_local(self):
+        """为本worker持有的所有连接刷新心跳"""
+        try:
+            self.backend.heartbeat(self._local_sids)
+        except Exception as e:
+            logger.warning(f"批量刷新心跳失败: {e}")
+
+    def sweep_expired(self) -> List[Tuple[str, Dict, int]]:
+        """
+        清理心跳超时的连接（通常是崩溃worker遗留的连接）
+
+        Returns:
+            被清理连接的 leave 结果列表
+        """
+        removed = []
+        try:
+            for sid in self.backend.expired_sids(time.time() - self.ttl):
+                result = self.leave(sid)
+                if result:
+                    removed.append(result)
+        except Exception as e:
+            logger.warning(f"清理过期连接失败: {e}")
+
+        if removed:
+            logger.info(f"🧹 已清理{len(removed)}个心跳超时的连接")
+        return removed
+
+    def start(self, socketio, on_expired=None):
+        """
+        启动心跳后台任务（每个worker一个）
+
+        Args:
+            socketio: SocketIO实例（使用其后台任务，兼容eventlet）
+            on_expired: 用户所有连接过期后的回调 callback(user_key, info)
+        """
+        if self._started:
+            return
+        self._started = True
+
+        def heartbeat_loop():
+            while True:
+                socketio.sleep(self.heartbeat_interval)
+                self.refresh_local()
+                for user_key, info, remaining in self.sweep_expired():
+                    if remaining == 0 and on_expired:
+                        try:
+                            on_expired(user_key, info)
+                        except Exception as e:
+                            logger.error(f"过期连接回调失败 [{user_key}]: {e}")
+
+        socketio.start_background_task(heartbeat_loop)
+        logger.info(f"✅ 在线状态心跳任务已启动 (间隔{self.heartbeat_interval}s, TTL {self.ttl}s)")
+
+
+# 全局单例
+presence_registry = PresenceRegistry()
@@ -0,0 +1,209 @@
+"""
+客服评价统计
+评价统计、整体统计、排行榜原来都把匹配的 ServiceRating 整行 .all() 取出后在 Python 中求和、分布、排序，
+不带 days 的整体统计会加载整张表，评价越积越多越慢。
+
+这里改为：
+- 数据库聚合：WHERE ... GROUP BY [service_id,] rating 得到评分直方图，数量、平均分、满意率都由直方图算出
+  （覆盖索引 idx_rating_service_created / idx_rating_created_service，只扫描索引）
+- 结果按 (客服, 时间窗口) 缓存 RATING_STATS_CACHE_TTL 秒（Redis，无 Redis 时进程内）
+- 提交评价后递增该客服和"全部客服"的版本号，旧缓存自然失效；其他 worker 同样可见
+
+存储结构（Redis）：
+- kefu:rating:version:{service_id|all}                  String  版本号，每次提交评价+1
+- kefu:rating:stats:{service_id|all}:{days|all}:{版本}   String  统计结果（JSON）
+- kefu:rating:ranking:{days}:{版本}                      String  排行榜（JSON，完整排序列表，返回时按 limit 截取）
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from mod.utils.cache import TTLLRUCache
+import log
+
+logger = log.get_logger(__name__)
+
+
+LEVELS = ('5', '4', '3', '2', '1')
+
+
+def summarize(histogram: Dict[int, int]) -> Dict:
+    """
+    由评分直方图计算统计数据
+
+    Args:
+        histogram: {评分: 数量}
+
+    Returns:
+        dict: total_count / avg_score / satisfaction_rate / level_distribution
+    """
+    distribution = {level: int(histogram.get(int(level), 0)) for level in LEVELS}
+    total_count = sum(distribution.values())
+    if not total_count:
+        return {'total_count': 0, 'avg_score': 0, 'satisfaction_rate': 0, 'level_distribution': distribution}
+    total_score = sum(int(level) * count for level, count in distribution.items())
+    satisfied_count = distribution['5'] + distribution['4']   # 4星及以上视为满意
+    return {
+        'total_count': total_count,
+        'avg_score': round(total_score / total_count, 2),
+        'satisfaction_rate': round(satisfied_count / total_count * 100, 2),
+        'level_distribution': distribution
+    }
+
+
+class RatingStats:
+    """
+    评价统计（SQL 聚合 + 按版本号失效的缓存）
+
+    使用方式：
+        rating_stats.summary(service_id=None, days=None)   # 某客服 / 全部客服
+        rating_stats.ranking(days=7)                        # 按平均分降序
+        rating_stats.invalidate(service_id)                 # 提交评价后调用
+    """
+
+    PREFIX = 'kefu:rating'
+    ALL = 'all'
+
+    def __init__(self, ttl: float = 300):
+        """
+        Args:
+            ttl: 缓存秒数（带 days 的窗口随时间滑动，过期后重新统计）
+        """
+        self.ttl = ttl
+        self._local = TTLLRUCache(maxsize=2000, ttl=ttl)   # 无 Redis 时使用
+        self._local_versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """从Flask配置读取缓存时间"""
+        self.ttl = app.config.get('RATING_STATS_CACHE_TTL', self.ttl)
+        self._local = TTLLRUCache(maxsize=2000, ttl=self.ttl)
+
+    @staticmethod
+    def _redis():
+        import exts
+        return exts.redis_client
+
+    # ========== 缓存 ==========
+
+    def _version(self, scope: str) -> int:
+        redis = self._redis()
+        if redis is not None:
+            try:
+                version = redis.get(f'{self.PREFIX}:version:{scope}')
+                return int(version) if version is not None else 0
+            except Exception as e:
+                logger.warning(f"读取评价统计版本失败: {e}")
+        with self._lock:
+            return self._local_versions.get(scope, 0)
+
+    def _cached(self, key: str, compute):
+        redis = self._redis()
+        if redis is not None:
+            try:
+                cached = redis.get(key)
+                if cached:
+                    return json.loads(cached)
+                value = compute()
+                redis.setex(key, int(self.ttl), json.dumps(value))
+                return value
+            except Exception as e:
+                logger.warning(f"评价统计缓存不可用: {e}")
+
+        value = self._local.get(key)
+        if value is None:
+            value = compute()
+            self._local.set(key, value)
+        return value
+
+    def invalidate(self, service_id):
+        """提交评价后使该客服及全部客服的统计失效"""
+        scopes = (str(service_id), self.ALL)
+        with self._lock:
+            for scope in scopes:
+                self._local_versions[scope] = self._local_versions.get(scope, 0) + 1
+
+        redis = self._redis()
+        if redis is None:
+            return
+        try:
+            pipe = redis.pipeline()
+            for scope in scopes:
+                pipe.incr(f'{self.PREFIX}:version:{scope}')
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"评价统计缓存失效失败: {e}")
+
+    # ========== 查询 ==========
+
+    @staticmethod
+    def _since(days: Optional[int]):
+        return datetime.now() - timedelta(days=days) if days else None
+
+    def _histogram(self, service_id: Optional[int], days: Optional[int]) -> Dict[int, int]:
+        from exts import db
+        from sqlalchemy import func
+        from mod.mysql.models import ServiceRating
+
+        query = db.session.query(ServiceRating.rating, func.count()).group_by(ServiceRating.rating)
+        if service_id:
+            query = query.filter(ServiceRating.service_id == service_id)
+        since = self._since(days)
+        if since:
+            query = query.filter(ServiceRating.created_at >= since)
+        return dict(query.all())
+
+    def summary(self, service_id: Optional[int] = None, days: Optional[int] = None) -> Dict:
+        """
+        评价统计
+
+        Args:
+            service_id: 客服ID，None 表示全部客服
+            days: 最近N天，None 表示全部
+
+        Returns:
+            dict: total_count / avg_score / satisfaction_rate / level_distribution
+        """
+        scope = str(service_id) if service_id else self.ALL
+        key = f'{self.PREFIX}:stats:{scope}:{days or self.ALL}:{self._version(scope)}'
+        return self._cached(key, lambda: summarize(self._histogram(service_id, days)))
+
+    def _compute_ranking(self, days: int) -> List[Dict]:
+        from exts import db
+        from sqlalchemy import func
+        from mod.mysql.models import ServiceRating, Service
+
+        query = db.session.query(
+            ServiceRating.service_id, ServiceRating.rating, func.count()
+        ).group_by(ServiceRating.service_id, ServiceRating.rating)
+        since = self._since(days)
+        if since:
+            query = query.filter(ServiceRating.created_at >= since)
+        rows = query.all()
+
+        histograms: Dict[int, Dict[int, int]] = {}
+        for service_id, rating, count in rows:
+            histograms.setdefault(service_id, {})[rating] = count
+        if not histograms:
+            return []
+
+        names = dict(db.session.query(Service.service_id, Service.nick_name).filter(
+            Service.service_id.in_(list(histograms))
+        ).all())
+
+        ranking = []
+        for service_id, histogram in histograms.items():
+            if service_id not in names:   # 客服已删除
+                continue
+            ranking.append({'service_id': service_id, 'service_name': names[service_id], **summarize(histogram)})
+        ranking.sort(key=lambda x: x['avg_score'], reverse=True)
+        return ranking
+
+    def ranking(self, days: int = 7, limit: int = 10) -> List[Dict]:
+        """客服评价排行榜（按平均分降序）"""
+        key = f'{self.PREFIX}:ranking:{days}:{self._version(self.ALL)}'
+        return self._cached(key, lambda: self._compute_ranking(days))[:limit]
+
+
+# 全局单例
+rating_stats = RatingStats()
@@ -0,0 +1,255 @@
+"""
+访客活跃会话缓存
+"访客当前进行中的会话"（Queue.query.filter_by(visitor_id, business_id, state='normal').first()）
+在发送消息、回复权限检查、结束会话、在线列表（每个访客一次）和多个接口中反复查询，
+一条消息的处理路径上就有 2-4 次相同的查询。
+
+这里按 (商户, 访客) 缓存会话快照：qid / service_id / state / last_message_time / 专属客服信息
+- 读穿透：缓存未命中时查询一次数据库并写入缓存（只缓存进行中的会话，不缓存"没有会话"）
+- 写穿透：Queue 对象经 ORM 插入/更新并提交后，用刷新时的值直接覆盖缓存
+  （分配、转接、结束、拉黑均走 ORM，不需要在各处手动失效）；会话不再是 normal 时删除缓存
+- 绕过 ORM 的批量 UPDATE（离线批处理、批量分配）由调用方调用 invalidate
+- 缓存带 TTL，兜底修正并发写入造成的短暂不一致
+
+存储结构（Redis，所有 worker 共享）：
+- kefu:session:{business_id}:{visitor_id}   String  会话快照JSON
+Redis 不可用时使用进程内 TTL LRU 缓存
+"""
+import json
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from mod.utils.cache import TTLLRUCache
+import log
+
+logger = log.get_logger(__name__)
+
+
+class ActiveSession:
+    """进行中会话的快照（只读，字段与 Queue 同名，可直接替代 Queue 对象读取这些字段）"""
+
+    FIELDS = ('qid', 'business_id', 'visitor_id', 'service_id', 'state',
+              'last_message_time', 'is_exclusive', 'exclusive_service_id')
+
+    __slots__ = FIELDS
+
+    def __init__(self, qid, business_id, visitor_id, service_id=None, state='normal',
+                 last_message_time=None, is_exclusive=0, exclusive_service_id=None):
+        self.qid = qid
+        self.business_id = business_id
+        self.visitor_id = visitor_id
+        self.service_id = service_id
+        self.state = state
+        self.last_message_time = last_message_time
+        self.is_exclusive = is_exclusive
+        self.exclusive_service_id = exclusive_service_id
+
+    @classmethod
+    def from_queue(cls, queue) -> 'ActiveSession':
+        return cls(**{field: getattr(queue, field) for field in cls.FIELDS})
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'ActiveSession':
+        data = dict(data)
+        if data.get('last_message_time'):
+            data['last_message_time'] = datetime.fromisoformat(data['last_message_time'])
+        return cls(**data)
+
+    def to_dict(self) -> Dict:
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        if self.last_message_time:
+            data['last_message_time'] = self.last_message_time.isoformat()
+        return data
+
+    def __repr__(self):
+        return f'<ActiveSession {self.qid} visitor={self.visitor_id} service={self.service_id}>'
+
+
+class ActiveSessionCache:
+    """
+    活跃会话缓存
+
+    使用方式：
+        session = active_sessions.get(business_id, visitor_id)   # ActiveSession 或 None
+        sessions = active_sessions.get_many(business_id, visitor_ids)
+    """
+
+    PREFIX = 'kefu:session'
+    PENDING_KEY = 'kefu_active_sessions'   # Session.info 中待提交的快照
+
+    def __init__(self, ttl: int = 60):
+        """
+        Args:
+            ttl: 缓存有效期（秒）
+        """
+        self.ttl = ttl
+        self._local = TTLLRUCache(maxsize=20000, ttl=ttl)   # 无 Redis 时使用
+        self._installed = False
+
+    def init_app(self, app):
+        """从Flask配置读取有效期和进程内缓存大小（ORM 事件在模块导入时已注册）"""
+        self.ttl = app.config.get('SESSION_CACHE_TTL', self.ttl)
+        self._local = TTLLRUCache(maxsize=app.config.get('SESSION_CACHE_SIZE', 20000), ttl=self.ttl)
+
+    @staticmethod
+    def _redis():
+        import exts
+        return exts.redis_client
+
+    def _key(self, business_id, visitor_id) -> str:
+        return f'{self.PREFIX}:{business_id}:{visitor_id}'
+
+    # ========== 读取 ==========
+
+    def get(self, business_id, visitor_id: str) -> Optional[ActiveSession]:
+        """
+        访客当前进行中的会话（缓存未命中时查询数据库）
+
+        Returns:
+            ActiveSession，没有进行中的会话返回None
+        """
+        if not visitor_id:
+            return None
+        cached = self._read([self._key(business_id, visitor_id)])[0]
+        if cached is not None:
+            return cached
+
+        from mod.mysql.models import Queue
+        queue = Queue.query.filter_by(
+            visitor_id=visitor_id,
+            business_id=business_id,
+            state='normal'
+        ).order_by(Queue.created_at.desc()).first()
+        if queue is None:
+            return None
+        session = ActiveSession.from_queue(queue)
+        self._write([session])
+        return session
+
+    def get_many(self, business_id, visitor_ids: Iterable[str]) -> Dict[str, ActiveSession]:
+        """
+        批量读取（一次 MGET，未命中的访客合并为一次 IN 查询）
+
+        Returns:
+            {visitor_id: ActiveSession}，没有进行中会话的访客不在结果中
+        """
+        visitor_ids = [vid for vid in dict.fromkeys(visitor_ids) if vid]
+        if not visitor_ids:
+            return {}
+        cached = self._read([self._key(business_id, vid) for vid in visitor_ids])
+        result = {vid: s for vid, s in zip(visitor_ids, cached) if s is not None}
+
+        missing = [vid for vid in visitor_ids if vid not in result]
+        if missing:
+            from mod.mysql.models import Queue
+            rows = Queue.query.filter(
+                Queue.visitor_id.in_(missing),
+                Queue.business_id == business_id,
+                Queue.state == 'normal'
+            ).order_by(Queue.created_at.asc()).all()
+            loaded = {q.visitor_id: ActiveSession.from_queue(q) for q in rows}  # 同一访客保留最新一条
+            self._write(loaded.values())
+            result.update(loaded)
+        return result
+
+    def _read(self, keys: List[str]) -> List[Optional[ActiveSession]]:
+        redis = self._redis()
+        if redis is not None:
+            try:
+                raws = redis.mget(keys)
+                return [ActiveSession.from_dict(json.loads(raw)) if raw else None for raw in raws]
+            except Exception as e:
+                logger.warning(f"读取会话缓存失败: {e}")
+        return [self._local.get(key) for key in keys]
+
+    # ========== 写入 / 失效 ==========
+
+    def _write(self, sessions: Iterable[ActiveSession]):
+        sessions = list(sessions)
+        if not sessions:
+            return
+        redis = self._redis()
+        if redis is not None:
+            try:
+                pipe = redis.pipeline(transaction=False)
+                for s in sessions:
+                    pipe.set(self._key(s.business_id, s.visitor_id),
+                             json.dumps(s.to_dict(), ensure_ascii=False), ex=self.ttl)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.warning(f"写入会话缓存失败: {e}")
+        for s in sessions:
+            self._local.set(self._key(s.business_id, s.visitor_id), s)
+
+    def touch(self, session: ActiveSession, last_message_time: datetime):
+        """会话有新消息：更新快照中的最后消息时间（同时续期）"""
+        session.last_message_time = last_message_time
+        self._write([session])
+
+    def invalidate(self, business_id, visitor_ids: Iterable[str]):
+        """删除访客的会话缓存（绕过 ORM 的批量更新后调用）"""
+        keys = [self._key(business_id, vid) for vid in visitor_ids if vid]
+        if not keys:
+            return
+        redis = self._redis()
+        if redis is not None:
+            try:
+                redis.delete(*keys)
+            except Exception as e:
+                logger.warning(f"删除会话缓存失败: {e}")
+        for key in keys:
+            self._local.pop(key)
+
+    # ========== ORM 写穿透 ==========
+
+    def _install_events(self):
+        if self._installed:
+            return
+        self._installed = True
+
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session, object_session
+        from mod.mysql.models import Queue
+
+        def on_flush(mapper, connection, target):
+            """记录刷新时的会话快照，提交后再写入缓存"""
+            session = object_session(target)
+            if session is None or not target.visitor_id or not target.business_id:
+                return
+            pending = session.info.setdefault(self.PENDING_KEY, {})
+            key = (target.business_id, target.visitor_id)
+            previous = pending.get(key)
+            # 同一事务中同一访客的旧会话被关闭时，不覆盖新会话
+            if previous is not None and previous.state == 'normal' and target.state != 'normal' \
+                    and previous.qid != target.qid:
+                return
+            pending[key] = ActiveSession.from_queue(target)
+
+        def on_commit(session):
+            pending = session.info.pop(self.PENDING_KEY, None)
+            if not pending:
+                return
+            try:
+                active = [s for s in pending.values() if s.state == 'normal']
+                closed = [s for s in pending.values() if s.state != 'normal']
+                self._write(active)
+                for s in closed:
+                    self.invalidate(s.business_id, [s.visitor_id])
+            except Exception as e:
+                logger.warning(f"同步会话缓存失败: {e}")
+
+        def on_rollback(session):
+            session.info.pop(self.PENDING_KEY, None)
+
+        event.listen(Queue, 'after_insert', on_flush)
+        event.listen(Queue, 'after_update', on_flush)
+        event.listen(Session, 'after_commit', on_commit)
+        event.listen(Session, 'after_rollback', on_rollback)
+
+
+# 全局单例
+active_sessions = ActiveSessionCache()
+
+# 写穿透事件在导入时注册，不等 init_app：
+# 任何 worker 上的 Queue 提交（结束、分配、转接）都必须同步缓存，否则其他 worker 会读到过期快照
+active_sessions._install_events()
@@ -0,0 +1,52 @@
+"""
+Socket.IO 房间命名与客服角色房间管理
+消息扇出统一通过房间完成：一次 emit 由 Socket.IO（及其 Redis 消息队列）
+投递给所有 worker 上的房间成员，不再在 Python 中遍历 online_users 逐个 sid 发送
+
+房间划分（按商户隔离）：
+- biz_{business_id}_admins          管理员（super_manager / manager）
+- biz_{business_id}_services        普通客服
+- biz_{business_id}_agent_{id}      单个客服的所有连接（多标签页）
+"所有客服" = [管理员房间, 普通客服房间]
+"""
+from flask_socketio import join_room
+
+
+def admins_room(business_id) -> str:
+    """商户管理员房间"""
+    return f'biz_{business_id}_admins'
+
+
+def services_room(business_id) -> str:
+    """商户普通客服房间"""
+    return f'biz_{business_id}_services'
+
+
+def agent_room(business_id, service_id) -> str:
+    """单个客服房间"""
+    return f'biz_{business_id}_agent_{service_id}'
+
+
+def all_agents_rooms(business_id) -> list:
+    """商户所有客服（含管理员）"""
+    return [admins_room(business_id), services_room(business_id)]
+
+
+def agent_and_admins_rooms(business_id, service_id) -> list:
+    """
+    指定客服 + 所有管理员（未分配时只有管理员）
+    Socket.IO 对多房间发送会按 sid 去重，管理员本身是被分配客服时不会收到两次
+    """
+    rooms = [admins_room(business_id)]
+    if service_id:
+        rooms.append(agent_room(business_id, service_id))
+    return rooms
+
+
+def join_agent_rooms(business_id, service_id, is_admin: bool):
+    """
+    当前连接加入客服角色房间（在 service_join / admin_join 中调用）
+    断开连接时 Socket.IO 会自动将 sid 移出所有房间
+    """
+    join_room(agent_room(business_id, service_id))
+    join_room(admins_room(business_id) if is_admin else services_room(business_id))
@@ -0,0 +1,159 @@
+"""
+后台服务启动
+在线状态心跳、写后持久化、对账循环等后台服务原来只在 @app.before_first_request 中启动，
+而 Socket.IO / Engine.IO 的流量不会触发 before_first_request：只处理 WebSocket 的 worker 从不刷新心跳，
+PRESENCE_TTL 后被其他 worker 当作崩溃清理，仍在线的访客和客服被按离线处理。
+
+这里集中启动所有后台服务，在 worker 开始处理流量前调用（每个进程只执行一次）：
+- python app.py：socketio.run 之前
+- gunicorn：post_worker_init 钩子（见 gunicorn_config.py.template）
+- 其他启动方式：第一次 HTTP 请求或第一次 Socket.IO 连接时兜底
+
+每个服务单独 try/except，一个服务启动失败不影响其他服务。
+"""
+import log
+
+logger = log.get_logger(__name__)
+
+_started = False
+
+
+def start_services(app, socketio):
+    """
+    启动所有后台服务（幂等）
+
+    Args:
+        app: Flask应用
+        socketio: SocketIO实例
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+
+    # 会话监控定时任务
+    try:
+        from mod.tasks import start_session_monitor
+        start_session_monitor(app, socketio)
+    except Exception as e:
+        logger.error(f"启动会话监控任务失败: {e}")
+
+    # 集群在线状态心跳
+    try:
+        import socketio_events
+        from mod.services.presence_service import presence_registry
+        presence_registry.init_app(app)
+        presence_registry.start(socketio, on_expired=socketio_events.handle_presence_expired)
+    except Exception as e:
+        logger.error(f"启动在线状态心跳任务失败: {e}")
+
+    try:
+        from mod.services.offline_batcher import visitor_offline_batcher
+        visitor_offline_batcher.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化访客离线批处理失败: {e}")
+
+    try:
+        from mod.services.stats_publisher import stats_publisher
+        stats_publisher.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化统计推送失败: {e}")
+
+    try:
+        from mod.services.unread_counter import unread_counter
+        unread_counter.init_app(app)
+        unread_counter.start(socketio)
+    except Exception as e:
+        logger.error(f"启动未读计数对账任务失败: {e}")
+
+    try:
+        from mod.services.waiting_line import waiting_line
+        waiting_line.init_app(app)
+        waiting_line.start(socketio)
+    except Exception as e:
+        logger.error(f"启动排队队列对账任务失败: {e}")
+
+    try:
+        from mod.services.assignment_engine import assignment_engine
+        assignment_engine.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化分配引擎失败: {e}")
+
+    try:
+        from mod.services.wait_estimator import wait_estimator
+        wait_estimator.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化等待时间估算失败: {e}")
+
+    try:
+        from mod.services.session_cache import active_sessions
+        active_sessions.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化会话缓存失败: {e}")
+
+    try:
+        from mod.services.blacklist import blacklist
+        blacklist.init_app(app)
+        blacklist.start(socketio)
+    except Exception as e:
+        logger.error(f"启动黑名单同步任务失败: {e}")
+
+    try:
+        from mod.services.chat_export import chat_exporter
+        chat_exporter.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化聊天记录导出失败: {e}")
+
+    try:
+        from mod.services.stats_rollup import stats_rollup
+        stats_rollup.init_app(app)
+        stats_rollup.start(socketio)
+    except Exception as e:
+        logger.error(f"启动统计汇总任务失败: {e}")
+
+    try:
+        from mod.services.unique_visitors import unique_visitors
+        unique_visitors.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化去重访客计数失败: {e}")
+
+    try:
+        from mod.services.rating_stats import rating_stats
+        rating_stats.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化评价统计失败: {e}")
+
+    try:
+        from mod.services.chat_analytics import chat_analytics
+        chat_analytics.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化会话时长分析失败: {e}")
+
+    try:
+        from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
+        workload_manager.start(socketio, app.config.get('WORKLOAD_RECONCILE_INTERVAL', 120))
+    except Exception as e:
+        logger.error(f"启动客服负载对账任务失败: {e}")
+
+    # 后台任务池
+    try:
+        from mod.services.task_pool import task_pool
+        task_pool.init_app(app)
+    except Exception as e:
+        logger.error(f"初始化后台任务池失败: {e}")
+
+    # 本地IP地理位置库
+    try:
+        from mod.utils.ip_geo import ip_geo_engine
+        ip_geo_engine.init_app(app)
+    except Exception as e:
+        logger.error(f"加载IP地理位置库失败: {e}")
+
+    # 消息写后持久化（MESSAGE_WRITE_BEHIND 开启时）
+    try:
+        from mod.services.message_writer import message_writer
+        message_writer.init_app(app)
+    except Exception as e:
+        logger.error(f"启动消息写后持久化失败: {e}")
+
+    logger.info("✅ 后台服务已启动")
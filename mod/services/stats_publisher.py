@@ -0,0 +1,217 @@
+"""
+实时统计推送
+原来每条消息都会调用 broadcast_statistics_update：查询实时统计 + 向所有连接（包括访客）广播，
+防抖状态存在进程内字典中，多 worker 时各自防抖。
+
+现在改为：
+- 业务事件只把商户标记为"待推送"（Redis 集合，所有 worker 共享），O(1)
+- 后台任务按固定频率取出待推送商户，每个商户每个周期在整个集群内最多推送一次（Redis NX 锁）
+- 与上次推送的数据（存在 Redis 中）比较，只推送变化的字段
+- 只推送到商户管理员房间
+消息吞吐量不再决定统计查询和推送的次数
+"""
+import threading
+from datetime import datetime
+from typing import Dict
+import log
+
+logger = log.get_logger(__name__)
+
+# 推送给管理员仪表盘的统计字段
+STAT_FIELDS = ('total_visitors', 'chatting_count', 'online_services', 'waiting_count')
+
+
+class StatisticsPublisher:
+    """
+    商户实时统计推送器
+
+    设计原则：
+    - mark_dirty 只做标记，不查库不推送
+    - 推送频率由 interval 控制，与消息量无关
+    - Redis 不可用时退化为进程内标记和比较
+    """
+
+    PREFIX = 'kefu:stats'
+
+    def __init__(self, interval: float = 3.0):
+        """
+        Args:
+            interval: 推送周期（秒），同一商户在一个周期内最多推送一次
+        """
+        self.interval = interval
+        self._local_dirty = set()
+        self._local_last: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def init_app(self, app):
+        """从Flask配置读取推送周期"""
+        self.interval = app.config.get('STATS_PUBLISH_INTERVAL', self.interval)
+
+    def _key(self, *parts) -> str:
+        return ':'.join((self.PREFIX,) + tuple(str(p) for p in parts))
+
+    @staticmethod
+    def _redis():
+        import exts
+        return exts.redis_client
+
+    # ========== 标记 ==========
+
+    def mark_dirty(self, business_id):
+        """
+        标记商户统计数据已变化（首次调用时自动启动推送任务）
+
+        Args:
+            business_id: 商户ID
+        """
+        if not business_id:
+            return
+        redis = self._redis()
+        try:
+            if redis is not None:
+                redis.sadd(self._key('dirty'), business_id)
+            else:
+                with self._lock:
+                    self._local_dirty.add(int(business_id))
+        except Exception as e:
+            logger.warning(f"标记统计更新失败: {e}")
+            with self._lock:
+                self._local_dirty.add(int(business_id))
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        self._started = True
+
+        from exts import socketio
+
+        def publish_loop():
+            while True:
+                socketio.sleep(self.interval)
+                try:
+                    self.publish_pending()
+                except Exception as e:
+                    logger.error(f"推送统计更新失败: {e}")
+
+        socketio.start_background_task(publish_loop)
+        logger.info(f"✅ 统计推送任务已启动 (周期{self.interval}s)")
+
+    # ========== 推送 ==========
+
+    def _take_dirty(self):
+        """取出待推送商户（Redis 中的标记由各 worker 共同消费）"""
+        with self._lock:
+            business_ids, self._local_dirty = self._local_dirty, set()
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                popped = redis.spop(self._key('dirty'), 1000) or []
+                business_ids.update(int(b) for b in popped)
+            except Exception as e:
+                logger.warning(f"读取待推送商户失败: {e}")
+        return business_ids
+
+    def _acquire_slot(self, business_id) -> bool:
+        """本周期内是否由当前 worker 推送该商户（集群内每周期最多一次）"""
+        redis = self._redis()
+        if redis is None:
+            return True
+        try:
+            return bool(redis.set(self._key('slot', business_id), 1,
+                                  nx=True, px=int(self.interval * 1000)))
+        except Exception:
+            return True
+
+    def publish_pending(self) -> int:
+        """
+        推送所有待推送商户的统计变化
+
+        Returns:
+            实际推送的商户数
+        """
+        business_ids = self._take_dirty()
+        if not business_ids:
+            return 0
+
+        from exts import app, db
+
+        published = 0
+        deferred = []
+        with app.app_context():
+            try:
+                for business_id in business_ids:
+                    if not self._acquire_slot(business_id):
+                        deferred.append(business_id)
+                        continue
+                    if self.publish(business_id):
+                        published += 1
+            finally:
+                db.session.remove()
+
+        # 其他 worker 本周期已推送过的商户，留到下个周期
+        for business_id in deferred:
+            self.mark_dirty(business_id)
+        return published
+
+    def publish(self, business_id, full: bool = False) -> bool:
+        """
+        查询商户实时统计，向管理员房间推送变化的字段
+
+        Args:
+            business_id: 商户ID
+            full: 是否推送全部字段
+
+        Returns:
+            是否有推送
+        """
+        from exts import socketio
+        from mod.mysql.ModuleClass import StatisticsService
+        from mod.services.socket_rooms import admins_room
+
+        realtime = StatisticsService(business_id, None, 'super_manager').get_realtime_stats()
+        current = {field: int(realtime.get(field) or 0) for field in STAT_FIELDS}
+
+        last = self._load_last(business_id)
+        changed = current if full else {k: v for k, v in current.items() if last.get(k) != v}
+        if not changed:
+            logger.debug(f"⏸️ 商户{business_id}统计无变化，跳过推送")
+            return False
+
+        self._save_last(business_id, current)
+        socketio.emit('statistics_update', dict(changed, timestamp=datetime.now().isoformat()),
+                      room=admins_room(business_id))
+        logger.info(f"📊 已推送商户{business_id}统计变化: {changed}")
+        return True
+
+    def _load_last(self, business_id) -> Dict:
+        redis = self._redis()
+        if redis is not None:
+            try:
+                raw = redis.hgetall(self._key('last', business_id))
+                return {
+                    (k.decode() if isinstance(k, bytes) else k): int(v)
+                    for k, v in raw.items()
+                }
+            except Exception:
+                pass
+        return dict(self._local_last.get(business_id, {}))
+
+    def _save_last(self, business_id, data: Dict):
+        self._local_last[business_id] = data
+        redis = self._redis()
+        if redis is not None:
+            try:
+                key = self._key('last', business_id)
+                pipe = redis.pipeline()
+                pipe.hset(key, mapping=data)
+                pipe.expire(key, 86400)
+                pipe.execute()
+            except Exception as e:
+                logger.warning(f"保存统计快照失败: {e}")
+
+
+# 全局单例
+stats_publisher = StatisticsPublisher()
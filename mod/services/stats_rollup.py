@@ -0,0 +1,424 @@
+"""
+统计汇总（数据看板）
+看板的今日 / 趋势 / 概览统计原来每次请求都扫描 chats、queues、visitors、comments，
+趋势图每天 3 条查询（默认 15 天就是 45 条）；visitor_stats_cache 汇总表只统计 business_id = 1。
+
+这里按 (商户, 客服, 时间桶) 维护两张汇总表：
+- stats_hourly：每小时的消息数、新会话数、结束会话数、去重访客数、新访客数、评价数、首次响应时间
+- stats_daily：可累加的指标由 stats_hourly 相加，去重访客数按天单独统计（不能由小时相加）
+- service_id = 0 的行是整个商户的汇总（包括机器人消息和未分配的会话）
+
+维护方式：
+- 后台任务每 STATS_ROLLUP_INTERVAL 秒重算最近 STATS_ROLLUP_LOOKBACK_HOURS 小时的小时桶及其所在的天
+  （重算 = 在一个事务内删除时间窗口内的汇总行后重新插入，可重复执行）
+- 多个 worker 通过 Redis 锁保证同一周期只有一个在重算
+- 启动后自动回填汇总表最早一天之前的全部历史（首次部署即全量回填；从近到远按天提交，
+  中断后下次启动从断点继续），之后"累计"类指标就是全部历史的合计
+- 修复某段历史数据后可用 backfill(start, end) 重算（见 backfill_stats.py）；
+  只重算明细仍完整保留的日期，已被清理的日期会被跳过，否则会用空明细覆盖汇总
+看板读取汇总表，最新数据最多延迟一个周期。
+chats / queues 超过60天的明细会被清理任务删除，汇总表不受影响，累计数不会随之减少。
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional, Tuple
+import log
+
+logger = log.get_logger(__name__)
+
+
+ALL_SERVICES = 0   # 全商户汇总行的 service_id
+
+METRICS = ('messages', 'sessions', 'completed_sessions', 'visitors', 'new_visitors',
+           'comments', 'response_time_sum', 'response_count')
+
+# 可由小时桶相加得到天汇总的指标
+ADDITIVE_METRICS = tuple(m for m in METRICS if m != 'visitors')
+
+
+def floor_hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+class StatsRollup:
+    """
+    统计汇总维护
+
+    使用方式：
+        stats_rollup.refresh()                     # 重算最近的时间桶（后台任务调用）
+        stats_rollup.backfill(date(2025, 1, 1))    # 重算历史数据（跳过明细已清理的日期）
+    """
+
+    LOCK_KEY = 'kefu:stats_rollup:lock'
+    BACKFILL_LOCK_KEY = 'kefu:stats_rollup:backfill_lock'
+
+    def __init__(self, interval: float = 60, lookback_hours: int = 2):
+        """
+        Args:
+            interval: 后台重算间隔（秒）
+            lookback_hours: 每次重算最近多少小时（覆盖晚到的数据，如会话结束、首次回复）
+        """
+        self.interval = interval
+        self.lookback_hours = lookback_hours
+        self._started = False
+
+    def init_app(self, app):
+        """从Flask配置读取重算间隔"""
+        self.interval = app.config.get('STATS_ROLLUP_INTERVAL', self.interval)
+        self.lookback_hours = app.config.get('STATS_ROLLUP_LOOKBACK_HOURS', self.lookback_hours)
+
+    # ========== 聚合 ==========
+
+    @staticmethod
+    def _hour(column):
+        from sqlalchemy import func
+        return func.date_format(column, '%Y-%m-%d %H:00:00')
+
+    @staticmethod
+    def _bucket(value) -> datetime:
+        return value if isinstance(value, datetime) else datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+    def _aggregate_hourly(self, start: datetime, end: datetime) -> Dict[Tuple, Dict[str, int]]:
+        """
+        统计 [start, end) 内各小时的指标
+
+        Returns:
+            {(business_id, service_id, bucket): {指标: 值}}
+        """
+        from sqlalchemy import and_, distinct, func, or_, text
+        from exts import db
+        from mod.mysql.models import Chat, Comment, Queue, Visitor
+
+        rows = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+
+        def add(business_id, service_id, bucket, metric, value, to_all=True):
+            bucket = self._bucket(bucket)
+            if service_id and service_id > 0:
+                rows[(business_id, service_id, bucket)][metric] += int(value or 0)
+            if to_all:
+                rows[(business_id, ALL_SERVICES, bucket)][metric] += int(value or 0)
+
+        # 消息数、去重访客数：按客服一次，全商户一次（去重数不能相加）
+        hour = self._hour(Chat.created_at)
+        window = and_(Chat.created_at >= start, Chat.created_at < end)
+        for business_id, service_id, bucket, messages, visitors in db.session.query(
+                Chat.business_id, Chat.service_id, hour, func.count(Chat.cid), func.count(distinct(Chat.visitor_id))
+        ).filter(window, Chat.service_id > 0).group_by(Chat.business_id, Chat.service_id, hour):
+            add(business_id, service_id, bucket, 'messages', messages, to_all=False)
+            add(business_id, service_id, bucket, 'visitors', visitors, to_all=False)
+        for business_id, bucket, messages, visitors in db.session.query(
+                Chat.business_id, hour, func.count(Chat.cid), func.count(distinct(Chat.visitor_id))
+        ).filter(window).group_by(Chat.business_id, hour):
+            add(business_id, ALL_SERVICES, bucket, 'messages', messages)
+            add(business_id, ALL_SERVICES, bucket, 'visitors', visitors)
+
+        # 新会话数（按创建时间）
+        hour = self._hour(Queue.created_at)
+        for business_id, service_id, bucket, count in db.session.query(
+                Queue.business_id, Queue.service_id, hour, func.count(Queue.qid)
+        ).filter(Queue.created_at >= start, Queue.created_at < end).group_by(
+                Queue.business_id, Queue.service_id, hour):
+            add(business_id, service_id, bucket, 'sessions', count)
+
+        # 结束会话数（按结束时间）
+        hour = self._hour(Queue.updated_at)
+        for business_id, service_id, bucket, count in db.session.query(
+                Queue.business_id, Queue.service_id, hour, func.count(Queue.qid)
+        ).filter(Queue.state == 'complete', Queue.updated_at >= start, Queue.updated_at < end).group_by(
+                Queue.business_id, Queue.service_id, hour):
+            add(business_id, service_id, bucket, 'completed_sessions', count)
+
+        # 新访客数（只有全商户行）
+        hour = self._hour(Visitor.created_at)
+        for business_id, bucket, count in db.session.query(
+                Visitor.business_id, hour, func.count(Visitor.vid)
+        ).filter(Visitor.created_at >= start, Visitor.created_at < end).group_by(Visitor.business_id, hour):
+            add(business_id, ALL_SERVICES, bucket, 'new_visitors', count)
+
+        # 评价数
+        hour = self._hour(Comment.add_time)
+        for business_id, service_id, bucket, count in db.session.query(
+                Comment.business_id, Comment.service_id, hour, func.count(Comment.id)
+        ).filter(Comment.add_time >= start, Comment.add_time < end).group_by(
+                Comment.business_id, Comment.service_id, hour):
+            add(business_id, service_id, bucket, 'comments', count)
+
+        # 首次响应时间：会话创建后该客服发给访客的第一条消息（按会话创建时间归桶）
+        first_reply = db.session.query(
+            Queue.business_id.label('business_id'),
+            Queue.service_id.label('service_id'),
+            Queue.created_at.label('created_at'),
+            func.min(Chat.created_at).label('replied_at')
+        ).join(Chat, and_(
+            Chat.business_id == Queue.business_id,
+            Chat.visitor_id == Queue.visitor_id,
+            Chat.service_id == Queue.service_id,
+            Chat.direction == 'to_visitor',
+            Chat.created_at >= Queue.created_at,
+            # 只算本次会话期间的回复（与 chat_analytics 的定义相同）
+            or_(Queue.state != 'complete', Queue.updated_at.is_(None), Chat.created_at <= Queue.updated_at)
+        )).filter(
+            Queue.created_at >= start,
+            Queue.created_at < end,
+            Queue.service_id > 0
+        ).group_by(Queue.qid, Queue.business_id, Queue.service_id, Queue.created_at).subquery()
+        hour = self._hour(first_reply.c.created_at)
+        for business_id, service_id, bucket, total, count in db.session.query(
+                first_reply.c.business_id, first_reply.c.service_id, hour,
+                func.sum(func.timestampdiff(text('SECOND'), first_reply.c.created_at, first_reply.c.replied_at)),
+                func.count()
+        ).group_by(first_reply.c.business_id, first_reply.c.service_id, hour):
+            add(business_id, service_id, bucket, 'response_time_sum', total)
+            add(business_id, service_id, bucket, 'response_count', count)
+
+        return rows
+
+    def _daily_visitors(self, start: date, end: date) -> Dict[Tuple, int]:
+        """[start, end) 内每天的去重访客数 {(business_id, service_id, day): 数量}"""
+        from sqlalchemy import distinct, func
+        from exts import db
+        from mod.mysql.models import Chat
+
+        day = func.date(Chat.created_at)
+        window = (Chat.created_at >= datetime.combine(start, datetime.min.time()),
+                  Chat.created_at < datetime.combine(end, datetime.min.time()))
+        result = {}
+        for business_id, service_id, bucket, count in db.session.query(
+                Chat.business_id, Chat.service_id, day, func.count(distinct(Chat.visitor_id))
+        ).filter(*window, Chat.service_id > 0).group_by(Chat.business_id, Chat.service_id, day):
+            result[(business_id, service_id, bucket)] = count
+        for business_id, bucket, count in db.session.query(
+                Chat.business_id, day, func.count(distinct(Chat.visitor_id))
+        ).filter(*window).group_by(Chat.business_id, day):
+            result[(business_id, ALL_SERVICES, bucket)] = count
+        return result
+
+    # ========== 重算 ==========
+
+    def refresh_hourly(self, start: datetime, end: datetime) -> int:
+        """重算 [start, end) 内的小时桶（调用方提交事务），返回写入行数"""
+        from exts import db
+        from mod.mysql.models import StatsHourly
+
+        rows = self._aggregate_hourly(start, end)
+        StatsHourly.query.filter(StatsHourly.bucket >= start, StatsHourly.bucket < end).delete(
+            synchronize_session=False)
+        now = datetime.now()
+        db.session.bulk_insert_mappings(StatsHourly, [
+            dict(business_id=b, service_id=s, bucket=bucket, updated_at=now, **metrics)
+            for (b, s, bucket), metrics in rows.items()
+        ])
+        return len(rows)
+
+    def refresh_daily(self, start: date, end: date) -> int:
+        """由小时桶重算 [start, end) 内的天汇总（调用方提交事务），返回写入行数"""
+        from sqlalchemy import func
+        from exts import db
+        from mod.mysql.models import StatsDaily, StatsHourly
+
+        day = func.date(StatsHourly.bucket)
+        totals = db.session.query(
+            StatsHourly.business_id, StatsHourly.service_id, day,
+            *[func.sum(getattr(StatsHourly, m)) for m in ADDITIVE_METRICS]
+        ).filter(
+            StatsHourly.bucket >= datetime.combine(start, datetime.min.time()),
+            StatsHourly.bucket < datetime.combine(end, datetime.min.time())
+        ).group_by(StatsHourly.business_id, StatsHourly.service_id, day).all()
+        visitors = self._daily_visitors(start, end)
+
+        StatsDaily.query.filter(StatsDaily.bucket >= start, StatsDaily.bucket < end).delete(
+            synchronize_session=False)
+        now = datetime.now()
+        mappings = []
+        for business_id, service_id, bucket, *sums in totals:
+            key = (business_id, service_id, bucket)
+            metrics = {m: int(v or 0) for m, v in zip(ADDITIVE_METRICS, sums)}
+            mappings.append(dict(business_id=business_id, service_id=service_id, bucket=bucket,
+                                 visitors=visitors.get(key, 0), updated_at=now, **metrics))
+        db.session.bulk_insert_mappings(StatsDaily, mappings)
+        return len(mappings)
+
+    def refresh(self, now: datetime = None):
+        """重算最近 lookback_hours 小时的小时桶，以及这些小时所在的天"""
+        from exts import db
+
+        now = now or datetime.now()
+        start = floor_hour(now) - timedelta(hours=self.lookback_hours)
+        end = floor_hour(now) + timedelta(hours=1)
+        try:
+            hourly = self.refresh_hourly(start, end)
+            daily = self.refresh_daily(start.date(), now.date() + timedelta(days=1))
+            db.session.commit()
+            logger.debug(f"📊 统计汇总已更新: {hourly}个小时桶, {daily}个天汇总")
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def _backfill_day(self, day: date):
+        """重算一天的汇总（一个事务）"""
+        from exts import db
+
+        day_start = datetime.combine(day, datetime.min.time())
+        try:
+            hourly = self.refresh_hourly(day_start, day_start + timedelta(days=1))
+            daily = self.refresh_daily(day, day + timedelta(days=1))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        logger.info(f"📊 回填 {day}: {hourly}个小时桶, {daily}个天汇总")
+
+    def backfill(self, start: date, end: date = None) -> int:
+        """
+        重算 [start, end] 的历史汇总（按天提交，需要应用上下文）
+        早于 _repairable_start() 的日期明细已被清理（或不完整），跳过
+
+        Args:
+            start: 开始日期
+            end: 结束日期（含），默认今天
+
+        Returns:
+            重算的天数
+        """
+        end = end or date.today()
+        floor = self._repairable_start()
+        if floor is None:
+            logger.warning("⚠️ 明细表为空，没有可重算的日期")
+            return 0
+        if start < floor:
+            logger.warning(f"⚠️ {start} ~ {floor - timedelta(days=1)} 的明细已被清理，跳过（保留现有汇总）")
+            start = floor
+
+        days = 0
+        day = start
+        while day <= end:
+            self._backfill_day(day)
+            days += 1
+            day += timedelta(days=1)
+        return days
+
+    @staticmethod
+    def _history_start() -> Optional[date]:
+        """明细表中最早的一天"""
+        from sqlalchemy import func
+        from exts import db
+        from mod.mysql.models import Chat, Comment, Queue, Visitor
+
+        earliest = [
+            db.session.query(func.min(column)).scalar()
+            for column in (Chat.created_at, Queue.created_at, Visitor.created_at, Comment.add_time)
+        ]
+        earliest = [dt for dt in earliest if dt is not None]
+        return min(earliest).date() if earliest else None
+
+    @staticmethod
+    def _repairable_start() -> Optional[date]:
+        """
+        明细仍完整保留的第一天
+        清理任务按时间删除 chats / queues，最早剩下的一天可能只剩一部分，从它的下一天算起
+        """
+        from sqlalchemy import func
+        from exts import db
+        from mod.mysql.models import Chat, Queue
+
+        earliest = [
+            db.session.query(func.min(column)).scalar()
+            for column in (Chat.created_at, Queue.created_at)
+        ]
+        earliest = [dt for dt in earliest if dt is not None]
+        return max(earliest).date() + timedelta(days=1) if earliest else None
+
+    def backfill_missing(self, keep_alive=None) -> int:
+        """
+        回填汇总表最早一天之前的历史（从近到远按天提交，中断后可继续）
+
+        Args:
+            keep_alive: 每回填一天调用一次（续期锁）
+
+        Returns:
+            回填的天数
+        """
+        from sqlalchemy import func
+        from exts import db
+        from mod.mysql.models import StatsDaily
+
+        earliest = self._history_start()
+        first = db.session.query(func.min(StatsDaily.bucket)).scalar()
+        day = first - timedelta(days=1) if first else date.today()
+        if earliest is None or earliest > day:
+            return 0
+
+        logger.info(f"📊 开始回填统计汇总历史: {earliest} ~ {day}")
+        days = 0
+        while day >= earliest:
+            self._backfill_day(day)
+            days += 1
+            if keep_alive:
+                keep_alive()
+            day -= timedelta(days=1)
+        logger.info(f"✅ 统计汇总历史回填完成: {days}天")
+        return days
+
+    # ========== 后台任务 ==========
+
+    def _acquire(self) -> bool:
+        """多个 worker 同一周期只有一个重算（无 Redis 时每个进程都重算）"""
+        import exts
+        redis = exts.redis_client
+        if redis is None:
+            return True
+        try:
+            return bool(redis.set(self.LOCK_KEY, 1, nx=True, ex=max(1, int(self.interval * 0.9))))
+        except Exception as e:
+            logger.warning(f"获取统计汇总锁失败: {e}")
+            return True
+
+    def start(self, socketio):
+        """启动后台重算任务"""
+        if self._started:
+            return
+        self._started = True
+
+        def backfill_task():
+            import exts
+            from exts import app, db
+            redis = exts.redis_client
+            try:
+                if redis is not None and not redis.set(self.BACKFILL_LOCK_KEY, 1, nx=True, ex=600):
+                    return   # 其他 worker 正在回填
+            except Exception as e:
+                logger.warning(f"获取统计汇总回填锁失败: {e}")
+                redis = None
+
+            keep_alive = (lambda: redis.expire(self.BACKFILL_LOCK_KEY, 600)) if redis is not None else None
+            with app.app_context():
+                try:
+                    self.backfill_missing(keep_alive)
+                except Exception as e:
+                    logger.error(f"回填统计汇总历史失败: {e}")
+                finally:
+                    db.session.remove()
+                    if redis is not None:
+                        redis.delete(self.BACKFILL_LOCK_KEY)
+
+        def rollup_loop():
+            from exts import app, db
+            while True:
+                socketio.sleep(self.interval)
+                if not self._acquire():
+                    continue
+                with app.app_context():
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        logger.error(f"更新统计汇总失败: {e}")
+                    finally:
+                        db.session.remove()
+
+        socketio.start_background_task(rollup_loop)
+        socketio.start_background_task(backfill_task)
+        logger.info(f"✅ 统计汇总任务已启动 (间隔{self.interval}s)")
+
+
+# 全局单例
+stats_rollup = StatsRollup()
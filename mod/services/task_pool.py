@@ -0,0 +1,208 @@
+"""
+后台任务池
+Socket 事件处理函数里原来直接 Thread(...).start()：没有并发上限，每个线程各自占用一个数据库连接，
+访客集中进入时会耗尽连接池（pool_size=15, max_overflow=30）。
+
+这里用固定数量的 worker（socketio.start_background_task，eventlet 下为绿色线程）消费一个有界队列：
+- 总并发 = worker 数，远小于连接池容量
+- 按任务类型限制并发（例如在线IP查询最多2个）
+- 队列满时提交方等待（背压），超时才拒绝
+- 同一类型、同一 key（如 visitor_id）尚未开始执行的任务会合并，只执行最后一次提交
+- 记录队列深度、等待/执行耗时、完成/失败/拒绝/合并次数
+"""
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, Optional
+import log
+
+logger = log.get_logger(__name__)
+
+
+class _Job:
+    __slots__ = ('task_type', 'key', 'func', 'args', 'kwargs', 'submitted_at')
+
+    def __init__(self, task_type, key, func, args, kwargs):
+        self.task_type = task_type
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted_at = time.time()
+
+
+class BackgroundTaskPool:
+    """
+    有界后台任务池
+
+    使用方式：
+        task_pool.submit('visitor_save', save_visitor, visitor_id, key=visitor_id)
+    """
+
+    SAMPLE_SIZE = 500
+
+    def __init__(self, max_workers: int = 8, max_queue: int = 1000, submit_timeout: float = 5.0):
+        """
+        Args:
+            max_workers: worker 数量（即最大并发，也是最多占用的数据库连接数）
+            max_queue: 队列容量
+            submit_timeout: 队列满时提交方最多等待的时间（秒）
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.submit_timeout = submit_timeout
+        self.type_limits: Dict[str, int] = {}
+
+        self._queue = deque()
+        self._pending_keys: Dict[tuple, _Job] = {}
+        self._running = Counter()
+        self._cond = threading.Condition()
+        self._started = False
+
+        self._counters = Counter()  # submitted / completed / failed / rejected / coalesced
+        self._wait_samples = deque(maxlen=self.SAMPLE_SIZE)
+        self._run_samples = deque(maxlen=self.SAMPLE_SIZE)
+
+    def init_app(self, app):
+        """从Flask配置读取任务池参数"""
+        self.max_workers = app.config.get('TASK_POOL_WORKERS', self.max_workers)
+        self.max_queue = app.config.get('TASK_POOL_MAX_QUEUE', self.max_queue)
+        self.submit_timeout = app.config.get('TASK_POOL_SUBMIT_TIMEOUT', self.submit_timeout)
+        self.type_limits = dict(app.config.get('TASK_POOL_TYPE_LIMITS', self.type_limits))
+
+    # ========== 提交 ==========
+
+    def submit(self, task_type: str, func: Callable, *args, key=None, **kwargs) -> bool:
+        """
+        提交后台任务（在应用上下文中执行，执行完释放数据库会话）
+
+        Args:
+            task_type: 任务类型（用于并发限制和统计）
+            func: 任务函数
+            key: 合并键；同类型同 key 的待执行任务只保留最后一次提交
+            *args, **kwargs: 任务参数
+
+        Returns:
+            是否已入队（队列持续满载超过 submit_timeout 时返回 False）
+        """
+        self._ensure_started()
+
+        with self._cond:
+            if key is not None:
+                job = self._pending_keys.get((task_type, key))
+                if job is not None:
+                    job.func, job.args, job.kwargs = func, args, kwargs
+                    self._counters['coalesced'] += 1
+                    return True
+
+            deadline = time.time() + self.submit_timeout
+            while len(self._queue) >= self.max_queue:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._counters['rejected'] += 1
+                    logger.warning(f"⚠️ 后台任务队列已满({self.max_queue})，拒绝任务: {task_type}")
+                    return False
+                self._cond.wait(remaining)
+
+            job = _Job(task_type, key, func, args, kwargs)
+            self._queue.append(job)
+            if key is not None:
+                self._pending_keys[(task_type, key)] = job
+            self._counters['submitted'] += 1
+            self._cond.notify_all()
+        return True
+
+    # ========== 执行 ==========
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        self._started = True
+
+        from exts import socketio
+        for _ in range(self.max_workers):
+            socketio.start_background_task(self._worker)
+        logger.info(f"✅ 后台任务池已启动 (worker={self.max_workers}, 队列={self.max_queue})")
+
+    def _next_job(self) -> Optional[_Job]:
+        """取出第一个未达到类型并发上限的任务（调用方持有锁）"""
+        for index, job in enumerate(self._queue):
+            limit = self.type_limits.get(job.task_type)
+            if limit is None or self._running[job.task_type] < limit:
+                del self._queue[index]
+                if job.key is not None:
+                    self._pending_keys.pop((job.task_type, job.key), None)
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.task_type] += 1
+                # 队列有空位，唤醒等待中的提交方
+                self._cond.notify_all()
+
+            started_at = time.time()
+            failed = self._execute(job)
+            finished_at = time.time()
+
+            with self._cond:
+                self._running[job.task_type] -= 1
+                self._counters['failed' if failed else 'completed'] += 1
+                self._wait_samples.append(started_at - job.submitted_at)
+                self._run_samples.append(finished_at - started_at)
+                # 同类型任务可能因并发上限在等待
+                self._cond.notify_all()
+
+    @staticmethod
+    def _execute(job: _Job) -> bool:
+        """执行任务，返回是否失败"""
+        from exts import app, db
+        with app.app_context():
+            try:
+                job.func(*job.args, **job.kwargs)
+                return False
+            except Exception as e:
+                logger.error(f"后台任务执行失败 [{job.task_type}] {getattr(job.func, '__name__', job.func)}: {e}")
+                return True
+            finally:
+                db.session.remove()
+
+    # ========== 统计 ==========
+
+    @staticmethod
+    def _percentiles(samples) -> Dict:
+        values = sorted(samples)
+        if not values:
+            return {'p50': 0, 'p95': 0, 'p99': 0}
+        pick = lambda q: round(values[min(len(values) - 1, int(q * (len(values) - 1)))] * 1000, 2)
+        return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+    def get_stats(self) -> Dict:
+        """
+        获取任务池状态
+
+        Returns:
+            队列深度、各类型执行中数量、计数器、等待/执行耗时分位数（毫秒）
+        """
+        with self._cond:
+            queued_by_type = Counter(job.task_type for job in self._queue)
+            return {
+                'workers': self.max_workers,
+                'queue_depth': len(self._queue),
+                'max_queue': self.max_queue,
+                'queued_by_type': dict(queued_by_type),
+                'running_by_type': {k: v for k, v in self._running.items() if v},
+                'type_limits': dict(self.type_limits),
+                'counters': dict(self._counters),
+                'wait_ms': self._percentiles(self._wait_samples),
+                'run_ms': self._percentiles(self._run_samples),
+            }
+
+
+# 全局单例
+task_pool = BackgroundTaskPool()
@@ -0,0 +1,278 @@
+"""
+去重访客数（HyperLogLog）
+"接入总量"（近30天去重访客）和趋势图的每日接入量原来都是对 chats 做 COUNT(DISTINCT visitor_id)，
+是慢查询日志里最慢的几条。
+
+这里为每个商户每天维护一个 HyperLogLog 草图：
+- 消息入库提交后把访客加入当天的草图（ORM 插入走提交事件，写后模式在批量入库后）
+- 任意日期范围的去重访客数由各天草图合并得到（Redis PFCOUNT 多个键即为并集），误差约 0.81%
+- 某天的草图第一次被用到时从数据库补一次（部署前的历史数据、Redis 数据丢失），之后不再查库
+- 没有 Redis 时使用进程内的纯 Python 实现（与 Redis 相同的 16384 个寄存器）
+
+存储结构（Redis）：
+- kefu:uv:{business_id}:{YYYYMMDD}          HyperLogLog  当天有消息的访客
+- kefu:uv:{business_id}:{YYYYMMDD}:seeded   String       当天已从数据库补齐
+两者保留 VISITOR_HLL_RETENTION_DAYS 天
+"""
+import hashlib
+import math
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+import log
+
+logger = log.get_logger(__name__)
+
+
+class HyperLogLog:
+    """HyperLogLog 基数估计（p=14，与 Redis 的寄存器数相同）"""
+
+    P = 14
+    M = 1 << P
+    ALPHA = 0.7213 / (1 + 1.079 / M)
+
+    def __init__(self):
+        self.registers = bytearray(self.M)
+
+    def add(self, item: str):
+        h = int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.P)
+        rest = h & ((1 << (64 - self.P)) - 1)
+        rank = (64 - self.P) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        estimate = self.ALPHA * self.M * self.M / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * self.M:
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = self.M * math.log(self.M / zeros)   # 小基数时用线性计数
+        return int(round(estimate))
+
+
+class UniqueVisitorCounter:
+    """
+    按商户、按天的去重访客计数
+
+    使用方式：
+        unique_visitors.count(business_id, start_day, end_day)      # 日期范围内去重访客数
+        unique_visitors.count_days(business_id, days)               # {日期: 当天去重访客数}
+    """
+
+    PREFIX = 'kefu:uv'
+    PENDING_KEY = 'kefu_unique_visitors'   # Session.info 中待提交的 (商户, 日期, 访客)
+
+    def __init__(self, retention_days: int = 90):
+        """
+        Args:
+            retention_days: 草图保留天数
+        """
+        self.retention_days = retention_days
+        self._local: Dict[Tuple[int, date], HyperLogLog] = {}   # 无 Redis 时使用
+        self._local_seeded = set()
+        self._lock = threading.Lock()
+        self._installed = False
+
+    def init_app(self, app):
+        """从Flask配置读取保留天数，并注册消息插入的 ORM 事件"""
+        self.retention_days = app.config.get('VISITOR_HLL_RETENTION_DAYS', self.retention_days)
+        self._install_events()
+
+    @staticmethod
+    def _redis():
+        import exts
+        return exts.redis_client
+
+    def _key(self, business_id, day: date) -> str:
+        return f'{self.PREFIX}:{business_id}:{day.strftime("%Y%m%d")}'
+
+    # ========== 写入 ==========
+
+    def add_many(self, entries: Iterable[Tuple[int, date, str]]):
+        """
+        记录访客在某天有消息
+
+        Args:
+            entries: [(business_id, day, visitor_id)]
+        """
+        grouped: Dict[Tuple[int, date], set] = {}
+        for business_id, day, visitor_id in entries:
+            if business_id and visitor_id:
+                grouped.setdefault((business_id, day), set()).add(visitor_id)
+        if not grouped:
+            return
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                ttl = self.retention_days * 86400
+                pipe = redis.pipeline(transaction=False)
+                for (business_id, day), visitor_ids in grouped.items():
+                    key = self._key(business_id, day)
+                    pipe.pfadd(key, *visitor_ids)
+                    pipe.expire(key, ttl)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.warning(f"写入访客HyperLogLog失败: {e}")
+
+        with self._lock:
+            for key, visitor_ids in grouped.items():
+                sketch = self._local.setdefault(key, HyperLogLog())
+                for visitor_id in visitor_ids:
+                    sketch.add(visitor_id)
+            self._evict_local()
+
+    def add_messages(self, records: Iterable[Dict]):
+        """记录已入库的消息（字典包含 business_id, visitor_id, created_at）"""
+        self.add_many(
+            (r['business_id'], (r.get('created_at') or datetime.now()).date(), r['visitor_id'])
+            for r in records
+        )
+
+    def _evict_local(self):
+        oldest = date.today() - timedelta(days=self.retention_days)
+        for key in [k for k in self._local if k[1] < oldest]:
+            del self._local[key]
+            self._local_seeded.discard(key)
+
+    # ========== 从数据库补齐 ==========
+
+    @staticmethod
+    def _query_day(business_id, day: date) -> List[str]:
+        from exts import db
+        from mod.mysql.models import Chat
+        start = datetime.combine(day, datetime.min.time())
+        rows = db.session.query(Chat.visitor_id).filter(
+            Chat.business_id == business_id,
+            Chat.created_at >= start,
+            Chat.created_at < start + timedelta(days=1)
+        ).distinct().all()
+        return [visitor_id for (visitor_id,) in rows]
+
+    def _seed(self, business_id, days: List[date]):
+        """补齐尚未从数据库加载过的日期"""
+        redis = self._redis()
+        if redis is not None:
+            try:
+                markers = redis.mget([self._key(business_id, day) + ':seeded' for day in days])
+                missing = [day for day, marker in zip(days, markers) if marker is None]
+                ttl = self.retention_days * 86400
+                for day in missing:
+                    key = self._key(business_id, day)
+                    visitor_ids = self._query_day(business_id, day)
+                    pipe = redis.pipeline(transaction=False)
+                    if visitor_ids:
+                        pipe.pfadd(key, *visitor_ids)
+                    pipe.expire(key, ttl)
+                    pipe.set(key + ':seeded', 1, ex=ttl)
+                    pipe.execute()
+                if missing:
+                    logger.info(f"📈 商户{business_id}从数据库补齐{len(missing)}天的访客HyperLogLog")
+                return
+            except Exception as e:
+                logger.warning(f"补齐访客HyperLogLog失败: {e}")
+
+        missing = [day for day in days if (business_id, day) not in self._local_seeded]
+        for day in missing:
+            visitor_ids = self._query_day(business_id, day)
+            with self._lock:
+                sketch = self._local.setdefault((business_id, day), HyperLogLog())
+                for visitor_id in visitor_ids:
+                    sketch.add(visitor_id)
+                self._local_seeded.add((business_id, day))
+
+    # ========== 查询 ==========
+
+    @staticmethod
+    def _days(start: date, end: date) -> List[date]:
+        return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    def count(self, business_id, start: date, end: Optional[date] = None) -> int:
+        """
+        [start, end] 内有消息的去重访客数（各天草图的并集）
+
+        Args:
+            start: 开始日期（含）
+            end: 结束日期（含），默认今天
+        """
+        days = self._days(start, end or date.today())
+        if not days:
+            return 0
+        self._seed(business_id, days)
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                return int(redis.pfcount(*[self._key(business_id, day) for day in days]))
+            except Exception as e:
+                logger.warning(f"读取访客HyperLogLog失败: {e}")
+
+        merged = HyperLogLog()
+        with self._lock:
+            for day in days:
+                sketch = self._local.get((business_id, day))
+                if sketch is not None:
+                    merged.merge(sketch)
+        return merged.count()
+
+    def count_days(self, business_id, days: List[date]) -> Dict[date, int]:
+        """每天各自的去重访客数"""
+        if not days:
+            return {}
+        self._seed(business_id, days)
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                pipe = redis.pipeline(transaction=False)
+                for day in days:
+                    pipe.pfcount(self._key(business_id, day))
+                return {day: int(n) for day, n in zip(days, pipe.execute())}
+            except Exception as e:
+                logger.warning(f"读取访客HyperLogLog失败: {e}")
+
+        with self._lock:
+            return {day: self._local[(business_id, day)].count() if (business_id, day) in self._local else 0
+                    for day in days}
+
+    # ========== ORM 事件 ==========
+
+    def _install_events(self):
+        if self._installed:
+            return
+        self._installed = True
+
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session, object_session
+        from mod.mysql.models import Chat
+
+        def on_insert(mapper, connection, target):
+            session = object_session(target)
+            if session is None:
+                return
+            day = (target.created_at or datetime.now()).date()
+            session.info.setdefault(self.PENDING_KEY, []).append((target.business_id, day, target.visitor_id))
+
+        def on_commit(session):
+            pending = session.info.pop(self.PENDING_KEY, None)
+            if pending:
+                try:
+                    self.add_many(pending)
+                except Exception as e:
+                    logger.warning(f"更新访客HyperLogLog失败: {e}")
+
+        def on_rollback(session):
+            session.info.pop(self.PENDING_KEY, None)
+
+        event.listen(Chat, 'after_insert', on_insert)
+        event.listen(Session, 'after_commit', on_commit)
+        event.listen(Session, 'after_rollback', on_rollback)
+
+
+# 全局单例
+unique_visitors = UniqueVisitorCounter()
@@ -0,0 +1,269 @@
+"""
+未读消息计数
+客服工作台的未读数原来靠轮询接口实时 GROUP BY chats 表的未读行，
+访客消息的实时未读推送也因为每条消息 5-10 次查询而被禁用。
+
+这里在 Redis 中维护增量计数：
+- kefu:unread:{business_id}:{service_id}   Hash  visitor_id -> 访客发给该客服的未读消息数
+- kefu:unread:{business_id}:services       Set   有计数的客服ID（未分配记为0）
+- kefu:unread:touched                      Set   上次校准以来计数有变化的 {business_id}:{visitor_id}
+访客消息入库时 +1，客服回复 / 打开会话时清零，后台任务定期按 Chat.state 校准。
+
+校准先清空 touched，再查询数据库，最后用 Lua 脚本原子地写入；查询之后计数又有变化的访客
+（仍在 touched 中）、以及消息还在写后日志中未入库的访客跳过本次校准，不会丢掉查询期间的增量。
+Redis 不可用时各查询方法返回 None，调用方回退到原来的 SQL 统计。
+"""
+import json
+from typing import Dict, Iterable, Optional
+import log
+
+logger = log.get_logger(__name__)
+
+
+class UnreadCounter:
+    """
+    访客未读消息计数器
+
+    设计原则：
+    - 计数只在 Redis 中维护，数据库仍以 Chat.state 为准
+    - 计数与数据库之间的偏差（并发窗口、异常）由定期校准修正
+    """
+
+    PREFIX = 'kefu:unread'
+
+    def __init__(self, reconcile_interval: int = 300):
+        """
+        Args:
+            reconcile_interval: 与数据库校准的间隔（秒）
+        """
+        self.reconcile_interval = reconcile_interval
+        self._started = False
+
+    def init_app(self, app):
+        """从Flask配置读取校准间隔"""
+        self.reconcile_interval = app.config.get('UNREAD_RECONCILE_INTERVAL', self.reconcile_interval)
+
+    @staticmethod
+    def _redis():
+        import exts
+        return exts.redis_client
+
+    def _hash_key(self, business_id, service_id) -> str:
+        return f'{self.PREFIX}:{business_id}:{service_id or 0}'
+
+    def _services_key(self, business_id) -> str:
+        return f'{self.PREFIX}:{business_id}:services'
+
+    def _touched_key(self) -> str:
+        return f'{self.PREFIX}:touched'
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode() if isinstance(value, bytes) else value
+
+    # ========== 写入 ==========
+
+    def increment(self, business_id, service_id, visitor_id, count: int = 1) -> Optional[int]:
+        """
+        访客消息入库后增加未读数
+
+        Returns:
+            该访客当前的未读总数（所有客服合计），Redis不可用时返回None
+        """
+        redis = self._redis()
+        if redis is None:
+            return None
+        try:
+            pipe = redis.pipeline()
+            pipe.sadd(self._services_key(business_id), service_id or 0)
+            pipe.hincrby(self._hash_key(business_id, service_id), visitor_id, count)
+            pipe.sadd(self._touched_key(), f'{business_id}:{visitor_id}')
+            pipe.execute()
+            return self.get_counts(business_id, [visitor_id]).get(visitor_id, 0)
+        except Exception as e:
+            logger.warning(f"增加未读计数失败: {e}")
+            return None
+
+    def clear_visitor(self, business_id, visitor_id):
+        """访客的未读消息已全部标记为已读（客服回复 / 打开会话）"""
+        redis = self._redis()
+        if redis is None:
+            return
+        try:
+            services = redis.smembers(self._services_key(business_id))
+            pipe = redis.pipeline()
+            for service_id in services:
+                pipe.hdel(self._hash_key(business_id, self._decode(service_id)), visitor_id)
+            pipe.sadd(self._touched_key(), f'{business_id}:{visitor_id}')
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"清零未读计数失败: {e}")
+
+    # ========== 查询 ==========
+
+    def get_counts(self, business_id, visitor_ids: Iterable[str],
+                   service_id=None) -> Optional[Dict[str, int]]:
+        """
+        批量获取访客未读数
+
+        Args:
+            business_id: 商户ID
+            visitor_ids: 访客ID列表
+            service_id: 只统计发给该客服的消息；None 表示所有客服（管理员视角）
+
+        Returns:
+            {visitor_id: unread_count}（不含0），Redis不可用时返回None
+        """
+        redis = self._redis()
+        if redis is None:
+            return None
+        visitor_ids = list(visitor_ids)
+        if not visitor_ids:
+            return {}
+        try:
+            if service_id is not None:
+                service_ids = [service_id]
+            else:
+                service_ids = [self._decode(s) for s in redis.smembers(self._services_key(business_id))]
+            if not service_ids:
+                return {}
+
+            pipe = redis.pipeline()
+            for sid in service_ids:
+                pipe.hmget(self._hash_key(business_id, sid), visitor_ids)
+
+            counts: Dict[str, int] = {}
+            for values in pipe.execute():
+                for visitor_id, value in zip(visitor_ids, values):
+                    if value:
+                        counts[visitor_id] = counts.get(visitor_id, 0) + int(value)
+            return {vid: c for vid, c in counts.items() if c > 0}
+        except Exception as e:
+            logger.warning(f"读取未读计数失败: {e}")
+            return None
+
+    def total(self, business_id, visitor_ids: Iterable[str], service_id=None) -> Optional[int]:
+        """指定访客的未读总数，Redis不可用时返回None"""
+        counts = self.get_counts(business_id, visitor_ids, service_id)
+        return None if counts is None else sum(counts.values())
+
+    # ========== 校准 ==========
+
+    # KEYS: services_set, touched_set
+    # ARGV: hash_key_prefix, business_id, expected_json {service_id: {visitor_id: count}}, skip_json [visitor_id]
+    _RECONCILE_SCRIPT = """
+    local expected = cjson.decode(ARGV[3])
+    local skip = {}
+    for _, visitor in ipairs(cjson.decode(ARGV[4])) do
+        skip[visitor] = true
+    end
+    local function skipped(visitor)
+        return skip[visitor] or redis.call('SISMEMBER', KEYS[2], ARGV[2] .. ':' .. visitor) == 1
+    end
+
+    for _, sid in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+        local key = ARGV[1] .. sid
+        local want = expected[sid] or {}
+        local current = redis.call('HKEYS', key)
+        for _, visitor in ipairs(current) do
+            if want[visitor] == nil and not skipped(visitor) then
+                redis.call('HDEL', key, visitor)
+            end
+        end
+    end
+    for sid, visitors in pairs(expected) do
+        for visitor, count in pairs(visitors) do
+            if not skipped(visitor) then
+                redis.call('HSET', ARGV[1] .. sid, visitor, count)
+                redis.call('SADD', KEYS[1], sid)
+            end
+        end
+    end
+    for _, sid in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+        if redis.call('HLEN', ARGV[1] .. sid) == 0 then
+            redis.call('SREM', KEYS[1], sid)
+        end
+    end
+    return 1
+    """
+
+    def reconcile(self) -> int:
+        """
+        按 Chat.state 校准所有计数（需在应用上下文中调用）
+        查询期间计数有变化、或仍有消息在写后日志中的访客保留现有计数
+
+        Returns:
+            有未读消息的访客数
+        """
+        redis = self._redis()
+        if redis is None:
+            return 0
+
+        from exts import db
+        from mod.mysql.models import Chat
+        from mod.services.message_writer import message_writer
+
+        # 顺序不能变：先清空 touched，再读写后日志，最后查询数据库
+        redis.delete(self._touched_key())
+        pending: Dict[int, set] = {}
+        for record in message_writer.pending(redis):
+            if record.get('direction') == 'to_service':
+                pending.setdefault(record.get('business_id'), set()).add(record.get('visitor_id'))
+
+        rows = db.session.query(
+            Chat.business_id, Chat.service_id, Chat.visitor_id, db.func.count(Chat.cid)
+        ).filter(
+            Chat.direction == 'to_service',
+            Chat.state == 'unread'
+        ).group_by(Chat.business_id, Chat.service_id, Chat.visitor_id).all()
+
+        expected: Dict[int, Dict[str, Dict[str, int]]] = {}
+        for business_id, service_id, visitor_id, count in rows:
+            expected.setdefault(business_id, {}).setdefault(str(service_id or 0), {})[visitor_id] = count
+
+        # 计数中出现过、但数据库中已没有未读的商户也要清空
+        stale_business_ids = {
+            int(self._decode(key).split(':')[2])
+            for key in redis.scan_iter(match=f'{self.PREFIX}:*:services', count=500)
+        }
+
+        script = redis.register_script(self._RECONCILE_SCRIPT)
+        for business_id in stale_business_ids | set(expected):
+            script(
+                keys=[self._services_key(business_id), self._touched_key()],
+                args=[f'{self.PREFIX}:{business_id}:', business_id,
+                      json.dumps(expected.get(business_id, {}), ensure_ascii=False),
+                      json.dumps(sorted(pending.get(business_id, ())), ensure_ascii=False)]
+            )
+
+        return len(rows)
+
+    def start(self, socketio):
+        """启动定期校准任务（集群内同一周期只有一个worker执行）"""
+        if self._started:
+            return
+        self._started = True
+
+        def reconcile_loop():
+            from exts import app, db
+            while True:
+                try:
+                    redis = self._redis()
+                    if redis is not None and redis.set(f'{self.PREFIX}:reconcile_lock', 1,
+                                                       nx=True, ex=max(1, self.reconcile_interval - 1)):
+                        with app.app_context():
+                            try:
+                                count = self.reconcile()
+                                logger.debug(f"📬 未读计数已校准: {count}个访客有未读消息")
+                            finally:
+                                db.session.remove()
+                except Exception as e:
+                    logger.error(f"未读计数校准失败: {e}")
+                socketio.sleep(self.reconcile_interval)
+
+        socketio.start_background_task(reconcile_loop)
+        logger.info(f"✅ 未读计数校准任务已启动 (间隔{self.reconcile_interval}s)")
+
+
+# 全局单例
+unread_counter = UnreadCounter()
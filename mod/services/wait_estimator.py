@@ -0,0 +1,267 @@
+"""
+排队等待时间估算
+原来每次估算都查询最近20个已完成会话求平均处理时间（再加一次在线客服数统计），
+给 N 个排队访客显示位置就是 N 次相同的聚合查询。
+
+这里按 (商户, 分组) 维护会话处理时长的指数衰减均值和方差（流式更新，O(1)）：
+- 会话结束（Queue 变为 complete）时调用 observe 更新统计
+- 估算时直接读取统计 + 在线状态注册中心的在线客服数，不访问数据库
+- 按正态近似给出 p50 / p90 的预计等待时间
+
+存储结构（Redis，所有 worker 共享）：
+- kefu:waitest:{business_id}:{group_id}   Hash  mean / var / count / updated_at
+Redis 不可用时使用进程内统计；统计为空时从数据库最近的已完成会话初始化一次
+"""
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+import log
+
+logger = log.get_logger(__name__)
+
+
+# 标准正态分布分位数
+Z_SCORES = {'p50': 0.0, 'p90': 1.2816}
+
+# 优先级对等待时间的缩放（与原估算规则一致）
+PRIORITY_FACTORS = {2: 0.3, 1: 0.6}
+
+DEFAULT_HANDLE_TIME = 300.0   # 没有任何历史数据时的平均处理时间（秒）
+MIN_HANDLE_TIME = 30          # 过滤异常值（小于30秒或大于1小时）
+MAX_HANDLE_TIME = 3600
+
+
+class HandleTimeStats:
+    """指数衰减的均值 / 方差"""
+
+    __slots__ = ('mean', 'var', 'count')
+
+    def __init__(self, mean: float = DEFAULT_HANDLE_TIME, var: float = 0.0, count: int = 0):
+        self.mean = mean
+        self.var = var
+        self.count = count
+
+    def update(self, value: float, alpha: float):
+        if self.count == 0:
+            self.mean, self.var = value, 0.0
+        else:
+            diff = value - self.mean
+            increment = alpha * diff
+            self.mean += increment
+            self.var = (1 - alpha) * (self.var + diff * increment)
+        self.count += 1
+
+
+class WaitTimeEstimator:
+    """
+    排队等待时间估算器
+
+    使用方式：
+        wait_estimator.observe(business_id, duration_seconds, group_id)
+        eta = wait_estimator.estimate(business_id, position, priority)   # {'p50': 秒, 'p90': 秒}
+    """
+
+    PREFIX = 'kefu:waitest'
+
+    # KEYS: stats_hash
+    # ARGV: value, alpha, now
+    _UPDATE_SCRIPT = """
+    local count = tonumber(redis.call('HGET', KEYS[1], 'count') or '0')
+    local value = tonumber(ARGV[1])
+    local alpha = tonumber(ARGV[2])
+    local mean, var
+    if count == 0 then
+        mean, var = value, 0
+    else
+        mean = tonumber(redis.call('HGET', KEYS[1], 'mean'))
+        var = tonumber(redis.call('HGET', KEYS[1], 'var'))
+        local diff = value - mean
+        local increment = alpha * diff
+        mean = mean + increment
+        var = (1 - alpha) * (var + diff * increment)
+    end
+    redis.call('HSET', KEYS[1], 'mean', tostring(mean), 'var', tostring(var),
+               'count', count + 1, 'updated_at', ARGV[3])
+    return tostring(mean)
+    """
+
+    def __init__(self, alpha: float = 0.1, cache_ttl: float = 5.0):
+        """
+        Args:
+            alpha: 衰减系数，越大越偏重最近的会话
+            cache_ttl: 进程内读取缓存的有效期（秒）
+        """
+        self.alpha = alpha
+        self.cache_ttl = cache_ttl
+        self._local: Dict[Tuple, HandleTimeStats] = {}
+        self._cache: Dict[Tuple, Tuple[float, HandleTimeStats]] = {}
+        self._seeded = set()
+        self._lock = threading.Lock()
+        self._update = None
+
+    def init_app(self, app):
+        """从Flask配置读取衰减系数和缓存有效期"""
+        self.alpha = app.config.get('WAIT_ESTIMATOR_ALPHA', self.alpha)
+        self.cache_ttl = app.config.get('WAIT_ESTIMATOR_CACHE_TTL', self.cache_ttl)
+
+    @staticmethod
+    def _redis():
+        import exts
+        return exts.redis_client
+
+    def _key(self, business_id, group_id) -> str:
+        return f'{self.PREFIX}:{business_id}:{int(group_id or 0)}'
+
+    # ========== 更新 ==========
+
+    def observe(self, business_id, duration: float, group_id=0) -> bool:
+        """
+        记录一次已完成会话的处理时长
+
+        Args:
+            business_id: 商户ID
+            duration: 处理时长（秒）
+            group_id: 客服分组ID
+
+        Returns:
+            是否计入统计（异常值会被过滤）
+        """
+        if not business_id or duration is None or not MIN_HANDLE_TIME <= duration <= MAX_HANDLE_TIME:
+            return False
+
+        key = (int(business_id), int(group_id or 0))
+        redis = self._redis()
+        if redis is not None:
+            try:
+                if self._update is None:
+                    self._update = redis.register_script(self._UPDATE_SCRIPT)
+                self._update(keys=[self._key(*key)], args=[float(duration), self.alpha, time.time()])
+                self._cache.pop(key, None)
+                return True
+            except Exception as e:
+                logger.warning(f"更新处理时长统计失败: {e}")
+
+        with self._lock:
+            self._local.setdefault(key, HandleTimeStats()).update(float(duration), self.alpha)
+            self._cache.pop(key, None)
+        return True
+
+    def observe_queue(self, queue, ended_at=None) -> bool:
+        """按 Queue 记录（刚变为 complete）记录处理时长；未分配过客服的会话不计入"""
+        if not queue or not queue.created_at or not queue.service_id:
+            return False
+        from datetime import datetime
+        duration = ((ended_at or datetime.now()) - queue.created_at).total_seconds()
+        return self.observe(queue.business_id, duration, getattr(queue, 'group_id', 0))
+
+    # ========== 读取 ==========
+
+    def _load(self, key: Tuple) -> Optional[HandleTimeStats]:
+        redis = self._redis()
+        if redis is not None:
+            try:
+                raw = redis.hmget(self._key(*key), 'mean', 'var', 'count')
+                if raw[0] is not None:
+                    return HandleTimeStats(float(raw[0]), float(raw[1] or 0), int(raw[2] or 0))
+                return None
+            except Exception as e:
+                logger.warning(f"读取处理时长统计失败: {e}")
+        with self._lock:
+            return self._local.get(key)
+
+    def _seed(self, business_id):
+        """统计为空时，用数据库中最近的已完成会话初始化（每个商户每个进程最多一次）"""
+        if business_id in self._seeded:
+            return
+        self._seeded.add(business_id)
+
+        from datetime import datetime, timedelta
+        from mod.mysql.models import Queue
+
+        try:
+            recent = Queue.query.with_entities(
+                Queue.group_id, Queue.created_at, Queue.updated_at
+            ).filter(
+                Queue.business_id == business_id,
+                Queue.state == 'complete',
+                Queue.service_id > 0,
+                Queue.updated_at >= datetime.now() - timedelta(hours=2)
+            ).order_by(Queue.updated_at.asc()).limit(50).all()
+        except Exception as e:
+            logger.warning(f"初始化处理时长统计失败: business={business_id}, {e}")
+            return
+
+        for group_id, created_at, updated_at in recent:
+            if created_at and updated_at:
+                self.observe(business_id, (updated_at - created_at).total_seconds(), group_id)
+        if recent:
+            logger.info(f"📈 商户{business_id}处理时长统计已初始化: {len(recent)}个会话")
+
+    def stats(self, business_id, group_id=0) -> HandleTimeStats:
+        """
+        处理时长统计（分组没有数据时使用商户整体统计，都没有时使用默认值）
+        读取结果在进程内缓存 cache_ttl 秒
+        """
+        key = (int(business_id), int(group_id or 0))
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        stats = self._load(key)
+        if stats is None and key[1] != 0:
+            stats = self._load((key[0], 0))
+        if stats is None and key[0] not in self._seeded:
+            self._seed(key[0])
+            stats = self._load(key) or self._load((key[0], 0))
+        stats = stats or HandleTimeStats()
+
+        self._cache[key] = (time.time() + self.cache_ttl, stats)
+        return stats
+
+    def mean_handle_time(self, business_id, group_id=0) -> float:
+        """平均处理时间（秒）"""
+        return self.stats(business_id, group_id).mean
+
+    @staticmethod
+    def online_count(business_id) -> int:
+        """在线客服数（取自在线状态注册中心，不查询数据库）"""
+        from mod.services.presence_service import presence_registry
+        return presence_registry.count_online_services(business_id)
+
+    def estimate(self, business_id, position: int, priority: int = 0, group_id=0,
+                 online_count: Optional[int] = None) -> Dict[str, int]:
+        """
+        预计等待时间
+
+        把前面 position 位访客的处理视为 position / 在线客服数 个独立的处理时长之和，
+        按正态近似：均值 = n * mean，标准差 = sqrt(n) * std
+
+        Args:
+            business_id: 商户ID
+            position: 排队位置（从1开始）
+            priority: 优先级 0=普通 1=VIP 2=紧急
+            group_id: 客服分组ID
+            online_count: 在线客服数（批量估算时由调用方传入）
+
+        Returns:
+            {'p50': 秒, 'p90': 秒}，无客服在线时均为 -1
+        """
+        if online_count is None:
+            online_count = self.online_count(business_id)
+        if not online_count:
+            return {name: -1 for name in Z_SCORES}
+
+        stats = self.stats(business_id, group_id)
+        n = max(position, 0) / online_count
+        factor = PRIORITY_FACTORS.get(int(priority or 0), 1.0)
+        mean = n * stats.mean
+        std = math.sqrt(n * max(stats.var, 0.0))
+        return {
+            name: int(max(0.0, mean + z * std) * factor)
+            for name, z in Z_SCORES.items()
+        }
+
+
+# 全局单例
+wait_estimator = WaitTimeEstimator()
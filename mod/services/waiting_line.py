@@ -0,0 +1,568 @@
+"""
+访客等待队列（排队线）
+排队位置原来每次都用 SQL 计算：按 priority DESC, created_at ASC 对 queues 表重新排序计数，
+update_queue_positions / update_estimated_wait_times 还会对每个等待行再做 2-3 次查询。
+
+这里为每个 (商户, 分组) 维护一条有序的等待线：
+- 分数 = (MAX_PRIORITY - priority) * PRIORITY_SPAN + 到达时间(毫秒)，优先级高的在前，同优先级先到先得
+- 查询位置、调整优先级、取队首均为 O(log n)
+- MySQL 中的 queues 表仍是持久化记录（state='normal' 且 service_id 为 NULL/0 即为等待中），
+  后台任务定期按数据库校准，修正异常或重启造成的偏差
+
+存储结构（Redis）：
+- kefu:waitline:{business_id}:line:{group_id}   ZSet  visitor_id -> 分数
+- kefu:waitline:{business_id}:entries           Hash  visitor_id -> 条目JSON {qid, group_id, priority, arrival}
+- kefu:waitline:{business_id}:groups            Set   有等待线的分组ID
+
+Redis 不可用时降级为进程内实现（LocalWaitingLineBackend，有序列表 + 二分查找），接口完全一致
+"""
+import bisect
+import heapq
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+import log
+
+logger = log.get_logger(__name__)
+
+
+MAX_PRIORITY = 2                 # 0=普通 1=VIP 2=紧急
+PRIORITY_SPAN = 10 ** 13         # 大于任意毫秒时间戳，保证优先级先于到达时间比较
+
+
+def make_score(priority, arrival: int) -> int:
+    """等待线分数（越小越靠前）"""
+    priority = min(max(int(priority or 0), 0), MAX_PRIORITY)
+    return (MAX_PRIORITY - priority) * PRIORITY_SPAN + int(arrival)
+
+
+def make_entry(visitor_id: str, qid, group_id, priority, arrival: int) -> Dict:
+    return {
+        'visitor_id': visitor_id,
+        'qid': int(qid) if qid else None,
+        'group_id': int(group_id or 0),
+        'priority': int(priority or 0),
+        'arrival': int(arrival)
+    }
+
+
+class LocalWaitingLineBackend:
+    """
+    进程内等待线（Redis不可用时的替代实现）
+
+    每条等待线是按 (分数, visitor_id) 排序的列表，查找用二分
+    """
+
+    def __init__(self):
+        self._lines: Dict[Tuple, List[Tuple[int, str]]] = {}   # (business_id, group_id) -> [(score, visitor_id)]
+        self._entries: Dict[str, Dict[str, Dict]] = {}          # business_id -> {visitor_id: entry}
+        self._lock = threading.Lock()
+
+    def _discard(self, business_id: str, entry: Dict):
+        line = self._lines.get((business_id, entry['group_id']))
+        if not line:
+            return
+        item = (make_score(entry['priority'], entry['arrival']), entry['visitor_id'])
+        index = bisect.bisect_left(line, item)
+        if index < len(line) and line[index] == item:
+            del line[index]
+
+    def add(self, business_id, entry: Dict) -> int:
+        business_id = str(business_id)
+        with self._lock:
+            entries = self._entries.setdefault(business_id, {})
+            old = entries.get(entry['visitor_id'])
+            if old is not None:
+                self._discard(business_id, old)
+            entries[entry['visitor_id']] = entry
+            line = self._lines.setdefault((business_id, entry['group_id']), [])
+            item = (make_score(entry['priority'], entry['arrival']), entry['visitor_id'])
+            bisect.insort(line, item)
+            return bisect.bisect_left(line, item) + 1
+
+    def remove(self, business_id, visitor_id: str) -> Optional[Dict]:
+        business_id = str(business_id)
+        with self._lock:
+            entry = self._entries.get(business_id, {}).pop(visitor_id, None)
+            if entry is not None:
+                self._discard(business_id, entry)
+            return entry
+
+    def get(self, business_id, visitor_id: str) -> Optional[Dict]:
+        entry = self._entries.get(str(business_id), {}).get(visitor_id)
+        return dict(entry) if entry else None
+
+    def rank(self, business_id, visitor_id: str) -> int:
+        business_id = str(business_id)
+        with self._lock:
+            entry = self._entries.get(business_id, {}).get(visitor_id)
+            if entry is None:
+                return 0
+            line = self._lines.get((business_id, entry['group_id']), [])
+            item = (make_score(entry['priority'], entry['arrival']), visitor_id)
+            return bisect.bisect_left(line, item) + 1
+
+    def pop(self, business_id, group_id=None) -> Optional[Dict]:
+        business_id = str(business_id)
+        with self._lock:
+            heads = [
+                (line[0], key) for key, line in self._lines.items()
+                if key[0] == business_id and line and (group_id is None or key[1] == int(group_id))
+            ]
+            if not heads:
+                return None
+            (score, visitor_id), key = min(heads)
+            del self._lines[key][0]
+            return self._entries.get(business_id, {}).pop(visitor_id, None)
+
+    def size(self, business_id, group_id=None) -> int:
+        business_id = str(business_id)
+        if group_id is None:
+            return len(self._entries.get(business_id, {}))
+        return len(self._lines.get((business_id, int(group_id)), []))
+
+    def head(self, business_id, group_id=None, limit: Optional[int] = None) -> List[Dict]:
+        business_id = str(business_id)
+        with self._lock:
+            lines = [
+                line for key, line in self._lines.items()
+                if key[0] == business_id and (group_id is None or key[1] == int(group_id))
+            ]
+            entries = self._entries.get(business_id, {})
+            merged = heapq.merge(*lines)
+            result = []
+            for _, visitor_id in merged:
+                if limit is not None and len(result) >= limit:
+                    break
+                result.append(dict(entries[visitor_id]))
+            return result
+
+    def entries(self, business_id) -> Dict[str, Dict]:
+        return {vid: dict(e) for vid, e in self._entries.get(str(business_id), {}).items()}
+
+    def businesses(self) -> Set[int]:
+        return {int(b) for b, entries in self._entries.items() if entries}
+
+
+class RedisWaitingLineBackend:
+    """
+    Redis 等待线
+
+    加入 / 移除 / 取队首使用 Lua 脚本，保证 ZSet 与条目 Hash 一致
+    """
+
+    PREFIX = 'kefu:waitline'
+
+    # KEYS: entries_hash, groups_set
+    # ARGV: line_key_prefix, visitor_id, group_id, score, entry_json
+    # 返回: 在本分组中的位置（从1开始）
+    _ADD_SCRIPT = """
+    local old = redis.call('HGET', KEYS[1], ARGV[2])
+    if old then
+        local old_group = tostring(cjson.decode(old)['group_id'])
+        if old_group ~= ARGV[3] then
+            redis.call('ZREM', ARGV[1] .. old_group, ARGV[2])
+        end
+    end
+    local line = ARGV[1] .. ARGV[3]
+    redis.call('ZADD', line, ARGV[4], ARGV[2])
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[5])
+    redis.call('SADD', KEYS[2], ARGV[3])
+    return redis.call('ZRANK', line, ARGV[2]) + 1
+    """
+
+    # KEYS: entries_hash
+    # ARGV: line_key_prefix, visitor_id
+    # 返回: 被移除的条目JSON 或 nil
+    _REMOVE_SCRIPT = """
+    local entry = redis.call('HGET', KEYS[1], ARGV[2])
+    if not entry then
+        return nil
+    end
+    redis.call('ZREM', ARGV[1] .. tostring(cjson.decode(entry)['group_id']), ARGV[2])
+    redis.call('HDEL', KEYS[1], ARGV[2])
+    return entry
+    """
+
+    # KEYS: entries_hash
+    # ARGV: line_key_prefix, visitor_id
+    # 返回: 在本分组中的位置（从1开始），不在等待线中返回0
+    _RANK_SCRIPT = """
+    local entry = redis.call('HGET', KEYS[1], ARGV[2])
+    if not entry then
+        return 0
+    end
+    local rank = redis.call('ZRANK', ARGV[1] .. tostring(cjson.decode(entry)['group_id']), ARGV[2])
+    if not rank then
+        return 0
+    end
+    return rank + 1
+    """
+
+    # KEYS: entries_hash, groups_set
+    # ARGV: line_key_prefix, group_id（空字符串表示所有分组）
+    # 返回: 队首条目JSON 或 nil（在所有候选分组的队首中取分数最小者）
+    _POP_SCRIPT = """
+    local groups
+    if ARGV[2] ~= '' then
+        groups = {ARGV[2]}
+    else
+        groups = redis.call('SMEMBERS', KEYS[2])
+    end
+    local best_line, best_member, best_score
+    for _, group in ipairs(groups) do
+        local line = ARGV[1] .. group
+        local head = redis.call('ZRANGE', line, 0, 0, 'WITHSCORES')
+        if head[1] then
+            local score = tonumber(head[2])
+            if not best_score or score < best_score then
+                best_line, best_member, best_score = line, head[1], score
+            end
+        elseif ARGV[2] == '' then
+            redis.call('SREM', KEYS[2], group)
+        end
+    end
+    if not best_line then
+        return nil
+    end
+    redis.call('ZREM', best_line, best_member)
+    local entry = redis.call('HGET', KEYS[1], best_member)
+    redis.call('HDEL', KEYS[1], best_member)
+    return entry or cjson.encode({visitor_id = best_member})
+    """
+
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+        self._add = redis_conn.register_script(self._ADD_SCRIPT)
+        self._remove = redis_conn.register_script(self._REMOVE_SCRIPT)
+        self._rank = redis_conn.register_script(self._RANK_SCRIPT)
+        self._pop = redis_conn.register_script(self._POP_SCRIPT)
+
+    def _key(self, *parts) -> str:
+        return ':'.join([self.PREFIX] + [str(p) for p in parts])
+
+    def _line_prefix(self, business_id) -> str:
+        return self._key(business_id, 'line') + ':'
+
+    def add(self, business_id, entry: Dict) -> int:
+        return int(self._add(
+            keys=[self._key(business_id, 'entries'), self._key(business_id, 'groups')],
+            args=[self._line_prefix(business_id), entry['visitor_id'], entry['group_id'],
+                  make_score(entry['priority'], entry['arrival']), json.dumps(entry)]
+        ))
+
+    def remove(self, business_id, visitor_id: str) -> Optional[Dict]:
+        entry = self._remove(keys=[self._key(business_id, 'entries')],
+                             args=[self._line_prefix(business_id), visitor_id])
+        return json.loads(entry) if entry else None
+
+    def get(self, business_id, visitor_id: str) -> Optional[Dict]:
+        entry = self.redis.hget(self._key(business_id, 'entries'), visitor_id)
+        return json.loads(entry) if entry else None
+
+    def rank(self, business_id, visitor_id: str) -> int:
+        return int(self._rank(keys=[self._key(business_id, 'entries')],
+                              args=[self._line_prefix(business_id), visitor_id]))
+
+    def pop(self, business_id, group_id=None) -> Optional[Dict]:
+        entry = self._pop(
+            keys=[self._key(business_id, 'entries'), self._key(business_id, 'groups')],
+            args=[self._line_prefix(business_id), '' if group_id is None else int(group_id)]
+        )
+        return json.loads(entry) if entry else None
+
+    def size(self, business_id, group_id=None) -> int:
+        if group_id is None:
+            return int(self.redis.hlen(self._key(business_id, 'entries')))
+        return int(self.redis.zcard(self._line_prefix(business_id) + str(int(group_id))))
+
+    def head(self, business_id, group_id=None, limit: Optional[int] = None) -> List[Dict]:
+        if group_id is None:
+            groups = list(self.redis.smembers(self._key(business_id, 'groups')))
+        else:
+            groups = [int(group_id)]
+        if not groups:
+            return []
+
+        end = -1 if limit is None else limit - 1
+        pipe = self.redis.pipeline()
+        for group in groups:
+            pipe.zrange(self._line_prefix(business_id) + str(group), 0, end, withscores=True)
+        merged = heapq.merge(*[
+            [(score, member) for member, score in line] for line in pipe.execute()
+        ])
+        visitor_ids = [member for _, member in merged][:limit]
+        if not visitor_ids:
+            return []
+
+        values = self.redis.hmget(self._key(business_id, 'entries'), visitor_ids)
+        return [json.loads(v) for v in values if v]
+
+    def entries(self, business_id) -> Dict[str, Dict]:
+        raw = self.redis.hgetall(self._key(business_id, 'entries'))
+        return {vid: json.loads(e) for vid, e in raw.items()}
+
+    def businesses(self) -> Set[int]:
+        return {
+            int(key.split(':')[2])
+            for key in self.redis.scan_iter(match=self._key('*', 'entries'), count=500)
+        }
+
+
+class WaitingLine:
+    """
+    访客等待线
+
+    设计原则：
+    - 排队相关的写操作（入队、分配、结束、调整优先级）同步更新等待线，位置查询不再访问数据库
+    - 等待线操作失败只记录日志，数据库事务不受影响，偏差由定期校准修正
+    - 后端可替换：优先 Redis（跨worker共享），失败时降级为进程内存储
+    """
+
+    def __init__(self, reconcile_interval: int = 60):
+        """
+        Args:
+            reconcile_interval: 与数据库校准的间隔（秒）
+        """
+        self._backend = None
+        self._started = False
+        self.reconcile_interval = reconcile_interval
+
+    @property
+    def backend(self):
+        """延迟初始化后端（首次使用时连接Redis）"""
+        if self._backend is None:
+            self._backend = self._create_backend()
+        return self._backend
+
+    @staticmethod
+    def _create_backend():
+        try:
+            import config
+            from redis import Redis
+            redis_url = getattr(config, 'PRESENCE_REDIS_URL', None) or config.SOCKETIO_MESSAGE_QUEUE
+            conn = Redis.from_url(redis_url, decode_responses=True)
+            conn.ping()
+            logger.info(f"✅ 访客等待线使用Redis: {redis_url}")
+            return RedisWaitingLineBackend(conn)
+        except Exception as e:
+            logger.warning(f"⚠️ 访客等待线Redis不可用: {e}，降级为进程内存储（仅单worker有效）")
+            return LocalWaitingLineBackend()
+
+    def init_app(self, app):
+        """从Flask配置读取校准间隔"""
+        self.reconcile_interval = app.config.get('WAITING_LINE_RECONCILE_INTERVAL', self.reconcile_interval)
+
+    @staticmethod
+    def _arrival(created_at) -> int:
+        if isinstance(created_at, datetime):
+            return int(created_at.timestamp() * 1000)
+        return int(time.time() * 1000)
+
+    # ========== 写入 ==========
+
+    def add(self, business_id, visitor_id: str, qid=None, priority=0,
+            created_at: Optional[datetime] = None, group_id=0) -> int:
+        """
+        访客进入等待线（已在线中时按新的分组/优先级重新排位，到达时间不变）
+
+        Args:
+            business_id: 商户ID
+            visitor_id: 访客ID
+            qid: 队列记录ID
+            priority: 优先级 0=普通 1=VIP 2=紧急
+            created_at: 队列记录创建时间（决定同优先级内的先后）
+            group_id: 客服分组ID
+
+        Returns:
+            在分组内的排队位置（从1开始），失败返回0
+        """
+        try:
+            old = self.backend.get(business_id, visitor_id)
+            arrival = old['arrival'] if old and created_at is None else self._arrival(created_at)
+            return self.backend.add(business_id, make_entry(visitor_id, qid, group_id, priority, arrival))
+        except Exception as e:
+            logger.warning(f"加入等待线失败: visitor={visitor_id}, {e}")
+            return 0
+
+    def add_queue(self, queue) -> int:
+        """按 Queue 记录加入等待线"""
+        return self.add(queue.business_id, queue.visitor_id, queue.qid, queue.priority,
+                        queue.created_at, getattr(queue, 'group_id', 0))
+
+    def remove(self, business_id, visitor_id: str) -> bool:
+        """
+        访客离开等待线（已分配客服 / 会话结束 / 离线）
+
+        Returns:
+            是否确实在等待线中
+        """
+        try:
+            return self.backend.remove(business_id, visitor_id) is not None
+        except Exception as e:
+            logger.warning(f"移出等待线失败: visitor={visitor_id}, {e}")
+            return False
+
+    def update_priority(self, business_id, visitor_id: str, priority) -> int:
+        """
+        调整优先级（保留到达时间）
+
+        Returns:
+            新的排队位置，不在等待线中返回0
+        """
+        try:
+            entry = self.backend.get(business_id, visitor_id)
+            if entry is None:
+                return 0
+            entry['priority'] = int(priority or 0)
+            return self.backend.add(business_id, entry)
+        except Exception as e:
+            logger.warning(f"调整等待线优先级失败: visitor={visitor_id}, {e}")
+            return 0
+
+    def pop_next(self, business_id, group_id=None) -> Optional[Dict]:
+        """
+        原子地取出队首访客
+
+        Args:
+            business_id: 商户ID
+            group_id: 只从该分组取；None 表示在所有分组的队首中取最靠前的
+
+        Returns:
+            条目 {visitor_id, qid, group_id, priority, arrival}，等待线为空返回None
+        """
+        try:
+            return self.backend.pop(business_id, group_id)
+        except Exception as e:
+            logger.warning(f"取出等待线队首失败: business={business_id}, {e}")
+            return None
+
+    def push_back(self, business_id, entry: Dict):
+        """把 pop_next 取出但未能分配的条目放回原位置"""
+        try:
+            self.backend.add(business_id, entry)
+        except Exception as e:
+            logger.warning(f"放回等待线失败: visitor={entry.get('visitor_id')}, {e}")
+
+    # ========== 查询 ==========
+
+    def get(self, business_id, visitor_id: str) -> Optional[Dict]:
+        """访客的等待线条目 {visitor_id, qid, group_id, priority, arrival}，不在等待中返回None"""
+        try:
+            return self.backend.get(business_id, visitor_id)
+        except Exception as e:
+            logger.warning(f"读取等待线条目失败: visitor={visitor_id}, {e}")
+            return None
+
+    def position(self, business_id, visitor_id: str) -> int:
+        """排队位置（从1开始），不在等待中返回0"""
+        try:
+            return self.backend.rank(business_id, visitor_id)
+        except Exception as e:
+            logger.warning(f"查询排队位置失败: visitor={visitor_id}, {e}")
+            return 0
+
+    def size(self, business_id, group_id=None) -> int:
+        """等待人数"""
+        try:
+            return self.backend.size(business_id, group_id)
+        except Exception as e:
+            logger.warning(f"查询等待人数失败: business={business_id}, {e}")
+            return 0
+
+    def snapshot(self, business_id, group_id=None, limit: Optional[int] = None) -> List[Dict]:
+        """
+        按排队顺序返回等待中的条目
+
+        Args:
+            business_id: 商户ID
+            group_id: 分组ID；None 表示所有分组合并排序
+            limit: 最多返回条数，None 表示全部
+        """
+        try:
+            return self.backend.head(business_id, group_id, limit)
+        except Exception as e:
+            logger.warning(f"读取等待线失败: business={business_id}, {e}")
+            return []
+
+    # ========== 校准 ==========
+
+    def rebuild(self, grace_seconds: float = 5.0) -> int:
+        """
+        按数据库中的等待记录校准等待线（需在应用上下文中调用）
+
+        Args:
+            grace_seconds: 到达时间在校准开始前这段时间内的条目不删除（对应的数据库事务可能尚未提交）
+
+        Returns:
+            修正的条目数
+        """
+        from exts import db
+        from mod.mysql.models import Queue
+
+        started_ms = int(time.time() * 1000)
+        rows = db.session.query(
+            Queue.qid, Queue.business_id, Queue.visitor_id, Queue.group_id,
+            Queue.priority, Queue.created_at
+        ).filter(
+            Queue.state == 'normal',
+            (Queue.service_id == None) | (Queue.service_id == 0)  # ✅ 兼容旧数据
+        ).all()
+
+        expected: Dict[int, Dict[str, Dict]] = {}
+        for qid, business_id, visitor_id, group_id, priority, created_at in rows:
+            expected.setdefault(business_id, {})[visitor_id] = make_entry(
+                visitor_id, qid, group_id, priority, self._arrival(created_at)
+            )
+
+        backend = self.backend
+        cutoff = started_ms - int(grace_seconds * 1000)
+        fixed = 0
+        for business_id in backend.businesses() | set(expected):
+            current = backend.entries(business_id)
+            wanted = expected.get(business_id, {})
+            for visitor_id, entry in current.items():
+                if visitor_id not in wanted and entry.get('arrival', 0) < cutoff:
+                    backend.remove(business_id, visitor_id)
+                    fixed += 1
+            for visitor_id, entry in wanted.items():
+                if current.get(visitor_id) != entry:
+                    backend.add(business_id, entry)
+                    fixed += 1
+        return fixed
+
+    def start(self, socketio):
+        """启动时校准一次，之后定期校准（集群内同一周期只有一个worker执行）"""
+        if self._started:
+            return
+        self._started = True
+
+        def reconcile_loop():
+            from exts import app, db
+            while True:
+                try:
+                    backend = self.backend
+                    locked = True
+                    if isinstance(backend, RedisWaitingLineBackend):
+                        locked = backend.redis.set(f'{backend.PREFIX}:reconcile_lock', 1,
+                                                   nx=True, ex=max(1, self.reconcile_interval - 1))
+                    if locked:
+                        with app.app_context():
+                            try:
+                                fixed = self.rebuild()
+                                if fixed:
+                                    logger.info(f"🚶 等待线已按数据库校准: 修正{fixed}条")
+                            finally:
+                                db.session.remove()
+                except Exception as e:
+                    logger.error(f"等待线校准失败: {e}")
+                socketio.sleep(self.reconcile_interval)
+
+        socketio.start_background_task(reconcile_loop)
+        logger.info(f"✅ 等待线校准任务已启动 (间隔{self.reconcile_interval}s)")
+
+
+# 全局单例
+waiting_line = WaitingLine()
@@ -55,6 +55,9 @@ def check_session_timeout():
                             session.state = 'complete'
                             session.updated_at = datetime.now()
                             db.session.commit()
+                            # 处理时长按最后一条消息计算，不含超时等待的部分
+                            from mod.services.wait_estimator import wait_estimator
+                            wait_estimator.observe_queue(session, session.last_message_time)
                             
                             # 通知访客和客服
                             _socketio.emit('session_timeout', {
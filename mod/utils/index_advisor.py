@@ -0,0 +1,145 @@
+"""
+索引分析
+把 DatabaseQueryMonitor 采集到的 SQL 语句用 EXPLAIN 回放（使用最近一次执行的参数），
+找出仍然全表扫描、全索引扫描、文件排序（filesort）或使用临时表的语句，
+并按语句中的等值条件 / 范围条件 / 排序列给出候选的复合索引。
+
+EXPLAIN 只生成执行计划，不会真正执行语句；只回放 SELECT / UPDATE / DELETE。
+"""
+import re
+from typing import Dict, List, Optional
+import log
+
+logger = log.get_logger(__name__)
+
+
+# EXPLAIN.type -> 问题
+ACCESS_PROBLEMS = {
+    'ALL': 'full_scan',
+    'index': 'full_index_scan',
+}
+
+# EXPLAIN.Extra 中的关键字 -> 问题
+EXTRA_PROBLEMS = {
+    'Using filesort': 'filesort',
+    'Using temporary': 'temporary',
+}
+
+EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE')
+
+
+class IndexAdvisor:
+    """
+    索引分析器
+
+    使用方式：
+        report = index_advisor.analyze(limit=50)
+    """
+
+    @staticmethod
+    def _explain(conn, statement: str, parameters) -> List[Dict]:
+        result = conn.exec_driver_sql('EXPLAIN ' + statement, parameters or ())
+        return [dict(row) for row in result.mappings()]
+
+    @staticmethod
+    def _problems(plan_row: Dict) -> List[str]:
+        problems = []
+        access = ACCESS_PROBLEMS.get(plan_row.get('type'))
+        if access:
+            problems.append(access)
+        extra = plan_row.get('Extra') or ''
+        problems.extend(name for keyword, name in EXTRA_PROBLEMS.items() if keyword in extra)
+        return problems
+
+    @staticmethod
+    def suggest(statement: str, table: str) -> Optional[List[str]]:
+        """
+        按语句推测候选索引列：等值条件列在前，随后是第一个范围条件列或排序列
+
+        Args:
+            statement: SQL语句
+            table: 表名（或别名）
+
+        Returns:
+            列名列表，推测不出时返回None
+        """
+        upper = statement.upper()
+        where_at = upper.find(' WHERE ')
+        if where_at < 0:
+            return None
+        order_at = upper.find(' ORDER BY ', where_at)
+        tail_at = min(i for i in (upper.find(' GROUP BY ', where_at), upper.find(' LIMIT ', where_at),
+                                  order_at, len(statement)) if i >= 0)
+        where = statement[where_at:tail_at]
+        prefix = re.escape(table) + r'\.'
+
+        columns = []
+        for column in re.findall(prefix + r'(\w+)\s*(?:=|<=>|IS\s+NULL)', where, re.IGNORECASE):
+            if column not in columns:
+                columns.append(column)
+        ranges = [c for c in re.findall(prefix + r'(\w+)\s*(?:>|<|>=|<=|IN\b|BETWEEN\b|LIKE\b)',
+                                        where, re.IGNORECASE) if c not in columns]
+        if ranges:
+            columns.append(ranges[0])
+        elif order_at >= 0:
+            order = re.findall(prefix + r'(\w+)', statement[order_at:])
+            columns.extend(c for c in order[:1] if c not in columns)
+        return columns or None
+
+    def analyze(self, limit: int = 50) -> List[Dict]:
+        """
+        回放已采集的语句（按总耗时取前 limit 条）
+
+        Returns:
+            [{'statement', 'count', 'total_time', 'avg_time',
+              'issues': [{'table', 'type', 'key', 'rows', 'extra', 'problems', 'suggested_index'}]}]
+            只包含存在问题的语句
+        """
+        from exts import db
+        from mod.utils.performance_monitor import DatabaseQueryMonitor
+
+        candidates = [
+            row for row in DatabaseQueryMonitor.captured()
+            if row[0].lstrip()[:6].upper() in EXPLAINABLE
+        ][:limit]
+
+        report = []
+        with db.engine.connect() as conn:
+            for statement, count, total_time, parameters in candidates:
+                try:
+                    plan = self._explain(conn, statement, parameters)
+                except Exception as e:
+                    logger.debug(f"EXPLAIN 失败: {statement[:100]}... {e}")
+                    continue
+
+                issues = []
+                for row in plan:
+                    problems = self._problems(row)
+                    if not problems:
+                        continue
+                    table = row.get('table') or ''
+                    issues.append({
+                        'table': table,
+                        'type': row.get('type'),
+                        'key': row.get('key'),
+                        'rows': row.get('rows'),
+                        'extra': row.get('Extra'),
+                        'problems': problems,
+                        'suggested_index': self.suggest(statement, table) if table else None
+                    })
+
+                if issues:
+                    report.append({
+                        'statement': statement,
+                        'count': count,
+                        'total_time': round(total_time, 6),
+                        'avg_time': round(total_time / count, 6) if count else 0,
+                        'issues': issues
+                    })
+
+        logger.info(f"🔍 索引分析: 回放{len(candidates)}条语句, {len(report)}条存在全表扫描/文件排序")
+        return report
+
+
+# 全局单例
+index_advisor = IndexAdvisor()
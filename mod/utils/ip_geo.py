@@ -0,0 +1,310 @@
+"""
+IP地理位置离线查询引擎
+- 本地数据库：纯真 qqwry.dat 或 MaxMind .mmdb，内存映射（mmap）+ 二分查找，单次查询微秒级
+- 前置有容量上限的 TTL LRU 缓存
+- 可选在线兜底：本地库查不到时提交到后台任务池调用在线API，结果回写缓存并通过回调通知
+访客加入时可以直接同步查询，不再阻塞也不再需要禁用定位
+"""
+import ipaddress
+import mmap
+import os
+import struct
+import threading
+from typing import Callable, Dict, Optional, Tuple
+from mod.utils.cache import TTLLRUCache
+import log
+
+logger = log.get_logger(__name__)
+
+
+class QQWryReader:
+    """
+    纯真IP数据库（qqwry.dat）读取器
+
+    文件结构：
+    - 文件头 8 字节：第一条/最后一条索引的偏移
+    - 索引区每条 7 字节：起始IP(4字节) + 记录偏移(3字节)，按起始IP升序
+    - 记录区：结束IP(4字节) + 国家/地区字符串（GBK，支持重定向模式 0x01/0x02）
+    """
+
+    INDEX_SIZE = 7
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index_start, self._index_end = struct.unpack('<II', self._buf[:8])
+        self.count = (self._index_end - self._index_start) // self.INDEX_SIZE + 1
+
+    def _offset(self, pos: int) -> int:
+        return int.from_bytes(self._buf[pos:pos + 3], 'little')
+
+    def _string(self, pos: int) -> Tuple[str, int]:
+        end = self._buf.find(b'\x00', pos)
+        text = self._buf[pos:end].decode('gbk', errors='replace')
+        return text, end + 1
+
+    def _area(self, pos: int) -> str:
+        mode = self._buf[pos]
+        if mode in (1, 2):
+            offset = self._offset(pos + 1)
+            return self._string(offset)[0] if offset else ''
+        return self._string(pos)[0]
+
+    def _record(self, offset: int) -> Tuple[str, str]:
+        pos = offset + 4
+        mode = self._buf[pos]
+        if mode == 1:
+            pos = self._offset(pos + 1)
+            mode = self._buf[pos]
+        if mode == 2:
+            country = self._string(self._offset(pos + 1))[0]
+            area = self._area(pos + 4)
+        else:
+            country, next_pos = self._string(pos)
+            area = self._area(next_pos)
+        return country, area
+
+    def lookup(self, ip: int) -> Optional[Tuple[str, str]]:
+        """
+        Args:
+            ip: 整数形式的IPv4地址
+
+        Returns:
+            (国家/省市, 地区/运营商)，查不到返回None
+        """
+        lo, hi = 0, self.count - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            pos = self._index_start + mid * self.INDEX_SIZE
+            if struct.unpack('<I', self._buf[pos:pos + 4])[0] <= ip:
+                lo = mid
+            else:
+                hi = mid - 1
+
+        pos = self._index_start + lo * self.INDEX_SIZE
+        start_ip = struct.unpack('<I', self._buf[pos:pos + 4])[0]
+        offset = self._offset(pos + 4)
+        end_ip = struct.unpack('<I', self._buf[offset:offset + 4])[0]
+        if not start_ip <= ip <= end_ip:
+            return None
+
+        country, area = self._record(offset)
+        area = area.replace('CZ88.NET', '').strip()
+        return country.replace('CZ88.NET', '').strip(), area
+
+    def close(self):
+        self._buf.close()
+        self._file.close()
+
+
+class IPGeoEngine:
+    """
+    IP地理位置查询引擎
+
+    查询顺序：本地/内网判断 -> LRU缓存 -> 本地数据库 -> （可选）后台在线查询
+    返回结构与 IPLocationService.get_location 一致
+    """
+
+    def __init__(self):
+        self.cache = TTLLRUCache()
+        self.online_fallback = False
+        self._qqwry: Optional[QQWryReader] = None
+        self._mmdb = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        从Flask配置加载本地数据库和缓存参数
+
+        配置项：
+            IP_GEO_DB_PATH: qqwry.dat 或 .mmdb 文件路径
+            IP_GEO_CACHE_SIZE / IP_GEO_CACHE_TTL: 缓存容量 / 过期时间（秒）
+            IP_GEO_ONLINE_FALLBACK: 本地库查不到时是否后台调用在线API
+        """
+        self.cache = TTLLRUCache(
+            maxsize=app.config.get('IP_GEO_CACHE_SIZE', 10000),
+            ttl=app.config.get('IP_GEO_CACHE_TTL', 3600)
+        )
+        self.online_fallback = app.config.get('IP_GEO_ONLINE_FALLBACK', False)
+        self.load(app.config.get('IP_GEO_DB_PATH', 'data/qqwry.dat'))
+
+    def load(self, path: str) -> bool:
+        """加载本地IP数据库（按扩展名识别格式）"""
+        if not path or not os.path.exists(path):
+            logger.warning(f"⚠️ IP数据库文件不存在: {path}，仅识别本地/内网地址")
+            return False
+        try:
+            if path.endswith('.mmdb'):
+                import maxminddb
+                self._mmdb = maxminddb.open_database(path, mode=maxminddb.MODE_MMAP)
+            else:
+                self._qqwry = QQWryReader(path)
+            logger.info(f"✅ IP数据库已加载: {path}")
+            return True
+        except ImportError:
+            logger.warning("maxminddb模块未安装，使用 pip install maxminddb 安装")
+        except Exception as e:
+            logger.error(f"IP数据库加载失败: {path}, 错误: {e}")
+        return False
+
+    # ========== 查询 ==========
+
+    def lookup(self, ip_address: str,
+               on_resolved: Optional[Callable[[str, Dict], None]] = None) -> Dict:
+        """
+        查询IP地理位置（不阻塞）
+
+        Args:
+            ip_address: IPv4地址
+            on_resolved: 本地查不到而转为后台在线查询时，查询完成后的回调 (ip, location)
+
+        Returns:
+            位置信息；后台查询进行中时 formatted 为 '定位中...'
+        """
+        try:
+            ip = ipaddress.IPv4Address(ip_address.split()[0] if ip_address else '')
+        except (ValueError, IndexError):
+            return self._location('未知')
+
+        if ip.is_loopback:
+            return self._location('本地')
+        if ip.is_private:
+            return self._location('内网')
+
+        key = str(ip)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        location = self._lookup_local(int(ip))
+        if location is not None:
+            self.cache.set(key, location)
+            return location
+
+        if self.online_fallback:
+            self._resolve_online(key, on_resolved)
+            return self._location('定位中...')
+
+        location = self._location('未知')
+        self.cache.set(key, location)
+        return location
+
+    def _lookup_local(self, ip: int) -> Optional[Dict]:
+        try:
+            if self._qqwry is not None:
+                result = self._qqwry.lookup(ip)
+                return self._from_qqwry(*result) if result else None
+            if self._mmdb is not None:
+                record = self._mmdb.get(str(ipaddress.IPv4Address(ip)))
+                return self._from_mmdb(record) if record else None
+        except Exception as e:
+            logger.debug(f"本地IP库查询失败: {ip}, {e}")
+        return None
+
+    def _resolve_online(self, ip_address: str, on_resolved=None):
+        """后台在线查询（同一IP同时只查询一次）"""
+        with self._lock:
+            if ip_address in self._pending:
+                return
+            self._pending.add(ip_address)
+
+        from mod.services.task_pool import task_pool
+
+        def resolve():
+            try:
+                from mod.mysql.ModuleClass import ip_location_service
+                location = ip_location_service.get_location(ip_address)
+                self.cache.set(ip_address, location)
+                if on_resolved:
+                    on_resolved(ip_address, location)
+            except Exception as e:
+                logger.error(f"在线IP查询失败: {ip_address}, 错误: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(ip_address)
+
+        if not task_pool.submit('ip_geo', resolve, key=ip_address):
+            with self._lock:
+                self._pending.discard(ip_address)
+
+    # ========== 结果格式 ==========
+
+    @staticmethod
+    def _location(formatted: str, country: str = '', province: str = '', city: str = '',
+                  country_code: str = '', latitude=None, longitude=None) -> Dict:
+        return {
+            'country': country,
+            'province': province,
+            'city': city,
+            'country_code': country_code,
+            'latitude': latitude,
+            'longitude': longitude,
+            'formatted': formatted
+        }
+
+    PROVINCE_SUFFIXES = ('省', '自治区', '特别行政区')
+    MUNICIPALITIES = ('北京', '上海', '天津', '重庆')
+
+    @classmethod
+    def _from_qqwry(cls, region: str, isp: str) -> Optional[Dict]:
+        """
+        解析纯真库的地区字段
+        新版数据库国内IP为 '广东省深圳市' 形式（不带国家），境外为国家名
+        """
+        if not region or region in ('IANA', '保留地址', '未知'):
+            return None
+
+        province, city = '', ''
+        for suffix in cls.PROVINCE_SUFFIXES:
+            if suffix in region:
+                head, tail = region.split(suffix, 1)
+                province, city = head + suffix, tail
+                break
+        else:
+            for name in cls.MUNICIPALITIES:
+                if region.startswith(name):
+                    province = city = region if region.endswith('市') else name + '市'
+                    break
+
+        if province:
+            country = '中国'
+            parts = [country, province] + ([city] if city and city != province else [])
+            formatted = ' '.join(parts)
+        else:
+            country = region
+            formatted = region
+
+        return cls._location(formatted, country, province, city, 'CN' if country == '中国' else '')
+
+    @classmethod
+    def _from_mmdb(cls, record: Dict) -> Dict:
+        def name(item):
+            names = (item or {}).get('names', {})
+            return names.get('zh-CN') or names.get('en', '')
+
+        country = name(record.get('country')) or '未知'
+        subdivisions = record.get('subdivisions') or []
+        province = name(subdivisions[0]) if subdivisions else ''
+        city = name(record.get('city'))
+        location = record.get('location', {})
+        return cls._location(
+            f"{country} {province} {city}".strip(), country, province, city,
+            (record.get('country') or {}).get('iso_code', ''),
+            location.get('latitude'), location.get('longitude')
+        )
+
+    def get_stats(self) -> Dict:
+        """缓存与数据库状态"""
+        total = self.cache.hits + self.cache.misses
+        return {
+            'database': 'qqwry' if self._qqwry else ('mmdb' if self._mmdb else None),
+            'cache_size': len(self.cache),
+            'cache_hit_rate': round(self.cache.hits / total * 100, 2) if total else 0,
+            'online_fallback': self.online_fallback,
+            'pending_online': len(self._pending)
+        }
+
+
+# 全局单例
+ip_geo_engine = IPGeoEngine()
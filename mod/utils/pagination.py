@@ -0,0 +1,164 @@
+"""
+游标分页（keyset pagination）
+聊天历史原来用 offset/limit 分页并且每次请求都额外执行一次 COUNT(*)：
+越往前翻 offset 越大，数据库要扫描并丢弃的行越多；消息越多 COUNT 越慢。
+
+这里按 (created_at, cid) 做游标分页：
+- 游标记录上一页最后一条消息的 (created_at, cid)，下一页用
+  created_at < t OR (created_at = t AND cid < id) 直接从索引位置继续，与翻到第几页无关
+- 多取一条（limit + 1）判断 has_more，不需要 COUNT
+- 总数可选（with_total=1），按查询条件缓存一段时间，只是近似值
+- created_at 可以为 NULL（只有 Python 端默认值）：NULL 视为最早，与 MySQL 的排序一致
+  （升序在最前、降序在最后），游标中记为空时间
+
+游标对客户端是不透明字符串（base64），客户端原样带回即可。
+"""
+import base64
+import hashlib
+from datetime import datetime
+from typing import Any, List, Optional
+from mod.utils.cache import TTLLRUCache
+import log
+
+logger = log.get_logger(__name__)
+
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+TOTAL_CACHE_TTL = 60
+
+
+class InvalidCursor(ValueError):
+    """游标格式错误"""
+
+
+def encode_cursor(created_at: Optional[datetime], key: int) -> str:
+    """把 (created_at, 主键) 编码为游标字符串（created_at 为 NULL 时记为空）"""
+    raw = f'{created_at.isoformat() if created_at else ""}|{key}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    """
+    解析游标
+
+    Returns:
+        (created_at, 主键)，created_at 可能为 None
+
+    Raises:
+        InvalidCursor: 游标格式错误
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, key = raw.rsplit('|', 1)
+        return (datetime.fromisoformat(created_at) if created_at else None), int(key)
+    except Exception:
+        raise InvalidCursor(f'无效的分页游标: {cursor}')
+
+
+class KeysetPage:
+    """一页结果"""
+
+    __slots__ = ('items', 'next_cursor', 'has_more', 'total')
+
+    def __init__(self, items: List[Any], next_cursor: Optional[str], has_more: bool,
+                 total: Optional[int] = None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.has_more = has_more
+        self.total = total
+
+    def meta(self) -> dict:
+        """分页信息（接口返回用）"""
+        return {
+            'next_cursor': self.next_cursor,
+            'has_more': self.has_more,
+            'total': self.total
+        }
+
+
+def keyset_paginate(query, time_column, key_column, cursor: Optional[str] = None,
+                    limit: int = DEFAULT_LIMIT, newest_first: bool = True,
+                    with_total: bool = False) -> KeysetPage:
+    """
+    按 (time_column, key_column) 游标分页
+
+    Args:
+        query: 已加好筛选条件、未排序的查询
+        time_column: 时间列（如 Chat.created_at）
+        key_column: 主键列（如 Chat.cid），时间相同时用来保证顺序唯一
+        cursor: 上一页返回的 next_cursor，None 表示第一页
+        limit: 每页数量
+        newest_first: True 从最新往前翻，False 从最早往后翻
+        with_total: 是否附带（近似）总数
+
+    Returns:
+        KeysetPage，items 按翻页方向排列
+
+    Raises:
+        InvalidCursor: 游标格式错误
+    """
+    from sqlalchemy import and_, or_
+
+    total = approximate_total(query) if with_total else None
+
+    if cursor:
+        created_at, key = decode_cursor(cursor)
+        # NULL 时间视为最早：降序排在最后，升序排在最前（MySQL 的默认 NULL 排序）
+        if created_at is None and newest_first:
+            query = query.filter(time_column.is_(None), key_column < key)
+        elif created_at is None:
+            query = query.filter(or_(time_column.isnot(None),
+                                     and_(time_column.is_(None), key_column > key)))
+        elif newest_first:
+            query = query.filter(or_(time_column < created_at,
+                                     and_(time_column == created_at, key_column < key),
+                                     time_column.is_(None)))
+        else:
+            query = query.filter(or_(time_column > created_at,
+                                     and_(time_column == created_at, key_column > key)))
+
+    if newest_first:
+        query = query.order_by(time_column.desc(), key_column.desc())
+    else:
+        query = query.order_by(time_column.asc(), key_column.asc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    items = rows[:limit]
+
+    next_cursor = None
+    if has_more and items:
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, time_column.key), getattr(last, key_column.key))
+    return KeysetPage(items, next_cursor, has_more, total)
+
+
+_total_cache = TTLLRUCache(maxsize=2000, ttl=TOTAL_CACHE_TTL)
+
+
+def approximate_total(query, ttl: float = TOTAL_CACHE_TTL) -> int:
+    """
+    查询的总数（按 SQL 和参数缓存 ttl 秒，新消息不会立即计入）
+    """
+    compiled = query.statement.compile()
+    key = hashlib.sha1(f'{compiled}|{sorted(compiled.params.items(), key=str)}'.encode('utf-8')).hexdigest()
+    total = _total_cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        _total_cache.set(key, total, ttl)
+    return total
+
+
+def cursor_args(request, default_limit: int = DEFAULT_LIMIT):
+    """
+    从请求参数读取分页参数：cursor / limit（不超过 MAX_LIMIT）/ with_total
+
+    Returns:
+        (cursor, limit, with_total)
+    """
+    cursor = request.args.get('cursor') or None
+    limit = request.args.get('limit', default_limit, type=int) or default_limit
+    limit = max(1, min(limit, MAX_LIMIT))
+    with_total = request.args.get('with_total', '0').lower() in ('1', 'true', 'yes')
+    return cursor, limit, with_total
@@ -3,9 +3,12 @@
 监控慢查询、慢接口和系统性能指标
 """
 import time
+import json
 import functools
+import threading
+from collections import OrderedDict, deque, defaultdict
 from datetime import datetime
-from flask import request, g
+from flask import request, g, has_app_context
 from exts import db
 import log
 
@@ -165,10 +168,48 @@ class DatabaseQueryMonitor:
     数据库查询性能监控
     
     使用SQLAlchemy事件监听器监控所有数据库查询
+    
+    同时按SQL文本采集执行过的语句（次数、总耗时、最近一次参数），
+    供索引分析（mod.utils.index_advisor）用 EXPLAIN 回放
     """
     
-    @staticmethod
-    def init_app(app):
+    # 最多采集的不同语句数（超出后淘汰最久未执行的）
+    CAPTURE_SIZE = 500
+    
+    _lock = threading.Lock()
+    _statements = OrderedDict()  # statement -> [count, total_time, parameters]
+    
+    @classmethod
+    def capture(cls, statement, parameters, duration):
+        """记录一次语句执行（EXPLAIN 自身和批量执行不记录）"""
+        if statement.lstrip()[:7].upper() == 'EXPLAIN':
+            return
+        with cls._lock:
+            item = cls._statements.get(statement)
+            if item is None:
+                item = cls._statements[statement] = [0, 0.0, None]
+                while len(cls._statements) > cls.CAPTURE_SIZE:
+                    cls._statements.popitem(last=False)
+            else:
+                cls._statements.move_to_end(statement)
+            item[0] += 1
+            item[1] += duration
+            item[2] = parameters
+    
+    @classmethod
+    def captured(cls):
+        """
+        已采集的语句
+        
+        Returns:
+            [(statement, count, total_time, parameters)]，按总耗时降序
+        """
+        with cls._lock:
+            rows = [(stmt, *item) for stmt, item in cls._statements.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+    
+    @classmethod
+    def init_app(cls, app):
         """
         初始化数据库查询监控
         
@@ -178,6 +219,8 @@ class DatabaseQueryMonitor:
         from sqlalchemy import event
         from sqlalchemy.engine import Engine
         
+        cls.CAPTURE_SIZE = app.config.get('QUERY_CAPTURE_SIZE', cls.CAPTURE_SIZE)
+        
         @event.listens_for(Engine, "before_cursor_execute")
         def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
             """查询执行前"""
@@ -188,11 +231,14 @@ class DatabaseQueryMonitor:
             """查询执行后"""
             total_time = time.time() - conn.info['query_start_time'].pop(-1)
             
-            # 累计查询次数和时间（存储在g对象中）
-            if hasattr(g, 'db_query_count'):
+            # 累计查询次数和时间（存储在g对象中，HTTP请求和SocketIO事件共用）
+            if has_app_context() and hasattr(g, 'db_query_count'):
                 g.db_query_count += 1
                 g.db_query_time += total_time
             
+            if not executemany:
+                DatabaseQueryMonitor.capture(statement, parameters, total_time)
+            
             # 记录慢查询
             if total_time > PerformanceMonitor.SLOW_QUERY_THRESHOLD:
                 logger.warning(
@@ -209,6 +255,196 @@ class DatabaseQueryMonitor:
                 )
 
 
+# ========== SocketIO 事件监控 ==========
+
+class SocketIOEventMonitor:
+    """
+    SocketIO 事件处理性能监控
+
+    Flask 请求钩子覆盖不到 @socketio.on 处理函数，这里在 SocketIO 的事件分发入口
+    （SocketIO._handle_event）外包一层，对每个事件记录：
+    - 处理耗时
+    - 数据库查询次数/耗时（复用 DatabaseQueryMonitor 的游标事件，计数存在 g 中）
+    - 处理期间的 emit 次数
+    - 入站数据大小
+
+    每个事件保留最近 SAMPLE_SIZE 个样本用于计算 p50/p95/p99，
+    另外累计总次数/总耗时/失败次数（Prometheus summary 的 _sum/_count）。
+    统计数据为当前 worker 进程内的数据。
+    """
+
+    SAMPLE_SIZE = 1000
+
+    # 指标名 -> (样本字段索引, 说明)
+    METRICS = {
+        'duration_seconds': (0, 'SocketIO event handler wall time'),
+        'db_queries': (1, 'Database queries per SocketIO event'),
+        'db_time_seconds': (2, 'Database time per SocketIO event'),
+        'emits': (3, 'Emits performed per SocketIO event'),
+        'payload_bytes': (4, 'Inbound payload size per SocketIO event'),
+    }
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    _lock = threading.Lock()
+    _samples = defaultdict(lambda: deque(maxlen=SocketIOEventMonitor.SAMPLE_SIZE))
+    _totals = defaultdict(lambda: [0, 0.0, 0])  # event -> [count, sum_duration, errors]
+    _installed = False
+
+    @classmethod
+    def init_app(cls, socketio):
+        """
+        安装事件监控（需在 DatabaseQueryMonitor.init_app 之后调用才能统计数据库查询）
+
+        Args:
+            socketio: Flask-SocketIO 实例
+        """
+        if cls._installed:
+            return
+        cls._installed = True
+
+        original_handle_event = socketio._handle_event
+        original_emit = socketio.emit
+
+        def handle_event(handler, message, namespace, sid, *args):
+            return original_handle_event(cls._wrap(handler, message, args), message, namespace, sid, *args)
+
+        def emit(*args, **kwargs):
+            if has_app_context() and hasattr(g, 'sio_emit_count'):
+                g.sio_emit_count += 1
+            return original_emit(*args, **kwargs)
+
+        socketio._handle_event = handle_event
+        socketio.emit = emit
+        logger.info("✅ SocketIO事件监控已启动")
+
+    @classmethod
+    def _wrap(cls, handler, message, args):
+        """包装处理函数（在 SocketIO 推入的应用上下文内执行）"""
+        @functools.wraps(handler)
+        def instrumented(*handler_args):
+            g.db_query_count = 0
+            g.db_query_time = 0.0
+            g.sio_emit_count = 0
+            start_time = time.time()
+            failed = False
+            try:
+                return handler(*handler_args)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                duration = time.time() - start_time
+                cls.record(message, duration, g.db_query_count, g.db_query_time,
+                           g.sio_emit_count, cls._payload_size(args), failed)
+
+                if duration > PerformanceMonitor.SLOW_API_THRESHOLD:
+                    logger.warning(
+                        f"🐌 慢事件：{message} 耗时 {duration:.3f}s | "
+                        f"查询 {g.db_query_count} 次 ({g.db_query_time:.3f}s)"
+                    )
+        return instrumented
+
+    @staticmethod
+    def _payload_size(args) -> int:
+        try:
+            return len(json.dumps(args, ensure_ascii=False, default=str).encode('utf-8'))
+        except Exception:
+            return 0
+
+    @classmethod
+    def record(cls, event, duration, db_queries, db_time, emits, payload_bytes, failed=False):
+        """记录一次事件处理样本"""
+        with cls._lock:
+            cls._samples[event].append((duration, db_queries, db_time, emits, payload_bytes))
+            totals = cls._totals[event]
+            totals[0] += 1
+            totals[1] += duration
+            if failed:
+                totals[2] += 1
+
+    @staticmethod
+    def _quantile(sorted_values, q):
+        if not sorted_values:
+            return 0
+        index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+        return sorted_values[index]
+
+    @classmethod
+    def _snapshot(cls):
+        with cls._lock:
+            return (
+                {event: list(samples) for event, samples in cls._samples.items()},
+                {event: list(totals) for event, totals in cls._totals.items()},
+            )
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        """
+        获取各事件的统计数据
+
+        Returns:
+            {event: {'count', 'errors', 'avg_duration', 'duration_seconds': {'p50', 'p95', 'p99'}, ...}}
+        """
+        samples, totals = cls._snapshot()
+        stats = {}
+        for event, rows in samples.items():
+            count, sum_duration, errors = totals[event]
+            item = {
+                'count': count,
+                'errors': errors,
+                'avg_duration': round(sum_duration / count, 6) if count else 0,
+            }
+            for name, (index, _) in cls.METRICS.items():
+                values = sorted(row[index] for row in rows)
+                item[name] = {
+                    f'p{int(q * 100)}': round(cls._quantile(values, q), 6)
+                    for q in cls.QUANTILES
+                }
+            stats[event] = item
+        return stats
+
+    @classmethod
+    def render_prometheus(cls, prefix: str = 'kefu_socketio_event') -> str:
+        """
+        以 Prometheus 文本格式输出（summary 类型）
+
+        Returns:
+            Prometheus exposition 格式文本
+        """
+        samples, totals = cls._snapshot()
+        lines = []
+        for name, (index, help_text) in cls.METRICS.items():
+            metric = f'{prefix}_{name}'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} summary')
+            for event in sorted(samples):
+                rows = samples[event]
+                values = sorted(row[index] for row in rows)
+                for q in cls.QUANTILES:
+                    lines.append(f'{metric}{{event="{event}",quantile="{q}"}} {cls._quantile(values, q)}')
+                if name == 'duration_seconds':
+                    total_sum, total_count = totals[event][1], totals[event][0]
+                else:
+                    total_sum, total_count = sum(values), len(values)
+                lines.append(f'{metric}_sum{{event="{event}"}} {total_sum}')
+                lines.append(f'{metric}_count{{event="{event}"}} {total_count}')
+
+        metric = f'{prefix}_errors_total'
+        lines.append(f'# HELP {metric} SocketIO event handler exceptions')
+        lines.append(f'# TYPE {metric} counter')
+        for event in sorted(totals):
+            lines.append(f'{metric}{{event="{event}"}} {totals[event][2]}')
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def reset(cls):
+        """清空统计数据"""
+        with cls._lock:
+            cls._samples.clear()
+            cls._totals.clear()
+
+
 # ========== 内存和CPU监控 ==========
 
 class SystemResourceMonitor:
@@ -6,12 +6,28 @@ from flask import request, session
 from flask_socketio import emit, join_room, leave_room, rooms
 from exts import socketio, db, app, redis_client
 from mod.mysql.models import Service, Visitor, Chat, Queue, SystemSetting
-from mod.mysql.ModuleClass import ip_location_service
+from mod.utils.ip_geo import ip_geo_engine
 from mod.mysql.ModuleClass.RobotServiceClass import RobotService
 from mod.utils.security_filter import SecurityFilter, sanitize_message
+from mod.services.presence_service import presence_registry
+from mod.services.offline_batcher import visitor_offline_batcher
+from mod.services.message_writer import message_writer
+from mod.services.delayed_scheduler import delayed_scheduler
+from mod.services.stats_publisher import stats_publisher
+from mod.services.unread_counter import unread_counter
+from mod.services.task_pool import task_pool
+from mod.services.waiting_line import waiting_line
+from mod.services.assignment_engine import assignment_engine
+from mod.services.wait_estimator import wait_estimator
+from mod.services.session_cache import active_sessions
+from mod.services.blacklist import blacklist
+from mod.services.startup import start_services
+from mod.services.socket_rooms import (
+    agent_room, all_agents_rooms, admins_room, services_room,
+    agent_and_admins_rooms, join_agent_rooms
+)
 from sqlalchemy import func, and_  # ✅ 添加SQL函数导入
 from datetime import datetime, timedelta
-from threading import Thread
 import json
 import log
 
@@ -34,70 +50,79 @@ def strip_html_tags_for_preview(text):
 
 
 # 在线用户字典 {user_id: {'sid': session_id, 'type': 'service/visitor', 'room': room_id}}
-# 🆕 改为支持多连接：{user_id: {'sids': [sid1, sid2], 'type': 'service/visitor', ...}}
+# 🆕 改为支持多连接：{user_id: {'sids': {sid1, sid2}, 'type': 'service/visitor', ...}}
+# 注意：仅包含本worker持有的连接，跨worker查询请使用 presence_registry
 online_users = {}
 
-# IP位置缓存（5分钟过期）{ip: {'data': {...}, 'time': datetime}}
-ip_location_cache = {}
+# 🆕 反向索引 {sid: user_id}，断开连接时 O(1) 定位用户（不再遍历 online_users）
+_sid_index = {}
 
-# 队列服务实例（延迟导入，避免循环导入）
-queue_service = None
-
-def get_queue_service():
-    """获取队列服务实例"""
-    global queue_service
-    if queue_service is None:
-        from app.services.queue_service import QueueService
-        queue_service = QueueService()
-    return queue_service
 
-
-def get_location_with_cache(ip_address):
+def _attach_sid(user_key, sid, defaults):
     """
-    带缓存的IP地理位置查询
+    登记本worker上的一个连接
     
     Args:
-        ip_address: IP地址
+        user_key: 用户键（visitor_xxx / service_1 / admin_1）
+        sid: Socket连接ID
+        defaults: 用户首次出现时的初始信息
         
     Returns:
-        dict: 位置信息
+        int: 该用户在本worker上的连接数
     """
-    global ip_location_cache
-    
-    # 检查缓存
-    now = datetime.now()
-    if ip_address in ip_location_cache:
-        cached = ip_location_cache[ip_address]
-        # 缓存5分钟内有效
-        if now - cached['time'] < timedelta(minutes=5):
-            logger.debug(f"IP位置缓存命中: {ip_address}")
-            return cached['data']
+    info = online_users.get(user_key)
+    if info is None:
+        info = dict(defaults)
+        info['sids'] = set()
+        online_users[user_key] = info
+    elif not isinstance(info.get('sids'), set):
+        # 兼容旧格式（单个sid / sids列表）
+        old_sid = info.pop('sid', None)
+        info['sids'] = set(info.get('sids') or ([old_sid] if old_sid else []))
     
-    # 缓存未命中，执行查询
-    location_info = ip_location_service.get_location(ip_address)
+    info['sids'].add(sid)
+    _sid_index[sid] = user_key
+    return len(info['sids'])
+
+
+def _detach_sid(sid):
+    """
+    注销本worker上的一个连接（O(1)）
     
-    # 存入缓存
-    ip_location_cache[ip_address] = {
-        'data': location_info,
-        'time': now
-    }
+    Returns:
+        (user_key, 用户信息, 剩余连接数)；sid未登记时返回 None
+    """
+    user_key = _sid_index.pop(sid, None)
+    if user_key is None:
+        return None
     
-    # 清理过期缓存（超过100条时清理）
-    if len(ip_location_cache) > 100:
-        expired_ips = [
-            ip for ip, cached in ip_location_cache.items()
-            if now - cached['time'] > timedelta(minutes=5)
-        ]
-        for ip in expired_ips:
-            del ip_location_cache[ip]
-        logger.info(f"清理过期IP缓存: {len(expired_ips)}条")
+    info = online_users.get(user_key)
+    if info is None:
+        return None
     
-    return location_info
+    info['sids'].discard(sid)
+    remaining = len(info['sids'])
+    if remaining == 0:
+        del online_users[user_key]
+    return user_key, info, remaining
+
+# 队列服务实例（延迟导入，避免循环导入）
+queue_service = None
+
+def get_queue_service():
+    """获取队列服务实例"""
+    global queue_service
+    if queue_service is None:
+        from app.services.queue_service import QueueService
+        queue_service = QueueService()
+    return queue_service
 
 
 @socketio.on('connect')
 def handle_connect():
     """客户端连接事件"""
+    # 兜底：未经 gunicorn 钩子 / app.py 启动的 worker 在第一次连接时启动后台服务（幂等）
+    start_services(app, socketio)
     sid = request.sid
     logger.info(f"Client connected: {sid}")
     emit('connect_response', {'status': 'connected', 'sid': sid})
@@ -105,118 +130,102 @@ def handle_connect():
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    """客户端断开连接事件（支持多连接）- 优化版：防止连接超时"""
+    """客户端断开连接事件（支持多连接）- 优化版：反向索引 O(1) 定位 + 访客离线批量处理"""
     sid = request.sid
     
-    # 查找并移除离线用户
-    user_id = None
-    user_type = None
+    # 🆕 集群级注销：返回该用户在所有worker上的剩余连接数
+    presence = presence_registry.leave(sid)
     
-    for uid, info in list(online_users.items()):
-        # 🆕 支持sids列表（多连接）
-        if 'sids' in info:
-            if sid in info['sids']:
-                user_id = uid
-                user_type = info['type']
-                # 从列表中移除这个sid
-                info['sids'].remove(sid)
-                
-                # 如果还有其他连接，保留该用户
-                if len(info['sids']) > 0:
-                    logger.info(f"User {user_type}_{uid} 断开一个连接 (剩余{len(info['sids'])}个连接)")
-                    return  # 还有其他连接，不删除用户
-                else:
-                    # 所有连接都断开了，删除该用户
-                    del online_users[user_id]
-                    logger.info(f"User {user_type}_{uid} 所有连接已断开，离线")
-                    
-                    # ✅ 如果是客服或管理员，更新数据库状态并广播统计更新
-                    if user_type in ['service', 'admin']:
-                        try:
-                            service_id = info.get('service_id')
-                            business_id = info.get('business_id', 1)
-                            if service_id:
-                                service = Service.query.get(service_id)
-                                if service:
-                                    service.state = 'offline'
-                                    # ✅ 不要清零计数！保持实际的队列数量
-                                    # 管理员的计数应该始终为0，普通客服保持实际队列数
-                                    if service.level in ['super_manager', 'manager']:
-                                        service.current_chat_count = 0
-                                    # 普通客服保持当前计数不变，等待重新上线或转接
-                                    
-                                    db.session.commit()
-                                    logger.info(f"✅ 客服{service_id}离线，状态已更新")
-                                    
-                                    # ⚡ 广播统计更新（客服数量变化）
-                                    broadcast_statistics_update(business_id)
-                        except Exception as e:
-                            logger.error(f"更新客服离线状态失败: {e}")
-                            db.session.rollback()  # ✅ 回滚失败的事务
-                        finally:
-                            db.session.remove()  # ✅ 关键：释放数据库连接
-                    
-                    # 如果是访客，关闭会话并减少对应客服的接待计数
-                    elif user_type == 'visitor':
-                        try:
-                            visitor_id = info.get('visitor_id')
-                            if visitor_id:
-                                # ✅ 使用with_for_update避免并发问题，设置超时
-                                queue = Queue.query.filter_by(
-                                    visitor_id=visitor_id,
-                                    state='normal'
-                                ).with_for_update(nowait=False).first()
-                                
-                                if queue:
-                                    # 1. 关闭会话（访客离线）
-                                    queue.state = 'complete'  # 使用complete而不是closed
-                                    queue.updated_at = datetime.now()
-                                    db.session.commit()
-                                    logger.info(f"🔒 访客{visitor_id}离线，会话已自动关闭")
-                                    
-                                    # 2. 减少客服接待计数
-                                    if queue.service_id and queue.service_id > 0:
-                                        # ✅ 使用统一的接待数管理器
-                                        from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
-                                        workload_manager.decrement_workload(
-                                            queue.service_id,
-                                            f"访客离线: {visitor_id}"
-                                        )
-                                        logger.info(f"✅ 访客{visitor_id}离线，客服{queue.service_id}接待数已减少")
-                                        
-                                        # 3. 广播统计更新
-                                        business_id = queue.business_id
-                                        broadcast_statistics_update(business_id)
-                                        
-                                        # 4. 通知客服访客已离线
-                                        socketio.emit('visitor_offline', {
-                                            'visitor_id': visitor_id,
-                                            'message': '访客已离线，会话自动关闭',
-                                            'timestamp': datetime.now().isoformat()
-                                        }, room='service_room')
-                                        
-                        except Exception as e:
-                            logger.error(f"访客离线时处理会话失败: {e}")
-                            db.session.rollback()  # ✅ 回滚失败的事务
-                            import traceback
-                            logger.error(traceback.format_exc())
-                        finally:
-                            db.session.remove()  # ✅ 关键：释放数据库连接
-                break
-        # 兼容旧格式（单个sid）
-        elif info.get('sid') == sid:
-            user_id = uid
-            user_type = info['type']
-            del online_users[user_id]
-            logger.info(f"User {user_type}_{user_id} disconnected (旧格式)")
-            break
+    # ⚡ 通过反向索引定位用户（不再遍历所有在线用户）
+    detached = _detach_sid(sid)
+    if not detached:
+        return
+    
+    user_id, info, remaining = detached
+    user_type = info.get('type')
+    
+    # 如果还有其他连接，保留该用户
+    if remaining > 0:
+        logger.info(f"User {user_id} 断开一个连接 (剩余{remaining}个连接)")
+        return
     
-    if user_id and user_type:
-        # 通知其他用户该用户离线
-        emit('user_offline', {
+    # 🆕 其他worker上仍有该用户的连接（如另一个标签页），不做离线处理
+    if presence and presence[2] > 0:
+        logger.info(f"User {user_id} 本worker连接已断开，其他worker仍有{presence[2]}个连接")
+        return
+    
+    logger.info(f"User {user_id} 所有连接已断开，离线")
+    _handle_user_offline(user_id, info)
+    
+    # 通知本商户的客服该用户离线
+    business_id = info.get('business_id') or (presence[1].get('business_id') if presence else None)
+    if business_id:
+        socketio.emit('user_offline', {
             'user_id': user_id,
             'user_type': user_type
-        }, broadcast=True)
+        }, room=all_agents_rooms(business_id))
+
+
+def _handle_user_offline(user_key, info):
+    """
+    用户所有连接都已断开后的离线处理
+    - 客服/管理员：更新数据库在线状态并广播统计
+    - 访客：关闭进行中的会话并减少对应客服的接待计数
+    
+    Args:
+        user_key: 用户键（visitor_xxx / service_1 / admin_1）
+        info: 用户信息（online_users 或在线状态注册中心中的记录）
+    """
+    user_type = info.get('type')
+    
+    # ✅ 如果是客服或管理员，更新数据库状态并广播统计更新
+    if user_type in ['service', 'admin']:
+        try:
+            service_id = info.get('service_id')
+            business_id = info.get('business_id', 1)
+            if service_id:
+                service = Service.query.get(service_id)
+                if service:
+                    service.state = 'offline'
+                    # ✅ 不要清零计数！保持实际的队列数量
+                    # 管理员的计数应该始终为0，普通客服保持实际队列数
+                    if service.level in ['super_manager', 'manager']:
+                        service.current_chat_count = 0
+                    # 普通客服保持当前计数不变，等待重新上线或转接
+                    
+                    db.session.commit()
+                    logger.info(f"✅ 客服{service_id}离线，状态已更新")
+                    assignment_engine.update(service)
+                    
+                    # ⚡ 广播统计更新（客服数量变化）
+                    stats_publisher.mark_dirty(business_id)
+        except Exception as e:
+            logger.error(f"更新客服离线状态失败: {e}")
+            db.session.rollback()  # ✅ 回滚失败的事务
+        finally:
+            db.session.remove()  # ✅ 关键：释放数据库连接
+    
+    # 如果是访客，关闭会话并减少对应客服的接待计数
+    # ⚡ 交给批处理器合并处理（断线风暴时多个访客合并为一次批量UPDATE）
+    elif user_type == 'visitor':
+        visitor_id = info.get('visitor_id')
+        if visitor_id:
+            visitor_offline_batcher.add(visitor_id, info.get('business_id', 1))
+
+
+def handle_presence_expired(user_key, info):
+    """
+    在线状态心跳超时回调（worker崩溃等原因遗留的连接被清理后触发）
+    在后台任务中执行，需要自行创建应用上下文
+    """
+    logger.warning(f"⏱️ 用户 {user_key} 心跳超时，按离线处理")
+    with app.app_context():
+        _handle_user_offline(user_key, info)
+    if info.get('business_id'):
+        socketio.emit('user_offline', {
+            'user_id': user_key,
+            'user_type': info.get('type')
+        }, room=all_agents_rooms(info['business_id']))
 
 
 @socketio.on('visitor_join')
@@ -312,71 +321,60 @@ def handle_visitor_join(data):
             real_ip = '127.0.0.1 (本地)'
             logger.info("开发环境，IP为本地地址")
         
-        # ⚡ 不要在这里同步解析IP位置，使用默认值，后续异步更新
-        location_info = {
-            'formatted': '定位中...',
-            'country': '',
-            'province': '',
-            'city': ''
-        }
-        
         # 记录在线用户（保存完整信息，支持多连接）
         user_key = f'visitor_{visitor_id}'
         
-        # 🆕 支持多连接
-        if user_key in online_users:
-            # 已存在，添加新的sid
-            if 'sids' not in online_users[user_key]:
-                # 兼容旧格式
-                old_sid = online_users[user_key].get('sid')
-                online_users[user_key]['sids'] = [old_sid] if old_sid else []
-                if 'sid' in online_users[user_key]:
-                    del online_users[user_key]['sid']
-            
-            if sid not in online_users[user_key]['sids']:
-                online_users[user_key]['sids'].append(sid)
-                logger.info(f"Visitor {visitor_id} 添加新连接 (共{len(online_users[user_key]['sids'])}个连接)")
-            
-            # 更新其他信息（使用最新的）
-            online_users[user_key].update({
-                'visitor_name': visitor_name,
-                'name': visitor_name,
-                'avatar': avatar,
-                'ip': real_ip,
-                'location': location_info.get('formatted', '未知'),
-                'country': location_info.get('country', ''),
-                'province': location_info.get('province', ''),
-                'city': location_info.get('city', ''),
-                'browser': device_info.get('browser', 'Unknown'),
-                'os': device_info.get('os', 'Unknown'),
-                'device': device_info.get('device', 'Desktop'),
-                'screen_resolution': device_info.get('screen_resolution', ''),
-                'visit_count': visit_info.get('visit_count', 1),
-                'first_visit': visit_info.get('first_visit', '')
-            })
+        # ⚡ 本地IP库 + LRU缓存查询（微秒级，不阻塞）；本地库未命中时可能转为后台在线查询
+        def on_location_resolved(ip, location):
+            """后台在线查询完成：更新在线信息和访客记录"""
+            if user_key in online_users:
+                online_users[user_key]['location'] = location.get('formatted', '未知')
+            presence_registry.update_user(user_key, location=location.get('formatted', '未知'))
+            with app.app_context():
+                try:
+                    Visitor.query.filter_by(visitor_id=visitor_id, business_id=business_id).update({
+                        'country': location.get('country', ''),
+                        'province': location.get('province', ''),
+                        'city': location.get('city', ''),
+                        'country_code': location.get('country_code', '')
+                    }, synchronize_session=False)
+                    db.session.commit()
+                finally:
+                    db.session.remove()
+        
+        location_info = ip_geo_engine.lookup(real_ip, on_resolved=on_location_resolved)
+        
+        visitor_entry = {
+            'type': 'visitor',
+            'visitor_id': visitor_id,
+            'business_id': business_id,
+            'visitor_name': visitor_name,
+            'name': visitor_name,
+            'avatar': avatar,
+            'ip': real_ip,
+            'location': location_info.get('formatted', '未知'),
+            'country': location_info.get('country', ''),
+            'province': location_info.get('province', ''),
+            'city': location_info.get('city', ''),
+            'browser': device_info.get('browser', 'Unknown'),
+            'os': device_info.get('os', 'Unknown'),
+            'device': device_info.get('device', 'Desktop'),
+            'screen_resolution': device_info.get('screen_resolution', ''),
+            'visit_count': visit_info.get('visit_count', 1),
+            'first_visit': visit_info.get('first_visit', '')
+        }
+        
+        # 🆕 支持多连接（已存在时追加sid，并使用最新的访客信息）
+        connection_count = _attach_sid(user_key, sid, visitor_entry)
+        online_users[user_key].update(visitor_entry)
+        if connection_count > 1:
+            logger.info(f"Visitor {visitor_id} 添加新连接 (共{connection_count}个连接)")
         else:
-            # 不存在，创建新entry
-            online_users[user_key] = {
-                'sids': [sid],  # 🆕 使用列表
-                'type': 'visitor',
-                'visitor_id': visitor_id,
-                'visitor_name': visitor_name,
-                'name': visitor_name,
-                'avatar': avatar,
-                'ip': real_ip,
-                'location': location_info.get('formatted', '未知'),
-                'country': location_info.get('country', ''),
-                'province': location_info.get('province', ''),
-                'city': location_info.get('city', ''),
-                'browser': device_info.get('browser', 'Unknown'),
-                'os': device_info.get('os', 'Unknown'),
-                'device': device_info.get('device', 'Desktop'),
-                'screen_resolution': device_info.get('screen_resolution', ''),
-                'visit_count': visit_info.get('visit_count', 1),
-                'first_visit': visit_info.get('first_visit', '')
-            }
             logger.info(f"Visitor {visitor_id} joined (新用户)")
-        
+
+        # 🆕 登记到集群在线状态（所有worker可见）
+        presence_registry.join(sid, user_key, 'visitor', business_id, visitor_entry)
+
         # ⚡ 修复：visitor_id本身已包含'visitor_'前缀，直接使用
         # 访客前端生成格式：visitor_${timestamp}_${random}
         room = visitor_id if visitor_id.startswith('visitor_') else f'visitor_{visitor_id}'
@@ -412,6 +410,10 @@ def handle_visitor_join(data):
                             device=device_info.get('device', 'Desktop'),
                             referrer=device_info.get('referrer', ''),
                             login_times=visit_info.get('visit_count', 1),
+                            country=location_info.get('country', ''),
+                            province=location_info.get('province', ''),
+                            city=location_info.get('city', ''),
+                            country_code=location_info.get('country_code', ''),
                             extends=json.dumps({
                                 'device_fingerprint': visit_info.get('device_fingerprint', ''),
                                 'screen_resolution': device_info.get('screen_resolution', ''),
@@ -431,6 +433,11 @@ def handle_visitor_join(data):
                         visitor.os = device_info.get('os', visitor.os)
                         visitor.device = device_info.get('device', visitor.device)
                         visitor.from_url = device_info.get('from_url', visitor.from_url)
+                        if location_info.get('country'):
+                            visitor.country = location_info['country']
+                            visitor.province = location_info.get('province', '')
+                            visitor.city = location_info.get('city', '')
+                            visitor.country_code = location_info.get('country_code', '')
                         
                         # 更新扩展信息
                         try:
@@ -456,44 +463,13 @@ def handle_visitor_join(data):
                 # ✅ 关键修复：清理数据库会话，释放连接
                 db.session.remove()
         
-        # ⚠️ 已禁用在线IP查询（性能优化）
-        # 仅保留基本的本地IP识别，不调用外部API
-        def async_resolve_location():
-            """后台异步保存IP基本信息（不调用在线API）"""
-            try:
-                # 简单的本地IP识别
-                if real_ip.startswith('127.') or real_ip == 'localhost':
-                    location_text = '本地'
-                elif real_ip.startswith('192.168.') or real_ip.startswith('10.') or real_ip.startswith('172.'):
-                    location_text = '内网'
-                else:
-                    location_text = '未知'  # 外网IP不查询，直接显示未知
-                
-                # 更新online_users中的位置信息
-                if user_key in online_users:
-                    online_users[user_key]['location'] = location_text
-                
-                logger.debug(f"访客{visitor_id}位置识别: {real_ip} -> {location_text}")
-                
-            except Exception as e:
-                logger.error(f"❌ IP基本识别失败: {visitor_id}, {real_ip}, 错误: {e}")
-            finally:
-                # ✅ 确保不持有数据库连接（虽然这个函数不使用数据库，但保持一致性）
-                pass
-        
-        # ⚡ 启动后台线程（数据库保存 + IP解析，不等待完成）
-        Thread(target=async_save_visitor, daemon=True).start()
-        Thread(target=async_resolve_location, daemon=True).start()
+        # ⚡ 提交到后台任务池（数据库保存，不等待完成；同一访客多次加入只保存最后一次）
+        task_pool.submit('visitor_save', async_save_visitor, key=visitor_id)
         
         logger.info(f"⚡ Visitor {visitor_id} 快速加入 - IP: {real_ip}, Browser: {device_info.get('browser')}, 访问次数: {visit_info.get('visit_count', 1)}")
         
         # 🚫 检查访客是否在黑名单中
-        blacklist_check = Queue.query.filter_by(
-            visitor_id=visitor_id,
-            state='blacklist'
-        ).first()
-        
-        if blacklist_check:
+        if blacklist.contains(visitor_id):
             logger.info(f"🚫 访客 {visitor_id} 在黑名单中，拒绝加入")
             # 发送黑名单提示给访客
             emit('blacklisted', {
@@ -542,10 +518,14 @@ def handle_visitor_join(data):
                     except (ValueError, TypeError):
                         logger.warning(f"⚠️ 无效的special参数: {special}")
                 
-                # 如果不是专属会话，且没有分配到客服，则使用智能分配（优先普通客服）
+                # 如果不是专属会话，且没有分配到客服，则使用智能分配（优先普通客服，同时预占接待名额）
+                reserved = False
                 if not is_exclusive and not available_service:
                     from mod.mysql.ModuleClass.AssignmentServiceClass import assignment_service
-                    available_service = assignment_service._find_available_service(business_id)
+                    available_service = assignment_service.reserve_available_service(
+                        business_id, f"访客接入: {visitor_id}"
+                    )
+                    reserved = available_service is not None
                 
                 service_id = available_service.service_id if available_service else None  # ✅ 未分配时使用 NULL
                 
@@ -564,39 +544,20 @@ def handle_visitor_join(data):
                 db.session.add(new_queue)
                 db.session.commit()
                 
+                # 未分配客服的访客进入等待线
+                if not service_id:
+                    waiting_line.add_queue(new_queue)
+                
                 queue_info = {
                     'queue_id': new_queue.qid,
                     'service_id': service_id,
                     'service_name': available_service.nick_name if available_service else '暂无客服'
                 }
                 
-                # ========== 更新客服接待计数（管理员不计入）==========
-                if service_id and service_id > 0:
-                    try:
-                        service = Service.query.get(service_id)
-                        if service:
-                            # 只有普通客服才计入接待数，管理员不限制
-                            if service.level not in ['super_manager', 'manager']:
-                                service.current_chat_count = (service.current_chat_count or 0) + 1
-                                logger.info(f"✅ 客服{service_id}接待数更新: {service.current_chat_count}/{service.max_concurrent_chats}")
-                                
-                                # 🔥 实时推送负载变化到客服端
-                                for user_key, user_info in list(online_users.items()):
-                                    # ✅ 同时检查service和admin
-                                    if user_info['type'] in ['service', 'admin'] and user_info.get('service_id') == service_id:
-                                        sids = user_info.get('sids', [])
-                                        for sid in sids:
-                                            socketio.emit('workload_update', {
-                                                'current': service.current_chat_count,
-                                                'max': service.max_concurrent_chats,
-                                                'utilization': round(service.current_chat_count / service.max_concurrent_chats * 100, 0) if service.max_concurrent_chats > 0 else 0
-                                            }, room=sid)
-                            else:
-                                logger.info(f"✅ 管理员{service_id}接待访客（不计入负载）")
-                            service.last_assign_time = datetime.now()
-                            db.session.commit()
-                    except Exception as e:
-                        logger.error(f"更新接待计数失败: {e}")
+                # ========== 专属客服接待计数（智能分配已在选择时预占，管理员不计入）==========
+                if service_id and service_id > 0 and not reserved:
+                    from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
+                    workload_manager.increment_workload(service_id, f"专属访客接入: {visitor_id}")
                 
                 # 如果没有在线客服，发送排队提示
                 if not available_service:
@@ -614,12 +575,8 @@ def handle_visitor_join(data):
                         settings = SystemSetting.query.filter_by(business_id=business_id).first()
                         queue_text = settings.chat_queue_text if settings else '当前排队人数较多，请稍候'
                         
-                        # 计算排队位置（未分配客服的队列数量）
-                        queue_position = Queue.query.filter(
-                            Queue.business_id == business_id,
-                            (Queue.service_id == None) | (Queue.service_id == 0),  # ✅ 兼容旧数据
-                            Queue.state == 'normal'
-                        ).count()
+                        # 排队位置（等待线中的名次）
+                        queue_position = waiting_line.position(business_id, visitor_id)
                         
                         # 发送排队通知到访客
                         emit('queue_notification', {
@@ -636,18 +593,9 @@ def handle_visitor_join(data):
                 need_reassign = False
                 
                 if old_service_id and old_service_id > 0:
-                    # 检查原客服是否在线
-                    old_service_online = False
-                    for user_key, user_info in online_users.items():
-                        # ✅ 同时检查service和admin
-                        if (user_info['type'] in ['service', 'admin'] and 
-                            user_info.get('service_id') == old_service_id):
-                            # 检查是否有有效连接
-                            if ('sids' in user_info and len(user_info['sids']) > 0) or \
-                               ('sid' in user_info and user_info['sid']):
-                                old_service_online = True
-                                break
-                    
+                    # 检查原客服是否在线（集群级在线状态，service和admin连接都算）
+                    old_service_online = presence_registry.is_service_online(old_service_id)
+
                     if not old_service_online:
                         logger.info(f"⚠️ 原客服{old_service_id}已离线，重新分配访客{visitor_id}")
                         need_reassign = True
@@ -658,20 +606,17 @@ def handle_visitor_join(data):
                 if need_reassign:
                     # 使用智能分配重新分配（优先普通客服）
                     from mod.mysql.ModuleClass.AssignmentServiceClass import assignment_service
-                    available_service = assignment_service._find_available_service(business_id)
+                    available_service = assignment_service.reserve_available_service(
+                        business_id, f"访客重新分配: {visitor_id}"
+                    )
                     
                     if available_service:
-                        # 更新队列的客服分配
+                        # 更新队列的客服分配（接待名额已预占）
                         existing_queue.service_id = available_service.service_id
                         existing_queue.updated_at = datetime.now()
                         existing_queue.last_message_time = datetime.now()
                         db.session.commit()
-                        
-                        # 更新接待计数（管理员不计入）
-                        if available_service.level not in ['super_manager', 'manager']:
-                            available_service.current_chat_count = (available_service.current_chat_count or 0) + 1
-                        available_service.last_assign_time = datetime.now()
-                        db.session.commit()
+                        waiting_line.remove(business_id, visitor_id)
                         
                         logger.info(f"✅ 访客{visitor_id}重新分配给客服{available_service.service_id}")
                         
@@ -684,6 +629,7 @@ def handle_visitor_join(data):
                         # 没有在线客服
                         existing_queue.service_id = None  # ✅ 使用 NULL 表示未分配，避免外键约束冲突
                         db.session.commit()
+                        waiting_line.add_queue(existing_queue)
                         logger.info(f"⚠️ 没有在线客服，访客{visitor_id}进入等待")
                         
                         queue_info = {
@@ -791,29 +737,10 @@ def handle_visitor_join(data):
         # ========== 智能通知：只通知分配到的客服和管理员 ==========
         assigned_service_id = queue_info.get('service_id') if queue_info else None
         
-        # 获取所有在线客服的详细信息（包含level）
-        # ✅ 同时检查service和admin
-        for user_key, user_info in online_users.items():
-            if user_info['type'] in ['service', 'admin']:
-                service_id_val = user_info.get('service_id')
-                if service_id_val:
-                    # 查询客服详细信息
-                    service = Service.query.get(service_id_val)
-                    if service:
-                        # 管理员或分配到的客服才收到通知
-                        is_admin = service.level in ['super_manager', 'manager']
-                        is_assigned = (assigned_service_id and service_id_val == assigned_service_id)
-                        
-                        if is_admin or is_assigned:
-                            # 获取该客服的所有连接ID
-                            sids = user_info.get('sids', [])
-                            for sid in sids:
-                                socketio.emit('new_visitor', visitor_full_info, room=sid)
-                            
-                            if is_admin:
-                                logger.info(f"📢 通知管理员客服{service_id_val}: 新访客{visitor_id}")
-                            else:
-                                logger.info(f"📢 通知分配客服{service_id_val}: 新访客{visitor_id}")
+        # ⚡ 房间扇出：管理员房间 + 分配客服房间（一次发送，无需逐个查询客服级别）
+        socketio.emit('new_visitor', visitor_full_info,
+                      room=agent_and_admins_rooms(business_id, assigned_service_id))
+        logger.info(f"📢 通知管理员及分配客服{assigned_service_id}: 新访客{visitor_id}")
         
     except Exception as e:
         logger.error(f"Error in visitor_join: {e}")
@@ -864,33 +791,33 @@ def handle_service_join(data):
         is_admin = service.level in ['super_manager', 'manager']
         
         if existing_key:
-            # 已存在，添加新的sid（如果还没有）
-            if 'sids' not in online_users[existing_key]:
-                # 兼容旧格式：从单个sid转换为sids列表
-                old_sid = online_users[existing_key].get('sid')
-                online_users[existing_key]['sids'] = [old_sid] if old_sid else []
-                if 'sid' in online_users[existing_key]:
-                    del online_users[existing_key]['sid']
-            
-            if sid not in online_users[existing_key]['sids']:
-                online_users[existing_key]['sids'].append(sid)
-                logger.info(f"✅ Service {service_id} ({service_name}) 添加新连接 (共{len(online_users[existing_key]['sids'])}个连接)")
+            # 已存在，添加新的sid
+            connection_count = _attach_sid(existing_key, sid, {})
+            logger.info(f"✅ Service {service_id} ({service_name}) 添加新连接 (共{connection_count}个连接)")
             
             # 更新权限级别缓存
             online_users[existing_key]['is_admin'] = is_admin
         else:
             # 不存在，创建新entry（包含权限级别缓存）
-            online_users[service_key] = {
-                'sids': [sid],  # 🆕 使用列表存储多个sid
+            _attach_sid(service_key, sid, {
                 'type': 'service',
                 'service_id': service_id,
                 'name': service_name,
+                'business_id': service.business_id,
                 'is_admin': is_admin  # ⚡ 缓存权限级别，避免消息推送时查询
-            }
+            })
             logger.info(f"✅ Service {service_id} ({service_name}) joined (新用户, is_admin={is_admin})")
         
-        # 加入客服总房间
-        join_room('service_room')
+        # 🆕 登记到集群在线状态（合并到admin记录时沿用admin类型）
+        presence_key = existing_key or service_key
+        presence_registry.join(sid, presence_key, online_users[presence_key]['type'], service.business_id, {
+            'service_id': service_id,
+            'name': service_name,
+            'is_admin': is_admin
+        })
+        
+        # 🆕 加入商户角色房间（管理员房间/普通客服房间 + 个人房间）
+        join_agent_rooms(service.business_id, service_id, is_admin)
         
         # 更新数据库中的在线状态（添加验证）
         if service_id:
@@ -900,11 +827,9 @@ def handle_service_join(data):
                 db.session.commit()
                 logger.info(f"✅ Service {service_id} 状态更新为 online")
                 
-                # ✅ 客服上线时，自动同步接待数（确保数据准确）
+                # ✅ 客服上线时，同步负载表并推送当前接待数（计数由定期校准保证准确）
                 from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
-                sync_result = workload_manager.sync_workload(service_id, "客服上线自动同步")
-                if sync_result['success']:
-                    logger.info(f"📊 客服{service_id}上线，接待数已同步: {sync_result['current_count']}")
+                workload_manager.announce_workload(service)
             else:
                 logger.warning(f"⚠️ Service {service_id} 不存在于数据库中")
         
@@ -920,13 +845,32 @@ def handle_service_join(data):
             'service_id': service_id,
             'service_name': service_name,
             'timestamp': datetime.now().isoformat()
-        }, room='service_room', broadcast=True, include_self=False)
+        }, room=all_agents_rooms(service.business_id), include_self=False)
         
     except Exception as e:
         logger.error(f"Error in service_join: {e}")
         emit('error', {'message': str(e)})
 
 
+def _touch_queue(queue, update_time=True):
+    """
+    更新会话的最后消息时间（随后由调用方提交）
+    
+    queue 可以是 Queue 对象或活跃会话快照（ActiveSession）；快照时按主键直接 UPDATE，不先查询
+    """
+    now = datetime.now()
+    if isinstance(queue, Queue):
+        queue.last_message_time = now
+        if update_time:
+            queue.updated_at = now  # 更新时间戳，用于列表排序
+        return
+    values = {'last_message_time': now}
+    if update_time:
+        values['updated_at'] = now
+    Queue.query.filter_by(qid=queue.qid).update(values, synchronize_session=False)
+    active_sessions.touch(queue, now)
+
+
 @socketio.on('send_message')
 def handle_send_message(data):
     """
@@ -1023,12 +967,7 @@ def handle_send_message(data):
         # ✅ 修复service_id获取逻辑
         # 🚫 检查访客是否在黑名单中（仅检查访客发送的消息）
         if from_type == 'visitor':
-            blacklist_check = Queue.query.filter_by(
-                visitor_id=visitor_id_val,
-                state='blacklist'
-            ).first()
-            
-            if blacklist_check:
+            if blacklist.contains(visitor_id_val):
                 logger.info(f"🚫 访客 {visitor_id_val} 在黑名单中，消息已拦截: {content[:30]}...")
                 # 直接返回，不保存消息、不转发、不提醒
                 emit('message_blocked', {
@@ -1073,68 +1012,15 @@ def handle_send_message(data):
             # ========== 访客发送消息 - 检查客服在线状态并自动重新分配 ==========
             service_id_val = 0  # 默认值，确保变量一定有值
             
-            # 查询访客的队列记录（queue已在前面初始化为None）
-            queue = Queue.query.filter_by(
-                visitor_id=visitor_id_val,
-                business_id=business_id,
-                state='normal'
-            ).first()
+            # 访客的会话快照（活跃会话缓存，需要修改时才加载Queue对象）
+            queue = active_sessions.get(business_id, visitor_id_val)
             logger.info(f"🔍 访客{visitor_id_val}发送消息，队列状态: queue={queue.qid if queue else 'None'}, service_id={queue.service_id if queue else 'N/A'}")
             
-            # 输出当前online_users状态（调试用）
-            # ✅ 同时统计service和admin
-            online_service_ids = [user_info.get('service_id') for user_key, user_info in online_users.items() if user_info['type'] in ['service', 'admin']]
-            logger.info(f"📊 当前在线客服ID列表: {online_service_ids}")
-            
             if queue and queue.service_id and queue.service_id > 0:
-                # 检查当前分配的客服是否在线（同时检查online_users和数据库）
-                current_service_online = False
-                found_in_memory = False
-                has_valid_connection = False
-                db_state = None
-                
-                logger.info(f"🔍 开始检查客服{queue.service_id}在线状态...")
-                
-                # 1. 先检查online_users（Socket连接状态）
-                # ✅ 修复：同时检查type='service'和type='admin'（管理员也是客服）
-                for user_key, user_info in online_users.items():
-                    if (user_info['type'] in ['service', 'admin'] and 
-                        user_info.get('service_id') == queue.service_id):
-                        found_in_memory = True
-                        logger.info(f"✓ 客服{queue.service_id}在online_users中找到，user_key={user_key}, type={user_info['type']}")
-                        
-                        # 检查是否有有效连接
-                        sids_list = user_info.get('sids', [])
-                        sid_single = user_info.get('sid')
-                        logger.info(f"  - sids列表: {sids_list}, 单sid: {sid_single}")
-                        
-                        if (sids_list and len(sids_list) > 0) or sid_single:
-                            has_valid_connection = True
-                            current_service_online = True
-                            logger.info(f"✓ 客服{queue.service_id}有有效Socket连接")
-                            break
-                        else:
-                            logger.warning(f"✗ 客服{queue.service_id}在online_users中但无有效Socket连接")
-                
-                if not found_in_memory:
-                    logger.warning(f"✗ 客服{queue.service_id}不在online_users中")
-                
-                # 2. 如果online_users中显示在线，还要检查数据库状态（双重验证）
-                if current_service_online:
-                    db_service = Service.query.get(queue.service_id)
-                    if db_service:
-                        db_state = db_service.state
-                        logger.info(f"  - 数据库中客服{queue.service_id}状态: {db_state}")
-                        
-                        if db_service.state != 'online':
-                            logger.warning(f"⚠️ 客服{queue.service_id}在online_users中但数据库显示{db_state}，判定为离线")
-                            current_service_online = False
-                    else:
-                        logger.error(f"✗ 数据库中未找到客服{queue.service_id}记录")
-                        current_service_online = False
-                
-                # 3. 最终判定结果
-                logger.info(f"{'✅' if current_service_online else '❌'} 客服{queue.service_id}在线判定结果: {current_service_online} (内存:{found_in_memory}, 连接:{has_valid_connection}, 数据库:{db_state})")
+                # 检查当前分配的客服是否在线
+                # ⚡ 使用集群在线状态注册中心（O(1)，所有worker一致），不再遍历online_users、不再回查数据库
+                current_service_online = presence_registry.is_service_online(queue.service_id)
+                logger.info(f"{'✅' if current_service_online else '❌'} 客服{queue.service_id}在线判定结果: {current_service_online}")
                 
                 if not current_service_online:
                     # 当前客服离线，使用智能分配重新分配
@@ -1152,6 +1038,7 @@ def handle_send_message(data):
                         else:
                             # 查找可用客服（优先普通客服 -> 管理员 -> 机器人）
                             new_service = assignment_service._find_available_service(business_id)
+                            queue = Queue.query.get(queue.qid)
                             
                             if new_service:
                                 # 有可用的人工客服，更新队列分配
@@ -1188,58 +1075,50 @@ def handle_send_message(data):
                                     visitor_obj = Visitor.query.get(visitor_id_val)
                                     visitor_info = visitor_obj.to_dict() if visitor_obj else {'visitor_id': visitor_id_val, 'visitor_name': from_name}
                                     
-                                    # ✅ 同时通知service和admin
-                                    for user_key, user_info in online_users.items():
-                                        if user_info['type'] in ['service', 'admin']:
-                                            current_service_id = user_info.get('service_id')
-                                            sids = user_info.get('sids', [])
-                                            
-                                            for sid in sids:
-                                                if current_service_id == new_service.service_id:
-                                                    # 新客服：可以回复，解锁输入框
-                                                    emit('visitor_assignment_updated', {
-                                                        'visitor_id': visitor_id_val,
-                                                        'visitor_name': from_name,
-                                                        'visitor': visitor_info,
-                                                        'assigned_to_me': True,
-                                                        'can_reply': True,
-                                                        'service_id': new_service.service_id,
-                                                        'service_name': new_service.nick_name,
-                                                        'old_service_id': old_service_id,
-                                                        'reason': 'reassigned',
-                                                        'message': f'访客 {from_name} 已自动分配给您',
-                                                        'timestamp': datetime.now().isoformat()
-                                                    }, room=sid)
-                                                elif current_service_id == old_service_id:
-                                                    # 原客服：不能回复，锁定输入框
-                                                    emit('visitor_assignment_updated', {
-                                                        'visitor_id': visitor_id_val,
-                                                        'visitor_name': from_name,
-                                                        'assigned_to_me': False,
-                                                        'can_reply': False,
-                                                        'service_id': new_service.service_id,
-                                                        'service_name': new_service.nick_name,
-                                                        'reason': 'reassigned_away',
-                                                        'message': f'访客 {from_name} 已被重新分配给 {new_service.nick_name}',
-                                                        'timestamp': datetime.now().isoformat()
-                                                    }, room=sid)
-                                                else:
-                                                    # 其他客服/管理员：清除状态，确保不能回复
-                                                    # 管理员可以查看但不能主动回复（除非访客主动发消息给他）
-                                                    service_obj = Service.query.get(current_service_id)
-                                                    is_admin = service_obj and service_obj.level in ['super_manager', 'manager']
-                                                    
-                                                    emit('visitor_assignment_updated', {
-                                                        'visitor_id': visitor_id_val,
-                                                        'visitor_name': from_name,
-                                                        'assigned_to_me': False,
-                                                        'can_reply': False,  # 其他客服不能回复
-                                                        'can_view': is_admin,  # 管理员可以查看
-                                                        'service_id': new_service.service_id,
-                                                        'service_name': new_service.nick_name,
-                                                        'reason': 'reassigned_to_other',
-                                                        'timestamp': datetime.now().isoformat()
-                                                    }, room=sid)
+                                    # ⚡ 房间扇出（按顺序发送，同一连接上后到的事件覆盖先到的）：
+                                    # 1. 其他客服/管理员：清除状态，确保不能回复（管理员可以查看）
+                                    other_payload = {
+                                        'visitor_id': visitor_id_val,
+                                        'visitor_name': from_name,
+                                        'assigned_to_me': False,
+                                        'can_reply': False,  # 其他客服不能回复
+                                        'service_id': new_service.service_id,
+                                        'service_name': new_service.nick_name,
+                                        'reason': 'reassigned_to_other',
+                                        'timestamp': datetime.now().isoformat()
+                                    }
+                                    emit('visitor_assignment_updated', dict(other_payload, can_view=False),
+                                         room=services_room(business_id))
+                                    emit('visitor_assignment_updated', dict(other_payload, can_view=True),
+                                         room=admins_room(business_id))
+                                    
+                                    # 2. 原客服：不能回复，锁定输入框
+                                    emit('visitor_assignment_updated', {
+                                        'visitor_id': visitor_id_val,
+                                        'visitor_name': from_name,
+                                        'assigned_to_me': False,
+                                        'can_reply': False,
+                                        'service_id': new_service.service_id,
+                                        'service_name': new_service.nick_name,
+                                        'reason': 'reassigned_away',
+                                        'message': f'访客 {from_name} 已被重新分配给 {new_service.nick_name}',
+                                        'timestamp': datetime.now().isoformat()
+                                    }, room=agent_room(business_id, old_service_id))
+                                    
+                                    # 3. 新客服：可以回复，解锁输入框
+                                    emit('visitor_assignment_updated', {
+                                        'visitor_id': visitor_id_val,
+                                        'visitor_name': from_name,
+                                        'visitor': visitor_info,
+                                        'assigned_to_me': True,
+                                        'can_reply': True,
+                                        'service_id': new_service.service_id,
+                                        'service_name': new_service.nick_name,
+                                        'old_service_id': old_service_id,
+                                        'reason': 'reassigned',
+                                        'message': f'访客 {from_name} 已自动分配给您',
+                                        'timestamp': datetime.now().isoformat()
+                                    }, room=agent_room(business_id, new_service.service_id))
                                     
                                     logger.info(f"📢 已向所有客服广播访客{visitor_id_val}的分配状态更新")
                                 except Exception as emit_err:
@@ -1254,6 +1133,7 @@ def handle_send_message(data):
                                 queue.service_id = None  # ✅ NULL 表示未分配/机器人
                                 queue.updated_at = datetime.now()
                                 db.session.commit()
+                                waiting_line.add_queue(queue)
                                 service_id_val = 0  # ✅ Chat表仍使用0表示机器人
                                 logger.info(f"🤖 访客{visitor_id_val}分配给机器人: {old_service_id} -> NULL (所有人工客服都不可用)")
                                 
@@ -1291,7 +1171,13 @@ def handle_send_message(data):
                 else:
                     # 尝试自动分配（优先普通客服 -> 管理员 -> 机器人）
                     from mod.mysql.ModuleClass.AssignmentServiceClass import assignment_service
-                    available_service = assignment_service._find_available_service(business_id)
+                    if queue:
+                        # 有队列记录时预占接待名额
+                        available_service = assignment_service.reserve_available_service(
+                            business_id, f"访客消息自动分配: {visitor_id_val}"
+                        )
+                    else:
+                        available_service = assignment_service._find_available_service(business_id)
                     if available_service:
                         # 有可用的人工客服
                         service_id_val = available_service.service_id
@@ -1299,15 +1185,11 @@ def handle_send_message(data):
                         
                         # 如果有队列记录，更新它
                         if queue:
+                            queue = Queue.query.get(queue.qid)
                             queue.service_id = service_id_val
                             queue.updated_at = datetime.now()
-                            
-                            # 更新客服接待计数（管理员不计入）
-                            if available_service.level not in ['super_manager', 'manager']:
-                                available_service.current_chat_count = (available_service.current_chat_count or 0) + 1
-                            available_service.last_assign_time = datetime.now()
-                            
                             db.session.commit()
+                            waiting_line.remove(queue.business_id, visitor_id_val)
                     else:
                         # 没有人工客服，标记为未分配（机器人模式）
                         service_id_val = None  # ✅ Chat表使用None表示机器人
@@ -1315,6 +1197,7 @@ def handle_send_message(data):
                         
                         # 如果有队列记录，更新它
                         if queue:
+                            queue = Queue.query.get(queue.qid)
                             queue.service_id = None  # ✅ Queue表使用NULL表示未分配
                             queue.updated_at = datetime.now()
                             db.session.commit()
@@ -1329,7 +1212,7 @@ def handle_send_message(data):
             first_service = Service.query.filter_by(business_id=business_id).first()
             service_id_val = first_service.service_id if first_service else None
         
-        chat = Chat(
+        chat_fields = dict(
             visitor_id=visitor_id_val,
             service_id=service_id_val,
             business_id=business_id,
@@ -1339,16 +1222,18 @@ def handle_send_message(data):
             direction='to_service' if from_type == 'visitor' else 'to_visitor',
             state='unread'
         )
-        db.session.add(chat)
+        # ⚡ 写后模式：预分配消息ID并写入Redis日志，由后台任务批量入库
+        write_behind = message_writer.enabled
+        if write_behind:
+            chat_id = message_writer.enqueue(chat_fields)
+        else:
+            chat = Chat(**chat_fields)
+            db.session.add(chat)
         
-        # ⚡ 优化：复用之前查询的queue对象，避免重复数据库查询
-        # 如果queue还未查询（非visitor发送），才进行查询
+        # ⚡ 优化：复用之前取到的会话，避免重复数据库查询
+        # 如果还未取过（非visitor发送），从活跃会话缓存读取
         if queue is None:
-            queue = Queue.query.filter_by(
-                visitor_id=visitor_id_val,
-                business_id=business_id,
-                state='normal'
-            ).first()
+            queue = active_sessions.get(business_id, visitor_id_val)
         
         # ⚡ 如果Queue不存在，尝试查找已关闭的Queue并重新激活
         if not queue and from_type == 'visitor':
@@ -1368,16 +1253,46 @@ def handle_send_message(data):
                 queue = closed_queue
                 logger.info(f"✅ 重新激活队列 {closed_queue.qid}，访客: {visitor_id_val}")
         
-        if queue:
-            queue.last_message_time = datetime.now()
-            queue.updated_at = datetime.now()  # 更新时间戳，用于列表排序
+        if queue and write_behind:
+            # 同一会话的时间戳更新在后台合并为一次UPDATE
+            message_writer.touch_queue(queue.qid)
+        elif queue:
+            _touch_queue(queue)
         else:
             logger.warning(f"⚠️ 找不到Queue记录，访客: {visitor_id_val}, 无法更新last_message_time")
         
-        db.session.commit()
+        if not write_behind:
+            db.session.commit()
+            chat_id = chat.cid
+        elif db.session.dirty:
+            # 重新激活队列等状态变更仍然同步提交
+            db.session.commit()
+        
+        # 📬 访客消息：Redis未读计数+1，推送给分配客服和管理员（不查询数据库）
+        if from_type == 'visitor':
+            unread_count = unread_counter.increment(business_id, service_id_val, visitor_id_val)
+            if unread_count is not None:
+                socketio.emit('unread_count_updated', {
+                    'visitor_id': visitor_id_val,
+                    'unread_count': unread_count,
+                    'reason': 'new_message',
+                    'timestamp': datetime.now().isoformat()
+                }, room=agent_and_admins_rooms(business_id, queue.service_id if queue else None))
         
         # ✅ 客服回复后，立即将该访客的所有未读消息标记为已读
         if from_type == 'service':
+            unread_counter.clear_visitor(business_id, visitor_id_val)
+        
+        if from_type == 'service' and write_behind:
+            # 已读标记在本条消息入库后由后台执行，未读清零事件直接广播
+            message_writer.mark_read(visitor_id_val, chat_id)
+            socketio.emit('unread_count_updated', {
+                'visitor_id': visitor_id_val,
+                'unread_count': 0,
+                'reason': 'service_replied',
+                'timestamp': datetime.now().isoformat()
+            }, room=all_agents_rooms(business_id))
+        elif from_type == 'service':
             try:
                 # 标记该访客发给客服的所有未读消息为已读
                 unread_messages = Chat.query.filter_by(
@@ -1390,20 +1305,13 @@ def handle_send_message(data):
                     db.session.commit()
                     logger.info(f"✅ 客服{service_id_val}回复访客{visitor_id_val}，已将{unread_messages}条未读消息标记为已读")
                     
-                    # 🔔 广播给所有在线客服：该访客的未读数量已清零
-                    for user_key, user_info in list(online_users.items()):
-                        if user_info['type'] in ['service', 'admin']:
-                            sids = user_info.get('sids', [])
-                            if not sids and 'sid' in user_info:
-                                sids = [user_info['sid']]
-                            
-                            for sid in sids:
-                                socketio.emit('unread_count_updated', {
-                                    'visitor_id': visitor_id_val,
-                                    'unread_count': 0,
-                                    'reason': 'service_replied',
-                                    'timestamp': datetime.now().isoformat()
-                                }, room=sid)
+                    # 🔔 广播给所有在线客服：该访客的未读数量已清零（商户客服房间，一次发送）
+                    socketio.emit('unread_count_updated', {
+                        'visitor_id': visitor_id_val,
+                        'unread_count': 0,
+                        'reason': 'service_replied',
+                        'timestamp': datetime.now().isoformat()
+                    }, room=all_agents_rooms(business_id))
                     
                     logger.info(f"📢 已广播访客{visitor_id_val}的未读数量清零事件")
             except Exception as e:
@@ -1414,7 +1322,7 @@ def handle_send_message(data):
         # 访客或客服发送消息都触发统计更新（表示会话活跃）
         # 但排除机器人自动回复（from_type == 'robot'）
         if from_type != 'robot':
-            broadcast_statistics_update(business_id)
+            stats_publisher.mark_dirty(business_id)
             logger.debug(f"📊 触发统计广播: from_type={from_type}, visitor={visitor_id_val}, service={service_id_val}")
         else:
             logger.debug(f"⏸️ 机器人消息，跳过统计广播")
@@ -1426,7 +1334,7 @@ def handle_send_message(data):
         content_preview = strip_html_tags_for_preview(content) if msg_type == 'text' else content
         
         message = {
-            'id': chat.cid,
+            'id': chat_id,
             'from_id': str(from_id),
             'from_type': from_type,
             'from_name': from_name,
@@ -1449,40 +1357,16 @@ def handle_send_message(data):
                 # queue对象在前面已经查询并可能被重新激活，直接使用
                 assigned_service_id = queue.service_id if queue else None
                 
-                # ⚡ 优化：遍历在线客服，定向发送（使用缓存的权限级别，避免数据库查询）
-                sent_count = 0
-                for user_key, user_info in list(online_users.items()):
-                    # ✅ 同时支持 service 和 admin 类型
-                    if user_info['type'] in ['service', 'admin']:
-                        service_id_check = user_info.get('service_id')
-                        if service_id_check:
-                            # ⚡ 使用缓存的权限级别，避免数据库查询
-                            is_admin = user_info.get('is_admin', False)
-                            is_assigned = (assigned_service_id and service_id_check == assigned_service_id)
-                            # ✅ 未分配的访客（assigned_service_id=None）也发给管理员
-                            is_unassigned_to_admin = (not assigned_service_id and is_admin)
-                            
-                            if is_admin or is_assigned or is_unassigned_to_admin:
-                                # 获取该客服的所有连接ID
-                                sids = user_info.get('sids', [])
-                                # 兼容旧格式：如果没有 sids，尝试获取单个 sid
-                                if not sids and 'sid' in user_info:
-                                    sids = [user_info['sid']]
-                                
-                                for sid in sids:
-                                    socketio.emit('receive_message', message, room=sid)
-                                    sent_count += 1
+                # ⚡ 房间扇出：管理员房间 + 分配客服房间（未分配的访客只发给管理员）
+                socketio.emit('receive_message', message,
+                              room=agent_and_admins_rooms(business_id, assigned_service_id))
                 
-                logger.info(f"📨 访客消息定向发送：visitor={visitor_id_val}, assigned_service={assigned_service_id}, 发送给{sent_count}个客服连接")
+                logger.info(f"📨 访客消息定向发送：visitor={visitor_id_val}, assigned_service={assigned_service_id}")
                 
-                # ⚡ 性能优化：禁用实时未读消息推送（严重影响性能）
-                # 每次访客发消息都推送未读数会导致 5-10次数据库查询（每条消息延迟1-2秒）
-                # 改为：客服打开聊天界面时主动查询，或定时轮询更新
-                # 原代码(100行)已禁用，如需查看请查看Git历史
-                pass  # ⚡ 已禁用：实时未读消息推送会严重阻塞(每条消息5-10次DB查询)
+                # 📬 未读数推送已在入库后通过 Redis 未读计数完成（unread_count_updated）
             else:
-                # 客服发送的消息，广播给所有客服（保持原有逻辑）
-                emit('receive_message', message, room='service_room')
+                # 客服发送的消息，发给本商户的所有客服
+                emit('receive_message', message, room=all_agents_rooms(business_id))
                 logger.info(f"Message broadcast to services from {from_type}_{from_id}")
         else:
             # 发送给特定访客
@@ -1497,7 +1381,7 @@ def handle_send_message(data):
         # 发送给发送者（确认）
         emit('message_sent', {
             'status': 'success',
-            'message_id': chat.cid,
+            'message_id': chat_id,
             'timestamp': datetime.now().isoformat()
         })
         
@@ -1531,9 +1415,8 @@ def handle_send_message(data):
                     reply_source = 'faq'
                     logger.info(f"📋 FAQ回复: {auto_reply[:50]}...")
                 else:
-                    # 1️⃣ 检查是否有在线客服（✅ 包括 admin 和 service）
-                    online_services = [u for u in online_users.values() if u.get('type') in ['service', 'admin']]
-                    is_service_online = len(online_services) > 0
+                    # 1️⃣ 检查是否有在线客服（✅ 包括 admin 和 service，集群级）
+                    is_service_online = presence_registry.count_online_services(business_id) > 0
                     
                     # 2️⃣ 使用新的机器人服务（会根据系统设置决定是否回复）
                     robot_service_instance = RobotService()
@@ -1555,9 +1438,8 @@ def handle_send_message(data):
                     if reply_source == 'faq':
                         logger.info(f"✅ [FAQ诊断] FAQ自动回复流程开始（常见问题点击）")
                     elif reply_source == 'keyword':
-                        # ✅ 检查在线客服（包括 admin 和 service）
-                        online_services = [u for u in online_users.values() if u.get('type') in ['service', 'admin']]
-                        is_service_online = len(online_services) > 0
+                        # ✅ 检查在线客服（包括 admin 和 service，集群级）
+                        is_service_online = presence_registry.count_online_services(business_id) > 0
                         if is_service_online:
                             logger.info(f"✅ 客服在线，但系统设置为始终回复，触发机器人回复")
                         else:
@@ -1565,9 +1447,9 @@ def handle_send_message(data):
                         logger.info(f"   关键词匹配成功: {auto_reply[:50]}...")
                     
                     # 🔧 修复：移除重复的auto_reply检查（原1477行）
-                    # 延迟一小段时间，模拟人工回复
+                    # 延迟一小段时间模拟人工回复：消息立即入库，推送交给延迟调度器
+                    # （不再 time.sleep 阻塞处理函数和数据库连接）
                     import time
-                    time.sleep(0.5)
                     
                     # 机器人回复使用 service_id=None 来标识（区别于真实客服）
                     robot_service_id = None
@@ -1575,7 +1457,7 @@ def handle_send_message(data):
                     logger.info(f"🔍 [FAQ诊断] 准备保存机器人消息到数据库...")
                     
                     # 保存自动回复到数据库
-                    auto_chat = Chat(
+                    auto_chat_fields = dict(
                         visitor_id=from_id,
                         service_id=robot_service_id,  # ✅ None表示机器人
                         business_id=business_id,
@@ -1586,22 +1468,30 @@ def handle_send_message(data):
                         state='unread'
                     )
                     logger.info(f"  visitor_id={from_id}, service_id={robot_service_id}, business_id={business_id}")
-                    db.session.add(auto_chat)
-                    logger.info(f"  已添加到session...")
-                    db.session.commit()
-                    logger.info(f"✅ [FAQ诊断] 机器人消息已保存到数据库，ID={auto_chat.cid}")
-                    
-                    # ⚡ 更新Queue的last_message_time（确保统计准确）
-                    if queue:
-                        queue.last_message_time = datetime.now()
+                    if write_behind:
+                        auto_chat_id = message_writer.enqueue(auto_chat_fields)
+                        if queue:
+                            message_writer.touch_queue(queue.qid)
+                        logger.info(f"✅ [FAQ诊断] 机器人消息已写入日志，ID={auto_chat_id}")
+                    else:
+                        auto_chat = Chat(**auto_chat_fields)
+                        db.session.add(auto_chat)
+                        logger.info(f"  已添加到session...")
                         db.session.commit()
+                        auto_chat_id = auto_chat.cid
+                        logger.info(f"✅ [FAQ诊断] 机器人消息已保存到数据库，ID={auto_chat_id}")
+                        
+                        # ⚡ 更新Queue的last_message_time（确保统计准确）
+                        if queue:
+                            _touch_queue(queue, update_time=False)
+                            db.session.commit()
                     
                     # 发送自动回复给访客
                     # ⚡ 机器人消息也需要过滤HTML标签
                     auto_content_preview = strip_html_tags_for_preview(auto_reply)
                     
                     auto_message = {
-                        'id': auto_chat.cid,
+                        'id': auto_chat_id,
                         'from_id': 'robot',  # robot表示机器人
                         'from_type': 'robot',
                         'from_name': '智能助手',
@@ -1619,12 +1509,11 @@ def handle_send_message(data):
                     visitor_room = from_id if from_id.startswith('visitor_') else f'visitor_{from_id}'
                     
                     logger.info(f"🔍 [FAQ诊断] 准备发送消息到访客 room={visitor_room}")
-                    emit('receive_message', auto_message, room=visitor_room)
-                    logger.info(f"🔍 [FAQ诊断] 消息已发送到访客")
-                    
-                    # ✅ 同时广播到客服工作台
-                    emit('receive_message', auto_message, room='service_room')
-                    logger.info(f"✅ [FAQ诊断] 自动回复发送完成: {auto_reply[:30]}...")
+                    # ✅ 同时发送到分配客服和管理员的工作台（一次发送到多个房间）
+                    delayed_scheduler.emit_later(0.5, 'receive_message', auto_message,
+                                                 room=[visitor_room] + agent_and_admins_rooms(
+                                                     business_id, queue.service_id if queue else None))
+                    logger.info(f"✅ [FAQ诊断] 自动回复已调度发送: {auto_reply[:30]}...")
                 else:
                     logger.info(f"⚠️ [FAQ诊断] 没有auto_reply，跳过机器人回复")
                     
@@ -1659,13 +1548,22 @@ def handle_typing(data):
         
         # 发送输入状态给目标用户
         if to_id == 'all' and to_type == 'service':
-            # 发送给所有客服
+            # 发送给本商户的客服：访客输入只发给分配客服和管理员
+            sender = online_users.get(_sid_index.get(request.sid), {})
+            business_id = sender.get('business_id')
+            if not business_id:
+                return
+            if sender.get('type') == 'visitor':
+                session = active_sessions.get(business_id, sender.get('visitor_id'))
+                target_rooms = agent_and_admins_rooms(business_id, session.service_id if session else None)
+            else:
+                target_rooms = all_agents_rooms(business_id)
             emit('user_typing', {
                 'from_id': str(from_id),
                 'from_type': from_type,
                 'from_name': from_name,
                 'is_typing': is_typing
-            }, room='service_room')
+            }, room=target_rooms)
         else:
             # 发送给特定用户
             target_room = f'{to_type}_{to_id}'
@@ -1708,173 +1606,104 @@ def handle_read_message(data):
 
 @socketio.on('get_online_users')
 def handle_get_online_users():
-    """获取在线用户列表（已按账号去重，普通客服只看到分配给自己的访客）"""
+    """
+    获取在线用户列表（已按账号去重，普通客服只看到分配给自己的访客）
+    ✅ 从集群在线状态读取并限定在请求者所属商户：连接在其他 worker 上的用户同样可见
+    """
     try:
-        # 获取当前请求的客服ID
+        # 查找当前用户（可能是客服或访客）
         current_sid = request.sid
-        current_service_id = None
-        is_admin = False
-        is_visitor_request = False
+        current_user_key = presence_registry.lookup_sid(current_sid) or _sid_index.get(current_sid)
+        current_user_info = (presence_registry.get_user(current_user_key) if current_user_key else None) \
+            or online_users.get(current_user_key, {})
+        business_id = current_user_info.get('business_id')
+        if not business_id:
+            logger.warning(f"获取在线用户列表失败：未找到连接 {current_sid} 的用户信息")
+            return
         
-        # 查找当前用户（可能是客服或访客）
-        # ✅ 同时检查service和admin
-        for user_key, user_info in online_users.items():
-            if user_info['type'] in ['service', 'admin']:
-                sids = user_info.get('sids', [])
-                if current_sid in sids:
-                    current_service_id = user_info.get('service_id')
-                    break
-            elif user_info['type'] == 'visitor':
-                sids = user_info.get('sids', [])
-                if current_sid in sids:
-                    is_visitor_request = True
-                    break
+        # 商户下的在线客服（service 与 admin 连接按 service_id 去重）
+        online_services = []
+        seen_service_ids = set()
+        service_users = presence_registry.get_users(sorted(presence_registry.users_by_business(business_id)))
+        for info in service_users.values():
+            service_id_val = info.get('service_id')
+            if service_id_val and service_id_val not in seen_service_ids:
+                seen_service_ids.add(service_id_val)
+                online_services.append({
+                    'service_id': service_id_val,
+                    'name': info.get('name', '客服')  # ✅ 安全访问，提供默认值
+                })
         
         # 如果是访客请求，只返回在线客服信息（不返回其他访客）
-        if is_visitor_request:
-            # ✅ 修复多worker同步问题：从数据库查询而不是从online_users内存字典
-            visitor_online_services = []
-            try:
-                # 从数据库查询state='online'的客服（假设business_id=1，实际应从访客信息获取）
-                business_id = 1  # TODO: 应从访客信息中获取business_id
-                online_service_records = Service.query.filter_by(
-                    business_id=business_id,
-                    state='online'
-                ).all()
-                
-                for service in online_service_records:
-                    visitor_online_services.append({
-                        'service_id': service.service_id,
-                        'name': service.nick_name
-                    })
-                
-                logger.info(f"📊 访客请求在线用户列表：{len(visitor_online_services)}个在线客服 (从数据库查询)")
-            except Exception as e:
-                logger.error(f"查询在线客服失败: {e}")
-                # 如果数据库查询失败，降级使用online_users（保持兼容性）
-                seen_service_ids = set()
-                for user_key, user_info in list(online_users.items()):
-                    if user_info['type'] in ['service', 'admin']:
-                        has_connection = False
-                        if 'sids' in user_info and len(user_info['sids']) > 0:
-                            has_connection = True
-                        elif 'sid' in user_info and user_info['sid']:
-                            has_connection = True
-                        
-                        if has_connection and user_info.get('service_id'):
-                            service_id_val = user_info['service_id']
-                            if service_id_val not in seen_service_ids:
-                                seen_service_ids.add(service_id_val)
-                                visitor_online_services.append({
-                                    'service_id': service_id_val,
-                                    'name': user_info.get('name', '客服')
-                                })
-                logger.warning(f"⚠️ 数据库查询失败，降级使用online_users，客服数：{len(visitor_online_services)}个")
-            
+        if current_user_info.get('type') == 'visitor':
+            logger.info(f"📊 访客请求在线用户列表：商户{business_id} {len(online_services)}个在线客服")
             emit('online_users_list', {
-                'services': visitor_online_services,
+                'services': online_services,
                 'visitors': [],  # 访客不应该看到其他访客
-                'total_services': len(visitor_online_services),
+                'total_services': len(online_services),
                 'total_visitors': 0
             })
             return
         
         # 查询当前客服是否是管理员
+        current_service_id = current_user_info.get('service_id')
+        is_admin = False
         if current_service_id:
             current_service = Service.query.get(current_service_id)
             if current_service:
                 is_admin = current_service.level in ['super_manager', 'manager']
         
-        # 区分客服和访客
-        online_services = []
+        visitor_users = presence_registry.get_users(
+            sorted(presence_registry.users_by_business(business_id, 'visitor'))
+        )
+        visitors = [info for info in visitor_users.values() if info.get('visitor_id')]
+        
+        # 普通客服只看到分配给自己的访客：从活跃会话缓存批量读取（原来每个访客一次查询）
+        if not is_admin:
+            visitor_sessions = active_sessions.get_many(business_id, [info['visitor_id'] for info in visitors])
+            visitors = [
+                info for info in visitors
+                if visitor_sessions.get(info['visitor_id'])
+                and visitor_sessions[info['visitor_id']].service_id == current_service_id
+            ]
+        
         online_visitors = []
-        seen_service_ids = set()  # ✅ 去重：防止同一客服既有admin连接又有service连接
-        
-        # 创建字典副本，避免遍历时字典被修改
-        for user_id, info in list(online_users.items()):
-            # 检查是否有有效连接（支持新旧格式）
-            has_connection = False
-            if 'sids' in info and len(info['sids']) > 0:
-                has_connection = True
-            elif 'sid' in info and info['sid']:
-                has_connection = True
+        for info in visitors:
+            visitor_id = info['visitor_id']
             
-            if not has_connection:
-                continue
+            # 查询访客的最后一条消息
+            last_chat = Chat.query.filter_by(
+                visitor_id=visitor_id
+            ).order_by(Chat.timestamp.desc()).first()
             
-            # ✅ 合并 admin 和 service 类型
-            if info['type'] in ['service', 'admin']:
-                service_id_val = info.get('service_id')
-                if service_id_val and service_id_val not in seen_service_ids:
-                    seen_service_ids.add(service_id_val)
-                    # 📊 同一个service_id只会出现一次（按账号去重）
-                    service_data = {
-                        'service_id': service_id_val,
-                        'name': info.get('name', '客服')  # ✅ 安全访问，提供默认值
-                    }
-                    # 🆕 添加连接数信息（用于调试）
-                    if 'sids' in info:
-                        service_data['connection_count'] = len(info['sids'])
-                    
-                    online_services.append(service_data)
-                
-            elif info['type'] == 'visitor':
-                # ========== 访客过滤：普通客服只看到分配给自己的访客 ==========
-                visitor_id = info.get('visitor_id')
-                
-                # 查询访客的队列信息
-                queue = Queue.query.filter_by(
-                    visitor_id=visitor_id,
-                    state='normal'
-                ).order_by(Queue.created_at.desc()).first()
-                
-                # 判断是否应该显示此访客
-                should_show = False
-                if is_admin:
-                    # 管理员看到所有访客
-                    should_show = True
-                elif queue and queue.service_id == current_service_id:
-                    # 普通客服只看到分配给自己的访客
-                    should_show = True
-                
-                if should_show:
-                    # 查询访客的最后一条消息
-                    last_chat = Chat.query.filter_by(
-                        visitor_id=visitor_id
-                    ).order_by(Chat.timestamp.desc()).first()
-                    
-                    # 返回完整的访客信息
-                    visitor_data = {
-                        'visitor_id': info.get('visitor_id'),
-                        'visitor_name': info.get('visitor_name', info.get('name')),
-                        'name': info.get('name'),
-                        'avatar': info.get('avatar', '👤'),
-                        'ip': info.get('ip', '-'),
-                        'location': info.get('location', '未知'),
-                        'country': info.get('country', ''),
-                        'province': info.get('province', ''),
-                        'city': info.get('city', ''),
-                        'browser': info.get('browser', 'Unknown'),
-                        'os': info.get('os', 'Unknown'),
-                        'device': info.get('device', 'Desktop'),
-                        'screen_resolution': info.get('screen_resolution', ''),
-                        'visit_count': info.get('visit_count', 1),
-                        'first_visit': info.get('first_visit', '')
-                    }
-                    
-                    # 添加最后一条消息信息（用于列表显示）
-                    if last_chat:
-                        visitor_data['last_message'] = last_chat.content
-                        visitor_data['last_message_time'] = last_chat.created_at.isoformat() if last_chat.created_at else None
-                    else:
-                        visitor_data['last_message'] = None
-                        visitor_data['last_message_time'] = None
-                    
-                    # 🆕 添加连接数信息（用于调试）
-                    if 'sids' in info:
-                        visitor_data['connection_count'] = len(info['sids'])
-                    
-                    online_visitors.append(visitor_data)
+            # 返回完整的访客信息
+            visitor_data = {
+                'visitor_id': visitor_id,
+                'visitor_name': info.get('visitor_name', info.get('name')),
+                'name': info.get('name'),
+                'avatar': info.get('avatar', '👤'),
+                'ip': info.get('ip', '-'),
+                'location': info.get('location', '未知'),
+                'country': info.get('country', ''),
+                'province': info.get('province', ''),
+                'city': info.get('city', ''),
+                'browser': info.get('browser', 'Unknown'),
+                'os': info.get('os', 'Unknown'),
+                'device': info.get('device', 'Desktop'),
+                'screen_resolution': info.get('screen_resolution', ''),
+                'visit_count': info.get('visit_count', 1),
+                'first_visit': info.get('first_visit', '')
+            }
+            
+            # 添加最后一条消息信息（用于列表显示）
+            if last_chat:
+                visitor_data['last_message'] = last_chat.content
+                visitor_data['last_message_time'] = last_chat.created_at.isoformat() if last_chat.created_at else None
+            else:
+                visitor_data['last_message'] = None
+                visitor_data['last_message_time'] = None
+            
+            online_visitors.append(visitor_data)
         
         logger.info(f"📊 客服{current_service_id}{'[管理员]' if is_admin else '[普通]'}在线统计：{len(online_services)}个客服，{len(online_visitors)}个访客")
         
@@ -1889,6 +1718,23 @@ def handle_get_online_users():
         logger.error(f"Error in get_online_users: {e}")
 
 
+def _push_comment_request(queue_id, service_id, visitor_id):
+    """向访客推送评价请求（会话结束后由延迟调度器执行）"""
+    # 获取客服信息
+    service = Service.query.get(service_id)
+    service_name = service.nick_name if service else '客服'
+    
+    # 向访客推送评价请求
+    socketio.emit('request_comment', {
+        'queue_id': queue_id,
+        'service_id': service_id,
+        'service_name': service_name,
+        'message': f'请为 {service_name} 的服务进行评价'
+    }, room=f'visitor_{visitor_id}')
+    
+    logger.info(f"✅ 已向访客 {visitor_id} 推送评价请求")
+
+
 @socketio.on('end_chat')
 def handle_end_chat(data):
     """
@@ -1906,28 +1752,23 @@ def handle_end_chat(data):
         
         logger.info(f"会话结束: 访客 {visitor_id} 与客服 {service_id}")
         
-        # 查找队列记录
-        queue = Queue.query.filter_by(
-            visitor_id=visitor_id,
-            business_id=business_id,
-            state='normal'
-        ).order_by(Queue.created_at.desc()).first()
+        # 查找队列记录（活跃会话缓存命中时按主键加载）
+        session = active_sessions.get(business_id, visitor_id)
+        queue = Queue.query.get(session.qid) if session else None
         
-        if queue:
+        if queue and queue.state == 'normal':
             # 更新队列状态为已完成
             queue.state = 'complete'
             queue.updated_at = datetime.now()
             db.session.commit()
+            waiting_line.remove(queue.business_id, visitor_id)
+            wait_estimator.observe_queue(queue, queue.updated_at)
             
             # ========== 减少客服接待计数 ==========
             if queue.service_id and queue.service_id > 0:
                 try:
-                    service = Service.query.get(queue.service_id)
-                    if service and service.current_chat_count > 0:
-                        # 减少接待数
-                        service.current_chat_count = max(0, service.current_chat_count - 1)
-                        db.session.commit()
-                        logger.info(f"✅ 客服{queue.service_id}接待数减少: {service.current_chat_count}/{service.max_concurrent_chats}")
+                    from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
+                    workload_manager.decrement_workload(queue.service_id, f"会话结束: {visitor_id}")
                 except Exception as e:
                     logger.error(f"减少接待计数失败: {e}")
             
@@ -1938,53 +1779,25 @@ def handle_end_chat(data):
                 'message': '会话已结束'
             }, room=f'visitor_{visitor_id}')
             
-            # 延迟1秒后推送评价请求
-            def push_comment_request():
-                """异步推送评价请求"""
-                try:
-                    import time
-                    time.sleep(1)
-                    
-                    with app.app_context():
-                        # 获取客服信息
-                        service = Service.query.get(service_id)
-                        service_name = service.nick_name if service else '客服'
-                        
-                        # 向访客推送评价请求
-                        socketio.emit('request_comment', {
-                            'queue_id': queue.qid,
-                            'service_id': service_id,
-                            'service_name': service_name,
-                            'message': f'请为 {service_name} 的服务进行评价'
-                        }, room=f'visitor_{visitor_id}')
-                        
-                        logger.info(f"✅ 已向访客 {visitor_id} 推送评价请求")
-                    
-                except Exception as e:
-                    logger.error(f"推送评价请求失败: {e}")
-                finally:
-                    # ✅ 关键修复：清理数据库会话，释放连接
-                    db.session.remove()
+            # 延迟1秒后推送评价请求（延迟调度器，不占用线程和数据库连接）
+            delayed_scheduler.call_later(1, _push_comment_request, queue.qid, service_id, visitor_id,
+                                         task_type='comment_request', key=visitor_id)
             
-            # 启动后台线程推送评价
-            from threading import Thread
-            Thread(target=push_comment_request, daemon=True).start()
-            
-            # 通知客服会话已结束
+            # 通知分配客服和管理员会话已结束
             emit('chat_ended', {
                 'visitor_id': visitor_id,
                 'message': '会话已结束'
-            }, room='service_room')
+            }, room=agent_and_admins_rooms(queue.business_id, queue.service_id))
             
             # 广播统计更新（会话结束）
-            broadcast_statistics_update(business_id)
+            stats_publisher.mark_dirty(queue.business_id)
             
             # 通知管理员会话结束
             socketio.emit('session_ended', {
                 'visitor_id': visitor_id,
                 'service_id': service_id,
                 'timestamp': datetime.now().isoformat()
-            }, broadcast=True)
+            }, room=admins_room(queue.business_id))
         else:
             emit('error', {'message': '未找到会话记录'})
         
@@ -2001,15 +1814,16 @@ def handle_error(error):
 
 # 辅助函数
 def get_user_sid(user_type, user_id):
-    """获取用户的socket ID"""
+    """获取用户的socket ID（集群级，多连接时返回任意一个）"""
     key = f'{user_type}_{user_id}'
-    return online_users.get(key, {}).get('sid')
+    sids = presence_registry.get_sids(key)
+    return next(iter(sids)) if sids else None
 
 
 def is_user_online(user_type, user_id):
-    """检查用户是否在线"""
+    """检查用户是否在线（集群级）"""
     key = f'{user_type}_{user_id}'
-    return key in online_users
+    return presence_registry.is_online(key)
 
 
 # ========== 队列管理相关事件 ==========
@@ -2035,12 +1849,15 @@ def handle_visitor_join_queue(data):
         # 获取排队位置和预计等待时间
         qs = get_queue_service()
         position = qs.get_queue_position(visitor_id, business_id)
+        eta = wait_estimator.estimate(business_id, position, queue.priority, queue.group_id) \
+            if position > 0 else {'p50': 0, 'p90': 0}
         
         # 通知访客加入成功
         emit('queue_joined', {
             'queue_id': queue.qid,
             'position': position,
-            'estimated_wait_time': queue.estimated_wait_time,
+            'estimated_wait_time': eta['p50'],
+            'estimated_wait_time_p90': eta['p90'],
             'priority': queue.priority
         })
         
@@ -2074,6 +1891,7 @@ def handle_service_accept_queue(data):
         queue.service_id = service_id
         queue.estimated_wait_time = 0
         db.session.commit()
+        waiting_line.remove(queue.business_id, queue.visitor_id)
         
         # 通知客服接入成功
         emit('queue_accepted', {
@@ -2093,14 +1911,14 @@ def handle_service_accept_queue(data):
         broadcast_queue_update(queue.business_id)
         
         # 广播统计更新（新会话开始）
-        broadcast_statistics_update(queue.business_id)
+        stats_publisher.mark_dirty(queue.business_id)
         
         # 通知管理员新会话创建
         socketio.emit('session_created', {
             'visitor_id': queue.visitor_id,
             'service_id': service_id,
             'timestamp': datetime.now().isoformat()
-        }, broadcast=True)
+        }, room=admins_room(queue.business_id))
         
     except Exception as e:
         logger.error(f"客服接入队列失败: {e}")
@@ -2129,9 +1947,9 @@ def handle_update_visitor_priority(data):
             queue.priority = priority
             db.session.commit()
             
-            # 重新计算预计等待时间
+            # 在等待线中重新排位（保留到达时间），重新计算预计等待时间
             qs = get_queue_service()
-            position = qs.get_queue_position(visitor_id, business_id)
+            position = waiting_line.update_priority(business_id, visitor_id, priority)
             estimated_time = qs.estimate_wait_time(business_id, position, priority)
             if estimated_time >= 0:
                 queue.estimated_wait_time = estimated_time
@@ -2191,19 +2009,16 @@ def notify_new_visitor_queued(business_id, visitor_id, priority, position):
         elif priority == 1:
             priority_text = 'VIP'
         
-        # 通知所有在线客服
-        # ✅ 同时通知service和admin
-        for user_key, user_info in online_users.items():
-            if user_info['type'] in ['service', 'admin']:
-                socketio.emit('new_visitor_queued', {
-                    'visitor_id': visitor_id,
-                    'visitor_name': visitor.visitor_name,
-                    'priority': priority,
-                    'priority_text': priority_text,
-                    'position': position,
-                    'timestamp': datetime.utcnow().isoformat()
-                }, room=user_info['sid'])
-                
+        # 通知所有在线客服（商户客服房间，同时覆盖service和admin）
+        socketio.emit('new_visitor_queued', {
+            'visitor_id': visitor_id,
+            'visitor_name': visitor.visitor_name,
+            'priority': priority,
+            'priority_text': priority_text,
+            'position': position,
+            'timestamp': datetime.utcnow().isoformat()
+        }, room=all_agents_rooms(business_id))
+        
     except Exception as e:
         logger.error(f"通知新访客排队失败: {e}")
 
@@ -2218,79 +2033,15 @@ def broadcast_queue_update(business_id):
         # 获取等待列表
         waiting_list = qs.get_waiting_list(business_id, limit=100)
         
-        # 广播给所有在线客服
-        # ✅ 同时广播给service和admin
-        for user_key, user_info in online_users.items():
-            if user_info['type'] in ['service', 'admin']:
-                socketio.emit('queue_update', {
-                    'stats': stats,
-                    'waiting_count': len(waiting_list),
-                    'timestamp': datetime.utcnow().isoformat()
-                }, room=user_info['sid'])
-                
-    except Exception as e:
-        logger.error(f"广播队列更新失败: {e}")
-
-
-# 广播防抖：缓存最后一次广播的时间和数据（避免短时间内重复广播相同数据）
-_last_broadcast_time = {}
-_last_broadcast_data = {}
-
-def broadcast_statistics_update(business_id):
-    """
-    广播统计数据更新（给管理员）
-    带防抖机制：3秒内相同数据不重复广播
-    
-    ⚡ 性能优化：
-    1. 移除主动清除缓存逻辑，利用10秒Redis缓存机制
-    2. 延长防抖时间到3秒，减少高频消息场景下的查询次数
-    """
-    try:
-        from mod.mysql.ModuleClass import StatisticsService
-        
-        # ⚡ 优化：不再主动清除缓存，利用get_realtime_stats的10秒缓存机制
-        # 这样可以显著减少数据库查询次数，提升消息推送性能
-        
-        # 获取实时统计数据（带10秒Redis缓存）
-        stats_service = StatisticsService(business_id, None, 'super_manager')
-        realtime = stats_service.get_realtime_stats()
-        
-        # 构建广播数据
-        broadcast_data = {
-            'total_visitors': realtime.get('total_visitors', 0),
-            'chatting_count': realtime.get('chatting_count', 0),
-            'online_services': realtime.get('online_services', 0),
-            'waiting_count': realtime.get('waiting_count', 0),
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        # ⚡ 防抖检查：如果3秒内已经广播过相同的数据，跳过（从1秒延长到3秒）
-        import time
-        current_time = time.time()
-        last_time = _last_broadcast_time.get(business_id, 0)
-        last_data = _last_broadcast_data.get(business_id, {})
-        
-        # 比较关键数据（排除timestamp）
-        key_data = {k: v for k, v in broadcast_data.items() if k != 'timestamp'}
-        last_key_data = {k: v for k, v in last_data.items() if k != 'timestamp'}
-        
-        if (current_time - last_time < 3.0) and (key_data == last_key_data):
-            logger.debug(f"⏸️ 防抖：3秒内已广播相同数据，跳过")
-            return
+        # 广播给所有在线客服（商户客服房间，同时覆盖service和admin）
+        socketio.emit('queue_update', {
+            'stats': stats,
+            'waiting_count': len(waiting_list),
+            'timestamp': datetime.utcnow().isoformat()
+        }, room=all_agents_rooms(business_id))
         
-        # 更新防抖缓存
-        _last_broadcast_time[business_id] = current_time
-        _last_broadcast_data[business_id] = broadcast_data
-        
-        # ⚡ Flask-SocketIO默认广播给所有连接的客户端（无需broadcast参数）
-        socketio.emit('statistics_update', broadcast_data)
-                
-        logger.info(f"📊 已广播统计更新: 正在咨询 {realtime.get('chatting_count', 0)} 人, 在线客服 {realtime.get('online_services', 0)} 人")
-                
     except Exception as e:
-        logger.error(f"广播统计更新失败: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.error(f"广播队列更新失败: {e}")
 
 
 @socketio.on('admin_join')
@@ -2327,25 +2078,29 @@ def handle_admin_join(data):
         user_key = f'admin_{service_id}'
         
         # 支持多连接
-        if user_key in online_users:
-            if 'sids' not in online_users[user_key]:
-                old_sid = online_users[user_key].get('sid')
-                online_users[user_key]['sids'] = [old_sid] if old_sid else []
-            if sid not in online_users[user_key]['sids']:
-                online_users[user_key]['sids'].append(sid)
-            # 更新权限缓存
-            online_users[user_key]['is_admin'] = True
-        else:
-            online_users[user_key] = {
-                'type': 'admin',
-                'service_id': service_id,
-                'service_name': service_name,
-                'level': service.level,
-                'is_admin': True,  # ⚡ 缓存权限级别，避免消息推送时查询
-                'sids': [sid],
-                'business_id': service.business_id,
-                'connected_at': datetime.now().isoformat()
-            }
+        _attach_sid(user_key, sid, {
+            'type': 'admin',
+            'service_id': service_id,
+            'service_name': service_name,
+            'level': service.level,
+            'is_admin': True,  # ⚡ 缓存权限级别，避免消息推送时查询
+            'business_id': service.business_id,
+            'connected_at': datetime.now().isoformat()
+        })
+        # 更新权限缓存
+        online_users[user_key]['is_admin'] = True
+        
+        # 🆕 加入商户管理员房间 + 个人房间
+        join_agent_rooms(service.business_id, service_id, True)
+        
+        # 🆕 登记到集群在线状态
+        presence_registry.join(sid, user_key, 'admin', service.business_id, {
+            'service_id': service_id,
+            'name': service_name,
+            'service_name': service_name,
+            'level': service.level,
+            'is_admin': True
+        })
         
         logger.info(f"✅ 管理员加入: {service_name} ({service_id}), SID: {sid}")
         
@@ -2355,11 +2110,9 @@ def handle_admin_join(data):
             db.session.commit()
             logger.info(f"✅ 管理员{service_id}状态更新为 online")
             
-            # ✅ 管理员上线时，自动同步接待数（确保数据准确）
+            # ✅ 管理员上线时，同步负载表（管理员不计入接待数）
             from mod.mysql.ModuleClass.ServiceWorkloadManager import workload_manager
-            sync_result = workload_manager.sync_workload(service_id, "管理员上线自动同步")
-            if sync_result['success']:
-                logger.info(f"📊 管理员{service_id}上线，接待数已同步: {sync_result['current_count']}")
+            workload_manager.announce_workload(service)
         except Exception as e:
             logger.error(f"更新管理员在线状态失败: {e}")
         
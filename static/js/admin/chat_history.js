@@ -5,6 +5,8 @@
 // 全局变量
 let currentPage = 1;
 let totalPages = 1;
+let messageCursors = [null];  // 消息列表每一页的游标（第1页为null）
+let messageHasMore = false;
 let currentMode = 'session'; // session 或 message
 
 // 页面加载
@@ -28,6 +30,16 @@ async function loadStatistics() {
             document.getElementById('totalSessions').textContent = data.total_sessions || 0;
             document.getElementById('avgDuration').textContent = (data.avg_duration || 0) + '分钟';
             document.getElementById('avgResponse').textContent = (data.avg_response_time || 0) + '秒';
+            
+            // 悬停显示中位数和P90
+            if (data.handle_time) {
+                document.getElementById('avgDuration').title =
+                    `中位数 ${Math.round(data.handle_time.median / 60)}分钟，P90 ${Math.round(data.handle_time.p90 / 60)}分钟（${data.handle_time.count}个已完成会话）`;
+            }
+            if (data.response_time) {
+                document.getElementById('avgResponse').title =
+                    `中位数 ${Math.round(data.response_time.median)}秒，P90 ${Math.round(data.response_time.p90)}秒（${data.response_time.count}个已响应会话）`;
+            }
         } else {
             console.error('加载统计数据失败:', result.msg);
         }
@@ -119,12 +131,19 @@ async function loadSessions(page = 1) {
     }
 }
 
-// 加载消息列表
+// 加载消息列表（游标分页，只支持逐页前后翻）
 async function loadMessages(page = 1) {
     try {
+        if (page === 1) {
+            messageCursors = [null];
+        }
         const params = getFilterParams();
-        params.append('page', page);
-        params.append('per_page', 50);
+        params.append('limit', 50);
+        if (messageCursors[page - 1]) {
+            params.append('cursor', messageCursors[page - 1]);
+        } else {
+            params.append('with_total', 1);
+        }
         
         console.log('加载消息列表，参数:', params.toString());
         const response = await fetch(`/api/admin/chat-history?${params}`);
@@ -134,7 +153,11 @@ async function loadMessages(page = 1) {
         
         if (result.code === 0) {
             currentPage = page;
-            totalPages = result.data.pages;
+            messageHasMore = result.data.has_more;
+            messageCursors[page] = result.data.next_cursor;
+            if (result.data.total !== null && result.data.total !== undefined) {
+                totalPages = Math.max(1, Math.ceil(result.data.total / 50));
+            }
             
             if (result.data.list && result.data.list.length > 0) {
                 renderMessagesList(result.data.list);
@@ -345,8 +368,7 @@ function switchMode(mode) {
 
 // 全局变量存储当前会话信息
 let currentSessionData = null;
-let currentSessionPage = 1;
-let totalSessionPages = 1;
+let sessionCursor = null;  // 会话详情中更早一页消息的游标
 let isLoadingMoreMessages = false;
 let hasMoreHistoryMessages = false;
 
@@ -355,7 +377,7 @@ async function viewSessionDetail(visitorId) {
     try {
         // 重置状态
         currentSessionData = null;
-        currentSessionPage = 1;
+        sessionCursor = null;
         isLoadingMoreMessages = false;
         
         // 显示加载中
@@ -398,60 +420,64 @@ async function viewSessionDetail(visitorId) {
     }
 }
 
+// 获取会话消息（cursor为null时获取最新一页并附带总数）
+async function fetchSessionMessages(visitorId, cursor) {
+    const params = new URLSearchParams({ limit: 50 });
+    if (cursor) {
+        params.append('cursor', cursor);
+    } else {
+        params.append('with_total', 1);
+    }
+    const response = await fetch(`/api/admin/chat-history/session/${visitorId}/messages?${params}`);
+    return await response.json();
+}
+
 // 使用分页API加载会话详情（倒序加载，最新消息先）
 async function loadSessionDetailWithPagination(visitorId, sessionInfo) {
     try {
         const container = document.getElementById('sessionDetail');
         
-        // 首先获取总消息数，计算最后一页
-        const response = await fetch(`/api/admin/chat-history/session/${visitorId}/messages?page=1&per_page=50`);
-        const result = await response.json();
+        // 获取最新的一页消息（附带总数）
+        const result = await fetchSessionMessages(visitorId, null);
         
         if (result.code === 0) {
-            totalSessionPages = result.data.total_pages;
-            currentSessionPage = totalSessionPages; // 从最后一页开始
-            hasMoreHistoryMessages = totalSessionPages > 1;
+            sessionCursor = result.data.next_cursor;
+            hasMoreHistoryMessages = result.data.has_more;
+            
+            // 创建头部
+            const header = document.createElement('div');
+            header.className = 'detail-header';
+            header.innerHTML = `
+                <h4>会话信息</h4>
+                <div class="detail-info">
+                    <span><strong>访客:</strong> ${sessionInfo.visitor_name}</span>
+                    <span><strong>客服:</strong> ${sessionInfo.service_name}</span>
+                    <span><strong>开始时间:</strong> ${formatDateTime(sessionInfo.start_time)}</span>
+                    <span><strong>消息数:</strong> ${result.data.total}</span>
+                </div>
+            `;
             
-            // 获取最后一页（最新的消息）
-            const lastPageResponse = await fetch(`/api/admin/chat-history/session/${visitorId}/messages?page=${totalSessionPages}&per_page=50`);
-            const lastPageResult = await lastPageResponse.json();
+            // 创建消息容器
+            const messagesContainer = document.createElement('div');
+            messagesContainer.className = 'detail-messages';
+            messagesContainer.id = 'detailMessages';
             
-            if (lastPageResult.code === 0) {
-                // 创建头部
-                const header = document.createElement('div');
-                header.className = 'detail-header';
-                header.innerHTML = `
-                    <h4>会话信息</h4>
-                    <div class="detail-info">
-                        <span><strong>访客:</strong> ${sessionInfo.visitor_name}</span>
-                        <span><strong>客服:</strong> ${sessionInfo.service_name}</span>
-                        <span><strong>开始时间:</strong> ${formatDateTime(sessionInfo.start_time)}</span>
-                        <span><strong>消息数:</strong> ${result.data.total}</span>
-                    </div>
-                `;
-                
-                // 创建消息容器
-                const messagesContainer = document.createElement('div');
-                messagesContainer.className = 'detail-messages';
-                messagesContainer.id = 'detailMessages';
-                
-                // 渲染最新的消息
-                renderMessagesBatch(messagesContainer, lastPageResult.data.messages, sessionInfo.visitor_name);
-                
-                // 清空并添加内容
-                container.innerHTML = '';
-                container.appendChild(header);
-                container.appendChild(messagesContainer);
-                
-                // 滚动到底部（显示最新消息）
-                setTimeout(() => {
-                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
-                }, 100);
-                
-                // 如果还有历史消息，设置向上滚动加载
-                if (hasMoreHistoryMessages) {
-                    setupScrollLoadingForHistory(messagesContainer, visitorId, sessionInfo.visitor_name);
-                }
+            // 渲染最新的消息
+            renderMessagesBatch(messagesContainer, result.data.messages, sessionInfo.visitor_name);
+            
+            // 清空并添加内容
+            container.innerHTML = '';
+            container.appendChild(header);
+            container.appendChild(messagesContainer);
+            
+            // 滚动到底部（显示最新消息）
+            setTimeout(() => {
+                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            }, 100);
+            
+            // 如果还有历史消息，设置向上滚动加载
+            if (hasMoreHistoryMessages) {
+                setupScrollLoadingForHistory(messagesContainer, visitorId, sessionInfo.visitor_name);
             }
         } else {
             container.innerHTML = `
@@ -478,7 +504,7 @@ function setupScrollLoadingForHistory(messagesContainer, visitorId, visitorName)
     messagesContainer.addEventListener('scroll', async function() {
         // 滚动到顶部时加载历史消息
         if (messagesContainer.scrollTop < 100) {
-            if (!isLoadingMoreMessages && hasMoreHistoryMessages && currentSessionPage > 1) {
+            if (!isLoadingMoreMessages && hasMoreHistoryMessages && sessionCursor) {
                 isLoadingMoreMessages = true;
                 
                 // 保存当前滚动高度
@@ -495,10 +521,8 @@ function setupScrollLoadingForHistory(messagesContainer, visitorId, visitorName)
                 messagesContainer.insertBefore(loadingIndicator, messagesContainer.firstChild);
                 
                 try {
-                    // 加载上一页（更早的消息）
-                    currentSessionPage--;
-                    const response = await fetch(`/api/admin/chat-history/session/${visitorId}/messages?page=${currentSessionPage}&per_page=50`);
-                    const result = await response.json();
+                    // 加载更早的消息
+                    const result = await fetchSessionMessages(visitorId, sessionCursor);
                     
                     // 移除加载指示器
                     loadingIndicator.remove();
@@ -511,8 +535,11 @@ function setupScrollLoadingForHistory(messagesContainer, visitorId, visitorName)
                         const newScrollHeight = messagesContainer.scrollHeight;
                         messagesContainer.scrollTop = newScrollHeight - oldScrollHeight;
                         
+                    }
+                    if (result.code === 0) {
                         // 检查是否还有更多历史消息
-                        hasMoreHistoryMessages = currentSessionPage > 1;
+                        sessionCursor = result.data.next_cursor;
+                        hasMoreHistoryMessages = result.data.has_more;
                     }
                 } catch (error) {
                     console.error('加载历史消息失败:', error);
@@ -522,7 +549,6 @@ function setupScrollLoadingForHistory(messagesContainer, visitorId, visitorName)
                         </div>
                     `;
                     setTimeout(() => loadingIndicator.remove(), 2000);
-                    currentSessionPage++; // 恢复页码
                 } finally {
                     isLoadingMoreMessages = false;
                 }
@@ -710,13 +736,22 @@ function resetFilters() {
 // 导出记录
 function exportHistory() {
     const params = getFilterParams();
+    // 格式形如 csv 或 csv.gz（gzip压缩）
+    const [format, compress] = document.getElementById('exportFormat').value.split('.');
+    params.append('format', format);
+    if (compress === 'gz') {
+        params.append('gzip', 1);
+    }
     window.location.href = `/api/admin/chat-history/export?${params}`;
 }
 
 // 分页
 function changePage(delta) {
     const newPage = currentPage + delta;
-    if (newPage >= 1 && newPage <= totalPages) {
+    if (currentMode !== 'session' && delta > 0 && !messageHasMore) {
+        return;
+    }
+    if (newPage >= 1 && (newPage <= totalPages || currentMode !== 'session')) {
         loadHistory(newPage);
     }
 }
@@ -724,7 +759,7 @@ function changePage(delta) {
 // 更新分页
 function updatePagination() {
     document.getElementById('prevBtn').disabled = currentPage <= 1;
-    document.getElementById('nextBtn').disabled = currentPage >= totalPages;
+    document.getElementById('nextBtn').disabled = currentMode === 'session' ? currentPage >= totalPages : !messageHasMore;
     document.getElementById('pageInfo').textContent = `第 ${currentPage} / ${totalPages} 页`;
 }
 
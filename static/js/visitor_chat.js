@@ -620,6 +620,18 @@
                 addSystemMessage(data.service_name + ' 已上线为您服务');
             });
 
+            // 排队结束，已分配客服接入
+            socket.on('service_connected', function(data) {
+                console.log('✅ 客服已接入:', data);
+                currentServiceId = data.service_id;
+                window.currentServiceId = data.service_id;
+                if (data.service_name) {
+                    window.currentServiceName = data.service_name;
+                    document.getElementById('serviceName').textContent = data.service_name;
+                }
+                addSystemMessage((data.service_name || '客服') + ' 已接入，为您服务');
+            });
+
             // ✅ 监听客服变更事件
             socket.on('service_changed', function(data) {
                 console.log('🔄 客服已变更:', data);
@@ -1074,7 +1086,7 @@
 
         // 加载聊天历史
         // 聊天记录分页变量
-        let chatOffset = 0;
+        let chatCursor = null;  // 更早一页消息的游标
         let chatHasMore = false;
         let isLoadingHistory = false;
         
@@ -1089,7 +1101,8 @@
             const controller = new AbortController();
             const timeoutId = setTimeout(() => controller.abort(), 3000); // 3秒超时
             
-            fetch(`/api/visitor/history?visitor_id=${visitorId}&business_id=1&limit=50&offset=${chatOffset}`, {
+            const cursorParam = isLoadMore && chatCursor ? `&cursor=${encodeURIComponent(chatCursor)}` : '';
+            fetch(`/api/visitor/history?visitor_id=${visitorId}&business_id=1&limit=50${cursorParam}`, {
                 signal: controller.signal
             })
                 .then(response => response.json())
@@ -1098,6 +1111,7 @@
                     if (result.code === 0 && result.data && result.data.messages) {
                         const messages = result.data.messages;
                         chatHasMore = result.data.has_more || false;
+                        chatCursor = result.data.next_cursor || null;
                         
                         if (messages.length > 0) {
                             if (isLoadMore) {
@@ -1123,8 +1137,6 @@
                                 // 滚动到底部
                                 chatMessages.scrollTop = chatMessages.scrollHeight;
                             }
-                            
-                            chatOffset += messages.length;
                         }
                     }
                     isLoadingHistory = false;